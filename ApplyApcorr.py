@@ -0,0 +1,130 @@
+# Applies the aperture correction to the final allstar magnitudes. This does
+# the job of apply_apcorrHDI.e/poly.e for every star in one go.
+#
+# The correction lives in apcorr.coef in the frame folder, written like the
+# option files:
+#   C0 = -0.231     constant term
+#   CX = 1.2e-06    x
+#   CY = -3.0e-06   y
+#   CXX, CXY, CYY   second order terms (optional)
+#   EC0, ECX, ...   the uncertainty of each coefficient (optional)
+# so the correction at (x, y) is C0 + CX*x + CY*y + CXX*x*x + CXY*x*y + CYY*y*y.
+# The coefficient errors are treated as independent and added in quadrature
+# to each star's own error.
+
+import multiprocessing
+import os
+import sys
+
+import numpy as np
+
+import Archive
+import Artifacts
+import DaoCatalog
+import OptionFiles
+
+# {coefficient name : (power of x, power of y)}
+polynomialTerms = {'C0': (0, 0),
+                   'CX': (1, 0),
+                   'CY': (0, 1),
+                   'CXX': (2, 0),
+                   'CXY': (1, 1),
+                   'CYY': (0, 2)}
+
+coefficientFile = 'apcorr.coef'
+
+
+def readCoefficients(path):
+    '''{name : value} from the coefficient file'''
+    return OptionFiles.readOptionFile(path)
+
+
+def writeCoefficients(path, coefficients):
+    coefficientHandle = open(path + '.tmp', 'w')
+    for name in ['C0', 'CX', 'CY', 'CXX', 'CXY', 'CYY']:
+        if name in coefficients:
+            coefficientHandle.write('%s = %.6g\n' % (name, coefficients[name]))
+        if 'E' + name in coefficients:
+            coefficientHandle.write('%s = %.6g\n' % ('E' + name, coefficients['E' + name]))
+    coefficientHandle.close()
+    os.rename(path + '.tmp', path)
+    return
+
+
+def evaluateCorrection(coefficients, x, y):
+    '''Correction and its uncertainty at every (x, y), all stars at once'''
+    correction = np.zeros(len(x))
+    variance = np.zeros(len(x))
+    for (name, (powerX, powerY)) in polynomialTerms.items():
+        if name not in coefficients and 'E' + name not in coefficients:
+            continue
+        term = x ** powerX * y ** powerY
+        correction += coefficients.get(name, 0.0) * term
+        variance += (coefficients.get('E' + name, 0.0) * term) ** 2
+    return correction, np.sqrt(variance)
+
+
+def correctCatalog(columns, coefficients):
+    '''Corrected copy of an allstar catalog. Stars without a magnitude are left alone.'''
+    corrected = dict((name, values.copy()) for (name, values) in columns.items())
+    correction, correctionError = evaluateCorrection(coefficients, columns['x'], columns['y'])
+    good = columns['mag'] < DaoCatalog.badMagnitude - 1
+    corrected['mag'][good] = columns['mag'][good] + correction[good]
+    corrected['err'][good] = np.sqrt(columns['err'][good] ** 2 + correctionError[good] ** 2)
+    summary = {'stars': int(good.sum()),
+               'meanCorrection': float(correction[good].mean()) if good.any() else 0.0,
+               'minCorrection': float(correction[good].min()) if good.any() else 0.0,
+               'maxCorrection': float(correction[good].max()) if good.any() else 0.0,
+               'correctionError': float(correctionError[good].mean()) if good.any() else 0.0}
+    return corrected, summary
+
+
+def applyFrame(dataSetDirectory, frame):
+    '''Writes edt${frame}.apc (the corrected catalog) and apcorr.summary for one frame.
+    Returns the summary, or None if the frame isn't ready.'''
+    frameDirectory = os.path.join(dataSetDirectory, frame)
+    catalogPath = os.path.join(frameDirectory, 'edt' + frame + '.als2')
+    coefficientPath = os.path.join(frameDirectory, coefficientFile)
+    if not Archive.exists(catalogPath) or not os.path.exists(coefficientPath):
+        return None
+
+    header, columns = DaoCatalog.readCatalog(catalogPath)
+    corrected, summary = correctCatalog(columns, readCoefficients(coefficientPath))
+    DaoCatalog.writeCatalog(os.path.join(frameDirectory, 'edt' + frame + '.apc'), header, corrected, 'als')
+
+    summaryFile = open(os.path.join(frameDirectory, 'apcorr.summary'), 'w')
+    for name in ['stars', 'meanCorrection', 'minCorrection', 'maxCorrection', 'correctionError']:
+        summaryFile.write('%-16s %s\n' % (name, summary[name]))
+    summaryFile.close()
+    summary['frame'] = frame
+    return summary
+
+
+def applyFrameJob(arguments):
+    return applyFrame(*arguments)
+
+
+def applyDataSet(dataSetDirectory, frames=None, processes=None):
+    '''Applies the correction to every frame that has apcorr.coef, in a worker pool.
+    Returns {frame : summary} for the frames that were done.'''
+    if frames is None:
+        frames = Artifacts.frameNames(dataSetDirectory)
+    pool = multiprocessing.Pool(processes)
+    try:
+        summaries = pool.map(applyFrameJob, [(dataSetDirectory, frame) for frame in frames])
+    finally:
+        pool.close()
+        pool.join()
+    return dict((summary['frame'], summary) for summary in summaries if summary is not None)
+
+
+if __name__ == '__main__':
+    # python ApplyApcorr.py /data/n2158_phot/n2158/ [frame ...]
+    if len(sys.argv) < 2:
+        print 'usage: python ApplyApcorr.py dataSetDirectory [frame ...]'
+        sys.exit(1)
+    results = applyDataSet(sys.argv[1], sys.argv[2:] or None)
+    for frameName in sorted(results):
+        print '%-10s %6d stars, mean correction %7.3f +/- %.3f' % (frameName, results[frameName]['stars'],
+                                                                  results[frameName]['meanCorrection'],
+                                                                  results[frameName]['correctionError'])
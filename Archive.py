@@ -0,0 +1,370 @@
+# Compressed copies of the bulky files of finished frames. A 4k x 4k frame
+# leaves a handful of float images (.pix) and psfs behind, plus catalogs that
+# run to megabytes in crowded fields; once the frame is done they are only ever
+# read again, so they are kept as <file>.arz and the original is deleted.
+#
+# Nothing has to unpack them first: openFile() gives a file object for a path
+# whether it's there as it is or archived (DaoCatalog reads catalogs through
+# it), readBytes() gives the whole thing (IrafImage.readPixels), and restore()
+# puts the plain file back for the fortran programs, which ExternalTools does
+# by itself for the files a run names (and dropRestored() takes away again
+# once the run is over).
+#
+# An .arz file is a header and then the file in chunks, each compressed on its
+# own, so a reader only ever holds one chunk and can seek:
+#   'ARZ1', codec (8 chars), chunk size, element size, mtime, size   header
+#   raw length, stored length, stored bytes                          every chunk
+# Chunks of pixel files are byte shuffled first (all the first bytes of the
+# floats, then all the second bytes, ...), which packs noisy floats about a
+# sixth smaller. The codec is zstd when the zstandard module is there, zlib
+# otherwise; it is written in the header, so either kind reads back anywhere
+# the codec is installed.
+
+import errno
+import fnmatch
+import os
+import struct
+import sys
+import zlib
+
+import numpy as np
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+suffix = '.arz'
+magic = 'ARZ1'
+headerFormat = '>4s8sIIdQ'
+chunkFormat = '>II'
+chunkBytes = 1 << 20
+zlibLevel = 1           # the fast end; the higher levels barely help on noisy pixels
+zstdLevel = 3
+
+# files of a finished frame worth archiving (never the .imh headers: they are tiny and
+# every image reader looks at them), and how big they have to be to bother
+archivePatterns = ['*.pix', '*.psf', '*.als', '*.als2', '*.ap', '*.ap2', '*.apc', '*.coo', '*.nei']
+minimumBytes = 64 * 1024
+# {pattern : element size} for the byte shuffle
+shufflePatterns = {'*.pix': 4}
+
+
+def defaultCodec():
+    return 'zstd' if zstandard is not None else 'zlib'
+
+
+def compressChunk(codec, data):
+    if codec == 'zstd':
+        return zstandard.ZstdCompressor(level=zstdLevel).compress(data)
+    return zlib.compress(data, zlibLevel)
+
+
+def decompressChunk(codec, data, rawLength):
+    if codec == 'zstd':
+        if zstandard is None:
+            raise IOError('this archive was written with zstd, and the zstandard module is not installed')
+        return zstandard.ZstdDecompressor().decompress(data, max_output_size=rawLength)
+    return zlib.decompress(data)
+
+
+def shuffle(data, elementSize):
+    '''Byte shuffle of the whole elements at the start of data (the odd bytes at the end stay put)'''
+    n = len(data) // elementSize * elementSize
+    if elementSize < 2 or n == 0:
+        return data
+    return np.frombuffer(data[:n], np.uint8).reshape(-1, elementSize).T.tostring() + data[n:]
+
+
+def unshuffle(data, elementSize):
+    n = len(data) // elementSize * elementSize
+    if elementSize < 2 or n == 0:
+        return data
+    return np.frombuffer(data[:n], np.uint8).reshape(elementSize, -1).T.tostring() + data[n:]
+
+
+def archivePath(path):
+    return path + suffix
+
+
+def isArchived(path):
+    '''True if only the archived copy of path is there'''
+    return not os.path.exists(path) and os.path.exists(archivePath(path))
+
+
+def exists(path):
+    return os.path.exists(path) or os.path.exists(archivePath(path))
+
+
+def storedPath(path):
+    '''The file actually on disk for path: path itself, or its archive'''
+    if isArchived(path):
+        return archivePath(path)
+    return path
+
+
+def originalStat(path):
+    '''(size, mtime) of path, from its archive if it's archived'''
+    if isArchived(path):
+        reader = ArchiveReader(archivePath(path))
+        reader.close()
+        return reader.size, reader.mtime
+    stats = os.stat(path)
+    return stats.st_size, stats.st_mtime
+
+
+def compressFile(path, codec=None, elementSize=None):
+    '''Writes path + suffix and deletes path. Returns (bytes before, bytes after).'''
+    codec = codec or defaultCodec()
+    if elementSize is None:
+        elementSize = 1
+        for (pattern, size) in shufflePatterns.items():
+            if fnmatch.fnmatchcase(os.path.basename(path), pattern):
+                elementSize = size
+    stats = os.stat(path)
+    tmpPath = archivePath(path) + '.' + str(os.getpid())
+    source = open(path, 'rb')
+    archive = open(tmpPath, 'wb')
+    try:
+        archive.write(struct.pack(headerFormat, magic, codec, chunkBytes, elementSize, stats.st_mtime, stats.st_size))
+        while True:
+            data = source.read(chunkBytes)
+            if not data:
+                break
+            stored = compressChunk(codec, shuffle(data, elementSize))
+            archive.write(struct.pack(chunkFormat, len(data), len(stored)))
+            archive.write(stored)
+    except:
+        archive.close()
+        source.close()
+        os.remove(tmpPath)
+        raise
+    archive.close()
+    source.close()
+    os.rename(tmpPath, archivePath(path))
+    os.remove(path)
+    return stats.st_size, os.path.getsize(archivePath(path))
+
+
+class ArchiveReader:
+    '''Read only file object over an .arz file (read, readline, iteration, seek, tell).
+    One chunk is unpacked at a time.'''
+
+    def __init__(self, path):
+        self.name = path
+        self.file = open(path, 'rb')
+        header = self.file.read(struct.calcsize(headerFormat))
+        if len(header) != struct.calcsize(headerFormat) or header[:4] != magic:
+            self.file.close()
+            raise IOError('Not an archive: ' + path)
+        (_, codec, self.chunkBytes, self.elementSize, self.mtime, self.size) = struct.unpack(headerFormat, header)
+        self.codec = codec.rstrip('\0')
+        # [(where the chunk starts in the file, where its stored bytes are, raw length, stored length)]
+        self.chunks = []
+        start = 0
+        position = self.file.tell()
+        chunkHeaderBytes = struct.calcsize(chunkFormat)
+        while start < self.size:
+            self.file.seek(position)
+            chunkHeader = self.file.read(chunkHeaderBytes)
+            if len(chunkHeader) != chunkHeaderBytes:
+                self.file.close()
+                raise IOError('Archive is cut short: ' + path)
+            rawLength, storedLength = struct.unpack(chunkFormat, chunkHeader)
+            self.chunks.append((start, position + chunkHeaderBytes, rawLength, storedLength))
+            start += rawLength
+            position += chunkHeaderBytes + storedLength
+        self.position = 0
+        self.current = (None, '')       # (chunk number, its raw bytes)
+        self.closed = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, kind, value, trace):
+        self.close()
+        return False
+
+    def __iter__(self):
+        while True:
+            line = self.readline()
+            if not line:
+                return
+            yield line
+
+    def close(self):
+        if not self.closed:
+            self.file.close()
+            self.closed = True
+        return
+
+    def tell(self):
+        return self.position
+
+    def seek(self, offset, whence=0):
+        if whence == 1:
+            offset += self.position
+        elif whence == 2:
+            offset += self.size
+        self.position = max(offset, 0)
+        return
+
+    def chunk(self, number):
+        if self.current[0] != number:
+            (_, storedStart, rawLength, storedLength) = self.chunks[number]
+            self.file.seek(storedStart)
+            data = decompressChunk(self.codec, self.file.read(storedLength), rawLength)
+            self.current = (number, unshuffle(data, self.elementSize))
+        return self.current[1]
+
+    def chunkAt(self, position):
+        '''(chunk number, offset in it) of a position in the raw file'''
+        number = min(position // self.chunkBytes, len(self.chunks) - 1)
+        return number, position - self.chunks[number][0]
+
+    def read(self, n=-1):
+        if n is None or n < 0:
+            n = self.size - self.position
+        n = max(min(n, self.size - self.position), 0)
+        pieces = []
+        while n > 0:
+            number, offset = self.chunkAt(self.position)
+            piece = self.chunk(number)[offset:offset + n]
+            pieces.append(piece)
+            self.position += len(piece)
+            n -= len(piece)
+        return ''.join(pieces)
+
+    def readline(self, limit=-1):
+        pieces = []
+        while self.position < self.size and limit != 0:
+            number, offset = self.chunkAt(self.position)
+            data = self.chunk(number)
+            end = data.find('\n', offset)
+            end = len(data) if end < 0 else end + 1
+            if limit > 0:
+                end = min(end, offset + limit)
+                limit -= end - offset
+            pieces.append(data[offset:end])
+            self.position += end - offset
+            if pieces[-1].endswith('\n'):
+                break
+        return ''.join(pieces)
+
+
+def openFile(path, mode='r'):
+    '''path opened for reading, straight from its archive if that's all there is'''
+    if isArchived(path):
+        return ArchiveReader(archivePath(path))
+    return open(path, mode)
+
+
+def readBytes(path, offset=0, count=None):
+    '''count bytes of path from offset (to the end with None), archived or not'''
+    fileHandle = openFile(path, 'rb')
+    try:
+        fileHandle.seek(offset)
+        return fileHandle.read(-1 if count is None else count)
+    finally:
+        fileHandle.close()
+
+
+def restore(path, destination=None):
+    '''Unpacks the archive of path to destination (path itself by default), with the original
+    mtime, so checkpoints see the same file they hashed. The archive stays. Returns destination,
+    or None if path isn't archived.'''
+    if not os.path.exists(archivePath(path)):
+        return None
+    destination = destination or path
+    reader = ArchiveReader(archivePath(path))
+    tmpPath = destination + '.' + str(os.getpid())
+    output = open(tmpPath, 'wb')
+    try:
+        for number in range(len(reader.chunks)):
+            output.write(reader.chunk(number))
+    finally:
+        output.close()
+        reader.close()
+    os.utime(tmpPath, (reader.mtime, reader.mtime))
+    os.rename(tmpPath, destination)
+    return destination
+
+
+def dropRestored(path):
+    '''Deletes the plain copy of an archived file that restore() put back, unless it has changed
+    since (then it's newer than the archive, and stays). Returns True if it was deleted.'''
+    if not os.path.isfile(path) or os.path.islink(path) or not os.path.exists(archivePath(path)):
+        return False
+    stats = os.stat(path)
+    reader = ArchiveReader(archivePath(path))
+    reader.close()
+    # utime doesn't give back the mtime to the last bit (nor below a second on some file systems)
+    if reader.size != stats.st_size or abs(reader.mtime - stats.st_mtime) >= 1.0:
+        return False
+    os.remove(path)
+    return True
+
+
+def unarchive(path):
+    '''Puts the plain file back for good and deletes the archive'''
+    if restore(path) is None:
+        return False
+    os.remove(archivePath(path))
+    return True
+
+
+def removeArchive(path):
+    try:
+        os.remove(archivePath(path))
+    except OSError, e:
+        if e.errno != errno.ENOENT:
+            raise
+    return
+
+
+def archivable(fileName):
+    return any(fnmatch.fnmatchcase(fileName, pattern) for pattern in archivePatterns)
+
+
+def archiveDirectory(directory, codec=None):
+    '''Compresses the archivable files in a folder. A plain file with an archive next to it was
+    restored for a rerun; if it hasn't changed since it is dropped, otherwise archived again.
+    Returns {fileName : (bytes before, bytes after)}.'''
+    archived = {}
+    for fileName in sorted(os.listdir(directory)):
+        path = os.path.join(directory, fileName)
+        if not archivable(fileName) or not os.path.isfile(path) or os.path.islink(path):
+            continue
+        stats = os.stat(path)
+        if dropRestored(path):
+            archived[fileName] = (stats.st_size, os.path.getsize(archivePath(path)))
+            continue
+        if not os.path.exists(archivePath(path)) and stats.st_size < minimumBytes:
+            continue
+        archived[fileName] = compressFile(path, codec)
+    return archived
+
+
+def unarchiveDirectory(directory):
+    '''Puts back every archived file in a folder. Returns the names restored.'''
+    restored = []
+    for fileName in sorted(os.listdir(directory)):
+        if fileName.endswith(suffix):
+            path = os.path.join(directory, fileName[:-len(suffix)])
+            if os.path.exists(path):
+                removeArchive(path)
+            else:
+                unarchive(path)
+                restored.append(os.path.basename(path))
+    return restored
+
+
+if __name__ == '__main__':
+    # python Archive.py golden01.als2  (prints an archived file, or a plain one)
+    if len(sys.argv) < 2:
+        print 'usage: python Archive.py file'
+        sys.exit(1)
+    reader = openFile(sys.argv[1])
+    for line in reader:
+        sys.stdout.write(line)
+    reader.close()
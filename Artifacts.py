@@ -0,0 +1,294 @@
+# Keeps track of the files the pipeline leaves in each frame folder, how big
+# they are, and which ones can be thrown away. Every file gets one of four
+# classes:
+#   input         the frame itself and the option files
+#   product       things we keep (final catalogs, final psf, plots, the frame log)
+#   intermediate  things a later step or a redo might reuse (psf lists, subtracted images, logs)
+#   scratch       command files and temporary images nobody looks at again
+# The retention policy says when each class may be deleted: after every step,
+# when the whole data set is finished, or never. Files Checkpoint counts as a
+# step's output are never deleted, whatever their class, or the frame would
+# no longer look finished and a resume would redo it. What is kept of a finished
+# frame can be archived (compressed, see Archive); an archive counts as the
+# file it holds.
+
+import fnmatch
+import json
+import logging
+import os
+import sys
+from string import Template
+
+import Archive
+import Checkpoint
+import FrameCache
+
+log = logging.getLogger(__name__)
+log.addHandler(logging.NullHandler())
+
+# first match wins, so specific names go before the wildcards
+artifactPatterns = [('${frame}.imh', 'input'),
+                    ('${frame}.pix', 'input'),
+                    ('*.opt', 'input'),
+                    ('*.scr', 'input'),
+                    ('macro1.sm', 'input'),
+                    ('${frame}.als2', 'product'),
+                    ('edt${frame}.als2', 'product'),
+                    ('edt${frame}.apc', 'product'),
+                    ('apcorr.coef', 'product'),
+                    ('apcorr.summary', 'product'),
+                    ('${frame}3s.psf', 'product'),
+                    ('${frame}.lst', 'product'),
+                    ('${frame}_2.lst', 'product'),
+                    ('${frame}.ap', 'product'),
+                    ('${frame}.ap2', 'product'),
+                    ('${frame}.als', 'product'),
+                    ('${frame}.log', 'product'),
+                    ('${frame}.artifacts', 'product'),
+                    ('${frame}.state', 'product'),
+                    ('*.iraf', 'product'),
+                    ('*.pdf', 'product'),
+                    ('apcorr.als', 'product'),
+                    ('apcorr.ap', 'product'),
+                    ('apcorr.apals', 'product'),
+                    ('apcorr.out', 'product'),
+                    ('poly*.dat', 'product'),
+                    ('?fitpts*', 'product'),
+                    ('${frame}.coo', 'intermediate'),
+                    ('${frame}.psf', 'intermediate'),
+                    ('${frame}_nonei.*', 'intermediate'),
+                    ('${frame}.nei', 'intermediate'),
+                    ('${frame}.neinew*', 'intermediate'),
+                    ('${frame}psf.als', 'intermediate'),
+                    ('${frame}?s.als', 'intermediate'),
+                    ('${frame}3s.imh', 'intermediate'),
+                    ('${frame}3s.pix', 'intermediate'),
+                    ('${frame}sub2.*', 'intermediate'),
+                    ('sub.lst', 'intermediate'),
+                    ('sub_nonei.lst', 'intermediate'),
+                    ('apcorr.*', 'intermediate'),
+                    ('fit.dat', 'intermediate'),
+                    ('SPATIALD.?', 'intermediate'),
+                    ('*.steps', 'intermediate'),
+                    ('*.log', 'intermediate'),
+                    ('*.in', 'scratch'),
+                    ('inpfile*', 'scratch'),
+                    ('${frame}1s.*', 'scratch'),
+                    ('${frame}2s.*', 'scratch'),
+                    ('${frame}sub.*', 'scratch'),
+                    ('${frame}?s.coo', 'scratch'),
+                    ('*.ps', 'scratch'),
+                    ('.*.partial', 'scratch')]
+
+artifactClasses = ['input', 'product', 'intermediate', 'scratch']
+
+# {class : when it may be deleted}. 'step' = after every step, 'dataset' = when the data set is done
+defaultPolicy = {'input': 'never',
+                 'product': 'never',
+                 'intermediate': 'dataset',
+                 'scratch': 'step'}
+
+
+def classify(fileName, frame):
+    '''Class of a file name, or None if the pipeline doesn't know about it (those are never deleted)'''
+    if fileName.endswith(Archive.suffix):
+        fileName = fileName[:-len(Archive.suffix)]
+    for (pattern, artifactClass) in artifactPatterns:
+        if fnmatch.fnmatchcase(fileName, Template(pattern).substitute(frame=frame)):
+            return artifactClass
+    return None
+
+
+def formatBytes(nBytes):
+    for unit in ['B', 'KB', 'MB', 'GB']:
+        if abs(nBytes) < 1024.0:
+            return '%.1f %s' % (nBytes, unit)
+        nBytes /= 1024.0
+    return '%.1f TB' % nBytes
+
+
+class ArtifactRegistry:
+    '''Registry for one frame folder, saved as ${frame}.artifacts next to the data.'''
+
+    def __init__(self, dataSetDirectory, frame, policy=None):
+        self.frame = frame
+        self.frameDirectory = os.path.join(dataSetDirectory, frame)
+        self.registryPath = os.path.join(self.frameDirectory, frame + '.artifacts')
+        self.policy = dict(defaultPolicy)
+        if policy:
+            self.policy.update(policy)
+        self.files = {}
+        if os.path.exists(self.registryPath):
+            registryFile = open(self.registryPath, 'r')
+            try:
+                self.files = json.load(registryFile)
+            except ValueError:
+                log.warning('Could not read ' + self.registryPath + ', starting a new one')
+            registryFile.close()
+
+    def save(self):
+        tmpPath = self.registryPath + '.' + str(os.getpid())
+        registryFile = open(tmpPath, 'w')
+        json.dump(self.files, registryFile, indent=1, sort_keys=True)
+        registryFile.close()
+        os.rename(tmpPath, self.registryPath)
+        return
+
+    def snapshot(self):
+        '''{fileName : (size, mtime)} for everything in the frame folder'''
+        listing = {}
+        for fileName in os.listdir(self.frameDirectory):
+            path = os.path.join(self.frameDirectory, fileName)
+            if os.path.isfile(path):
+                stats = os.stat(path)
+                listing[fileName] = (stats.st_size, stats.st_mtime)
+        return listing
+
+    def recordStep(self, stepName, before=None):
+        '''Registers every file that is new or changed since the "before" snapshot as made by
+        stepName. Files that were already there but never registered are added without a step.'''
+        if before is None:
+            before = {}
+        after = self.snapshot()
+        for (fileName, (size, mtime)) in after.items():
+            entry = self.files.get(fileName)
+            unchanged = before.get(fileName) == (size, mtime)
+            if entry is not None and unchanged:
+                entry['bytes'] = size
+                continue
+            self.files[fileName] = {'class': classify(fileName, self.frame),
+                                    'bytes': size,
+                                    'step': None if unchanged else stepName,
+                                    'modified': mtime}
+        for fileName in self.files.keys():
+            if fileName not in after:
+                del self.files[fileName]
+        self.save()
+        return
+
+    def usage(self):
+        '''Bytes per class for this frame'''
+        totals = dict((artifactClass, 0) for artifactClass in artifactClasses + ['unknown'])
+        for entry in self.files.values():
+            totals[entry['class'] or 'unknown'] += entry['bytes']
+        return totals
+
+    def applyPolicy(self, stage, dryRun=False):
+        '''Deletes the files the policy allows at this stage ('step' or 'dataset').
+        Everything deletable at 'step' is also deletable at 'dataset'. Step outputs are kept.
+        Returns bytes freed.'''
+        allowed = ['step'] if stage == 'step' else ['step', 'dataset']
+        stepOutputs = Checkpoint.allStepOutputs(self.frame)
+        # an image is its header and its pixels
+        stepOutputs.update([name[:-len('.imh')] + '.pix' for name in stepOutputs if name.endswith('.imh')])
+        freed = 0
+        for (fileName, entry) in self.files.items():
+            if entry['class'] is None or self.policy.get(entry['class'], 'never') not in allowed:
+                continue
+            if fileName in stepOutputs or (fileName.endswith(Archive.suffix) and
+                                           fileName[:-len(Archive.suffix)] in stepOutputs):
+                continue
+            path = os.path.join(self.frameDirectory, fileName)
+            if not dryRun:
+                FrameCache.forget(path)
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+                del self.files[fileName]
+            freed += entry['bytes']
+        if not dryRun:
+            self.save()
+        return freed
+
+
+def frameNames(dataSetDirectory):
+    '''Frame folders in a data set are the ones holding an image named after the folder'''
+    frames = []
+    for name in sorted(os.listdir(dataSetDirectory)):
+        if os.path.exists(os.path.join(dataSetDirectory, name, name + '.imh')):
+            frames.append(name)
+    return frames
+
+
+def dataSetUsage(dataSetDirectory, policy=None):
+    '''{frame : {class : bytes}} for every frame in the data set. Frames are rescanned so files
+    made outside the pipeline (by hand, or by an older version of this program) are counted too.'''
+    report = {}
+    for frame in frameNames(dataSetDirectory):
+        registry = ArtifactRegistry(dataSetDirectory, frame, policy)
+        registry.recordStep('scan', registry.snapshot())
+        report[frame] = registry.usage()
+    return report
+
+
+def finishDataSet(dataSetDirectory, policy=None, dryRun=False):
+    '''Applies the end of data set retention to every frame. Returns {frame : bytes freed}.'''
+    freed = {}
+    for frame in frameNames(dataSetDirectory):
+        registry = ArtifactRegistry(dataSetDirectory, frame, policy)
+        registry.recordStep('scan', registry.snapshot())
+        freed[frame] = registry.applyPolicy('dataset', dryRun)
+    return freed
+
+
+def archiveDataSet(dataSetDirectory, onlyFinished=True, codec=None):
+    '''Compresses the bulky files of every frame (every finished one with onlyFinished).
+    Returns {frame : (bytes before, bytes after)} for the frames that had anything to archive.'''
+    archived = {}
+    for frame in frameNames(dataSetDirectory):
+        if onlyFinished and Checkpoint.FrameState(dataSetDirectory, frame).firstIncompleteStep() is not None:
+            continue
+        frameDirectory = os.path.join(dataSetDirectory, frame)
+        registry = ArtifactRegistry(dataSetDirectory, frame)
+        before = registry.snapshot()
+        # memory maps of the files about to go would keep them on disk
+        FrameCache.forget(frameDirectory)
+        sizes = Archive.archiveDirectory(frameDirectory, codec).values()
+        if sizes:
+            archived[frame] = (sum(size[0] for size in sizes), sum(size[1] for size in sizes))
+        registry.recordStep('archive', before)
+    return archived
+
+
+def unarchiveDataSet(dataSetDirectory):
+    '''Puts back every archived file. Returns {frame : names restored}.'''
+    restored = {}
+    for frame in frameNames(dataSetDirectory):
+        restored[frame] = Archive.unarchiveDirectory(os.path.join(dataSetDirectory, frame))
+    return restored
+
+
+def printUsage(report):
+    columns = artifactClasses + ['unknown']
+    print 'frame'.ljust(12) + ''.join(column.rjust(14) for column in columns) + 'total'.rjust(14)
+    grandTotals = dict((column, 0) for column in columns)
+    for frame in sorted(report):
+        row = report[frame]
+        print frame.ljust(12) + ''.join(formatBytes(row[column]).rjust(14) for column in columns) + \
+            formatBytes(sum(row.values())).rjust(14)
+        for column in columns:
+            grandTotals[column] += row[column]
+    print 'data set'.ljust(12) + ''.join(formatBytes(grandTotals[column]).rjust(14) for column in columns) + \
+        formatBytes(sum(grandTotals.values())).rjust(14)
+    return
+
+
+if __name__ == '__main__':
+    # python Artifacts.py /data/n2158_phot/n2158/ [--clean] [--archive | --unarchive]
+    if len(sys.argv) < 2:
+        print 'usage: python Artifacts.py dataSetDirectory [--clean] [--archive | --unarchive]'
+        sys.exit(1)
+    logging.basicConfig(format='%(message)s')
+    printUsage(dataSetUsage(sys.argv[1]))
+    if '--clean' in sys.argv:
+        freedBytes = finishDataSet(sys.argv[1])
+        print '\nFreed ' + formatBytes(sum(freedBytes.values()))
+    if '--archive' in sys.argv:
+        archivedBytes = archiveDataSet(sys.argv[1])
+        before = sum(sizes[0] for sizes in archivedBytes.values())
+        after = sum(sizes[1] for sizes in archivedBytes.values())
+        print '\nArchived ' + str(len(archivedBytes)) + ' frames: ' + formatBytes(before) + ' down to ' + formatBytes(after)
+    if '--unarchive' in sys.argv:
+        restoredNames = unarchiveDataSet(sys.argv[1])
+        print '\nRestored ' + str(sum(len(names) for names in restoredNames.values())) + ' files'
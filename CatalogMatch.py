@@ -0,0 +1,478 @@
+# Data set level stage: match the stars in every frame of a cluster to one
+# reference frame and build a master catalog with each star's mean magnitude,
+# scatter and number of detections.
+#
+# 1) The offset between a frame and the reference is found with a triangle
+#    matcher: triangles made from the brightest stars are hashed by the
+#    ratios of their sides, which don't change when the frame is shifted or
+#    rotated. Triangles that hash together vote for star pairs, and the pairs
+#    with the most votes give a first transformation, which is then refined
+#    with every star.
+# 2) All stars are then matched to the reference through a grid index (a hash
+#    of the positions by cell, so each star is only compared to its
+#    neighbors), a chunk at a time.
+# 3) Frames are matched in a worker pool; the results are folded into running
+#    sums, so memory goes with the number of stars, not the number of detections.
+# Each filter gets its own mean, scatter and count columns. A frame's filter is
+# the one Reduction saved in its state, or else the one in its header.
+
+import itertools
+import logging
+import multiprocessing
+import os
+import sys
+
+import numpy as np
+
+import Archive
+import Artifacts
+import Checkpoint
+import DaoCatalog
+import IrafImage
+
+# the skipped frames and the match counts, for whoever set up logging (autoreduce does)
+log = logging.getLogger(__name__)
+log.addHandler(logging.NullHandler())
+
+# defaults for the matcher
+triangleStars = 30          # brightest stars used to make triangles
+triangleTolerance = 0.005   # tolerance on the side ratios
+scaleTolerance = 0.05       # same telescope, so triangles shouldn't change size much
+matchRadius = 2.0           # pixels
+chunkSize = 50000           # stars matched per pass through the grid index
+
+
+def frameCatalogPath(dataSetDirectory, frame):
+    '''The edited catalog if alsedt was run, otherwise the raw allstar output'''
+    for name in ['edt' + frame + '.als2', frame + '.als2']:
+        path = os.path.join(dataSetDirectory, frame, name)
+        if Archive.exists(path):
+            return path
+    return None
+
+
+class GridIndex:
+    '''Positions hashed into square cells of cellSize pixels. A nearest neighbor lookup only
+    looks at the 3x3 cells around each star.'''
+
+    def __init__(self, x, y, cellSize):
+        self.x = np.asarray(x, dtype=float)
+        self.y = np.asarray(y, dtype=float)
+        self.cellSize = float(cellSize)
+        if len(self.x) == 0:
+            self.x0 = self.y0 = 0.0
+        else:
+            self.x0 = self.x.min()
+            self.y0 = self.y.min()
+        cellX, cellY = self._cells(self.x, self.y)
+        self.nCellsX = (cellX.max() + 2) if len(cellX) else 2
+        self.nCellsY = (cellY.max() + 2) if len(cellY) else 2
+        keys = cellY * self.nCellsX + cellX
+        self.order = np.argsort(keys, kind='mergesort')
+        self.sortedKeys = keys[self.order]
+
+    def _cells(self, x, y):
+        # +1 so there is always an empty row/column of cells around the stars
+        cellX = np.floor((x - self.x0) / self.cellSize).astype(np.int64) + 1
+        cellY = np.floor((y - self.y0) / self.cellSize).astype(np.int64) + 1
+        return cellX, cellY
+
+    def _candidatePairs(self, x, y):
+        '''Yields (query rows, indexed stars, squared distances) for everything in the 3x3 cells
+        around each query position, one slice of the cell contents at a time'''
+        cellX, cellY = self._cells(x, y)
+        for offsetY in [-1, 0, 1]:
+            for offsetX in [-1, 0, 1]:
+                neighborX = cellX + offsetX
+                neighborY = cellY + offsetY
+                inside = (neighborX >= 0) & (neighborX < self.nCellsX) & (neighborY >= 0) & (neighborY < self.nCellsY)
+                keys = np.where(inside, neighborY * self.nCellsX + neighborX, -1)
+                starts = np.searchsorted(self.sortedKeys, keys, 'left')
+                counts = np.searchsorted(self.sortedKeys, keys, 'right') - starts
+                counts[~inside] = 0
+                for j in range(counts.max() if len(counts) else 0):
+                    rows = np.nonzero(counts > j)[0]
+                    candidates = self.order[starts[rows] + j]
+                    distance2 = (self.x[candidates] - x[rows]) ** 2 + (self.y[candidates] - y[rows]) ** 2
+                    yield rows, candidates, distance2
+
+    def nearest(self, x, y, radius):
+        '''Index of the nearest indexed star within radius of each (x, y), -1 if there is none.
+        Returns (indices, distances).'''
+        if radius > self.cellSize:
+            raise ValueError('search radius is bigger than the grid cells')
+        x = np.asarray(x, dtype=float)
+        y = np.asarray(y, dtype=float)
+        best = np.zeros(len(x), dtype=np.int64) - 1
+        bestDistance2 = np.zeros(len(x)) + radius * radius
+        if len(self.x) == 0 or len(x) == 0:
+            return best, np.sqrt(bestDistance2)
+
+        for (rows, candidates, distance2) in self._candidatePairs(x, y):
+            closer = distance2 < bestDistance2[rows]
+            best[rows[closer]] = candidates[closer]
+            bestDistance2[rows[closer]] = distance2[closer]
+        return best, np.sqrt(bestDistance2)
+
+    def within(self, x, y, radius):
+        '''Every (query, indexed star) pair closer than radius, as two index arrays'''
+        if radius > self.cellSize:
+            raise ValueError('search radius is bigger than the grid cells')
+        x = np.asarray(x, dtype=float)
+        y = np.asarray(y, dtype=float)
+        queries = [np.zeros(0, dtype=np.int64)]
+        neighbors = [np.zeros(0, dtype=np.int64)]
+        if len(self.x) == 0 or len(x) == 0:
+            return queries[0], neighbors[0]
+
+        for (rows, candidates, distance2) in self._candidatePairs(x, y):
+            close = distance2 <= radius * radius
+            queries.append(rows[close])
+            neighbors.append(candidates[close])
+        return np.concatenate(queries), np.concatenate(neighbors)
+
+
+def triangles(x, y):
+    '''Every triangle of the given stars, as (side ratios, vertices, longest side). Vertices are
+    ordered opposite the shortest, middle and longest side, so the same triangle in two frames
+    lists its stars in the same order. Nearly isosceles triangles are dropped, since their order
+    is ambiguous.'''
+    combos = np.array(list(itertools.combinations(range(len(x)), 3)), dtype=np.int64)
+    if len(combos) == 0:
+        return np.zeros((0, 2)), np.zeros((0, 3), dtype=np.int64), np.zeros(0)
+    px = x[combos]
+    py = y[combos]
+    sides = np.column_stack([np.hypot(px[:, 1] - px[:, 2], py[:, 1] - py[:, 2]),
+                             np.hypot(px[:, 0] - px[:, 2], py[:, 0] - py[:, 2]),
+                             np.hypot(px[:, 0] - px[:, 1], py[:, 0] - py[:, 1])])
+    order = np.argsort(sides, axis=1)
+    rows = np.arange(len(combos))[:, np.newaxis]
+    sides = sides[rows, order]
+    vertices = combos[rows, order]
+    ratios = np.column_stack([sides[:, 0] / sides[:, 2], sides[:, 1] / sides[:, 2]])
+    distinct = ((sides[:, 1] - sides[:, 0]) / sides[:, 2] > 0.02) & ((sides[:, 2] - sides[:, 1]) / sides[:, 2] > 0.02)
+    return ratios[distinct], vertices[distinct], sides[distinct, 2]
+
+
+def fitTransform(fromX, fromY, toX, toY):
+    '''Least squares x' = a + b x + c y, y' = d + e x + f y. With fewer than 6 pairs only the
+    offset is fitted.'''
+    if len(fromX) < 6:
+        return np.array([np.median(toX - fromX), 1.0, 0.0, np.median(toY - fromY), 0.0, 1.0])
+    design = np.column_stack([np.ones(len(fromX)), fromX, fromY])
+    xCoefficients = np.linalg.lstsq(design, toX, rcond=-1)[0]
+    yCoefficients = np.linalg.lstsq(design, toY, rcond=-1)[0]
+    return np.concatenate([xCoefficients, yCoefficients])
+
+
+def applyTransform(transform, x, y):
+    return (transform[0] + transform[1] * x + transform[2] * y,
+            transform[3] + transform[4] * x + transform[5] * y)
+
+
+def brightest(columns, nStars):
+    good = np.nonzero(columns['mag'] < DaoCatalog.badMagnitude - 1)[0]
+    return good[np.argsort(columns['mag'][good])[:nStars]]
+
+
+def solveTransform(frameColumns, referenceColumns, referenceIndex=None, nStars=triangleStars,
+                   tolerance=triangleTolerance, radius=matchRadius):
+    '''Transformation taking frame positions onto the reference. Returns (transform, pairs used),
+    or (None, 0) if the triangles didn't agree on anything.'''
+    frameStars = brightest(frameColumns, nStars)
+    referenceStars = brightest(referenceColumns, nStars)
+    frameRatios, frameVertices, frameSides = triangles(frameColumns['x'][frameStars], frameColumns['y'][frameStars])
+    referenceRatios, referenceVertices, referenceSides = triangles(referenceColumns['x'][referenceStars],
+                                                                   referenceColumns['y'][referenceStars])
+
+    # hash the reference triangles by their (quantized) side ratios
+    table = {}
+    referenceKeys = np.floor(referenceRatios / tolerance).astype(np.int64)
+    for (i, key) in enumerate(map(tuple, referenceKeys)):
+        table.setdefault(key, []).append(i)
+
+    votes = np.zeros((len(frameStars), len(referenceStars)), dtype=np.int64)
+    frameKeys = np.floor(frameRatios / tolerance).astype(np.int64)
+    for (i, (keyX, keyY)) in enumerate(frameKeys):
+        for key in [(keyX + dx, keyY + dy) for dx in [-1, 0, 1] for dy in [-1, 0, 1]]:
+            for j in table.get(key, []):
+                if np.abs(frameRatios[i] - referenceRatios[j]).max() > tolerance:
+                    continue
+                if abs(frameSides[i] / referenceSides[j] - 1.0) > scaleTolerance:
+                    continue
+                votes[frameVertices[i], referenceVertices[j]] += 1
+
+    # keep pairs that are each other's best match and got a fair share of the votes
+    minimumVotes = max(2, votes.max() // 4)
+    bestReference = votes.argmax(axis=1)
+    bestFrame = votes.argmax(axis=0)
+    pairs = [(i, bestReference[i]) for i in range(len(frameStars))
+             if votes[i, bestReference[i]] >= minimumVotes and bestFrame[bestReference[i]] == i]
+    if len(pairs) < 3:
+        return None, 0
+    frameIndices = frameStars[[i for (i, j) in pairs]]
+    referenceIndices = referenceStars[[j for (i, j) in pairs]]
+
+    # chance coincidences still sneak in. Throw out the worst pair until everything fits.
+    while True:
+        transform = fitTransform(frameColumns['x'][frameIndices], frameColumns['y'][frameIndices],
+                                 referenceColumns['x'][referenceIndices], referenceColumns['y'][referenceIndices])
+        x, y = applyTransform(transform, frameColumns['x'][frameIndices], frameColumns['y'][frameIndices])
+        residuals = np.hypot(x - referenceColumns['x'][referenceIndices], y - referenceColumns['y'][referenceIndices])
+        if residuals.max() <= radius:
+            break
+        if len(frameIndices) <= 3:
+            return None, 0
+        keep = np.arange(len(frameIndices)) != residuals.argmax()
+        frameIndices = frameIndices[keep]
+        referenceIndices = referenceIndices[keep]
+
+    # refine with every star that lands near a reference star
+    if referenceIndex is None:
+        referenceIndex = GridIndex(referenceColumns['x'], referenceColumns['y'], radius)
+    nPairs = len(pairs)
+    for iteration in range(3):
+        x, y = applyTransform(transform, frameColumns['x'], frameColumns['y'])
+        matches, distances = referenceIndex.nearest(x, y, radius)
+        matched = np.nonzero(matches >= 0)[0]
+        if len(matched) < nPairs:
+            break
+        nPairs = len(matched)
+        transform = fitTransform(frameColumns['x'][matched], frameColumns['y'][matched],
+                                 referenceColumns['x'][matches[matched]], referenceColumns['y'][matches[matched]])
+    return transform, nPairs
+
+
+# the reference catalog for the pool workers, set once per worker by the initializer
+workerReference = {}
+
+
+def setWorkerReference(referenceColumns, radius):
+    workerReference['columns'] = referenceColumns
+    workerReference['index'] = GridIndex(referenceColumns['x'], referenceColumns['y'], radius)
+    workerReference['radius'] = radius
+    return
+
+
+def matchFrame(catalogPath):
+    '''Pool job: solves the frame's transformation and matches its stars to the reference, a chunk
+    at a time. Returns a dictionary of compact arrays (nothing else of the catalog comes back).'''
+    header, columns = DaoCatalog.readCatalog(catalogPath)
+    good = np.nonzero(columns['mag'] < DaoCatalog.badMagnitude - 1)[0]
+    result = matchColumns(DaoCatalog.selectRows(columns, good))
+    result['path'] = catalogPath
+    return result
+
+
+def matchColumns(columns):
+    '''matchFrame for a catalog that is already read: {'transform', 'pairs', 'matches' (index of
+    the reference star, -1 for none), 'x', 'y' (on the reference), 'mag', 'err'}. Only
+    'transform' (None) and 'pairs' if the frame couldn't be matched.'''
+    transform, nPairs = solveTransform(columns, workerReference['columns'], workerReference['index'],
+                                       radius=workerReference['radius'])
+    if transform is None:
+        return {'transform': None, 'pairs': 0}
+
+    x, y = applyTransform(transform, columns['x'], columns['y'])
+    matches = np.zeros(len(x), dtype=np.int64) - 1
+    distances = np.zeros(len(x))
+    for start in range(0, len(x), chunkSize):
+        stop = start + chunkSize
+        matches[start:stop], distances[start:stop] = workerReference['index'].nearest(x[start:stop], y[start:stop],
+                                                                                        workerReference['radius'])
+    # two stars on one reference star: the closer one gets it, the other is treated as a new star
+    matched = np.nonzero(matches >= 0)[0]
+    matched = matched[np.argsort(distances[matched], kind='mergesort')]
+    duplicate = np.ones(len(matched), dtype=bool)
+    duplicate[np.unique(matches[matched], return_index=True)[1]] = False
+    matches[matched[duplicate]] = -1
+    errors = columns['err'] if 'err' in columns else np.zeros(len(x)) + 0.01
+    return {'transform': transform, 'pairs': nPairs, 'matches': matches, 'x': x, 'y': y, 'mag': columns['mag'],
+            'err': errors}
+
+
+class MasterCatalog:
+    '''Running sums for the master catalog. Stars are the reference frame's stars plus any
+    star seen in other frames that the reference doesn't have.'''
+
+    def __init__(self, referenceColumns, radius):
+        self.radius = radius
+        self.x = list(referenceColumns['x'])
+        self.y = list(referenceColumns['y'])
+        self.nReference = len(self.x)
+        self.extraIndex = None
+        self.sums = {}
+        self.zeroPoints = {}
+
+    def _statistics(self, filterName):
+        if filterName not in self.sums:
+            self.sums[filterName] = dict((name, np.zeros(0)) for name in ['n', 'm', 'm2', 'w', 'wm'])
+        sums = self.sums[filterName]
+        size = len(self.x)
+        for name in sums:
+            if len(sums[name]) < size:
+                sums[name] = np.concatenate([sums[name], np.zeros(size - len(sums[name]))])
+        return sums
+
+    def _assignExtras(self, x, y):
+        '''Master ids for detections the reference didn't have. New stars get added.'''
+        ids = np.zeros(len(x), dtype=np.int64) - 1
+        if len(x) == 0:
+            return ids
+        if self.extraIndex is not None:
+            matches = self.extraIndex.nearest(x, y, self.radius)[0]
+            ids[matches >= 0] = matches[matches >= 0] + self.nReference
+        new = np.nonzero(ids < 0)[0]
+        ids[new] = len(self.x) + np.arange(len(new))
+        self.x.extend(x[new])
+        self.y.extend(y[new])
+        extraX = np.array(self.x[self.nReference:])
+        extraY = np.array(self.y[self.nReference:])
+        self.extraIndex = GridIndex(extraX, extraY, self.radius)
+        return ids
+
+    def add(self, result, filterName, normalize=True):
+        '''Folds one frame's matches into the sums. With normalize, the frame's magnitudes are
+        shifted onto the first frame of the same filter (exposure time, airmass) before averaging.'''
+        ids = result['matches'].copy()
+        unmatched = np.nonzero(ids < 0)[0]
+        ids[unmatched] = self._assignExtras(result['x'][unmatched], result['y'][unmatched])
+        mag = result['mag'].copy()
+        err = np.maximum(result['err'], 0.001)
+
+        referenceStars = ids < self.nReference
+        if normalize:
+            if filterName not in self.zeroPoints:
+                zeroPoint = np.zeros(self.nReference) + np.nan
+                zeroPoint[ids[referenceStars]] = mag[referenceStars]
+                self.zeroPoints[filterName] = zeroPoint
+            else:
+                zeroPoint = self.zeroPoints[filterName]
+                common = referenceStars & (err < 0.05)
+                common[common] = ~np.isnan(zeroPoint[ids[common]])
+                if common.sum() > 0:
+                    mag -= np.median(mag[common] - zeroPoint[ids[common]])
+
+        sums = self._statistics(filterName)
+        size = len(self.x)
+        weights = 1.0 / err ** 2
+        sums['n'] += np.bincount(ids, minlength=size)[:size]
+        sums['m'] += np.bincount(ids, mag, minlength=size)[:size]
+        sums['m2'] += np.bincount(ids, mag * mag, minlength=size)[:size]
+        sums['w'] += np.bincount(ids, weights, minlength=size)[:size]
+        sums['wm'] += np.bincount(ids, weights * mag, minlength=size)[:size]
+        return
+
+    def table(self):
+        '''{column : array}, with mean, scatter and count columns per filter'''
+        columns = {'id': np.arange(1, len(self.x) + 1), 'x': np.array(self.x), 'y': np.array(self.y)}
+        for filterName in sorted(self.sums):
+            sums = self._statistics(filterName)
+            seen = sums['n'] > 0
+            mean = np.zeros(len(self.x)) + DaoCatalog.badMagnitude
+            scatter = np.zeros(len(self.x))
+            mean[seen] = sums['wm'][seen] / sums['w'][seen]
+            variance = sums['m2'][seen] / sums['n'][seen] - (sums['m'][seen] / sums['n'][seen]) ** 2
+            scatter[seen] = np.sqrt(np.maximum(variance, 0.0))
+            columns['mag' + filterName] = mean
+            columns['scatter' + filterName] = scatter
+            columns['n' + filterName] = sums['n'].astype(int)
+        return columns
+
+
+def writeMasterCatalog(path, columns):
+    names = ['id', 'x', 'y'] + sorted(name for name in columns if name not in ['id', 'x', 'y'])
+    masterFile = open(path + '.tmp', 'w')
+    masterFile.write('#' + ' '.join(name.rjust(10) for name in names) + '\n')
+    formats = ['%10d' if name == 'id' or name.startswith('n') else '%10.3f' for name in names]
+    rowFormat = ' ' + ' '.join(formats) + '\n'
+    table = np.column_stack([columns[name] for name in names])
+    for row in table:
+        masterFile.write(rowFormat % tuple(row))
+    masterFile.close()
+    os.rename(path + '.tmp', path)
+    return
+
+
+# header keywords the filter may be under, the first one set wins
+filterKeywords = ['FILTER', 'FILTERS', 'FILTER1', 'FILTNAME']
+
+
+def frameFilter(dataSetDirectory, frame, default=''):
+    '''A frame's filter: the one saved in its state, or else the one in its .imh header, or else
+    default'''
+    saved = Checkpoint.FrameState(dataSetDirectory, frame).getParameter('filter')
+    if saved:
+        # json gives unicode
+        return str(saved)
+    try:
+        keywords = IrafImage.readKeywords(os.path.join(dataSetDirectory, frame, frame + '.imh'))
+    except IOError:
+        keywords = {}
+    for keyword in filterKeywords:
+        if keywords.get(keyword):
+            return keywords[keyword]
+    return default
+
+
+def frameFilters(dataSetDirectory, frames, default=''):
+    '''{frame : filter name} (see frameFilter)'''
+    return dict((frame, frameFilter(dataSetDirectory, frame, default)) for frame in frames)
+
+
+def buildMasterCatalog(dataSetDirectory, referenceFrame, frames=None, filters=None, outputPath=None,
+                       radius=matchRadius, processes=None, normalize=True):
+    '''Matches every frame of the data set to referenceFrame and writes the master catalog
+    (dataSetDirectory/master.cat by default). filters is {frame : filter name} (frameFilters by
+    default); frames without one are averaged together. Returns (columns, {frame : transform or
+    None}).'''
+    if frames is None:
+        frames = Artifacts.frameNames(dataSetDirectory)
+    if filters is None:
+        filters = frameFilters(dataSetDirectory, frames)
+    if outputPath is None:
+        outputPath = os.path.join(dataSetDirectory, 'master.cat')
+
+    referencePath = frameCatalogPath(dataSetDirectory, referenceFrame)
+    if referencePath is None:
+        raise IOError('No reduced catalog for the reference frame ' + referenceFrame)
+    header, referenceColumns = DaoCatalog.readCatalog(referencePath)
+    good = np.nonzero(referenceColumns['mag'] < DaoCatalog.badMagnitude - 1)[0]
+    referenceColumns = DaoCatalog.selectRows(referenceColumns, good)
+
+    framePaths = []
+    for frame in frames:
+        path = frameCatalogPath(dataSetDirectory, frame)
+        if path is None:
+            log.warning('Skipping ' + frame + ', it has no reduced catalog')
+            continue
+        framePaths.append((frame, path))
+
+    master = MasterCatalog(referenceColumns, radius)
+    transforms = {}
+    pool = multiprocessing.Pool(processes, setWorkerReference, (referenceColumns, radius))
+    try:
+        # imap hands the frames back in order as they finish, so only a few are in memory at once
+        for ((frame, path), result) in itertools.izip(framePaths, pool.imap(matchFrame, [path for (frame, path) in framePaths])):
+            transforms[frame] = result['transform']
+            if result['transform'] is None:
+                log.warning('Could not match ' + frame + ' to ' + referenceFrame)
+                continue
+            master.add(result, filters.get(frame, ''), normalize)
+            log.info('%s: %d pairs, %d stars matched', frame, result['pairs'], (result['matches'] >= 0).sum())
+    finally:
+        pool.close()
+        pool.join()
+
+    columns = master.table()
+    writeMasterCatalog(outputPath, columns)
+    return columns, transforms
+
+
+if __name__ == '__main__':
+    # python CatalogMatch.py /data/n2158_phot/n2158/ n21100
+    if len(sys.argv) < 3:
+        print 'usage: python CatalogMatch.py dataSetDirectory referenceFrame'
+        sys.exit(1)
+    logging.basicConfig(level=logging.INFO, format='%(message)s')
+    buildMasterCatalog(sys.argv[1], sys.argv[2])
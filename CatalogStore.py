@@ -0,0 +1,246 @@
+# Binary store for the reduced catalogs, so questions about a whole data set
+# (or a whole season) don't mean re-parsing every .als2 file.
+#
+# The store is a folder of compressed numpy (.npz) files split up by position:
+#   storeDirectory/index.json              what is in every partition (counts, magnitude and position ranges)
+#   storeDirectory/p{bx}_{by}/{dataSet}.{hash}_{frame}.npz
+# where hash is from the data set's full path, so two nights' folders with the
+# same name (/data/2019/n2158 and /data/2020/n2158) don't overwrite each other.
+# Each partition covers binSize x binSize pixels. Within a file the stars are
+# sorted by magnitude, so "brighter than" is a binary search instead of a scan.
+# Every record carries its data set (name and folder), frame, filter and the
+# step that made it.
+#
+# There is no WCS anywhere in this pipeline, so positions are pixels: the
+# frame's own (x, y) and, once the master catalog has been built, the
+# reference frame's (xref, yref). Queries can use either.
+
+import errno
+import fcntl
+import hashlib
+import json
+import os
+import sys
+import time
+
+import numpy as np
+
+import CatalogMatch
+import DaoCatalog
+
+binSize = 512
+
+# columns kept for every star
+storeColumns = ['x', 'y', 'xref', 'yref', 'mag', 'err', 'chi', 'sharp']
+provenanceColumns = ['dataSet', 'dataSetPath', 'frame', 'filter', 'step']
+
+
+def makeDirectory(path):
+    '''os.makedirs that doesn't mind another process making the folder first'''
+    try:
+        os.makedirs(path)
+    except OSError, e:
+        if e.errno != errno.EEXIST or not os.path.isdir(path):
+            raise
+    return
+
+
+class CatalogStore:
+    def __init__(self, storeDirectory):
+        self.storeDirectory = storeDirectory
+        self.indexPath = os.path.join(storeDirectory, 'index.json')
+        makeDirectory(storeDirectory)
+        self.index = self._readIndex()
+
+    def _readIndex(self):
+        if not os.path.exists(self.indexPath):
+            return {'binSize': binSize, 'partitions': {}}
+        indexFile = open(self.indexPath, 'r')
+        index = json.load(indexFile)
+        indexFile.close()
+        return index
+
+    def _updateIndex(self, function):
+        '''Read-modify-write of the index under a lock, in case two frames finish at once'''
+        lockFile = open(self.indexPath + '.lock', 'a')
+        fcntl.flock(lockFile, fcntl.LOCK_EX)
+        try:
+            self.index = self._readIndex()
+            function(self.index)
+            tmpPath = self.indexPath + '.' + str(os.getpid())
+            indexFile = open(tmpPath, 'w')
+            json.dump(self.index, indexFile)
+            indexFile.close()
+            os.rename(tmpPath, self.indexPath)
+        finally:
+            fcntl.flock(lockFile, fcntl.LOCK_UN)
+            lockFile.close()
+        return
+
+    def addCatalog(self, columns, dataSetDirectory, frame, filterName='', step='', transform=None):
+        '''Stores one frame's catalog, replacing whatever was stored for that frame of that data set
+        before. transform (from CatalogMatch) fills in the reference frame positions.'''
+        size = self.index['binSize']
+        nStars = len(columns['x'])
+        table = {'x': columns['x'], 'y': columns['y']}
+        if transform is not None:
+            table['xref'], table['yref'] = CatalogMatch.applyTransform(transform, columns['x'], columns['y'])
+        else:
+            table['xref'] = np.zeros(nStars) + np.nan
+            table['yref'] = np.zeros(nStars) + np.nan
+        for name in ['mag', 'err', 'chi', 'sharp']:
+            table[name] = columns[name] if name in columns else np.zeros(nStars) + np.nan
+
+        # partitions follow the reference positions when we have them, so one sky box is one set of partitions
+        if transform is not None:
+            binX = np.floor(table['xref'] / size).astype(int)
+            binY = np.floor(table['yref'] / size).astype(int)
+        else:
+            binX = np.floor(table['x'] / size).astype(int)
+            binY = np.floor(table['y'] / size).astype(int)
+        dataSetPath = normalizedPath(dataSetDirectory)
+        dataSet = dataSetName(dataSetDirectory)
+        fileName = frameFileName(dataSetDirectory, frame)
+        partitionEntries = {}
+        self.removeFrame(dataSetDirectory, frame)
+        for (bx, by) in set(zip(binX, binY)):
+            rows = np.nonzero((binX == bx) & (binY == by))[0]
+            rows = rows[np.argsort(table['mag'][rows], kind='mergesort')]
+            partition = 'p%d_%d' % (bx, by)
+            partitionDirectory = os.path.join(self.storeDirectory, partition)
+            makeDirectory(partitionDirectory)
+            arrays = dict((name, np.asarray(table[name], dtype=np.float32)[rows]) for name in storeColumns)
+            tmpPath = os.path.join(partitionDirectory, '.' + fileName)
+            np.savez_compressed(tmpPath, **arrays)
+            os.rename(tmpPath, os.path.join(partitionDirectory, fileName))
+            partitionEntries[partition] = {'file': fileName, 'n': len(rows), 'dataSet': dataSet,
+                                           'dataSetPath': dataSetPath, 'frame': frame,
+                                           'filter': filterName, 'step': step, 'stored': time.time(),
+                                           'reference': transform is not None,
+                                           'magMin': float(table['mag'][rows].min()),
+                                           'magMax': float(table['mag'][rows].max()),
+                                           'box': [bx * size, (bx + 1) * size, by * size, (by + 1) * size]}
+
+        def addEntries(index):
+            for (partition, entry) in partitionEntries.items():
+                index['partitions'].setdefault(partition, {})[fileName] = entry
+        self._updateIndex(addEntries)
+        return len(partitionEntries)
+
+    def removeFrame(self, dataSetDirectory, frame):
+        fileName = frameFileName(dataSetDirectory, frame)
+        dataSet = dataSetName(dataSetDirectory)
+
+        def dropEntries(index):
+            for (partition, entries) in index['partitions'].items():
+                for (entryName, entry) in entries.items():
+                    # stores written before the path was in the key only have {dataSet}_{frame}.npz
+                    legacy = 'dataSetPath' not in entry and entry['dataSet'] == dataSet and entry['frame'] == frame
+                    if entryName != fileName and not legacy:
+                        continue
+                    del entries[entryName]
+                    try:
+                        os.remove(os.path.join(self.storeDirectory, partition, entryName))
+                    except OSError:
+                        pass
+        self._updateIndex(dropEntries)
+        return
+
+    def query(self, xMin, xMax, yMin, yMax, magLimit=None, filters=None, dataSets=None, frames=None,
+              reference=True):
+        '''Every stored star inside the box and brighter than magLimit. reference=True searches
+        the reference frame positions (frames without them are skipped), otherwise each frame's own
+        pixels. dataSets may name data sets by folder name or by full path. Returns {column : array}
+        including the provenance columns.'''
+        results = dict((name, []) for name in storeColumns + provenanceColumns)
+        xName, yName = ('xref', 'yref') if reference else ('x', 'y')
+        for (partition, entries) in self.index['partitions'].items():
+            for (fileName, entry) in entries.items():
+                if reference and not entry['reference']:
+                    continue
+                # the partition box is only in the query's coordinates if the frame was partitioned the same way
+                box = entry['box']
+                if entry['reference'] == reference and (box[1] <= xMin or box[0] > xMax or box[3] <= yMin or box[2] > yMax):
+                    continue
+                if magLimit is not None and entry['magMin'] > magLimit:
+                    continue
+                if filters is not None and entry['filter'] not in filters:
+                    continue
+                if dataSets is not None and entry['dataSet'] not in dataSets and \
+                        entry.get('dataSetPath') not in dataSets:
+                    continue
+                if frames is not None and entry['frame'] not in frames:
+                    continue
+
+                arrays = np.load(os.path.join(self.storeDirectory, partition, fileName))
+                mag = arrays['mag']
+                end = len(mag) if magLimit is None else np.searchsorted(mag, magLimit, 'right')
+                x = arrays[xName][:end]
+                y = arrays[yName][:end]
+                rows = np.nonzero((x >= xMin) & (x <= xMax) & (y >= yMin) & (y <= yMax))[0]
+                for name in storeColumns:
+                    results[name].append(arrays[name][:end][rows])
+                for name in provenanceColumns:
+                    results[name].append(np.array([entry.get(name, '')] * len(rows), dtype=object))
+                arrays.close()
+
+        for name in results:
+            if results[name]:
+                results[name] = np.concatenate(results[name])
+            else:
+                results[name] = np.zeros(0, dtype=object if name in provenanceColumns else np.float32)
+        return results
+
+
+def normalizedPath(dataSetDirectory):
+    return os.path.normpath(os.path.abspath(dataSetDirectory))
+
+
+def dataSetName(dataSetDirectory):
+    return os.path.basename(normalizedPath(dataSetDirectory))
+
+
+def frameFileName(dataSetDirectory, frame):
+    '''{dataSet}.{hash of the full path}_{frame}.npz'''
+    pathHash = hashlib.sha1(normalizedPath(dataSetDirectory)).hexdigest()[:8]
+    return dataSetName(dataSetDirectory) + '.' + pathHash + '_' + frame + '.npz'
+
+
+def storeFrame(storeDirectory, dataSetDirectory, frame, filterName='', transform=None):
+    '''Stores a frame's final catalog (edited if alsedt was run). Returns False if there is none yet.'''
+    path = CatalogMatch.frameCatalogPath(dataSetDirectory, frame)
+    if path is None:
+        return False
+    step = 'alsedt' if os.path.basename(path).startswith('edt') else 'allstarScript'
+    header, columns = DaoCatalog.readCatalog(path)
+    good = columns['mag'] < DaoCatalog.badMagnitude - 1
+    CatalogStore(storeDirectory).addCatalog(DaoCatalog.selectRows(columns, good), dataSetDirectory, frame,
+                                            filterName, step, transform)
+    return True
+
+
+def storeDataSet(storeDirectory, dataSetDirectory, transforms, filters=None):
+    '''Stores every frame with the transformations from CatalogMatch.buildMasterCatalog'''
+    if filters is None:
+        filters = {}
+    stored = 0
+    for (frame, transform) in transforms.items():
+        if storeFrame(storeDirectory, dataSetDirectory, frame, filters.get(frame, ''), transform):
+            stored += 1
+    return stored
+
+
+if __name__ == '__main__':
+    # python CatalogStore.py storeDirectory xmin xmax ymin ymax [maglimit] [--pixels]
+    if len(sys.argv) < 6:
+        print 'usage: python CatalogStore.py storeDirectory xmin xmax ymin ymax [maglimit] [--pixels]'
+        sys.exit(1)
+    arguments = [argument for argument in sys.argv[2:] if argument != '--pixels']
+    limit = float(arguments[4]) if len(arguments) > 4 else None
+    started = time.time()
+    stars = CatalogStore(sys.argv[1]).query(float(arguments[0]), float(arguments[1]), float(arguments[2]),
+                                            float(arguments[3]), limit, reference='--pixels' not in sys.argv)
+    print '%d stars in %.1f ms' % (len(stars['mag']), (time.time() - started) * 1000.0)
+    for i in range(len(stars['mag'])):
+        print '%-10s %-8s %-4s %9.3f %9.3f %9.3f %8.4f' % (stars['dataSet'][i], stars['frame'][i], stars['filter'][i],
+                                                         stars['x'][i], stars['y'][i], stars['mag'][i], stars['err'][i])
@@ -0,0 +1,182 @@
+# Per frame checkpoint file, so a dead session doesn't lose the FWHM, the psf
+# star choices or which steps are finished. The state lives in ${frame}.state
+# (json) in the frame folder and is rewritten after every step. It is written
+# to a temporary file and renamed over the old one, so a crash in the middle
+# of a save leaves the previous state behind instead of half a file.
+
+import hashlib
+import json
+import logging
+import os
+import socket
+import time
+from string import Template
+
+import Archive
+import OptionFiles
+
+log = logging.getLogger(__name__)
+log.addHandler(logging.NullHandler())
+
+# the reduction steps in the order they are run, by function name
+reductionSteps = ['getFWHM',
+                  'setupOptFiles',
+                  'psfFirstPass',
+                  'psfCandidateSelection',
+                  'psfErrorDeletion',
+                  'neighborStarSubtraction',
+                  'mkpsfScript',
+                  'badPSFSubtractionStarRemoval',
+                  'allstarScript',
+                  'makePlots',
+                  'alsedt']
+
+# a step is finished when all of its outputs exist (and its parameters were recorded)
+stepOutputs = {'getFWHM': [],
+               'setupOptFiles': sorted(OptionFiles.optionFileDict.keys()),
+               'psfFirstPass': ['${frame}.coo', '${frame}.ap'],
+               'psfCandidateSelection': ['${frame}.lst'],
+               'psfErrorDeletion': ['${frame}.psf', '${frame}.iraf'],
+               'neighborStarSubtraction': ['${frame}_nonei.lst', '${frame}_nonei.psf'],
+               'mkpsfScript': ['${frame}3s.imh', '${frame}2s.als'],
+               'badPSFSubtractionStarRemoval': ['${frame}_2.lst', '${frame}3s.psf'],
+               'allstarScript': ['${frame}.als2', '${frame}sub2.imh', 'als.iraf'],
+               'makePlots': ['magplot.pdf', 'chiplot.pdf', 'roundplot.pdf'],
+               'alsedt': ['edt${frame}.als2', 'edt.iraf']}
+
+stepParameters = {'getFWHM': ['fwhm']}
+
+
+def allStepOutputs(frame):
+    '''Every file some step counts as its output, for this frame'''
+    return set(Template(name).substitute(frame=frame) for names in stepOutputs.values() for name in names)
+
+
+def fileHash(path, blockSize=1 << 20):
+    sha = hashlib.sha1()
+    fileHandle = Archive.openFile(path, 'rb')
+    while True:
+        block = fileHandle.read(blockSize)
+        if not block:
+            break
+        sha.update(block)
+    fileHandle.close()
+    return sha.hexdigest()
+
+
+class FrameState:
+    '''Everything we know about one frame's reduction. Step entries look like
+    {'status': 'running'|'done'|'incomplete'|'failed', 'started', 'finished', 'seconds', 'outputs'}
+    where outputs is {fileName : [sha1, size, mtime]}.'''
+
+    def __init__(self, dataSetDirectory, frame):
+        self.frame = frame
+        self.frameDirectory = os.path.join(dataSetDirectory, frame)
+        self.statePath = os.path.join(self.frameDirectory, frame + '.state')
+        self.state = {'frame': frame, 'parameters': {}, 'steps': {}}
+        if os.path.exists(self.statePath):
+            stateFile = open(self.statePath, 'r')
+            try:
+                self.state = json.load(stateFile)
+            except ValueError:
+                log.warning('Could not read ' + self.statePath + '. Starting with a blank state.')
+            stateFile.close()
+
+    def save(self):
+        self.state['saved'] = time.time()
+        self.state['host'] = socket.gethostname()
+        tmpPath = self.statePath + '.' + str(os.getpid())
+        stateFile = open(tmpPath, 'w')
+        json.dump(self.state, stateFile, indent=1, sort_keys=True)
+        stateFile.flush()
+        os.fsync(stateFile.fileno())
+        stateFile.close()
+        os.rename(tmpPath, self.statePath)
+        return
+
+    def outputNames(self, stepName):
+        return [Template(name).substitute(frame=self.frame) for name in stepOutputs.get(stepName, [])]
+
+    def getParameter(self, name, default=None):
+        return self.state['parameters'].get(name, default)
+
+    def setParameter(self, name, value):
+        self.state['parameters'][name] = value
+        self.save()
+        return
+
+    def appendParameter(self, name, value):
+        '''For parameters we collect more than one of, like the accepted chi values'''
+        self.state['parameters'].setdefault(name, []).append(value)
+        self.save()
+        return
+
+    def startStep(self, stepName):
+        entry = self.state['steps'].setdefault(stepName, {})
+        entry['status'] = 'running'
+        entry['started'] = time.time()
+        self.save()
+        return
+
+    def finishStep(self, stepName):
+        '''Marks a step done if its outputs and parameters are all there, otherwise incomplete.
+        Returns True when the step is done.'''
+        entry = self.state['steps'].setdefault(stepName, {'started': time.time()})
+        entry['finished'] = time.time()
+        entry['seconds'] = entry['finished'] - entry['started']
+
+        missing = [name for name in self.outputNames(stepName)
+                   if not Archive.exists(os.path.join(self.frameDirectory, name))]
+        missing += [name for name in stepParameters.get(stepName, []) if self.getParameter(name) is None]
+        entry['outputs'] = {}
+        if missing:
+            entry['status'] = 'incomplete'
+            entry['missing'] = missing
+        else:
+            entry['status'] = 'done'
+            entry.pop('missing', None)
+            for name in self.outputNames(stepName):
+                path = os.path.join(self.frameDirectory, name)
+                size, mtime = Archive.originalStat(path)
+                entry['outputs'][name] = [fileHash(path), size, mtime]
+        self.save()
+        return entry['status'] == 'done'
+
+    def failStep(self, stepName, message):
+        '''Marks a step that raised as failed, with what it raised'''
+        entry = self.state['steps'].setdefault(stepName, {'started': time.time()})
+        entry['finished'] = time.time()
+        entry['seconds'] = entry['finished'] - entry['started']
+        entry['status'] = 'failed'
+        entry['error'] = message
+        entry['outputs'] = {}
+        entry.pop('missing', None)
+        self.save()
+        return
+
+    def stepDone(self, stepName):
+        '''True if the step finished and its outputs haven't changed since. Outputs with the same size
+        and mtime are trusted, anything else gets rehashed.'''
+        entry = self.state['steps'].get(stepName)
+        if entry is None or entry.get('status') != 'done':
+            return False
+        for (name, (sha, size, mtime)) in entry.get('outputs', {}).items():
+            path = os.path.join(self.frameDirectory, name)
+            # an archived output still counts, the archive remembers its size and mtime
+            if not Archive.exists(path):
+                return False
+            if Archive.originalStat(path) == (size, mtime):
+                continue
+            if fileHash(path) != sha:
+                return False
+        return True
+
+    def firstIncompleteStep(self):
+        '''Name of the first reduction step that still needs doing, or None if the frame is finished'''
+        for stepName in reductionSteps:
+            if not self.stepDone(stepName):
+                return stepName
+        return None
+
+    def hasProgress(self):
+        return any(self.stepDone(stepName) for stepName in reductionSteps)
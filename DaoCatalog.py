@@ -0,0 +1,162 @@
+# Readers and writers for the daophot text catalogs (.coo, .lst, .ap, .als and
+# friends). Everything is read into numpy arrays in one go, since splitting
+# the whole file at once is a lot faster than parsing it line by line.
+#
+# All of these files start with the same three line header:
+#  NL    NX    NY  LOWBAD HIGHBAD  THRESH     AP1  PH/ADU  RNOISE    FRAD
+#   1  4096  4096   -18.2 55000.0   28.54    3.70    1.30    9.00    3.70
+# (blank line)
+
+import os
+
+import numpy as np
+
+import Archive
+
+headerNames = ['NL', 'NX', 'NY', 'LOWBAD', 'HIGHBAD', 'THRESH', 'AP1', 'PH/ADU', 'RNOISE', 'FRAD']
+
+# column names for the one line per star formats
+catalogColumns = {'coo': ['id', 'x', 'y', 'mag', 'sharp', 'round', 'dround'],
+                  'lst': ['id', 'x', 'y', 'mag', 'sky'],
+                  'als': ['id', 'x', 'y', 'mag', 'err', 'sky', 'niter', 'chi', 'sharp']}
+
+catalogFormats = {'coo': '%7d%9.3f%9.3f%9.3f%9.3f%9.3f%9.3f',
+                  'lst': '%7d%9.3f%9.3f%9.3f%9.3f',
+                  'als': '%7d%9.3f%9.3f%9.3f%9.4f%9.3f%8.0f.%9.3f%9.3f'}
+
+# what daophot writes for a magnitude it couldn't measure
+badMagnitude = 99.999
+
+
+def catalogKind(path):
+    '''Works out the format from the file name'''
+    name = os.path.basename(path).lower()
+    extension = os.path.splitext(name)[1]
+    if extension in ['.coo']:
+        return 'coo'
+    if extension in ['.lst', '.nei'] or extension.startswith('.neinew'):
+        return 'lst'
+    if extension in ['.ap', '.apfull']:
+        return 'ap'
+    # .als, .als2, .apals, .ap2 (append of .als files) are all allstar style
+    return 'als'
+
+
+def defaultHeader(nx=0, ny=0, lowBad=0.0, highBad=55000.0, threshold=0.0, ap1=0.0,
+                  gain=1.3, readNoise=9.0, fittingRadius=0.0, nl=1):
+    return {'NL': nl, 'NX': nx, 'NY': ny, 'LOWBAD': lowBad, 'HIGHBAD': highBad, 'THRESH': threshold,
+            'AP1': ap1, 'PH/ADU': gain, 'RNOISE': readNoise, 'FRAD': fittingRadius}
+
+
+def readHeader(lines):
+    '''Parses the header from the first lines of a file. Returns (header dict, lines used)'''
+    if not lines or not lines[0].strip().startswith('NL'):
+        return None, 0
+    values = lines[1].split()
+    header = {}
+    for (name, value) in zip(headerNames, values):
+        header[name] = int(value) if name in ['NL', 'NX', 'NY'] else float(value)
+    used = 2
+    if len(lines) > 2 and not lines[2].strip():
+        used = 3
+    return header, used
+
+
+def formatHeader(header):
+    return (' NL    NX    NY  LOWBAD HIGHBAD  THRESH     AP1  PH/ADU  RNOISE    FRAD\n' +
+            ' %2d %5d %5d %7.1f %7.1f %7.2f %7.2f %7.2f %7.2f %7.2f\n\n' %
+            tuple(header.get(name, 0) for name in headerNames))
+
+
+def readCatalog(path, kind=None):
+    '''Reads a catalog into (header, {column : array}). For .ap files, 'mag' and 'err' are
+    (stars x apertures) arrays and the sky columns are 'sky', 'skysigma' and 'skyskew'.'''
+    if kind is None:
+        kind = catalogKind(path)
+    catalogFile = openCatalog(path)
+    lines = catalogFile.read().splitlines()
+    catalogFile.close()
+    header, used = readHeader(lines)
+    lines = lines[used:]
+    if kind == 'ap':
+        return header, parseApertureRecords(lines)
+
+    rows = [line for line in lines if line.strip()]
+    if not rows:
+        return header, dict((name, np.zeros(0)) for name in catalogColumns[kind])
+    # some programs write a column or two more or less than daophot does. Use what is there.
+    nColumns = min(len(row.split()) for row in rows)
+    values = np.array(' '.join(' '.join(row.split()[:nColumns]) for row in rows).split(), dtype=float)
+    values = values.reshape(len(rows), nColumns)
+    names = list(catalogColumns.get(kind, []))
+    names += ['column%d' % i for i in range(len(names), nColumns)]
+    columns = dict((names[i], values[:, i]) for i in range(nColumns))
+    columns['id'] = columns['id'].astype(int)
+    return header, columns
+
+
+def parseApertureRecords(lines):
+    '''.ap records are a blank line followed by two lines:
+         id x y mag(1..n)
+         sky skysigma skyskew err(1..n)'''
+    records = [line for line in lines if line.strip()]
+    first = records[0::2]
+    second = records[1::2]
+    if not first:
+        empty = np.zeros(0)
+        return {'id': empty.astype(int), 'x': empty, 'y': empty, 'mag': np.zeros((0, 1)),
+                'err': np.zeros((0, 1)), 'sky': empty, 'skysigma': empty, 'skyskew': empty}
+    nFirst = len(first[0].split())
+    nSecond = len(second[0].split())
+    magnitudeLines = np.array(' '.join(first).split(), dtype=float).reshape(len(first), nFirst)
+    skyLines = np.array(' '.join(second).split(), dtype=float).reshape(len(second), nSecond)
+    return {'id': magnitudeLines[:, 0].astype(int),
+            'x': magnitudeLines[:, 1],
+            'y': magnitudeLines[:, 2],
+            'mag': magnitudeLines[:, 3:],
+            'sky': skyLines[:, 0],
+            'skysigma': skyLines[:, 1],
+            'skyskew': skyLines[:, 2],
+            'err': skyLines[:, 3:]}
+
+
+def writeCatalog(path, header, columns, kind=None):
+    '''Writes columns back out in daophot's layout. The file appears in one piece (written next
+    to the destination and renamed), so nothing ever reads half a catalog.'''
+    if kind is None:
+        kind = catalogKind(path)
+    if header is None:
+        header = defaultHeader(nl=2 if kind == 'ap' else 1)
+
+    tmpPath = path + '.' + str(os.getpid()) + '.tmp'
+    catalogFile = open(tmpPath, 'w')
+    catalogFile.write(formatHeader(header))
+    if kind == 'ap':
+        nApertures = columns['mag'].shape[1]
+        firstFormat = '%7d%9.3f%9.3f' + '%9.3f' * nApertures + '\n'
+        secondFormat = '%14.3f%6.2f%6.2f' + '%8.4f' * nApertures + '\n'
+        for i in range(len(columns['id'])):
+            catalogFile.write('\n')
+            catalogFile.write(firstFormat % ((columns['id'][i], columns['x'][i], columns['y'][i]) +
+                                             tuple(columns['mag'][i])))
+            catalogFile.write(secondFormat % ((columns['sky'][i], columns['skysigma'][i], columns['skyskew'][i]) +
+                                              tuple(columns['err'][i])))
+    else:
+        names = catalogColumns[kind]
+        table = np.column_stack([np.asarray(columns[name], dtype=float) for name in names])
+        rowFormat = catalogFormats[kind] + '\n'
+        for row in table:
+            catalogFile.write(rowFormat % tuple(row))
+    catalogFile.close()
+    os.rename(tmpPath, path)
+    return
+
+
+def openCatalog(path):
+    # archived catalogs are read straight out of the archive
+    return Archive.openFile(path, 'r')
+
+
+def selectRows(columns, mask):
+    '''Same catalog, only the rows where mask is True (or the given indices)'''
+    return dict((name, values[mask]) for (name, values) in columns.items())
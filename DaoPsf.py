@@ -0,0 +1,258 @@
+# DAOPHOT II .psf files, and evaluating the PSF they describe.
+#
+# A .psf file is
+#   line 1   LABEL NPSF NPSF NPAR NEXP NFRAC PSFMAG BRIGHT XPSF YPSF
+#   line 2   the NPAR parameters of the analytic profile (half widths first)
+#   the rest NEXP lookup tables of NPSF x NPSF corrections, sampled every half
+#            pixel around the star, x running fastest, six numbers per line
+# The PSF at an offset (dx, dy) from a star at (x, y) is
+#   BRIGHT * profile(dx, dy) + sum over k of term_k(x, y) * table_k(dx, dy)
+# where the terms are 1, then X and Y, then 1.5 X^2 - 0.5, X Y, 1.5 Y^2 - 0.5
+# (NEXP = 1, 3 or 6 for VA = 0, 1, 2) with X = (x - 1) / XPSF - 1 and the same
+# for Y. A star of magnitude PSFMAG is the PSF times one.
+#
+# The analytic profiles have a peak of one and are averaged over each pixel
+# with a 3 x 3 Gauss-Legendre rule. The table is interpolated with cubic
+# convolution. Everything takes arrays, so whole groups of stars and their
+# pixels are evaluated in one call.
+
+import os
+
+import numpy as np
+
+import Archive
+
+# {AN option : (label, number of parameters)}
+analyticProfiles = {1: ('GAUSSIAN', 2),
+                    2: ('MOFFAT15', 3),
+                    3: ('MOFFAT25', 3),
+                    4: ('LORENTZ', 3),
+                    5: ('PENNY1', 4),
+                    6: ('PENNY2', 5)}
+profileNumbers = dict((label, number) for (number, (label, nParameters)) in analyticProfiles.items())
+
+# pixel averaging: offsets inside the pixel and their weights
+quadratureOffsets = np.array([-0.5 * np.sqrt(0.6), 0.0, 0.5 * np.sqrt(0.6)])
+quadratureWeights = np.array([5.0, 8.0, 5.0]) / 18.0
+
+log2 = np.log(2.0)
+
+
+def tableSize(psfRadius):
+    '''NPSF for a PSF radius: half pixel steps out to the radius and a point either side'''
+    return 2 * (2 * int(psfRadius) + 1) + 1
+
+
+def pointProfile(label, parameters, dx, dy, gradient=False):
+    '''The analytic profile at a point, peak one. With gradient, (value, d/dx, d/dy).'''
+    p = parameters
+    if label == 'GAUSSIAN':
+        value = np.exp(-log2 * (dx * dx / (p[0] * p[0]) + dy * dy / (p[1] * p[1])))
+        if not gradient:
+            return value
+        return value, -2 * log2 * dx / (p[0] * p[0]) * value, -2 * log2 * dy / (p[1] * p[1]) * value
+    z = dx * dx / (p[0] * p[0]) + dy * dy / (p[1] * p[1])
+    zx = 2 * dx / (p[0] * p[0])
+    zy = 2 * dy / (p[1] * p[1])
+    if len(p) > 2:
+        z = z + p[2] * dx * dy
+        zx = zx + p[2] * dy
+        zy = zy + p[2] * dx
+    if label in ['MOFFAT15', 'MOFFAT25']:
+        beta = 1.5 if label == 'MOFFAT15' else 2.5
+        # scaled so the parameters are half widths at half maximum
+        alpha = 2.0 ** (1.0 / beta) - 1.0
+        base = 1.0 + alpha * z
+        value = base ** -beta
+        dValue = -beta * alpha * value / base
+    elif label == 'LORENTZ':
+        value = 1.0 / (1.0 + z)
+        dValue = -value * value
+    elif label in ['PENNY1', 'PENNY2']:
+        # gaussian core and lorentzian wings, p[3] of the light in the wings
+        gaussianZ = dx * dx / (p[0] * p[0]) + dy * dy / (p[1] * p[1])
+        gaussianZx = 2 * dx / (p[0] * p[0])
+        gaussianZy = 2 * dy / (p[1] * p[1])
+        if label == 'PENNY2':
+            gaussianZ = gaussianZ + p[4] * dx * dy
+            gaussianZx = gaussianZx + p[4] * dy
+            gaussianZy = gaussianZy + p[4] * dx
+        core = (1.0 - p[3]) * np.exp(-log2 * gaussianZ)
+        wings = 1.0 / (1.0 + z)
+        value = core + p[3] * wings
+        if not gradient:
+            return value
+        return (value, -log2 * gaussianZx * core - p[3] * wings * wings * zx,
+                -log2 * gaussianZy * core - p[3] * wings * wings * zy)
+    else:
+        raise ValueError('Unknown analytic PSF ' + label)
+    if not gradient:
+        return value
+    return value, dValue * zx, dValue * zy
+
+
+def pixelProfile(label, parameters, dx, dy, gradient=False):
+    '''The analytic profile averaged over the pixel centered at (dx, dy)'''
+    total = [0.0, 0.0, 0.0] if gradient else 0.0
+    for (offsetX, weightX) in zip(quadratureOffsets, quadratureWeights):
+        for (offsetY, weightY) in zip(quadratureOffsets, quadratureWeights):
+            point = pointProfile(label, parameters, dx + offsetX, dy + offsetY, gradient)
+            if gradient:
+                total = [sum + weightX * weightY * part for (sum, part) in zip(total, point)]
+            else:
+                total = total + weightX * weightY * point
+    return total
+
+
+def cubicWeights(t):
+    '''Cubic convolution (a = -0.5) weights for the four samples around a point t of the way
+    from sample 0 to sample 1'''
+    return [((-0.5 * t + 1.0) * t - 0.5) * t,
+            (1.5 * t - 2.5) * t * t + 1.0,
+            ((-1.5 * t + 2.0) * t + 0.5) * t,
+            (0.5 * t - 0.5) * t * t]
+
+
+def cubicWeightDerivatives(t):
+    '''d/dt of cubicWeights'''
+    return [(-1.5 * t + 2.0) * t - 0.5,
+            (4.5 * t - 5.0) * t,
+            (-4.5 * t + 4.0) * t + 0.5,
+            (1.5 * t - 1.0) * t]
+
+
+class DaoPsf:
+    def __init__(self, label, parameters, table, psfMag, bright, xpsf, ypsf, nfrac=0):
+        self.label = label
+        self.parameters = np.asarray(parameters, dtype=float)
+        # (NEXP, NPSF, NPSF), indexed [term, y, x]
+        self.table = np.asarray(table, dtype=float)
+        self.psfMag = psfMag
+        self.bright = bright
+        self.xpsf = xpsf
+        self.ypsf = ypsf
+        self.nfrac = nfrac
+        self.npsf = self.table.shape[1]
+        self.nexp = self.table.shape[0]
+        # (NPSF * NPSF, NEXP), so one lookup gets every term's correction
+        self.flatTable = np.ascontiguousarray(self.table.reshape(self.nexp, -1).T)
+        self.center = (self.npsf - 1) / 2.0
+        # the table reaches half a pixel past the radius on either side
+        self.radius = ((self.npsf - 1) / 2 - 1) / 2.0
+
+    def spatialTerms(self, x, y):
+        '''term_k(x, y) for each star, shape (..., NEXP)'''
+        x = np.asarray(x, dtype=float)
+        y = np.asarray(y, dtype=float)
+        deltaX = (x - 1.0) / self.xpsf - 1.0
+        deltaY = (y - 1.0) / self.ypsf - 1.0
+        terms = [np.ones_like(deltaX)]
+        if self.nexp >= 3:
+            terms += [deltaX, deltaY]
+        if self.nexp >= 6:
+            terms += [1.5 * deltaX * deltaX - 0.5, deltaX * deltaY, 1.5 * deltaY * deltaY - 0.5]
+        return np.stack(terms, axis=-1)
+
+    def tableValue(self, dx, dy, terms, gradient=False):
+        '''The lookup table part at offsets dx, dy (any shape), with terms broadcastable to
+        dx.shape + (NEXP,). With gradient, (value, d/dx, d/dy).'''
+        u = 2.0 * dx + self.center
+        v = 2.0 * dy + self.center
+        u0 = np.floor(u).astype(int)
+        v0 = np.floor(v).astype(int)
+        # points off the table get zero weight, so their (clipped) index doesn't matter
+        insideU = []
+        insideV = []
+        columns = []
+        rows = []
+        for i in range(4):
+            insideU.append((u0 + i - 1 >= 0) & (u0 + i - 1 < self.npsf))
+            columns.append(np.clip(u0 + i - 1, 0, self.npsf - 1))
+            insideV.append((v0 + i - 1 >= 0) & (v0 + i - 1 < self.npsf))
+            rows.append(np.clip(v0 + i - 1, 0, self.npsf - 1) * self.npsf)
+        weightsU = [inside * weight for (inside, weight) in zip(insideU, cubicWeights(u - u0))]
+        weightsV = [inside * weight for (inside, weight) in zip(insideV, cubicWeights(v - v0))]
+        if gradient:
+            # d/ddx = 2 d/du, the table being every half pixel
+            slopesU = [2.0 * inside * slope for (inside, slope) in zip(insideU, cubicWeightDerivatives(u - u0))]
+            slopesV = [2.0 * inside * slope for (inside, slope) in zip(insideV, cubicWeightDerivatives(v - v0))]
+
+        value = np.zeros(np.shape(dx))
+        valueX = np.zeros(np.shape(dx))
+        valueY = np.zeros(np.shape(dx))
+        for j in range(4):
+            # interpolate along the row first, then between rows
+            rowValue = 0.0
+            rowSlope = 0.0
+            for i in range(4):
+                # all NEXP tables at once, combined with each star's terms
+                sample = np.einsum('...k,...k->...', self.flatTable[rows[j] + columns[i]], terms)
+                rowValue = rowValue + weightsU[i] * sample
+                if gradient:
+                    rowSlope = rowSlope + slopesU[i] * sample
+            value += weightsV[j] * rowValue
+            if gradient:
+                valueX += weightsV[j] * rowSlope
+                valueY += slopesV[j] * rowValue
+        if gradient:
+            return value, valueX, valueY
+        return value
+
+    def evaluate(self, dx, dy, x, y, gradient=False):
+        '''PSF (for a star of PSFMAG) at pixel offsets dx, dy from stars at x, y. x and y
+        broadcast against dx without the last axis, so dx of shape (groups, stars, pixels) goes
+        with x of shape (groups, stars). Zero beyond the PSF radius. With gradient,
+        (value, d/ddx, d/ddy).'''
+        dx = np.asarray(dx, dtype=float)
+        dy = np.asarray(dy, dtype=float)
+        terms = self.spatialTerms(x, y)[..., np.newaxis, :]
+        inside = dx * dx + dy * dy <= self.radius * self.radius
+        analytic = pixelProfile(self.label, self.parameters, dx, dy, gradient)
+        table = self.tableValue(dx, dy, terms, gradient)
+        if not gradient:
+            return np.where(inside, self.bright * analytic + table, 0.0)
+        return tuple(np.where(inside, self.bright * analyticPart + tablePart, 0.0)
+                     for (analyticPart, tablePart) in zip(analytic, table))
+
+
+def readPsf(path):
+    psfFile = Archive.openFile(path, 'r')
+    lines = psfFile.read().splitlines()
+    psfFile.close()
+    fields = lines[0].split()
+    label = fields[0]
+    npsf, npar, nexp, nfrac = int(fields[1]), int(fields[3]), int(fields[4]), int(fields[5])
+    psfMag, bright, xpsf, ypsf = [float(field) for field in fields[6:10]]
+    # fortran E format runs numbers together when they're negative, so read fixed width fields
+    numbers = []
+    for line in lines[1:]:
+        line = line.rstrip()
+        for start in range(1, len(line), 13):
+            field = line[start:start + 13].strip()
+            if field:
+                numbers.append(float(field.replace('D', 'E')))
+    parameters = numbers[:npar]
+    tableValues = numbers[npar:npar + nexp * npsf * npsf]
+    if len(tableValues) < nexp * npsf * npsf:
+        raise IOError(path + ' is too short for a ' + str(npsf) + ' x ' + str(npsf) + ' x ' + str(nexp) + ' table')
+    table = np.array(tableValues).reshape(nexp, npsf, npsf)
+    return DaoPsf(label, parameters, table, psfMag, bright, xpsf, ypsf, nfrac)
+
+
+def formatNumbers(values):
+    lines = []
+    for start in range(0, len(values), 6):
+        lines.append(' ' + ''.join('%13.6E' % value for value in values[start:start + 6]))
+    return '\n'.join(lines) + '\n'
+
+
+def writePsf(path, psf):
+    psfFile = open(path + '.tmp', 'w')
+    psfFile.write(' %-8s%5d%5d%3d%3d%3d%10.3f%15.7E%10.3f%10.3f\n' % (psf.label, psf.npsf, psf.npsf,
+                                                                  len(psf.parameters), psf.nexp, psf.nfrac,
+                                                                  psf.psfMag, psf.bright, psf.xpsf, psf.ypsf))
+    psfFile.write(formatNumbers(psf.parameters))
+    psfFile.write(formatNumbers(psf.table.ravel()))
+    psfFile.close()
+    os.rename(path + '.tmp', path)
+    return
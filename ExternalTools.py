@@ -0,0 +1,394 @@
+# Runs the external programs (daophot, allstar, sm, the .e fortran tools).
+# They are all driven the same way: start the program in the frame folder and
+# type the answers to its questions on stdin, one per line. The scripts did
+# that with inpfiles; here the answers go straight down a pipe, so there is
+# nothing to clean up and the output comes back to whoever asked for it. A
+# program only starts once its memory fits next to whatever else is running
+# (MemoryBudget), and its peak memory is remembered for next time.
+#
+# Every run can go through a cache. A run is identified by the program, its
+# arguments, its stdin and the contents of the files it reads (every file
+# named in the answers, and the .opt files), and the cache keeps the files it
+# made or changed plus what it printed. Running the same thing again puts the
+# files back instead of running the program. The modes (setCacheMode):
+#   'run'     no cache, always run the program
+#   'cache'   use the cache when it has the answer, otherwise run and store
+#   'record'  always run, and store the result
+#   'replay'  never run anything; a run that isn't in the cache fails. With a
+#             cache recorded from a real reduction this drives the whole
+#             pipeline without the fortran programs (regression runs)
+# The cache is cacheDirectory/entries/<key>/ and cacheDirectory/index.json
+# (size and last use of every entry, and which files each command writes, so
+# an old output lying around isn't mistaken for an input next time). When it gets bigger than cacheBytes the
+# least recently used entries are thrown out.
+#
+# The fortran programs can't read archived files (Archive), so whatever a run
+# names that only exists archived is unpacked next to its archive first, and
+# deleted again when the run is over (unless the run changed it).
+
+import fcntl
+import hashlib
+import json
+import os
+import shutil
+import struct
+import subprocess
+import threading
+import time
+
+import Archive
+import IrafImage
+import MemoryBudget
+
+cacheModes = ['run', 'cache', 'record', 'replay']
+cacheMode = 'run'
+cacheDirectory = os.path.expanduser('~/.autoreduce_cache')
+cacheBytes = 20 * 1024 ** 3
+
+# return codes for runs that never got as far as the program
+missingProgram = 127
+notInCache = 126
+
+
+def setCacheMode(mode, directory=None, maxBytes=None):
+    global cacheMode, cacheDirectory, cacheBytes
+    if mode not in cacheModes:
+        raise ValueError('Cache mode must be one of ' + ', '.join(cacheModes))
+    cacheMode = mode
+    if directory is not None:
+        cacheDirectory = directory
+    if maxBytes is not None:
+        cacheBytes = maxBytes
+    return
+
+
+def runProgram(program, answers, workingDirectory, arguments=(), environment=None):
+    '''Runs the program for real, once its memory fits (MemoryBudget). Returns (return code,
+    everything it printed).'''
+    stdin = ''.join(answer + '\n' for answer in answers)
+    pixels = MemoryBudget.imagePixels(referencedFiles(answers, arguments, workingDirectory), workingDirectory)
+    with MemoryBudget.Admission(program, MemoryBudget.predictFootprint(program, pixels)):
+        try:
+            process = subprocess.Popen([program] + list(arguments), cwd=workingDirectory, stdin=subprocess.PIPE,
+                                       stdout=subprocess.PIPE, stderr=subprocess.STDOUT, env=environment)
+        except OSError, e:
+            return missingProgram, program + ': ' + str(e) + '\n'
+        # the answers are a few lines, well within the pipe, so they can all go in before reading
+        try:
+            process.stdin.write(stdin)
+        except IOError:
+            # it quit without reading them all
+            pass
+        process.stdin.close()
+        output = process.stdout.read()
+        process.stdout.close()
+        # reaped with wait4 instead of communicate() to get its peak memory
+        status, usage = os.wait4(process.pid, 0)[1:]
+    if os.WIFSIGNALED(status):
+        returnCode = -os.WTERMSIG(status)
+    else:
+        returnCode = os.WEXITSTATUS(status)
+    process.returncode = returnCode
+    MemoryBudget.recordRun(program, pixels, MemoryBudget.peakBytes(usage))
+    return returnCode, output
+
+
+# {path : runs still reading it} of the archived files restoreArchived unpacked. Steps running
+# side by side often read the same frame, and the last one done deletes it.
+restoredUsers = {}
+restoredLock = threading.Lock()
+
+
+def restoreArchived(answers, arguments, inputs, workingDirectory):
+    '''Unpacks the archived files a run reads (and the pixel files of the images it names).
+    Returns the paths the run now uses, for dropRestored.'''
+    paths = set(os.path.join(workingDirectory, fileName) for fileName in inputs)
+    for line in list(answers) + list(arguments):
+        for word in line.replace(',', ' ').split():
+            for candidate in [word, word + '.imh']:
+                paths.add(os.path.join(workingDirectory, candidate))
+    restored = []
+    with restoredLock:
+        for path in sorted(paths):
+            if path.endswith('.imh') and os.path.isfile(path):
+                try:
+                    path = IrafImage.pixelFilePath(IrafImage.readHeader(path))
+                except IOError:
+                    continue
+            if path in restoredUsers:
+                restoredUsers[path] += 1
+            elif Archive.isArchived(path):
+                Archive.restore(path)
+                restoredUsers[path] = 1
+            else:
+                continue
+            restored.append(path)
+    return restored
+
+
+def dropRestored(restored):
+    '''Deletes the files restoreArchived unpacked for a run once no run is reading them'''
+    with restoredLock:
+        for path in restored:
+            restoredUsers[path] -= 1
+            if restoredUsers[path] == 0:
+                del restoredUsers[path]
+                Archive.dropRestored(path)
+    return
+
+
+def runTool(program, answers, workingDirectory, arguments=(), inputs=(), environment=None):
+    '''Runs program in workingDirectory with answers (a list of lines) on stdin, going through
+    the cache if there is one. inputs are files it reads that aren't named in the answers.
+    Returns (return code, everything it printed). A missing program comes back as return code
+    127, like the shell would give.'''
+    restored = restoreArchived(answers, arguments, inputs, workingDirectory)
+    try:
+        return runCached(program, answers, workingDirectory, arguments, inputs, environment)
+    finally:
+        dropRestored(restored)
+
+
+def runCached(program, answers, workingDirectory, arguments, inputs, environment):
+    if cacheMode == 'run':
+        return runProgram(program, answers, workingDirectory, arguments, environment)
+
+    cache = ToolCache(cacheDirectory, cacheBytes)
+    command = commandKey(program, answers, arguments)
+    if cacheMode in ['cache', 'replay']:
+        # what this command wrote last time isn't one of its inputs, even if an old copy is lying around
+        key = runKey(command, answers, workingDirectory, arguments, inputs, cache.writtenBy(command))
+        result = cache.replay(key, workingDirectory)
+        if result is not None:
+            return result
+        if cacheMode == 'replay':
+            return notInCache, program + ': not in the cache (' + key + ')\n'
+
+    before = directorySnapshot(workingDirectory)
+    returnCode, output = runProgram(program, answers, workingDirectory, arguments, environment)
+    # failed runs aren't kept, so a program that fell over once doesn't keep failing from the cache
+    if returnCode == 0:
+        after = directorySnapshot(workingDirectory)
+        changed = sorted(fileName for fileName in after if before.get(fileName) != after[fileName])
+        removed = sorted(fileName for fileName in before if fileName not in after)
+        key = runKey(command, answers, workingDirectory, arguments, inputs, changed + removed)
+        cache.store(key, command, workingDirectory, changed, removed, returnCode, output, os.path.basename(program))
+    return returnCode, output
+
+
+# {path : (size, mtime, hash)} so a frame isn't hashed again for every run that reads it
+hashMemory = {}
+
+
+def contentHash(path):
+    '''sha1 of a file. Images are hashed without the file names in their headers, so the same
+    image in another folder (or with its pixel file relinked) hashes the same.'''
+    stat = os.stat(path)
+    remembered = hashMemory.get(path)
+    if remembered is not None and remembered[:2] == (stat.st_size, stat.st_mtime):
+        return remembered[2]
+
+    sha = hashlib.sha1()
+    header = None
+    if path.endswith('.imh'):
+        try:
+            header = IrafImage.readHeader(path)
+        except IOError:
+            # not a version 2 header, so it gets hashed like any other file
+            pass
+    if header is not None:
+        headerFile = open(path, 'rb')
+        data = bytearray(headerFile.read())
+        headerFile.close()
+        # the pixel file and header file names (255 chars and a NUL each) run from pixfile up to the title
+        start = IrafImage.imhOffsets['pixfile']
+        end = IrafImage.imhOffsets['title']
+        data[start:end] = '\0' * (end - start)
+        sha.update(data)
+        pixelPath = IrafImage.pixelFilePath(header)
+        if Archive.exists(pixelPath):
+            pixelFile = Archive.openFile(pixelPath, 'rb')
+            pixelFile.seek((header['pixoff'] - 1) * 2)
+            copyInto(pixelFile, sha)
+            pixelFile.close()
+    elif path.endswith('.pix'):
+        # the data is hashed with its header, and the pix file's own header has paths in it
+        sha.update(struct.pack('>q', stat.st_size))
+    else:
+        hashedFile = open(path, 'rb')
+        copyInto(hashedFile, sha)
+        hashedFile.close()
+    digest = sha.hexdigest()
+    hashMemory[path] = (stat.st_size, stat.st_mtime, digest)
+    return digest
+
+
+def copyInto(fileHandle, sha, blockSize=1 << 20):
+    while True:
+        block = fileHandle.read(blockSize)
+        if not block:
+            return
+        sha.update(block)
+
+
+def referencedFiles(answers, arguments, workingDirectory):
+    '''Files in the working directory a run reads: every word of the answers and arguments that
+    names a file (or an image without its .imh, like "at n21157"), and the option files'''
+    names = set()
+    for line in list(answers) + list(arguments):
+        for word in line.replace(',', ' ').split():
+            for candidate in [word, word + '.imh']:
+                if os.path.isfile(os.path.join(workingDirectory, candidate)):
+                    names.add(candidate)
+    for fileName in os.listdir(workingDirectory):
+        if fileName.endswith('.opt'):
+            names.add(fileName)
+    return sorted(names)
+
+
+def commandKey(program, answers, arguments=()):
+    '''sha1 of what was typed, without the files'''
+    return hashlib.sha1(json.dumps([os.path.basename(program), list(arguments), list(answers)])).hexdigest()
+
+
+def runKey(command, answers, workingDirectory, arguments=(), inputs=(), written=()):
+    '''sha1 of the command and the contents of every file it reads (leaving out the ones it writes)'''
+    sha = hashlib.sha1(command)
+    fileNames = set(referencedFiles(answers, arguments, workingDirectory)) | set(inputs)
+    for fileName in sorted(fileNames - set(written)):
+        path = os.path.join(workingDirectory, fileName)
+        if os.path.isfile(path):
+            sha.update(fileName + '\0' + contentHash(path) + '\0')
+        else:
+            sha.update(fileName + '\0absent\0')
+    return sha.hexdigest()
+
+
+def directorySnapshot(workingDirectory):
+    snapshot = {}
+    for fileName in os.listdir(workingDirectory):
+        path = os.path.join(workingDirectory, fileName)
+        if os.path.isfile(path) and not os.path.islink(path):
+            stat = os.stat(path)
+            snapshot[fileName] = (stat.st_size, stat.st_mtime)
+    return snapshot
+
+
+class ToolCache:
+    def __init__(self, directory, maxBytes):
+        self.directory = directory
+        self.maxBytes = maxBytes
+        self.entriesDirectory = os.path.join(directory, 'entries')
+        self.indexPath = os.path.join(directory, 'index.json')
+        if not os.path.isdir(self.entriesDirectory):
+            try:
+                os.makedirs(self.entriesDirectory)
+            except OSError:
+                # somebody else just made it
+                pass
+
+    def _readIndex(self):
+        '''{'entries': {key : [bytes, last used]}, 'commands': {command : [files it writes]}}'''
+        if not os.path.exists(self.indexPath):
+            return {'entries': {}, 'commands': {}}
+        indexFile = open(self.indexPath, 'r')
+        index = json.load(indexFile)
+        indexFile.close()
+        return index
+
+    def _updateIndex(self, function):
+        '''Read-modify-write of the index under a lock, since pool workers share the cache'''
+        lockFile = open(self.indexPath + '.lock', 'a')
+        fcntl.flock(lockFile, fcntl.LOCK_EX)
+        try:
+            index = self._readIndex()
+            function(index)
+            tmpPath = self.indexPath + '.' + str(os.getpid())
+            indexFile = open(tmpPath, 'w')
+            json.dump(index, indexFile)
+            indexFile.close()
+            os.rename(tmpPath, self.indexPath)
+        finally:
+            fcntl.flock(lockFile, fcntl.LOCK_UN)
+            lockFile.close()
+        return
+
+    def writtenBy(self, command):
+        return self._readIndex()['commands'].get(command, [])
+
+    def replay(self, key, workingDirectory):
+        '''Puts a stored run's files back. Returns (return code, output), or None if it isn't stored.'''
+        entryDirectory = os.path.join(self.entriesDirectory, key)
+        manifestPath = os.path.join(entryDirectory, 'manifest.json')
+        if not os.path.exists(manifestPath):
+            return None
+        try:
+            manifestFile = open(manifestPath, 'r')
+            manifest = json.load(manifestFile)
+            manifestFile.close()
+            for fileName in manifest['removed']:
+                if os.path.exists(os.path.join(workingDirectory, fileName)):
+                    os.remove(os.path.join(workingDirectory, fileName))
+            for fileName in manifest['files']:
+                destination = os.path.join(workingDirectory, fileName)
+                shutil.copyfile(os.path.join(entryDirectory, fileName), destination + '.cache')
+                os.rename(destination + '.cache', destination)
+            for fileName in manifest['files']:
+                if fileName.endswith('.imh'):
+                    # daophot may have written the recording folder into the header
+                    IrafImage.relinkPixelFile(os.path.join(workingDirectory, fileName))
+        except (IOError, OSError, ValueError):
+            # evicted while we were reading it
+            return None
+
+        def touch(index):
+            if key in index['entries']:
+                index['entries'][key][1] = time.time()
+        self._updateIndex(touch)
+        return manifest['returnCode'], manifest['output']
+
+    def store(self, key, command, workingDirectory, changed, removed, returnCode, output, program):
+        '''Keeps the files the run made or changed, then evicts whatever is too old to fit'''
+        entryDirectory = os.path.join(self.entriesDirectory, key)
+        tmpDirectory = entryDirectory + '.' + str(os.getpid()) + '.tmp'
+        if os.path.isdir(tmpDirectory):
+            shutil.rmtree(tmpDirectory)
+        os.mkdir(tmpDirectory)
+        size = len(output)
+        for fileName in changed:
+            shutil.copyfile(os.path.join(workingDirectory, fileName), os.path.join(tmpDirectory, fileName))
+            size += os.path.getsize(os.path.join(tmpDirectory, fileName))
+        manifest = {'program': program, 'returnCode': returnCode, 'output': output, 'files': changed,
+                    'removed': removed, 'stored': time.time(), 'bytes': size}
+        manifestFile = open(os.path.join(tmpDirectory, 'manifest.json'), 'w')
+        json.dump(manifest, manifestFile)
+        manifestFile.close()
+        if os.path.isdir(entryDirectory):
+            shutil.rmtree(entryDirectory, ignore_errors=True)
+        try:
+            os.rename(tmpDirectory, entryDirectory)
+        except OSError:
+            # another worker stored the same run first
+            shutil.rmtree(tmpDirectory, ignore_errors=True)
+
+        evicted = []
+
+        def addAndEvict(index):
+            entries = index['entries']
+            entries[key] = [size, time.time()]
+            index['commands'][command] = sorted(set(index['commands'].get(command, [])) | set(changed) | set(removed))
+            total = sum(entry[0] for entry in entries.values())
+            for oldKey in sorted(entries, key=lambda name: entries[name][1]):
+                if total <= self.maxBytes or oldKey == key:
+                    break
+                total -= entries.pop(oldKey)[0]
+                evicted.append(oldKey)
+        self._updateIndex(addAndEvict)
+        for oldKey in evicted:
+            shutil.rmtree(os.path.join(self.entriesDirectory, oldKey), ignore_errors=True)
+        return
+
+    def usage(self):
+        '''(entries, bytes) in the cache'''
+        entries = self._readIndex()['entries']
+        return len(entries), sum(entry[0] for entry in entries.values())
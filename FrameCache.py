@@ -0,0 +1,232 @@
+# The frames the native steps work on, opened once per process. PsfSelect,
+# PsfBuilder, NativeAllstar, ModelSubtract and TiledAllstar all read
+# ${frame}.imh (and the subtracted frames) again and again; through here the
+# header is parsed and the pixels memory mapped once, and the same array comes
+# back every time after that.
+#
+# Things worked out from a frame are kept too (products):
+#   background   sky level map: sigma clipped medians in backgroundBox pixel
+#                boxes, interpolated between the box centers
+#   noise        expected noise of each pixel from the background, in ADU
+#   saturation   pixels at or above highBad
+#   detection    background subtracted frame smoothed with a gaussian of the
+#                FWHM, what FIND looks for peaks in
+#
+# Everything is keyed by the file's identity (path, inode, size and mtime of
+# the .imh and the .pix, or the .pix's archive), so a frame that gets written again is read again
+# and its old products are dropped. The least recently used entries go when
+# the cache is over maxBytes. One cache per process: pool workers inherit
+# what the parent had when they were forked.
+
+import os
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+import Archive
+import IrafImage
+
+maxBytes = 2 * 1024 ** 3
+maxEntries = 64         # every memory map holds a file open
+backgroundBox = 64
+backgroundClip = 3.0
+
+# {key : (value, bytes)}, least recently used first
+entries = OrderedDict()
+usedBytes = [0]
+counts = {'hits': 0, 'misses': 0, 'evictions': 0}
+# {(path, .imh identity) : .pix path}, so finding the pixel file doesn't parse the header every time
+pixelFiles = {}
+lock = threading.RLock()
+
+
+def setBudget(nBytes):
+    global maxBytes
+    maxBytes = nBytes
+    evict()
+    return
+
+
+def statIdentity(path):
+    stats = os.stat(path)
+    return (stats.st_ino, stats.st_size, stats.st_mtime)
+
+
+def frameIdentity(imhPath):
+    '''(path, .imh identity, .pix identity) of the frame as it is on disk now'''
+    path = os.path.realpath(imhPath)
+    headerIdentity = statIdentity(path)
+    pixPath = pixelFiles.get((path, headerIdentity))
+    if pixPath is None:
+        pixPath = IrafImage.pixelFilePath(IrafImage.readHeader(path))
+        pixelFiles[(path, headerIdentity)] = pixPath
+    # archiving a frame changes its identity, which is fine: it gets read from the archive next time
+    return (path, headerIdentity, statIdentity(Archive.storedPath(pixPath)))
+
+
+def evict():
+    with lock:
+        while entries and (usedBytes[0] > maxBytes or len(entries) > maxEntries):
+            key, (value, nBytes) = entries.popitem(last=False)
+            usedBytes[0] -= nBytes
+            counts['evictions'] += 1
+    return
+
+
+def dropStale(identity):
+    '''Drops everything kept for an older version of the same file'''
+    with lock:
+        for key in [key for key in entries if key[0][0] == identity[0] and key[0] != identity]:
+            value, nBytes = entries.pop(key)
+            usedBytes[0] -= nBytes
+        for key in [key for key in pixelFiles if key[0] == identity[0] and key[1] != identity[1]]:
+            del pixelFiles[key]
+    return
+
+
+def cached(key, compute):
+    '''The value kept for key, or compute() kept for next time'''
+    with lock:
+        if key in entries:
+            # to the back of the line
+            entry = entries.pop(key)
+            entries[key] = entry
+            counts['hits'] += 1
+            return entry[0]
+        counts['misses'] += 1
+    # computed outside the lock so other threads can use the cache meanwhile
+    value = compute()
+    with lock:
+        if key not in entries:
+            entries[key] = (value, value.nbytes)
+            usedBytes[0] += value.nbytes
+        evict()
+    return value
+
+
+def pixels(imhPath):
+    '''IrafImage.readPixels(imhPath), read once (memory mapped, read only)'''
+    identity = frameIdentity(imhPath)
+    dropStale(identity)
+    return cached((identity, 'pixels'), lambda: IrafImage.readPixels(identity[0]))
+
+
+def interpolationWeights(n, nBoxes, box):
+    '''For pixels 0..n-1: the boxes on either side (by their centers) and the weight of the second'''
+    centers = (np.arange(nBoxes) + 0.5) * box - 0.5
+    position = np.clip(np.interp(np.arange(n), centers, np.arange(nBoxes)), 0, nBoxes - 1)
+    low = np.floor(position).astype(int)
+    high = np.minimum(low + 1, nBoxes - 1)
+    return low, high, (position - low).astype(np.float32)
+
+
+def backgroundMap(frame, box=backgroundBox, clipSigma=backgroundClip):
+    nRows, nColumns = frame.shape
+    nBoxRows = -(-nRows // box)
+    nBoxColumns = -(-nColumns // box)
+    padded = np.zeros((nBoxRows * box, nBoxColumns * box), dtype=np.float32) + np.nan
+    padded[:nRows, :nColumns] = frame
+    cells = padded.reshape(nBoxRows, box, nBoxColumns, box).transpose(0, 2, 1, 3).reshape(nBoxRows, nBoxColumns, -1)
+    # stars and cosmic rays out, a couple of times
+    for iteration in range(3):
+        level = np.nanmedian(cells, axis=2)
+        low, high = np.nanpercentile(cells, [15.87, 84.13], axis=2)
+        spread = (high - low) / 2.0
+        with np.errstate(invalid='ignore'):
+            cells = np.where(np.abs(cells - level[:, :, np.newaxis]) <= clipSigma * spread[:, :, np.newaxis], cells,
+                             np.nan)
+    level = np.nanmedian(cells, axis=2)
+    # boxes with nothing left in them (all bad) get the median of the rest
+    if np.isnan(level).any():
+        level[np.isnan(level)] = np.nanmedian(level) if not np.isnan(level).all() else 0.0
+    level = level.astype(np.float32)
+    rowLow, rowHigh, rowWeight = interpolationWeights(nRows, nBoxRows, box)
+    columnLow, columnHigh, columnWeight = interpolationWeights(nColumns, nBoxColumns, box)
+    byColumn = level[:, columnLow] * (1 - columnWeight) + level[:, columnHigh] * columnWeight
+    return (byColumn[rowLow] * (1 - rowWeight)[:, np.newaxis] + byColumn[rowHigh] * rowWeight[:, np.newaxis])
+
+
+def noiseMap(background, gain, readNoise):
+    '''ADU, the same noise NativeAllstar and PsfBuilder weight with'''
+    return np.sqrt(readNoise ** 2 + np.maximum(background, 0.0) / gain).astype(np.float32)
+
+
+def gaussianKernel(fwhm):
+    sigma = fwhm / 2.3548
+    offsets = np.arange(-int(np.ceil(2 * sigma)), int(np.ceil(2 * sigma)) + 1)
+    kernel = np.exp(-0.5 * (offsets / sigma) ** 2)
+    return kernel / kernel.sum()
+
+
+def detectionImage(frame, background, fwhm):
+    '''FIND convolves with a lowered gaussian (zero sum, so the sky drops out); here the sky is
+    taken off first and the gaussian goes along rows and then columns'''
+    kernel = gaussianKernel(fwhm)
+    reach = len(kernel) // 2
+    residual = np.nan_to_num(np.asarray(frame, dtype=np.float32) - background)
+    smoothed = np.zeros(residual.shape, dtype=np.float32)
+    for (i, weight) in enumerate(kernel):
+        shift = i - reach
+        smoothed[:, max(0, -shift):residual.shape[1] - max(0, shift)] += (
+            weight * residual[:, max(0, shift):residual.shape[1] - max(0, -shift)])
+    result = np.zeros(residual.shape, dtype=np.float32)
+    for (i, weight) in enumerate(kernel):
+        shift = i - reach
+        result[max(0, -shift):residual.shape[0] - max(0, shift)] += (
+            weight * smoothed[max(0, shift):residual.shape[0] - max(0, -shift)])
+    return result
+
+
+def background(imhPath, box=backgroundBox):
+    identity = frameIdentity(imhPath)
+    dropStale(identity)
+    return cached((identity, 'background', box), lambda: backgroundMap(pixels(imhPath), box))
+
+
+def noise(imhPath, gain, readNoise, box=backgroundBox):
+    identity = frameIdentity(imhPath)
+    dropStale(identity)
+    return cached((identity, 'noise', gain, readNoise, box),
+                  lambda: noiseMap(background(imhPath, box), gain, readNoise))
+
+
+def saturation(imhPath, highBad):
+    identity = frameIdentity(imhPath)
+    dropStale(identity)
+    return cached((identity, 'saturation', highBad), lambda: pixels(imhPath) >= highBad)
+
+
+def detection(imhPath, fwhm, box=backgroundBox):
+    identity = frameIdentity(imhPath)
+    dropStale(identity)
+    return cached((identity, 'detection', fwhm, box),
+                  lambda: detectionImage(pixels(imhPath), background(imhPath, box), fwhm))
+
+
+def forget(path=None):
+    '''Drops a frame (its .imh or .pix), or every frame in a folder, or with None everything. Call
+    it before deleting frames: a memory map keeps a deleted file's space in use until it's closed.'''
+    with lock:
+        if path is not None:
+            path = os.path.realpath(path)
+            if path.endswith('.pix'):
+                path = path[:-len('.pix')] + '.imh'
+
+        def matches(framePath):
+            return path is None or framePath == path or framePath.startswith(path.rstrip('/') + '/')
+        for key in [key for key in entries if matches(key[0][0])]:
+            value, nBytes = entries.pop(key)
+            usedBytes[0] -= nBytes
+        for key in [key for key in pixelFiles if matches(key[0])]:
+            del pixelFiles[key]
+    return
+
+
+def usage():
+    '''{'entries', 'bytes', 'hits', 'misses', 'evictions'}'''
+    with lock:
+        report = dict(counts)
+        report['entries'] = len(entries)
+        report['bytes'] = usedBytes[0]
+    return report
@@ -0,0 +1,285 @@
+# The aperture correction without looking at apcorrplot. apcorrHDI.scr measures
+# the bright stars in the 12 apertures of apcorr.opt (4 to 36 px) on a frame
+# with everything else subtracted, ap_plot.e and sm plot the growth curves, and
+# somebody picks the aperture where they flatten out before compapcorrHDI.e
+# compares that aperture with the allstar magnitudes. Here all of it is done on
+# the (stars x apertures) magnitude array of the .ap file:
+#   - each star's growth curve is its magnitude in every aperture minus the
+#     one in the biggest aperture
+#   - stars whose curve is off the median curve by more than clipSigma robust
+#     sigmas (a leftover neighbor, a cosmic ray, a bad sky) are thrown out
+#   - the others are averaged weighted by their errors, so the faint stars count
+#     for little instead of being left out: in the big apertures even the bright
+#     stars are measured worse than maxError
+#   - the aperture is the smallest one from which the curve is flat, as far out
+#     as it is measured to better than convergence: every step out to the next
+#     aperture, and all of them together, are smaller than convergence. If the
+#     curve is still rising there, or isn't measured that well even between the
+#     smallest apertures, there is no correction
+#   - the correction is aperture magnitude minus allstar magnitude (from
+#     edt${frame}.als2) in that aperture, fitted as C0 + CX x + CY y (like
+#     compapcorr's r, x and y fits) with sigma clipping, and the coefficient
+#     errors from the fit
+# The result goes in apcorr.coef for ApplyApcorr, and growth.txt has the
+# curve and what was picked.
+#
+#   python GrowthCurve.py /data/n2158_phot/n2158/ [frame ...]
+
+import multiprocessing
+import os
+import sys
+
+import numpy as np
+
+import ApplyApcorr
+import Artifacts
+import DaoCatalog
+import OptionFiles
+
+apertureKeys = ['A1', 'A2', 'A3', 'A4', 'A5', 'A6', 'A7', 'A8', 'A9', 'AA', 'AB', 'AC']
+clipSigma = 4.0         # growth curves further than this many sigmas from the median are thrown out
+offsetClipSigma = 3.0   # and so are aperture - allstar differences, in the correction fit
+convergence = 0.01      # mag, the curve has converged when it rises less than this further out
+maxError = 0.05         # mag, stars with a bigger error in the chosen aperture aren't used
+minimumStars = 5
+minimumSpatialStars = 15  # fewer than this only get the constant term
+
+
+def apertureRadii(optPath):
+    '''The aperture radii from apcorr.opt, in order'''
+    options = OptionFiles.readOptionFile(optPath)
+    return [options[key] for key in apertureKeys if key in options]
+
+
+def robustSigma(values, axis=0):
+    '''1.4826 x median absolute deviation, ignoring NaN'''
+    median = np.nanmedian(values, axis=axis)
+    return 1.4826 * np.nanmedian(np.abs(values - np.expand_dims(median, axis)), axis=axis)
+
+
+def growthCurves(mag, err):
+    '''Each star's magnitude in every aperture minus the one in the biggest aperture, NaN where
+    daophot couldn't measure it. Returns (curves, their errors).'''
+    bad = (mag >= DaoCatalog.badMagnitude - 1) | (err >= 9.0) | ~np.isfinite(mag)
+    mag = np.where(bad, np.nan, mag)
+    err = np.where(bad, np.nan, err)
+    curves = mag - mag[:, -1:]
+    curveErrors = np.sqrt(err ** 2 + err[:, -1:] ** 2)
+    curveErrors[:, -1] = 0.0
+    return curves, curveErrors
+
+
+def rejectOutliers(curves, curveErrors, iterations=3):
+    '''Stars whose growth curve is like the others: at most clipSigma robust sigmas (or their own
+    errors, whichever is bigger) from the median curve in every aperture'''
+    # stars daophot couldn't measure in some aperture are out anyway, and nanmax warns on them
+    measured = np.all(np.isfinite(curves), axis=1)
+    keep = measured
+    for iteration in range(iterations):
+        if keep.sum() < minimumStars:
+            break
+        median = np.median(curves[keep], axis=0)
+        sigma = np.maximum(robustSigma(curves[keep]), np.median(curveErrors[keep], axis=0))
+        # the biggest aperture is 0 by definition
+        sigma = np.maximum(sigma, 1e-4)
+        deviation = np.abs(curves[measured] - median) / np.maximum(sigma, curveErrors[measured])
+        newKeep = measured.copy()
+        newKeep[measured] = np.max(deviation, axis=1) <= clipSigma
+        if (newKeep == keep).all():
+            break
+        keep = newKeep
+    return keep
+
+
+def weightedMean(values, errors):
+    '''Mean of the columns of values weighted by 1 / errors**2, and its error, scaled up when the
+    stars scatter more than their errors say'''
+    weights = 1.0 / np.maximum(errors, 0.005) ** 2
+    mean = np.sum(weights * values, axis=0) / np.sum(weights, axis=0)
+    scatter = np.sqrt(np.sum(weights * (values - mean) ** 2, axis=0) / max(len(values) - 1, 1))
+    return mean, np.maximum(scatter, 1.0) / np.sqrt(np.sum(weights, axis=0))
+
+
+def convergedAperture(mag, err, keep):
+    '''Index of the smallest aperture from which the growth curve is flat, as far out as the steps
+    between apertures are measured to better than convergence: each step and their sum less than
+    convergence. Returns it with the weighted curve (minus the biggest aperture) and its errors.
+    The index is None when the curve is still rising, or when not even the first step is measured
+    well enough to tell.'''
+    curve, curveError = weightedMean(*growthCurves(mag[keep], err[keep]))
+    steps, stepErrors = weightedMean(np.diff(mag[keep], axis=1),
+                                     np.sqrt(err[keep, 1:] ** 2 + err[keep, :-1] ** 2))
+    # the steps out to the first one that isn't known well enough
+    measured = int(np.argmin(np.append(stepErrors <= convergence, False)))
+    for aperture in range(measured):
+        if np.all(np.abs(steps[aperture:measured]) <= convergence) and \
+                abs(np.sum(steps[aperture:measured])) <= convergence:
+            return aperture, curve, curveError
+    return None, curve, curveError
+
+
+def fitOffset(difference, errors, x, y, order=1):
+    '''Fits difference (aperture - allstar) as C0 (+ CX x + CY y) with sigma clipping. Returns
+    ({coefficient : value, 'E' + coefficient : error}, stars used).'''
+    names = ['C0', 'CX', 'CY'] if order >= 1 else ['C0']
+    design = np.column_stack([np.ones(len(difference)), x, y])[:, :len(names)]
+    weights = 1.0 / np.maximum(errors, 0.005) ** 2
+    # start from the median, so one bad star doesn't pull the first fit
+    use = np.abs(difference - np.median(difference)) <= clipSigma * max(robustSigma(difference), 0.005)
+    for iteration in range(10):
+        weightedDesign = design[use] * weights[use][:, np.newaxis]
+        normal = design[use].T.dot(weightedDesign)
+        solution = np.linalg.solve(normal, weightedDesign.T.dot(difference[use]))
+        residual = difference - design.dot(solution)
+        scatter = np.sqrt(np.sum(weights[use] * residual[use] ** 2) / max(use.sum() - len(names), 1))
+        newUse = np.abs(residual) * np.sqrt(weights) <= offsetClipSigma * max(scatter, 1.0)
+        if (newUse == use).all() or newUse.sum() < len(names) + 2:
+            break
+        use = newUse
+    # errors scaled up when the stars scatter more than their errors say
+    covariance = np.linalg.inv(normal) * max(scatter, 1.0) ** 2
+    coefficients = {}
+    for (i, name) in enumerate(names):
+        coefficients[name] = float(solution[i])
+        coefficients['E' + name] = float(np.sqrt(covariance[i, i]))
+    return coefficients, use
+
+
+def measure(apColumns, alsColumns, radii=None, order=1):
+    '''Growth curves, aperture and correction from the .ap columns (mag and err are stars x
+    apertures) and the allstar columns of the same stars. Returns a result dictionary, with
+    'error' set instead when it can't be done.'''
+    ids, apIndex, alsIndex = np.intersect1d(apColumns['id'], alsColumns['id'], return_indices=True)
+    mag = apColumns['mag'][apIndex]
+    err = apColumns['err'][apIndex]
+    if radii is None or len(radii) != mag.shape[1]:
+        radii = range(1, mag.shape[1] + 1)
+    result = {'stars': len(ids), 'radii': list(radii)}
+    if len(ids) < minimumStars:
+        result['error'] = '%d stars are in both catalogs, need %d' % (len(ids), minimumStars)
+        return result
+
+    curves, curveErrors = growthCurves(mag, err)
+    keep = rejectOutliers(curves, curveErrors)
+    result['rejected'] = int(len(ids) - keep.sum())
+    if keep.sum() < minimumStars:
+        result['error'] = 'only %d stars have a normal growth curve' % keep.sum()
+        return result
+    aperture, curve, curveError = convergedAperture(mag, err, keep)
+    result.update(aperture=aperture, curve=curve.tolist(), curveError=curveError.tolist())
+    if aperture is None:
+        result['error'] = 'the growth curve doesn\'t flatten out to %.3f mag where it is measured that well' % \
+            convergence
+        return result
+    result['radius'] = float(radii[aperture])
+
+    alsMag = alsColumns['mag'][alsIndex]
+    good = (keep & (err[:, aperture] < maxError) & (alsMag < DaoCatalog.badMagnitude - 1))
+    if good.sum() < minimumStars:
+        result['error'] = 'only %d stars are good enough in aperture %d' % (good.sum(), aperture + 1)
+        return result
+    difference = mag[good, aperture] - alsMag[good]
+    errors = np.sqrt(err[good, aperture] ** 2 + alsColumns['err'][alsIndex][good] ** 2)
+    if good.sum() < minimumSpatialStars:
+        order = 0
+    coefficients, used = fitOffset(difference, errors, apColumns['x'][apIndex][good], apColumns['y'][apIndex][good],
+                                   order)
+    result.update(coefficients=coefficients, used=int(used.sum()), clipped=int(len(used) - used.sum()),
+                  scatter=float(robustSigma(difference[used])))
+    return result
+
+
+def formatReport(frame, result):
+    lines = ['growth curve of ' + frame + ': %d stars, %d with an odd curve' % (result['stars'],
+                                                                               result.get('rejected', 0))]
+    if 'curve' in result:
+        lines.append('  radius    curve   +/-   (minus the biggest aperture)')
+        for (i, radius) in enumerate(result['radii']):
+            marker = '  <- aperture' if i == result['aperture'] else ''
+            lines.append('  %6.1f  %7.4f  %6.4f%s' % (radius, result['curve'][i], result['curveError'][i], marker))
+    if 'error' in result:
+        lines.append('no correction: ' + result['error'])
+    else:
+        coefficients = result['coefficients']
+        lines.append('correction from %d stars (%d clipped), scatter %.3f mag' % (result['used'], result['clipped'],
+                                                                                  result['scatter']))
+        for name in ['C0', 'CX', 'CY']:
+            if name in coefficients:
+                lines.append('  %-3s = %11.4e +/- %.2e' % (name, coefficients[name], coefficients['E' + name]))
+    return '\n'.join(lines) + '\n'
+
+
+def measureFrame(frameDirectory, frame=None, apName='apcorr.apfull', alsName=None, order=1):
+    '''Measures one frame's correction and writes apcorr.coef (ApplyApcorr) and growth.txt.
+    apcorr.ap is used if there is no apcorr.apfull. The allstar magnitudes come from
+    edt${frame}.als2 by default; apcorr.als is what apstar.e left to subtract, the neighbors and
+    not the apcorr stars. Returns the result (see measure).'''
+    frame = frame or os.path.basename(os.path.normpath(frameDirectory))
+    alsName = alsName or 'edt' + frame + '.als2'
+    if not os.path.exists(os.path.join(frameDirectory, apName)):
+        apName = 'apcorr.ap'
+    header, apColumns = DaoCatalog.readCatalog(os.path.join(frameDirectory, apName), 'ap')
+    alsHeader, alsColumns = DaoCatalog.readCatalog(os.path.join(frameDirectory, alsName), 'als')
+    radii = None
+    if os.path.exists(os.path.join(frameDirectory, 'apcorr.opt')):
+        radii = apertureRadii(os.path.join(frameDirectory, 'apcorr.opt'))
+    result = measure(apColumns, alsColumns, radii, order)
+    result['frame'] = frame
+    reportFile = open(os.path.join(frameDirectory, 'growth.txt'), 'w')
+    reportFile.write(formatReport(frame, result))
+    reportFile.close()
+    if 'error' not in result:
+        ApplyApcorr.writeCoefficients(os.path.join(frameDirectory, ApplyApcorr.coefficientFile),
+                                      result['coefficients'])
+    return result
+
+
+def growthCurveStep(frame, order=1):
+    '''StepGraph function: the correction from apcorr.apfull and edt${frame}.als2'''
+    def runGrowthCurve(workingDirectory):
+        result = measureFrame(workingDirectory, frame, order=order)
+        if 'error' in result:
+            raise ValueError(result['error'])
+        return formatReport(frame, result)
+    return runGrowthCurve
+
+
+def measureFrameJob(arguments):
+    dataSetDirectory, frame = arguments
+    frameDirectory = os.path.join(dataSetDirectory, frame)
+    if not os.path.exists(os.path.join(frameDirectory, 'apcorr.apfull')) and \
+            not os.path.exists(os.path.join(frameDirectory, 'apcorr.ap')):
+        return None
+    try:
+        return measureFrame(frameDirectory, frame)
+    except (IOError, ValueError, np.linalg.LinAlgError), e:
+        return {'frame': frame, 'error': str(e)}
+
+
+def measureDataSet(dataSetDirectory, frames=None, processes=None):
+    '''Measures every frame that has its apcorr photometry, in a worker pool. Returns
+    {frame : result} for the frames that had it.'''
+    if frames is None:
+        frames = Artifacts.frameNames(dataSetDirectory)
+    pool = multiprocessing.Pool(processes)
+    try:
+        results = pool.map(measureFrameJob, [(dataSetDirectory, frame) for frame in frames])
+    finally:
+        pool.close()
+        pool.join()
+    return dict((result['frame'], result) for result in results if result is not None)
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2:
+        print 'usage: python GrowthCurve.py dataSetDirectory [frame ...]'
+        sys.exit(1)
+    results = measureDataSet(sys.argv[1], sys.argv[2:] or None)
+    for frameName in sorted(results):
+        result = results[frameName]
+        if 'error' in result:
+            print '%-10s no correction: %s' % (frameName, result['error'])
+        else:
+            print '%-10s aperture %4.1f px, C0 %7.3f +/- %.3f from %d stars' % (
+                frameName, result['radius'], result['coefficients']['C0'], result['coefficients']['EC0'],
+                result['used'])
@@ -24,3 +24,14 @@ def beep():
     sys.stdout.write("\a\a\a\a\a")
 
     return None
+
+def processAlive(pid):
+    '''True if a process with this pid is running on this machine'''
+    import errno
+    import os
+    try:
+        os.kill(pid, 0)
+    except OSError, e:
+        # EPERM: it's there, just not ours
+        return e.errno == errno.EPERM
+    return True
@@ -0,0 +1,227 @@
+# Small reader for the IRAF .imh/.pix (OIF) image format. Only the
+# machine-independent version 2 header ("imhv2") is understood. If you have
+# an old version 1 header, run it through imcopy once and it will be written
+# as version 2.
+
+import os
+import struct
+
+import numpy as np
+
+import Archive
+
+imhMagic = 'imhv2'
+
+# byte offsets into the version 2 header (see imhv2.h in the iraf source)
+imhOffsets = {'hdrlen': 12,
+              'pixtype': 16,
+              'swapped': 20,
+              'ndim': 24,
+              'len': 28,
+              'physlen': 56,
+              'pixoff': 92,
+              'pixfile': 132,
+              'hdrfile': 388,
+              'title': 644,
+              'userarea': 1236}
+pixFileLength = 255
+
+# iraf pixel type codes
+pixelTypes = {3: 'i2', 4: 'i4', 5: 'i4', 6: 'f4', 7: 'f8', 11: 'u2'}
+
+
+def readHeader(imhPath):
+    '''Returns a dictionary with the interesting parts of a .imh header'''
+    headerFile = open(imhPath, 'rb')
+    data = headerFile.read()
+    headerFile.close()
+
+    if data[:len(imhMagic)] != imhMagic:
+        raise IOError(imhPath + ' is not a version 2 iraf header')
+
+    header = {}
+    for key in ['hdrlen', 'pixtype', 'swapped', 'ndim', 'pixoff']:
+        header[key] = struct.unpack('>i', data[imhOffsets[key]:imhOffsets[key] + 4])[0]
+    header['len'] = list(struct.unpack('>7i', data[imhOffsets['len']:imhOffsets['len'] + 28]))
+    header['physlen'] = list(struct.unpack('>7i', data[imhOffsets['physlen']:imhOffsets['physlen'] + 28]))
+    start = imhOffsets['pixfile']
+    header['pixfile'] = data[start:start + pixFileLength].split('\0')[0]
+    header['path'] = imhPath
+    return header
+
+
+def readKeywords(imhPath):
+    '''The keywords in the user area of a .imh header (the FITS cards iraf keeps there), as
+    {keyword : value}. String values lose their quotes, and comments are dropped.'''
+    headerFile = open(imhPath, 'rb')
+    data = headerFile.read()
+    headerFile.close()
+    if data[:len(imhMagic)] != imhMagic:
+        raise IOError(imhPath + ' is not a version 2 iraf header')
+    keywords = {}
+    # 80 character cards, each ended by a newline, up to the first null
+    for card in data[imhOffsets['userarea']:].split('\0')[0].split('\n'):
+        if card[8:10] != '= ':
+            continue
+        value = card[10:].strip()
+        if value.startswith("'"):
+            value = value[1:].split("'", 1)[0].strip()
+        else:
+            value = value.split('/', 1)[0].strip()
+        keywords[card[:8].strip()] = value
+    return keywords
+
+
+def pixelFilePath(header):
+    '''Works out where the .pix file for a header actually is. 'HDR$' means
+    "next to the header", and 'node!' prefixes are dropped.'''
+    pixFile = header['pixfile']
+    headerDirectory = os.path.dirname(os.path.abspath(header['path']))
+    if '!' in pixFile:
+        pixFile = pixFile.split('!', 1)[1]
+    if pixFile.startswith('HDR$'):
+        return os.path.join(headerDirectory, pixFile[4:])
+    if os.path.isabs(pixFile) and Archive.exists(pixFile):
+        return pixFile
+    # stale absolute path (the frame got moved or copied). Assume it sits next to the header
+    return os.path.join(headerDirectory, os.path.basename(pixFile))
+
+
+def relinkPixelFile(imhPath):
+    '''Points a header at the .pix file sitting next to it ('HDR$name.pix').
+    Needed after an image is copied out of a scratch directory, since daophot
+    may have written the scratch path into the header.'''
+    header = readHeader(imhPath)
+    newName = 'HDR$' + os.path.basename(pixelFilePath(header))
+    if newName == header['pixfile']:
+        return False
+
+    headerFile = open(imhPath, 'r+b')
+    headerFile.seek(imhOffsets['pixfile'])
+    headerFile.write(newName + '\0' * (pixFileLength - len(newName)))
+    headerFile.close()
+    return True
+
+
+def readPixels(imhPath, memoryMap=True):
+    '''The pixels of a 2d image as a (rows, columns) numpy array, so pixel (x, y) in daophot
+    coordinates is pixels[y - 1, x - 1]. The array is memory mapped (read only) unless
+    memoryMap is False, so nothing is read until it is used.'''
+    header = readHeader(imhPath)
+    if header['pixtype'] not in pixelTypes:
+        raise IOError('Unsupported pixel type %d in %s' % (header['pixtype'], imhPath))
+    # iraf says "swapped" when the pixels aren't in the big endian (MII) order
+    byteOrder = '<' if header['swapped'] else '>'
+    dtype = np.dtype(byteOrder + pixelTypes[header['pixtype']])
+    nColumns, nRows = header['len'][0], max(header['len'][1], 1)
+    physicalColumns = header['physlen'][0]
+    # pixoff counts 2 byte chars, starting at 1
+    offset = (header['pixoff'] - 1) * 2
+    shape = (nRows, physicalColumns)
+    pixPath = pixelFilePath(header)
+    if Archive.isArchived(pixPath):
+        # an archived frame can't be mapped, so it is unpacked into memory
+        data = Archive.readBytes(pixPath, offset, nRows * physicalColumns * dtype.itemsize)
+        pixels = np.frombuffer(data, dtype=dtype).reshape(shape)
+        if not memoryMap:
+            pixels = pixels.copy()
+    elif memoryMap:
+        pixels = np.memmap(pixPath, dtype=dtype, mode='r', offset=offset, shape=shape)
+    else:
+        pixelFile = open(pixPath, 'rb')
+        pixelFile.seek(offset)
+        pixels = np.fromfile(pixelFile, dtype=dtype, count=nRows * physicalColumns).reshape(shape)
+        pixelFile.close()
+    return pixels[:, :nColumns]
+
+
+def stamps(pixels, x, y, radius):
+    '''Square cutouts (2 radius + 1 on a side) centered on the nearest pixel to each (x, y), all in one
+    go, as a (stars, side, side) float array. Pixels off the edge of the image are NaN.'''
+    side = 2 * radius + 1
+    centerColumns = np.rint(np.asarray(x) - 1).astype(int)
+    centerRows = np.rint(np.asarray(y) - 1).astype(int)
+    offsets = np.arange(-radius, radius + 1)
+    rows = centerRows[:, np.newaxis, np.newaxis] + offsets[np.newaxis, :, np.newaxis]
+    columns = centerColumns[:, np.newaxis, np.newaxis] + offsets[np.newaxis, np.newaxis, :]
+    rows, columns = np.broadcast_arrays(rows, columns)
+    inside = (rows >= 0) & (rows < pixels.shape[0]) & (columns >= 0) & (columns < pixels.shape[1])
+    cutouts = np.zeros((len(centerRows), side, side)) + np.nan
+    cutouts[inside] = pixels[rows[inside], columns[inside]]
+    return cutouts
+
+
+def imageHeaders(pixPath, nRows, nColumns, templateImhPath=None, title=''):
+    '''(.imh header, .pix header) for a real (float32) image with its pixels in pixPath. With a
+    template, its header (user area and all) and pixel file header are copied and only the size,
+    type and file names are changed, so iraf and daophot see the same keywords as on the
+    original frame.'''
+    if templateImhPath is not None:
+        templateFile = open(templateImhPath, 'rb')
+        headerData = bytearray(templateFile.read())
+        templateFile.close()
+        template = readHeader(templateImhPath)
+        pixOffsetBytes = (template['pixoff'] - 1) * 2
+        templatePixels = Archive.openFile(pixelFilePath(template), 'rb')
+        pixHeader = bytearray(templatePixels.read(pixOffsetBytes))
+        templatePixels.close()
+    else:
+        headerData = bytearray(2048)
+        headerData[0:len(imhMagic)] = imhMagic
+        headerData[imhOffsets['hdrlen']:imhOffsets['hdrlen'] + 4] = struct.pack('>i', 2048 / 4)
+        pixOffsetBytes = 1024
+        pixHeader = bytearray(pixOffsetBytes)
+        pixHeader[0:5] = 'impv2'
+
+    headerData[imhOffsets['pixtype']:imhOffsets['pixtype'] + 4] = struct.pack('>i', 6)
+    headerData[imhOffsets['swapped']:imhOffsets['swapped'] + 4] = struct.pack('>i', int(np.little_endian))
+    headerData[imhOffsets['ndim']:imhOffsets['ndim'] + 4] = struct.pack('>i', 2)
+    dimensions = struct.pack('>7i', nColumns, nRows, 1, 1, 1, 1, 1)
+    headerData[imhOffsets['len']:imhOffsets['len'] + 28] = dimensions
+    headerData[imhOffsets['physlen']:imhOffsets['physlen'] + 28] = dimensions
+    headerData[imhOffsets['pixoff']:imhOffsets['pixoff'] + 4] = struct.pack('>i', pixOffsetBytes / 2 + 1)
+    pixName = 'HDR$' + os.path.basename(pixPath)
+    headerData[imhOffsets['pixfile']:imhOffsets['pixfile'] + pixFileLength] = pixName + '\0' * (pixFileLength - len(pixName))
+    if title or templateImhPath is None:
+        headerData[imhOffsets['title']:imhOffsets['title'] + 80] = title[:79] + '\0' * (80 - len(title[:79]))
+    return headerData, pixHeader
+
+
+def writeImage(imhPath, pixels, templateImhPath=None, title=''):
+    '''Writes a 2d array as a real (float32) .imh/.pix pair next to each other ('HDR$name.pix'),
+    with the template's header if there is one (see imageHeaders).'''
+    pixels = np.asarray(pixels, dtype=np.float32)
+    nRows, nColumns = pixels.shape
+    pixPath = os.path.splitext(imhPath)[0] + '.pix'
+    headerData, pixHeader = imageHeaders(pixPath, nRows, nColumns, templateImhPath, title)
+
+    # pixels first, then the header, so a header never points at a pixel file that isn't there yet
+    pixelFile = open(pixPath + '.tmp', 'wb')
+    pixelFile.write(pixHeader)
+    pixels.tofile(pixelFile)
+    pixelFile.close()
+    os.rename(pixPath + '.tmp', pixPath)
+    headerFile = open(imhPath + '.tmp', 'wb')
+    headerFile.write(headerData)
+    headerFile.close()
+    os.rename(imhPath + '.tmp', imhPath)
+    return
+
+
+def createImage(imhPath, shape, templateImhPath=None, title=''):
+    '''Makes a real (float32) .imh/.pix pair of shape (rows, columns) and returns its pixels as a
+    writable memory map, so a frame can be computed straight into the file instead of in memory
+    and then written. The pixels start at zero. Call flush() on the map when done.'''
+    nRows, nColumns = shape
+    pixPath = os.path.splitext(imhPath)[0] + '.pix'
+    headerData, pixHeader = imageHeaders(pixPath, nRows, nColumns, templateImhPath, title)
+    pixelFile = open(pixPath, 'wb')
+    pixelFile.write(pixHeader)
+    # sparse where the file system allows it: nothing is written until the pixels are
+    pixelFile.truncate(len(pixHeader) + nRows * nColumns * 4)
+    pixelFile.close()
+    headerFile = open(imhPath + '.tmp', 'wb')
+    headerFile.write(headerData)
+    headerFile.close()
+    os.rename(imhPath + '.tmp', imhPath)
+    return np.memmap(pixPath, dtype=np.float32, mode='r+', offset=len(pixHeader), shape=(nRows, nColumns))
@@ -0,0 +1,227 @@
+# Keeps the external programs that run at the same time within the memory of
+# the machine. allstar8192 sizes its arrays for images up to 8192x8192, and a
+# few copies side by side (a step graph, the tiles of TiledAllstar, two
+# sessions on the same box) push the machine into swap, which is slower than
+# running them one after the other.
+#
+# Before a program starts, its footprint is predicted from the biggest image
+# it reads and the peak memory (rusage maxrss from os.wait4) of its earlier
+# runs, kept in historyPath. It only starts while everything running plus its
+# footprint fits in budgetBytes; otherwise it waits. Whatever is running on
+# the machine is in a ledger file in the temp folder (shared by every process
+# on the machine, locked with flock), so pool workers and other sessions count
+# too. Small programs (dao2iraf.e, sublst.e, ...) fit in the gaps and go ahead
+# while a big one waits. A program that needs more than the whole budget still
+# runs, on its own.
+
+import fcntl
+import json
+import logging
+import os
+import sys
+import tempfile
+import threading
+import time
+
+import numpy as np
+
+import HelperFunctions
+import IrafImage
+
+# pool workers and tool runners call in here, so waits and failures are logged, not printed
+log = logging.getLogger(__name__)
+log.addHandler(logging.NullHandler())
+
+budgetBytes = None  # None is budgetFraction of the physical memory, 0 turns admission control off
+budgetFraction = 0.8
+historyPath = os.path.expanduser('~/.autoreduce_memory.json')
+ledgerPath = os.path.join(tempfile.gettempdir(), 'autoreduce-memory.ledger')
+historyRuns = 20            # runs of each program remembered
+safetyFactor = 1.15         # on top of the predicted footprint
+pollSeconds = 0.25
+
+# footprints for programs that haven't been run here yet: bytes per pixel of their biggest image
+# plus baseBytes. Programs that don't read an image get smallBytes.
+defaultBytesPerPixel = {'allstar8192': 48, 'allstar': 48, 'daophot': 24}
+unknownBytesPerPixel = 16
+baseBytes = 64 * 1024 ** 2
+smallBytes = 32 * 1024 ** 2
+
+
+def setBudget(nBytes):
+    global budgetBytes
+    budgetBytes = nBytes
+    return
+
+
+def physicalMemory():
+    try:
+        return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES')
+    except (ValueError, OSError, AttributeError):
+        return None
+
+
+def currentBudget():
+    '''Bytes the external programs may use together, or None for no limit'''
+    if budgetBytes is None:
+        total = physicalMemory()
+        return int(total * budgetFraction) if total else None
+    return budgetBytes or None
+
+
+def peakBytes(rusage):
+    '''maxrss is in kilobytes on Linux and in bytes on OS X'''
+    if sys.platform == 'darwin':
+        return int(rusage.ru_maxrss)
+    return int(rusage.ru_maxrss) * 1024
+
+
+def imagePixels(fileNames, workingDirectory):
+    '''Pixels in the biggest image among fileNames (0 if there isn't one)'''
+    pixels = 0
+    for fileName in fileNames:
+        if not fileName.endswith('.imh'):
+            continue
+        try:
+            header = IrafImage.readHeader(os.path.join(workingDirectory, fileName))
+        except (IOError, OSError):
+            continue
+        pixels = max(pixels, header['len'][0] * max(header['len'][1], 1))
+    return pixels
+
+
+def updateJson(path, function, default):
+    '''Read-modify-write of a json file under a lock. Returns what function returns.'''
+    lockFile = open(path + '.lock', 'a')
+    fcntl.flock(lockFile, fcntl.LOCK_EX)
+    try:
+        data = default
+        if os.path.exists(path):
+            dataFile = open(path, 'r')
+            try:
+                data = json.load(dataFile)
+            except ValueError:
+                pass
+            dataFile.close()
+        result = function(data)
+        tmpPath = path + '.' + str(os.getpid())
+        dataFile = open(tmpPath, 'w')
+        json.dump(data, dataFile)
+        dataFile.close()
+        os.rename(tmpPath, path)
+    finally:
+        fcntl.flock(lockFile, fcntl.LOCK_UN)
+        lockFile.close()
+    return result
+
+
+def readHistory():
+    '''{program : [[pixels, peak bytes], ...]}'''
+    if not os.path.exists(historyPath):
+        return {}
+    historyFile = open(historyPath, 'r')
+    try:
+        history = json.load(historyFile)
+    except ValueError:
+        history = {}
+    historyFile.close()
+    return history
+
+
+def recordRun(program, pixels, peak):
+    def addRun(history):
+        runs = history.setdefault(os.path.basename(program), [])
+        runs.append([pixels, peak])
+        del runs[:-historyRuns]
+    try:
+        updateJson(historyPath, addRun, {})
+    except (IOError, OSError), e:
+        log.warning('Could not record the memory use of ' + program + ': ' + str(e))
+    return
+
+
+def predictFootprint(program, pixels, history=None):
+    '''Bytes the program is expected to need for an image of this many pixels'''
+    if history is None:
+        history = readHistory()
+    runs = history.get(os.path.basename(program), [])
+    if runs:
+        runPixels = np.array([run[0] for run in runs], dtype=float)
+        peaks = np.array([run[1] for run in runs], dtype=float)
+        if len(set(runPixels)) >= 2:
+            # memory grows with the image: a straight line through the runs
+            slope, intercept = np.polyfit(runPixels, peaks, 1)
+            slope = max(slope, 0.0)
+            predicted = max(intercept + slope * pixels, peaks[runPixels >= pixels].max() if (runPixels >= pixels).any()
+                            else 0.0)
+        else:
+            # one size so far: scale up for bigger images, never down
+            predicted = peaks.max() * max(1.0, float(pixels) / runPixels[0] if runPixels[0] > 0 else 1.0)
+        return int(predicted * safetyFactor)
+    if pixels == 0:
+        return smallBytes
+    return int(baseBytes + defaultBytesPerPixel.get(os.path.basename(program), unknownBytesPerPixel) * pixels)
+
+
+def dropDead(ledger):
+    for (token, entry) in ledger.items():
+        if entry['pid'] != os.getpid() and not HelperFunctions.processAlive(entry['pid']):
+            del ledger[token]
+    return
+
+
+# makes the ledger tokens of this process unique
+tokenCounter = [0]
+tokenLock = threading.Lock()
+
+
+class Admission:
+    '''with Admission(program, nBytes): ... waits until nBytes fit in the budget, holds them
+    in the ledger while the program runs, and gives them back after'''
+
+    def __init__(self, program, nBytes):
+        self.program = os.path.basename(program)
+        self.nBytes = nBytes
+        with tokenLock:
+            tokenCounter[0] += 1
+            self.token = '%d.%d' % (os.getpid(), tokenCounter[0])
+        self.waited = 0.0
+
+    def _tryAdmit(self, ledger):
+        dropDead(ledger)
+        budget = currentBudget()
+        used = sum(entry['bytes'] for entry in ledger.values())
+        # with nothing else running it goes, however big it is, or it would never run
+        if budget is not None and ledger and used + self.nBytes > budget:
+            return used
+        ledger[self.token] = {'pid': os.getpid(), 'bytes': self.nBytes, 'program': self.program,
+                              'since': time.time()}
+        return None
+
+    def __enter__(self):
+        if currentBudget() is None:
+            return self
+        started = time.time()
+        told = False
+        while True:
+            used = updateJson(ledgerPath, self._tryAdmit, {})
+            if used is None:
+                break
+            if not told:
+                log.info('%s waits for memory: needs %.0f MB, %.0f of %.0f MB in use', self.program,
+                         self.nBytes / 1024.0 ** 2, used / 1024.0 ** 2, currentBudget() / 1024.0 ** 2)
+                told = True
+            time.sleep(pollSeconds)
+        self.waited = time.time() - started
+        return self
+
+    def __exit__(self, kind, value, traceback):
+        if currentBudget() is not None:
+            updateJson(ledgerPath, lambda ledger: ledger.pop(self.token, None), {})
+        return False
+
+
+def running():
+    '''What the ledger says is running on this machine: [{'program', 'bytes', 'pid', 'since'}]'''
+    ledger = updateJson(ledgerPath, lambda ledger: dropDead(ledger) or dict(ledger), {})
+    return sorted(ledger.values(), key=lambda entry: entry['since'])
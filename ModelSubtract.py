@@ -0,0 +1,108 @@
+# Drawing PSF stars into a frame and taking them out again (daophot's SUBSTAR
+# and the subtracted frames allstar writes), thousands of stars at a time.
+#
+# Stars are sorted by y and handled in chunks. A chunk's stamps come from one
+# DaoPsf.evaluate call and are scatter-added (np.bincount) into a buffer that
+# only covers the rows the chunk touches, which then goes onto the frame in
+# one slice. The frame can be an array in memory or a writable memory map
+# (IrafImage.createImage), so a subtracted frame is computed straight into its
+# file.
+
+import os
+
+import numpy as np
+
+import DaoCatalog
+import DaoPsf
+import FrameCache
+import IrafImage
+
+chunkStars = 2000   # stars whose stamps are made at once
+bandRows = 256      # and how far apart in y they may be, so the buffer stays small
+
+
+def addStars(frame, psf, x, y, scale, sign=1.0):
+    '''Adds sign x scale x PSF of every star (out to the PSF radius) to frame, a 2d float array
+    or memory map, in place'''
+    x = np.asarray(x, dtype=float)
+    y = np.asarray(y, dtype=float)
+    scale = np.asarray(scale, dtype=float)
+    nRows, nColumns = frame.shape
+    radius = int(psf.radius) + 1
+    offsets = np.arange(-radius, radius + 1)
+    # only the pixels any star on its nearest pixel can reach: the PSF is zero past its radius
+    stampRows, stampColumns = np.meshgrid(offsets, offsets, indexing='ij')
+    reached = np.hypot(stampRows, stampColumns) <= psf.radius + 0.75
+    stampRows = stampRows[reached]
+    stampColumns = stampColumns[reached]
+    order = np.argsort(y, kind='mergesort')
+    sortedY = y[order]
+    start = 0
+    while start < len(order):
+        end = min(start + chunkStars, np.searchsorted(sortedY, sortedY[start] + bandRows, 'right'))
+        end = max(end, start + 1)
+        chunk = order[start:end]
+        start = end
+
+        columns = np.rint(x[chunk] - 1).astype(int)[:, np.newaxis] + stampColumns
+        rows = np.rint(y[chunk] - 1).astype(int)[:, np.newaxis] + stampRows
+        stamps = psf.evaluate(columns + 1 - x[chunk][:, np.newaxis], rows + 1 - y[chunk][:, np.newaxis],
+                              x[chunk], y[chunk]) * (sign * scale[chunk])[:, np.newaxis]
+        inside = (rows >= 0) & (rows < nRows) & (columns >= 0) & (columns < nColumns)
+        if not inside.any():
+            continue
+        firstRow = rows[inside].min()
+        lastRow = rows[inside].max()
+        band = np.bincount((rows[inside] - firstRow) * nColumns + columns[inside], weights=stamps[inside],
+                           minlength=(lastRow - firstRow + 1) * nColumns)
+        frame[firstRow:lastRow + 1] += band.reshape(lastRow - firstRow + 1, nColumns).astype(frame.dtype)
+    return frame
+
+
+def renderModel(shape, psf, x, y, scale, out=None):
+    '''Frame (float32) of just the stars. out can be an array or memory map to draw into.'''
+    if out is None:
+        out = np.zeros(shape, dtype=np.float32)
+    else:
+        out[:] = 0.0
+    return addStars(out, psf, x, y, scale)
+
+
+def subtractStars(pixels, psf, x, y, scale, out=None):
+    '''pixels minus the stars, as a new float32 frame or into out (an array or a memory map from
+    IrafImage.createImage; out can be pixels itself)'''
+    if out is None:
+        out = np.array(pixels, dtype=np.float32)
+    elif out is not pixels:
+        out[:] = pixels
+    return addStars(out, psf, x, y, scale, -1.0)
+
+
+def subtractCatalog(workingDirectory, imageName, psfName, catalogName, outputName, exceptName=None):
+    '''daophot's SUBSTAR: every star in catalogName (except the ones whose ids are in exceptName)
+    taken out of imageName.imh with the PSF, into outputName.imh. The result is computed straight
+    into the new file.'''
+    imhPath = os.path.join(workingDirectory, imageName + '.imh')
+    outputPath = os.path.join(workingDirectory, outputName + '.imh')
+    psf = DaoPsf.readPsf(os.path.join(workingDirectory, psfName))
+    header, stars = DaoCatalog.readCatalog(os.path.join(workingDirectory, catalogName))
+    mag = stars['mag'][:, 0] if stars['mag'].ndim == 2 else stars['mag']
+    use = mag < DaoCatalog.badMagnitude - 0.001
+    if exceptName:
+        exceptHeader, exceptStars = DaoCatalog.readCatalog(os.path.join(workingDirectory, exceptName))
+        use &= ~np.in1d(stars['id'], exceptStars['id'])
+    scale = 10.0 ** (-0.4 * (mag[use] - psf.psfMag))
+    pixels = FrameCache.pixels(imhPath)
+    out = IrafImage.createImage(outputPath, pixels.shape, imhPath)
+    subtractStars(pixels, psf, stars['x'][use], stars['y'][use], scale, out)
+    out.flush()
+    del out
+    return int(use.sum())
+
+
+def substarStep(imageName, psfName, catalogName, outputName, exceptName=None):
+    '''StepGraph function for a native SUBSTAR'''
+    def runSubstar(workingDirectory):
+        nStars = subtractCatalog(workingDirectory, imageName, psfName, catalogName, outputName, exceptName)
+        return 'subtracted %d stars in %s from %s into %s\n' % (nStars, catalogName, imageName, outputName)
+    return runSubstar
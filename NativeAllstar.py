@@ -0,0 +1,498 @@
+# ALLSTAR in Python, for when allstar8192 is too small, too slow or too opaque.
+#
+# Does what one allstar run does: reads the frame, a .psf (DaoPsf) and a star
+# list (.ap, .ap2, .als, ...), fits every star's position and brightness, and
+# writes the .als and the subtracted frame.
+#
+#   - stars closer than twice the fitting radius share fitting pixels, so they
+#     are put in the same crowding group (union-find over a GridIndex). Groups
+#     bigger than maxGroupSize are split again with a smaller radius
+#   - every group is fitted on its own: x, y and brightness of each star and
+#     one sky level for the group, by least squares (Gauss-Newton, weighted by
+#     the noise and tapered to zero at the fitting radius like allstar does).
+#     Like allstar, RE=0 in allstar.opt keeps the positions where they are, so
+#     only the brightness is fitted, and the sky is only fitted when there is a
+#     sky annulus (OS > IS). Groups with the same number of stars are stacked and fitted together,
+#     so one numpy call does a whole batch of groups
+#   - stars in other groups are still in the way of the wings, so after the
+#     first pass everything is subtracted with the first pass results and the
+#     groups are fitted again on that (passes). That model frame (ModelSubtract)
+#     stays in memory, and only goes to shared memory (SharedImage) for a pool
+#   - stars that fade into the noise are dropped, one per group per iteration,
+#     and don't come out in the .als, same as allstar
+#   - jobs of groups go to a pool of processes (SharedImage.SharedPool). Each
+#     worker maps the frame's .pix once when it starts, and maps the model of
+#     each pass when its first job of that pass arrives, so neither is copied.
+#
+# chi is the rms of the weighted residuals within the fitting radius (about 1
+# for a star that looks like the PSF) and sharp is how much the star is wider
+# than the PSF (> 0 for galaxies, < 0 for cosmic rays and hot pixels).
+#
+# runNativeAllstar takes the same arguments as TiledAllstar.runAllstar, so it
+# can be the fitter for every tile of a tiled run too.
+
+import multiprocessing
+import os
+
+import numpy as np
+
+import CatalogMatch
+import DaoCatalog
+import DaoPsf
+import FrameCache
+import IrafImage
+import ModelSubtract
+import OptionFiles
+import SharedImage
+
+maxGroupSize = 60          # stars fitted together at most
+maxIterations = 40
+passes = 2                 # fits of every group, each one with all the other stars subtracted
+minimumSignalToNoise = 1.0 # stars fainter than this many sigma are dropped
+positionTolerance = 0.005  # pixels, converged when no star moves more than this...
+scaleTolerance = 1e-4      # ...and no star's brightness changes by more than this fraction
+maxShift = 0.5             # pixels a star may move in one iteration
+derivativeStep = 0.05      # pixels, for the second derivatives of the PSF (sharp)
+jobStars = 2000            # stars per pool job
+batchElements = 1000000    # stars x pixels evaluated at once
+
+defaultOptions = {'FI': 5.0, 'RE': 1.0, 'IS': 33.0, 'OS': 36.0, 'gain': 1.3, 'readNoise': 9.0, 'lowBad': -np.inf, 'highBad': 55000.0}
+
+
+def readOptions(workingDirectory, header=None):
+    '''Fitting radius, whether to recenter (RE) and the sky annulus (IS, OS) from allstar.opt, noise
+    and bad pixel limits from the catalog header (daophot.opt if there is none)'''
+    options = dict(defaultOptions)
+    allstarPath = os.path.join(workingDirectory, 'allstar.opt')
+    if os.path.exists(allstarPath):
+        allstarOptions = OptionFiles.readOptionFile(allstarPath)
+        for key in ['FI', 'RE', 'IS', 'OS']:
+            if key in allstarOptions:
+                options[key] = allstarOptions[key]
+    if header:
+        options['gain'] = header['PH/ADU']
+        options['readNoise'] = header['RNOISE']
+        options['lowBad'] = header['LOWBAD']
+        options['highBad'] = header['HIGHBAD']
+    elif os.path.exists(os.path.join(workingDirectory, 'daophot.opt')):
+        daophotOptions = OptionFiles.readOptionFile(os.path.join(workingDirectory, 'daophot.opt'))
+        options['gain'] = daophotOptions.get('GA', options['gain'])
+        options['readNoise'] = daophotOptions.get('RE', options['readNoise'])
+        options['highBad'] = daophotOptions.get('HI', options['highBad'])
+    return options
+
+
+def unionFind(nItems, first, second):
+    '''Connected components of the pairs (first[i], second[i]): the smallest member of each
+    item's component. Roots are hooked onto the smaller root and paths compressed, all pairs at once.'''
+    parent = np.arange(nItems)
+    first = np.asarray(first, dtype=np.int64)
+    second = np.asarray(second, dtype=np.int64)
+    while True:
+        rootFirst = parent[first]
+        rootSecond = parent[second]
+        different = rootFirst != rootSecond
+        if not different.any():
+            break
+        np.minimum.at(parent, np.maximum(rootFirst, rootSecond)[different],
+                      np.minimum(rootFirst, rootSecond)[different])
+        while True:
+            grandparent = parent[parent]
+            if (grandparent == parent).all():
+                break
+            parent = grandparent
+    return parent
+
+
+def crowdingGroups(x, y, radius, maxSize=maxGroupSize):
+    '''Group number (0, 1, ...) of every star. Stars closer than radius are in the same group,
+    and groups of more than maxSize stars are split up with a smaller radius.'''
+    x = np.asarray(x, dtype=float)
+    y = np.asarray(y, dtype=float)
+    groups = np.zeros(len(x), dtype=np.int64) - 1
+    if not len(x):
+        return groups
+    nextGroup = 0
+    toSplit = [(np.arange(len(x)), radius)]
+    while toSplit:
+        members, linkRadius = toSplit.pop()
+        if linkRadius < 1.0:
+            # can't be pulled apart any more, so just cut the pile up
+            for start in range(0, len(members), maxSize):
+                groups[members[start:start + maxSize]] = nextGroup
+                nextGroup += 1
+            continue
+        index = CatalogMatch.GridIndex(x[members], y[members], linkRadius)
+        first, second = index.within(x[members], y[members], linkRadius)
+        roots = unionFind(len(members), first, second)
+        labels = np.unique(roots, return_inverse=True)[1]
+        sizes = np.bincount(labels)
+        for label in np.nonzero(sizes > maxSize)[0]:
+            toSplit.append((members[labels == label], linkRadius * 0.8))
+        small = sizes[labels] <= maxSize
+        # renumber the groups that are small enough
+        kept, newLabels = np.unique(labels[small], return_inverse=True)
+        groups[members[small]] = nextGroup + newLabels
+        nextGroup += len(kept)
+    return groups
+
+
+def groupPixels(x, y, fittingRadius, nColumns, nRows):
+    '''(columns, rows), 0 based, of the pixels within the fitting radius of any of the stars'''
+    c0 = max(int(np.ceil(x.min() - fittingRadius - 1)), 0)
+    c1 = min(int(np.floor(x.max() + fittingRadius - 1)), nColumns - 1)
+    r0 = max(int(np.ceil(y.min() - fittingRadius - 1)), 0)
+    r1 = min(int(np.floor(y.max() + fittingRadius - 1)), nRows - 1)
+    if c1 < c0 or r1 < r0:
+        return np.zeros(0, dtype=int), np.zeros(0, dtype=int)
+    columns, rows = np.meshgrid(np.arange(c0, c1 + 1), np.arange(r0, r1 + 1))
+    columns = columns.ravel()
+    rows = rows.ravel()
+    distance2 = ((columns + 1)[np.newaxis, :] - x[:, np.newaxis]) ** 2 + ((rows + 1)[np.newaxis, :] - y[:, np.newaxis]) ** 2
+    near = distance2.min(axis=0) < fittingRadius * fittingRadius
+    return columns[near], rows[near]
+
+
+def psfLaplacian(psf, dx, dy, x, y):
+    '''d2/ddx2 + d2/ddy2 of the PSF, by differences'''
+    h = derivativeStep
+    return (psf.evaluate(dx + h, dy, x, y) + psf.evaluate(dx - h, dy, x, y) + psf.evaluate(dx, dy + h, x, y) +
+            psf.evaluate(dx, dy - h, x, y) - 4 * psf.evaluate(dx, dy, x, y)) / (h * h)
+
+
+def fitBatch(psf, data, valid, columns, rows, x, y, scale, sky, options):
+    '''Fits a stack of groups with the same number of stars.
+      data, valid, columns, rows   (groups, pixels): the pixels to fit (padded with valid False)
+      x, y, scale                  (groups, stars) starting values, scale 0 for stars already dropped
+      sky                          (groups,)
+    Returns a dictionary of (groups, stars) arrays: x, y, scale, scaleError, chi, sharp, active,
+    and (groups,) arrays sky and niter.'''
+    nGroups, nStars = x.shape
+    x = x.copy()
+    y = y.copy()
+    scale = scale.copy()
+    sky = sky.copy()
+    active = scale > 0
+    recenter = options['RE'] != 0
+    fitSky = options['OS'] > options['IS']
+    # parameters of each star: brightness, then x and y when recentering
+    perStar = 3 if recenter else 1
+    fittingRadius = options['FI']
+    pixelX = (columns + 1).astype(float)[:, np.newaxis, :]
+    pixelY = (rows + 1).astype(float)[:, np.newaxis, :]
+    readNoise2 = options['readNoise'] ** 2
+
+    # allstar's taper: full weight at the star, none at the fitting radius
+    distance2 = (pixelX - x[:, :, np.newaxis]) ** 2 + (pixelY - y[:, :, np.newaxis]) ** 2
+    nearest2 = np.where(active[:, :, np.newaxis], distance2, np.inf).min(axis=1) / fittingRadius ** 2
+    taper = np.where(nearest2 < 1.0, 5.0 / (5.0 + nearest2 / np.maximum(1.0 - nearest2, 1e-10)), 0.0) * valid
+
+    converged = np.zeros(nGroups, dtype=bool)
+    niter = np.zeros(nGroups, dtype=int)
+    nParameters = perStar * nStars + (1 if fitSky else 0)
+    diagonal = np.arange(nParameters)
+    brightness = np.arange(0, perStar * nStars, perStar)
+    for iteration in range(1, maxIterations + 2):
+        dx = pixelX - x[:, :, np.newaxis]
+        dy = pixelY - y[:, :, np.newaxis]
+        f, fx, fy = psf.evaluate(dx, dy, x, y, gradient=True)
+        f = f * active[:, :, np.newaxis]
+        model = (scale[:, :, np.newaxis] * f).sum(axis=1) + sky[:, np.newaxis]
+        residual = data - model
+        variance = readNoise2 + np.maximum(model, 0.0) / options['gain']
+        weight = taper / variance
+
+        # columns of the jacobian: brightness (x, y) of each star, then the sky
+        jacobian = np.zeros((nGroups, nParameters, data.shape[1]))
+        jacobian[:, brightness] = f
+        if recenter:
+            jacobian[:, brightness + 1] = -scale[:, :, np.newaxis] * fx * active[:, :, np.newaxis]
+            jacobian[:, brightness + 2] = -scale[:, :, np.newaxis] * fy * active[:, :, np.newaxis]
+        if fitSky:
+            jacobian[:, -1] = valid
+        weighted = jacobian * weight[:, np.newaxis, :]
+        normal = np.einsum('gip,gjp->gij', weighted, jacobian)
+        vector = np.einsum('gip,gp->gi', weighted, residual)
+        # dropped stars (and pixels-less groups) have empty rows, so they get a 1 on the diagonal
+        scaleOfDiagonal = normal[:, diagonal, diagonal]
+        normal[:, diagonal, diagonal] += np.where(scaleOfDiagonal > 0, 1e-9 * scaleOfDiagonal, 1.0)
+        covariance = np.linalg.inv(normal)
+
+        if iteration > maxIterations or converged.all():
+            break
+        step = np.einsum('gij,gj->gi', covariance, vector)
+        step[converged] = 0.0
+        niter[~converged] = iteration
+        dScale = step[:, brightness]
+        dX = np.zeros(x.shape)
+        dY = np.zeros(y.shape)
+        if recenter:
+            dX = np.clip(step[:, brightness + 1], -maxShift, maxShift)
+            dY = np.clip(step[:, brightness + 2], -maxShift, maxShift)
+        # never let a star go negative in one jump, let it fade and be dropped instead
+        newScale = np.where(active, np.maximum(scale + dScale, 0.5 * scale), 0.0)
+        relativeChange = np.abs(newScale - scale) / np.maximum(scale, 1e-30)
+        moved = np.maximum(np.abs(dX), np.abs(dY))
+        scale = newScale
+        x = x + dX * active
+        y = y + dY * active
+        if fitSky:
+            sky = sky + step[:, -1]
+
+        # the faintest star of each group goes if it's lost in the noise
+        scaleError = np.sqrt(np.maximum(covariance[:, brightness, brightness], 0.0))
+        signalToNoise = np.where(active, scale / np.maximum(scaleError, 1e-30), np.inf)
+        faintest = signalToNoise.argmin(axis=1)
+        drop = (signalToNoise[np.arange(nGroups), faintest] < minimumSignalToNoise) & ~converged & (iteration >= 3)
+        active[np.nonzero(drop)[0], faintest[drop]] = False
+        scale[~active] = 0.0
+
+        done = ((np.where(active, moved, 0.0).max(axis=1) < positionTolerance) &
+                (np.where(active, relativeChange, 0.0).max(axis=1) < scaleTolerance) & ~drop)
+        converged |= done
+
+    # chi and sharp from the pixels near each star
+    near = (dx * dx + dy * dy < fittingRadius * fittingRadius) & (taper[:, np.newaxis, :] > 0)
+    weightedResidual2 = weight * residual * residual
+    chi = np.sqrt((near * weightedResidual2[:, np.newaxis, :]).sum(axis=2) /
+                  np.maximum((near * taper[:, np.newaxis, :]).sum(axis=2), 1e-30))
+    # how the star would change if it were a little wider than the PSF
+    broadening = 0.5 * scale[:, :, np.newaxis] * psfLaplacian(psf, dx, dy, x, y)
+    nearWeight = near * weight[:, np.newaxis, :]
+    sharp = ((nearWeight * broadening * residual[:, np.newaxis, :]).sum(axis=2) /
+             np.maximum((nearWeight * broadening * broadening).sum(axis=2), 1e-30))
+    scaleError = np.sqrt(np.maximum(covariance[:, brightness, brightness], 0.0))
+    return {'x': x, 'y': y, 'scale': scale, 'scaleError': scaleError * np.maximum(chi, 1.0), 'chi': chi,
+            'sharp': sharp, 'active': active, 'sky': sky, 'niter': niter}
+
+
+# the frame for the pool workers, set once per worker by the initializer
+workerFrame = {}
+
+
+def setWorkerFrame(imhPath, psfPath, options):
+    # a SharedPool worker has the frame attached already
+    workerFrame['pixels'] = SharedImage.workerImages.get('pixels')
+    if workerFrame['pixels'] is None:
+        workerFrame['pixels'] = FrameCache.pixels(imhPath)
+    workerFrame['psf'] = DaoPsf.readPsf(psfPath)
+    workerFrame['options'] = options
+    return
+
+
+def fitJob(job):
+    '''Pool job: fits a list of groups. job has the stars (x, y, scale, sky arrays, group by
+    group), 'sizes' (stars in each group) and 'model', the frame of every star from the last
+    pass: None on the first pass, 'memory' for the one in workerFrame (no pool), or else the
+    descriptor of the SharedImage it was drawn into. Returns the fitted values in the same order.'''
+    pixels = workerFrame['pixels']
+    psf = workerFrame['psf']
+    options = workerFrame['options']
+    nRows, nColumns = pixels.shape
+    model = None
+    if job['model'] == 'memory':
+        model = workerFrame['model']
+    elif job['model'] is not None:
+        # the last pass's model is gone, no need to keep it mapped
+        if workerFrame.get('modelDescriptor', job['model'])['path'] != job['model']['path']:
+            SharedImage.detach(workerFrame['modelDescriptor'])
+        workerFrame['modelDescriptor'] = job['model']
+        model = SharedImage.attach(job['model'])
+
+    starts = np.concatenate([[0], np.cumsum(job['sizes'])])
+    results = dict((name, np.zeros(len(job['x']))) for name in ['x', 'y', 'scale', 'scaleError', 'chi',
+                                                                'sharp', 'sky', 'niter'])
+    results['active'] = np.zeros(len(job['x']), dtype=bool)
+    # groups of the same size go together, as many as fit in a batch
+    for size in np.unique(job['sizes']):
+        groupNumbers = np.nonzero(job['sizes'] == size)[0]
+        pixelLists = []
+        for group in groupNumbers:
+            members = slice(starts[group], starts[group + 1])
+            pixelLists.append(groupPixels(job['x'][members], job['y'][members], options['FI'], nColumns, nRows))
+        order = np.argsort([len(columns) for (columns, rows) in pixelLists])
+        batchStart = 0
+        while batchStart < len(order):
+            nPixels = max(len(pixelLists[order[batchStart]][0]), 1)
+            batchEnd = batchStart + 1
+            while batchEnd < len(order) and (batchEnd - batchStart + 1) * size * len(pixelLists[order[batchEnd]][0]) <= batchElements:
+                nPixels = max(len(pixelLists[order[batchEnd]][0]), 1)
+                batchEnd += 1
+            batch = order[batchStart:batchEnd]
+            batchStart = batchEnd
+
+            columns = np.zeros((len(batch), nPixels), dtype=int)
+            rows = np.zeros((len(batch), nPixels), dtype=int)
+            valid = np.zeros((len(batch), nPixels), dtype=bool)
+            for (i, groupIndex) in enumerate(batch):
+                groupColumns, groupRows = pixelLists[groupIndex]
+                columns[i, :len(groupColumns)] = groupColumns
+                rows[i, :len(groupRows)] = groupRows
+                valid[i, :len(groupColumns)] = True
+            data = np.asarray(pixels[rows, columns], dtype=float)
+            valid &= (data > options['lowBad']) & (data < options['highBad'])
+            memberIndices = np.array([np.arange(starts[groupNumbers[g]], starts[groupNumbers[g] + 1]) for g in batch])
+            x = job['x'][memberIndices]
+            y = job['y'][memberIndices]
+            scale = job['scale'][memberIndices]
+            if model is not None:
+                # the other stars are taken out, this group's own stars put back
+                dx = (columns + 1)[:, np.newaxis, :] - x[:, :, np.newaxis]
+                dy = (rows + 1)[:, np.newaxis, :] - y[:, :, np.newaxis]
+                own = (scale[:, :, np.newaxis] * psf.evaluate(dx, dy, x, y)).sum(axis=1)
+                data = data - model[rows, columns] + own
+            sky = np.median(job['sky'][memberIndices], axis=1)
+            fitted = fitBatch(psf, data, valid, columns, rows, x, y, scale, sky, options)
+            for name in ['x', 'y', 'scale', 'scaleError', 'chi', 'sharp', 'active']:
+                results[name][memberIndices] = fitted[name]
+            results['sky'][memberIndices] = fitted['sky'][:, np.newaxis]
+            results['niter'][memberIndices] = fitted['niter'][:, np.newaxis]
+    del model
+    return results
+
+
+def startingScales(pixels, psf, x, y, mag, sky):
+    '''Brightness relative to the PSF from the input magnitudes, or from the peak pixel for stars
+    without one (99.999 from phot, or fainter than makes sense)'''
+    scale = 10.0 ** (-0.4 * (np.minimum(mag, 50.0) - psf.psfMag))
+    bad = (mag >= DaoCatalog.badMagnitude - 0.001) | ~np.isfinite(mag)
+    if bad.any():
+        cutouts = IrafImage.stamps(pixels, x[bad], y[bad], 1)
+        peak = np.nanmax(cutouts.reshape(len(cutouts), -1), axis=1) - sky[bad]
+        center = psf.evaluate(np.zeros((bad.sum(), 1)), np.zeros((bad.sum(), 1)), x[bad], y[bad])[:, 0]
+        scale[bad] = np.maximum(np.nan_to_num(peak), 1.0) / np.maximum(center, 1e-10)
+    return scale
+
+
+def fitFrame(workingDirectory, frame, psfName, inputName, processes=None, subtracted=None, optionChanges=None):
+    '''Fits the stars in inputName on the frame. Returns (catalog header, als columns of the
+    stars that survived, subtracted pixels). The subtracted frame is computed into subtracted if
+    given (an array or a memory map from IrafImage.createImage), a new array if not.
+    optionChanges override allstar.opt, like 're=0' typed at allstar's prompt.'''
+    imhPath = os.path.join(workingDirectory, frame + '.imh')
+    psfPath = os.path.join(workingDirectory, psfName)
+    header, stars = DaoCatalog.readCatalog(os.path.join(workingDirectory, inputName))
+    options = readOptions(workingDirectory, header)
+    options.update(optionChanges or {})
+    pixels = FrameCache.pixels(imhPath)
+    psf = DaoPsf.readPsf(psfPath)
+
+    mag = stars['mag'][:, 0] if stars['mag'].ndim == 2 else stars['mag']
+    sky = np.asarray(stars.get('sky', np.zeros(len(mag))), dtype=float)
+    x = stars['x'].copy()
+    y = stars['y'].copy()
+    scale = startingScales(pixels, psf, x, y, mag, sky)
+    results = {'active': np.zeros(len(x), dtype=bool)}
+    for name in ['scaleError', 'chi', 'sharp', 'niter']:
+        results[name] = np.zeros(len(x))
+
+    groups = crowdingGroups(x, y, 2 * options['FI'])
+    order = np.argsort(groups, kind='mergesort')
+    sizes = np.bincount(groups) if len(groups) else np.zeros(0, dtype=int)
+    groupStarts = np.concatenate([[0], np.cumsum(sizes)])
+
+    if processes is None:
+        processes = multiprocessing.cpu_count()
+    # a tile of a tiled run is already in a pool, and pool workers can't have their own
+    if multiprocessing.current_process().daemon:
+        processes = 1
+    pool = None
+    model = None
+    if processes > 1:
+        # the workers map the frame's .pix and each pass's model, nothing is copied to them
+        pool = SharedImage.SharedPool(processes, {'pixels': SharedImage.frameImage(imhPath)}, setWorkerFrame,
+                                      (imhPath, psfPath, options))
+    else:
+        setWorkerFrame(imhPath, psfPath, options)
+    try:
+        for passNumber in range(passes):
+            modelName = None
+            if passNumber > 0 and pool is None:
+                # one process: the model stays in memory
+                workerFrame['model'] = ModelSubtract.renderModel(pixels.shape, psf, x, y, scale)
+                modelName = 'memory'
+            elif passNumber > 0:
+                # drawn straight into shared memory, the workers map it from there
+                if model is not None:
+                    model.close()
+                model = pool.create(pixels.shape, np.float32, 'model')
+                ModelSubtract.renderModel(pixels.shape, psf, x, y, scale, model.array)
+                modelName = model.descriptor
+            jobs = []
+            jobGroups = []
+            first = 0
+            while first < len(sizes):
+                last = first + 1
+                while last < len(sizes) and groupStarts[last + 1] - groupStarts[first] <= jobStars:
+                    last += 1
+                members = order[groupStarts[first]:groupStarts[last]]
+                jobs.append({'x': x[members], 'y': y[members], 'scale': scale[members], 'sky': sky[members],
+                             'sizes': sizes[first:last], 'model': modelName})
+                jobGroups.append(members)
+                first = last
+            fitted = pool.map(fitJob, jobs) if pool else map(fitJob, jobs)
+            x, y, scale, sky = x.copy(), y.copy(), scale.copy(), sky.copy()
+            for (members, jobResults) in zip(jobGroups, fitted):
+                x[members] = jobResults['x']
+                y[members] = jobResults['y']
+                scale[members] = jobResults['scale']
+                sky[members] = jobResults['sky']
+                for name in results:
+                    results[name][members] = jobResults[name]
+    finally:
+        if pool is not None:
+            pool.close()
+        workerFrame.pop('model', None)
+
+    kept = results['active']
+    scale = np.maximum(scale, 1e-30)
+    columns = {'id': stars['id'][kept],
+               'x': x[kept],
+               'y': y[kept],
+               'mag': psf.psfMag - 2.5 * np.log10(scale[kept]),
+               'err': (1.0857 * results['scaleError'] / scale)[kept],
+               'sky': sky[kept],
+               'niter': results['niter'][kept],
+               'chi': results['chi'][kept],
+               'sharp': results['sharp'][kept]}
+    subtracted = ModelSubtract.subtractStars(pixels, psf, columns['x'], columns['y'], scale[kept], subtracted)
+    if header is None:
+        header = DaoCatalog.defaultHeader(pixels.shape[1], pixels.shape[0], gain=options['gain'],
+                                          readNoise=options['readNoise'])
+    header = dict(header, NL=1, FRAD=options['FI'])
+    return header, columns, subtracted
+
+
+def runNativeAllstar(workingDirectory, frame, psfName, inputName, outputName, subtractedName, processes=None,
+                     optionChanges=None):
+    '''One allstar run: inputName -> outputName (.als) and subtractedName.imh. Same arguments and
+    results as TiledAllstar.runAllstar: (return code, output). The subtracted frame is computed
+    straight into its file.'''
+    imhPath = os.path.join(workingDirectory, frame + '.imh')
+    subtractedPath = os.path.join(workingDirectory, subtractedName + '.imh')
+    try:
+        subtracted = IrafImage.createImage(subtractedPath, FrameCache.pixels(imhPath).shape, imhPath)
+        header, columns, subtracted = fitFrame(workingDirectory, frame, psfName, inputName, processes, subtracted,
+                                               optionChanges)
+    except (IOError, ValueError, np.linalg.LinAlgError), e:
+        # not a half made frame for the next step to pick up
+        for path in [subtractedPath, os.path.splitext(subtractedPath)[0] + '.pix']:
+            if os.path.exists(path):
+                os.remove(path)
+        return 1, 'native allstar failed on ' + inputName + ': ' + str(e) + '\n'
+    subtracted.flush()
+    del subtracted
+    DaoCatalog.writeCatalog(os.path.join(workingDirectory, outputName), header, columns, 'als')
+    return 0, ('native allstar: %d stars fitted into %s, %.1f iterations on average\n' %
+               (len(columns['id']), outputName, columns['niter'].mean() if len(columns['id']) else 0))
+
+
+def allstarStep(frame, psfName, inputName, outputName, subtractedName, processes=None, optionChanges=None):
+    '''StepGraph function for a native allstar run'''
+    def runNative(workingDirectory):
+        returnCode, output = runNativeAllstar(workingDirectory, frame, psfName, inputName, outputName, subtractedName,
+                                              processes, optionChanges)
+        if returnCode != 0:
+            raise IOError(output.strip())
+        return output
+    return runNative
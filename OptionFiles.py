@@ -29,6 +29,23 @@ class OptionFiles:
                                  'macro1.scr' : macro1scr.substitute(workingDirectory=workingDirectoryVar),
                                  'magChiRoundPlot.scr' : magChiRoundPlotscr.substitute(workingDirectory=workingDirectoryVar,currentFrame=currentFrameVar)}
 
+def readOptionFile(path):
+    '''Reads a daophot style option file (KEY=value, one per line) into {KEY : float}.
+    Anything after a # is ignored.'''
+    options = {}
+    optionFile = open(path, 'r')
+    for line in optionFile:
+        line = line.split('#')[0].strip()
+        if '=' not in line:
+            continue
+        (key, value) = line.split('=', 1)
+        try:
+            options[key.strip().upper()] = float(value)
+        except ValueError:
+            continue
+    optionFile.close()
+    return options
+
 optionFileDict = {'allstar.opt' : '',
                         'daophot.opt' : '',
                          'photo.opt' : '',
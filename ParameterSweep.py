@@ -0,0 +1,360 @@
+# Parameter sweeps: how many stars a setting keeps and how good their
+# photometry is, for every combination of a grid of settings, over a whole
+# data set in one pass instead of one rerun per setting.
+#
+# Catalog level parameters never rerun anything. Each frame's allstar catalog
+# (${frame}.als2, before alsedt) is read once in a pool worker, and everything
+# a cut looks at is worked out once per star:
+#   err, chi, sharp   from the catalog, the alsedt cuts (kept below the cut,
+#                     |sharp| for sharp)
+#   HI                brightest pixel within the fitting radius (kept below)
+#   LO                how far the darkest pixel there is below the sky, in
+#                     sigmas of the noise (kept below)
+#   TH                height of the star in FrameCache.detection over the
+#                     noise of that image, roughly FIND's threshold (kept at
+#                     or above)
+# Every star is matched to the reference frame too (CatalogMatch). A grid of S
+# settings is then an S x stars boolean array, and the counts, rejected
+# fractions and scatter of all settings come out of a few bincounts over it.
+# The scatter is the median, over the stars seen in at least two frames, of
+# each star's rms about its own mean (frames shifted onto the reference by
+# their median offset first), so it needs more than one frame of the field.
+#
+# PSF star selection (psfStars, magLimit) needs a new PSF for every setting;
+# each frame and setting is a PsfSelect + PsfBuilder run in the pool, in
+# memory, and the table has the stars used, their chi and how many got
+# flagged.
+#
+#   python ParameterSweep.py /data/n2158_phot/n2158/ chi=1.5,2,3 sharp=0.5,1 err=0.1,0.2
+#   python ParameterSweep.py /data/n2158_phot/n2158/ psfStars=25,50,100
+
+import itertools
+import multiprocessing
+import os
+import sys
+from collections import OrderedDict
+from string import Template
+
+import numpy as np
+
+import Archive
+import Artifacts
+import CatalogMatch
+import Checkpoint
+import DaoCatalog
+import FrameCache
+import IrafImage
+import PsfBuilder
+import PsfSelect
+
+# {parameter : (what it cuts on, 'max' = kept below the value, 'min' = kept at or above it)}
+catalogParameters = OrderedDict([('err', ('err', 'max')),
+                                 ('chi', ('chi', 'max')),
+                                 ('sharp', ('sharp', 'max')),
+                                 ('HI', ('peak', 'max')),
+                                 ('LO', ('low', 'max')),
+                                 ('TH', ('significance', 'min'))])
+psfParameters = ['psfStars', 'magLimit']
+
+catalogName = '${frame}.als2'
+maskBytes = 64 * 1024 ** 2    # how big the settings x stars masks may get at once
+minDetections = 2             # frames a star needs to count in the scatter
+zeroPointError = 0.05         # stars used for a frame's offset from the reference
+
+
+def expandGrid(grid):
+    '''[{parameter : value}] for every combination of the grid ({parameter : [values]}), the
+    last parameter changing fastest'''
+    names = list(grid)
+    return [OrderedDict(zip(names, values)) for values in itertools.product(*[grid[name] for name in names])]
+
+
+def parseGrid(arguments):
+    '''"chi=1.5,2,3" arguments into a grid'''
+    grid = OrderedDict()
+    for argument in arguments:
+        name, values = argument.split('=', 1)
+        if name not in catalogParameters and name not in psfParameters:
+            raise ValueError('Unknown parameter ' + name + ', it has to be one of ' +
+                             ', '.join(list(catalogParameters) + psfParameters))
+        grid[name] = [float(value) for value in values.split(',')]
+        if name == 'psfStars':
+            grid[name] = [int(value) for value in grid[name]]
+    return grid
+
+
+def frameFwhm(dataSetDirectory, frame, header):
+    fwhm = Checkpoint.FrameState(dataSetDirectory, frame).getParameter('fwhm')
+    if fwhm is None and header:
+        # the fitting radius is usually about the FWHM
+        fwhm = header['FRAD']
+    return fwhm or 3.0
+
+
+def measureStars(imhPath, header, columns, fwhm):
+    '''{'peak', 'low', 'significance'} arrays for the stars of a catalog, see the top'''
+    gain = header['PH/ADU'] if header else 1.0
+    readNoise = header['RNOISE'] if header else 0.0
+    radius = int(np.ceil(header['FRAD'] if header else fwhm))
+    pixels = FrameCache.pixels(imhPath)
+    background = FrameCache.background(imhPath)
+    noise = FrameCache.noise(imhPath, gain, readNoise)
+    x, y = columns['x'], columns['y']
+
+    cutouts = IrafImage.stamps(pixels, x, y, radius).reshape(len(x), -1)
+    below = (IrafImage.stamps(background, x, y, radius).reshape(len(x), -1) - cutouts) / \
+        np.maximum(IrafImage.stamps(noise, x, y, radius).reshape(len(x), -1), 1e-6)
+    # the noise of the smoothed image is the pixel noise times the sum of the squared kernel
+    kernel = FrameCache.gaussianKernel(fwhm)
+    height = IrafImage.stamps(FrameCache.detection(imhPath, fwhm), x, y, 0).reshape(-1)
+    smoothedNoise = IrafImage.stamps(noise, x, y, 0).reshape(-1) * (kernel ** 2).sum()
+    with np.errstate(invalid='ignore'):
+        return {'peak': np.nanmax(cutouts, axis=1) if len(x) else np.zeros(0),
+                'low': np.nanmax(below, axis=1) if len(x) else np.zeros(0),
+                'significance': height / np.maximum(smoothedNoise, 1e-6)}
+
+
+def frameJob(arguments):
+    '''Pool job: one frame's catalog, what the cuts look at and its matches to the reference.
+    The reference is CatalogMatch's worker reference.'''
+    dataSetDirectory, frame, catalogPath = arguments
+    header, columns = DaoCatalog.readCatalog(catalogPath)
+    good = np.nonzero(columns['mag'] < DaoCatalog.badMagnitude - 1)[0]
+    columns = DaoCatalog.selectRows(columns, good)
+    imhPath = os.path.join(dataSetDirectory, frame, frame + '.imh')
+    quantities = measureStars(imhPath, header, columns, frameFwhm(dataSetDirectory, frame, header))
+    for name in ['err', 'chi']:
+        quantities[name] = columns[name]
+    quantities['sharp'] = np.abs(columns['sharp'])
+
+    matched = CatalogMatch.matchColumns(columns)
+    ids = np.zeros(len(good), dtype=np.int64) - 1
+    mag = columns['mag'].copy()
+    if matched['transform'] is not None:
+        ids = matched['matches']
+        referenceMag = CatalogMatch.workerReference['columns']['mag']
+        common = (ids >= 0) & (columns['err'] < zeroPointError)
+        if common.sum() > 0:
+            mag -= np.median(mag[common] - referenceMag[ids[common]])
+    return {'frame': frame, 'quantities': quantities, 'ids': ids, 'mag': mag, 'err': columns['err'],
+            'matched': matched['transform'] is not None}
+
+
+def keepMasks(quantities, settings):
+    '''(settings x stars) True where a star survives every cut of a setting'''
+    nStars = len(quantities['err'])
+    keep = np.ones((len(settings), nStars), dtype=bool)
+    for name in settings[0] if settings else []:
+        quantity, kind = catalogParameters[name]
+        values = np.array([setting[name] for setting in settings], dtype=float)[:, np.newaxis]
+        with np.errstate(invalid='ignore'):
+            if kind == 'max':
+                keep &= quantities[quantity][np.newaxis, :] < values
+            else:
+                keep &= quantities[quantity][np.newaxis, :] >= values
+    return keep
+
+
+def summarizeCuts(observations, settings, nStars):
+    '''Rows of the catalog sweep table from every frame's observations put together (observations
+    has 'quantities', 'ids' (into nStars, -1 for unmatched), 'mag' and 'err')'''
+    nObservations = len(observations['err'])
+    matched = observations['ids'] >= 0
+    rows = []
+    batch = max(1, maskBytes // max(nObservations, 1))
+    for start in range(0, len(settings), batch):
+        batchSettings = settings[start:start + batch]
+        keep = keepMasks(observations['quantities'], batchSettings)
+        kept = keep.sum(axis=1)
+
+        # per star sums of every setting at once: setting s, star i goes in bin s * nStars + i
+        scatter = [None] * len(batchSettings)
+        repeated = [0] * len(batchSettings)
+        if nStars:
+            settingIndex, observation = np.nonzero(keep & matched[np.newaxis, :])
+            bins = settingIndex * nStars + observations['ids'][observation]
+            size = len(batchSettings) * nStars
+            mag = observations['mag'][observation]
+            n = np.bincount(bins, minlength=size).reshape(len(batchSettings), nStars)
+            m = np.bincount(bins, mag, minlength=size).reshape(len(batchSettings), nStars)
+            m2 = np.bincount(bins, mag * mag, minlength=size).reshape(len(batchSettings), nStars)
+            seen = n >= minDetections
+            variance = np.zeros(n.shape)
+            variance[seen] = (m2[seen] - m[seen] ** 2 / n[seen]) / (n[seen] - 1)
+            for s in range(len(batchSettings)):
+                repeated[s] = int(seen[s].sum())
+                if repeated[s]:
+                    scatter[s] = float(np.median(np.sqrt(np.maximum(variance[s][seen[s]], 0.0))))
+
+        for s in range(len(batchSettings)):
+            errors = observations['err'][keep[s]]
+            rows.append({'setting': batchSettings[s], 'stars': int(kept[s]),
+                         'rejected': 1.0 - kept[s] / float(max(nObservations, 1)),
+                         'medianErr': float(np.median(errors)) if len(errors) else None,
+                         'scatter': scatter[s], 'repeated': repeated[s]})
+    return rows
+
+
+def sweepCatalogCuts(dataSetDirectory, grid, referenceFrame=None, frames=None, filters=None, processes=None,
+                     radius=CatalogMatch.matchRadius):
+    '''Evaluates every setting of a grid of catalog parameters (catalogParameters) on every frame.
+    filters is {frame : filter name} (CatalogMatch.frameFilters by default), so the scatter
+    doesn't mix filters. Returns the rows of the table: {'setting', 'stars' (kept over all
+    frames), 'rejected' (fraction), 'medianErr', 'scatter', 'repeated' (stars in the scatter)}.'''
+    if frames is None:
+        frames = Artifacts.frameNames(dataSetDirectory)
+    if filters is None:
+        filters = CatalogMatch.frameFilters(dataSetDirectory, frames)
+    framePaths = []
+    for frame in frames:
+        path = os.path.join(dataSetDirectory, frame, Template(catalogName).substitute(frame=frame))
+        if Archive.exists(path):
+            framePaths.append((frame, path))
+    if not framePaths:
+        raise IOError('No frame in ' + dataSetDirectory + ' has a ' + catalogName)
+    if referenceFrame is None:
+        referenceFrame = framePaths[0][0]
+    referencePath = dict(framePaths).get(referenceFrame)
+    if referencePath is None:
+        raise IOError('The reference frame ' + referenceFrame + ' has no ' + catalogName)
+    header, referenceColumns = DaoCatalog.readCatalog(referencePath)
+    good = np.nonzero(referenceColumns['mag'] < DaoCatalog.badMagnitude - 1)[0]
+    referenceColumns = DaoCatalog.selectRows(referenceColumns, good)
+    nReference = len(good)
+    filterNames = sorted(set(filters.get(frame, '') for (frame, path) in framePaths))
+
+    results = []
+    pool = multiprocessing.Pool(processes, CatalogMatch.setWorkerReference, (referenceColumns, radius))
+    try:
+        for result in pool.imap(frameJob, [(dataSetDirectory, frame, path) for (frame, path) in framePaths]):
+            # each filter has its own set of stars
+            offset = filterNames.index(filters.get(result['frame'], '')) * nReference
+            result['ids'] = np.where(result['ids'] >= 0, result['ids'] + offset, -1)
+            results.append(result)
+    finally:
+        pool.close()
+        pool.join()
+
+    observations = {'quantities': {}}
+    for name in ['ids', 'mag', 'err']:
+        observations[name] = np.concatenate([result[name] for result in results])
+    for name in results[0]['quantities']:
+        observations['quantities'][name] = np.concatenate([result['quantities'][name] for result in results])
+    return summarizeCuts(observations, expandGrid(grid), nReference * len(filterNames))
+
+
+def psfJob(arguments):
+    '''Pool job: the PSF of one frame with one selection setting. Returns {'frame', 'selected',
+    'chi', 'flagged' (stars marked ? or *), 'unused'}, with 'error' if there is no PSF.'''
+    dataSetDirectory, frame, setting = arguments
+    frameDirectory = os.path.join(dataSetDirectory, frame)
+    header, apColumns = DaoCatalog.readCatalog(os.path.join(frameDirectory, frame + '.ap'))
+    pixels = FrameCache.pixels(os.path.join(frameDirectory, frame + '.imh'))
+    options = PsfBuilder.readOptions(frameDirectory)
+    if header:
+        options['HI'] = header['HIGHBAD']
+    chosen, summary = PsfSelect.selectPsfStars(apColumns, pixels, frameFwhm(dataSetDirectory, frame, header),
+                                               int(setting.get('psfStars', PsfSelect.defaultPsfStars)),
+                                               setting.get('magLimit'), options['HI'], options['PS'])
+    result = {'frame': frame, 'selected': len(chosen), 'chi': None, 'flagged': 0, 'unused': 0}
+    if len(chosen) == 0:
+        result['error'] = 'no PSF stars'
+        return result
+    stars = {'id': apColumns['id'][chosen], 'x': apColumns['x'][chosen], 'y': apColumns['y'][chosen],
+             'mag': apColumns['mag'][chosen, 0], 'sky': apColumns['sky'][chosen]}
+    psf, report = PsfBuilder.buildPsf(pixels, stars, options)
+    if psf is None:
+        result['error'] = 'none of the stars could be used'
+        return result
+    flags = [star['flag'] for star in report['stars']]
+    result['chi'] = report['chi']
+    result['flagged'] = len([flag for flag in flags if flag in ['?', '*']])
+    result['unused'] = len([flag for flag in flags if flag not in ['', '?', '*']])
+    return result
+
+
+def sweepPsfSelection(dataSetDirectory, grid, frames=None, processes=None):
+    '''Builds every frame's PSF with every setting of a grid of psfParameters. Returns the rows of
+    the table: {'setting', 'stars' (PSF stars selected over all frames), 'rejected' (fraction
+    flagged or unused), 'chi' (median of the frames), 'failed' (frames without a PSF)}.'''
+    if frames is None:
+        frames = [frame for frame in Artifacts.frameNames(dataSetDirectory)
+                  if Archive.exists(os.path.join(dataSetDirectory, frame, frame + '.ap'))]
+    settings = expandGrid(grid)
+    jobs = [(dataSetDirectory, frame, setting) for setting in settings for frame in frames]
+    pool = multiprocessing.Pool(processes)
+    try:
+        results = pool.map(psfJob, jobs)
+    finally:
+        pool.close()
+        pool.join()
+
+    rows = []
+    for (s, setting) in enumerate(settings):
+        frameResults = results[s * len(frames):(s + 1) * len(frames)]
+        selected = sum(result['selected'] for result in frameResults)
+        chis = [result['chi'] for result in frameResults if result['chi'] is not None]
+        rows.append({'setting': setting, 'stars': selected,
+                     'rejected': sum(result['flagged'] + result['unused'] for result in frameResults) /
+                     float(max(selected, 1)),
+                     'chi': float(np.median(chis)) if chis else None,
+                     'failed': len([result for result in frameResults if 'error' in result])})
+    return rows
+
+
+def sweep(dataSetDirectory, grid, referenceFrame=None, frames=None, filters=None, processes=None):
+    '''Splits a grid into its catalog and PSF parameters and sweeps each. Returns
+    (catalog rows or None, PSF rows or None).'''
+    for name in grid:
+        if name not in catalogParameters and name not in psfParameters:
+            raise ValueError('Unknown parameter ' + name)
+    catalogGrid = OrderedDict((name, values) for (name, values) in grid.items() if name in catalogParameters)
+    psfGrid = OrderedDict((name, values) for (name, values) in grid.items() if name in psfParameters)
+    catalogRows = psfRows = None
+    if catalogGrid:
+        catalogRows = sweepCatalogCuts(dataSetDirectory, catalogGrid, referenceFrame, frames, filters, processes)
+    if psfGrid:
+        psfRows = sweepPsfSelection(dataSetDirectory, psfGrid, frames, processes)
+    return catalogRows, psfRows
+
+
+def formatValue(value, format):
+    if value is None:
+        return '-'
+    return format % value
+
+
+def formatTable(rows, columns):
+    '''The rows as a text table. columns is [(name, format)] of the numbers after the settings.'''
+    if not rows:
+        return ''
+    names = list(rows[0]['setting'])
+    lines = [''.join(name.rjust(10) for name in names) + ''.join(name.rjust(12) for (name, format) in columns)]
+    for row in rows:
+        lines.append(''.join(formatValue(row['setting'][name], '%g').rjust(10) for name in names) +
+                     ''.join(formatValue(row[name], format).rjust(12) for (name, format) in columns))
+    return '\n'.join(lines) + '\n'
+
+
+catalogColumns = [('stars', '%d'), ('rejected', '%.3f'), ('medianErr', '%.4f'), ('scatter', '%.4f'),
+                  ('repeated', '%d')]
+psfColumns = [('stars', '%d'), ('rejected', '%.3f'), ('chi', '%.4f'), ('failed', '%d')]
+
+
+if __name__ == '__main__':
+    # python ParameterSweep.py /data/n2158_phot/n2158/ chi=1.5,2,3 sharp=0.5,1 [--reference n21100]
+    if len(sys.argv) < 3:
+        print 'usage: python ParameterSweep.py dataSetDirectory parameter=value,value,... [--reference frame]'
+        print 'parameters: ' + ', '.join(list(catalogParameters) + psfParameters)
+        sys.exit(1)
+    arguments = sys.argv[2:]
+    reference = None
+    if '--reference' in arguments:
+        reference = arguments[arguments.index('--reference') + 1]
+        arguments.remove('--reference')
+        arguments.remove(reference)
+    catalogRows, psfRows = sweep(sys.argv[1], parseGrid(arguments), reference)
+    if catalogRows:
+        print formatTable(catalogRows, catalogColumns)
+    if psfRows:
+        print formatTable(psfRows, psfColumns)
@@ -0,0 +1,411 @@
+# DAOPHOT's PSF command in Python: the PSF stars in a .lst and the frame in,
+# a .psf (DaoPsf) and a .nei out, and what happened to every star as a
+# dictionary instead of a log to read through.
+#
+#   1. a cutout around every PSF star (IrafImage.stamps, all in one go).
+#      Stars running off the frame or with saturated pixels inside the fitting
+#      radius aren't used, same as daophot
+#   2. the analytic profile (AN in daophot.opt; negative tries every type up
+#      to -AN and keeps the best) is fitted to all the stars at once: the
+#      profile's parameters shared, a height, x and y per star, within the
+#      fitting radius (Levenberg-Marquardt on one stacked system)
+#   3. what the profile misses goes into the lookup table. Every star's
+#      residuals are interpolated onto the half pixel grid around its center,
+#      and each table point gets a weighted least squares fit over the stars
+#      of the terms for VA (constant, linear or quadratic in x and y). All the
+#      table points are solved in one batch, a second time without the points
+#      more than 5 sigma out (neighbors and cosmic rays)
+#   4. every star's chi is the rms of its residuals from the finished PSF over
+#      its height, like the list daophot prints. Stars more than twice the
+#      average get '?', more than three times '*'
+#
+# The magnitude scale is tied to the aperture magnitudes in the .ap: PSFMAG is
+# the first star's and BRIGHT is set so the stars' heights match their .ap
+# magnitudes on average.
+
+import os
+
+import numpy as np
+
+import CatalogMatch
+import DaoCatalog
+import DaoPsf
+import FrameCache
+import IrafImage
+import OptionFiles
+
+maxIterations = 50
+clipSigma = 5.0
+defaultOptions = {'FW': 2.5, 'FI': 2.5, 'PS': 15.0, 'VA': 2.0, 'AN': 3.0, 'GA': 1.3, 'RE': 9.0, 'HI': 55000.0}
+
+# {VA : number of lookup tables}. -1 is the analytic profile alone
+variabilityTerms = {-1: 1, 0: 1, 1: 3, 2: 6}
+
+
+def readOptions(workingDirectory):
+    options = dict(defaultOptions)
+    path = os.path.join(workingDirectory, 'daophot.opt')
+    if os.path.exists(path):
+        options.update(OptionFiles.readOptionFile(path))
+    return options
+
+
+def startingParameters(label, fwhm):
+    '''Half widths from the FWHM, no tilt, a bit of light in the Penny wings'''
+    halfWidth = max(fwhm / 2.0, 0.5)
+    return {'GAUSSIAN': [halfWidth, halfWidth],
+            'MOFFAT15': [halfWidth, halfWidth, 0.0],
+            'MOFFAT25': [halfWidth, halfWidth, 0.0],
+            'LORENTZ': [halfWidth, halfWidth, 0.0],
+            'PENNY1': [halfWidth, halfWidth, 0.0, 0.2],
+            'PENNY2': [halfWidth, halfWidth, 0.0, 0.2, 0.0]}[label]
+
+
+def limitParameters(label, parameters):
+    '''Keeps the parameters where the profile makes sense'''
+    parameters = np.array(parameters, dtype=float)
+    parameters[0:2] = np.maximum(parameters[0:2], 0.2)
+    if len(parameters) > 2:
+        # the tilt can't turn the ellipse into a saddle
+        limit = 1.9 / (parameters[0] * parameters[1])
+        parameters[2] = np.clip(parameters[2], -limit, limit)
+    if label in ['PENNY1', 'PENNY2']:
+        parameters[3] = np.clip(parameters[3], 0.0, 1.0)
+    if label == 'PENNY2':
+        limit = 1.9 / (parameters[0] * parameters[1])
+        parameters[4] = np.clip(parameters[4], -limit, limit)
+    return parameters
+
+
+def fitProfile(label, data, weight, dx0, dy0, heights, parameters):
+    '''Fits the analytic profile to the stars together.
+      data, weight   (stars, pixels) sky subtracted pixels and their weights (0 = not used)
+      dx0, dy0       (stars, pixels) pixel offsets from each star's starting position
+      heights        (stars,) starting heights
+    Returns (parameters, heights, x shifts, y shifts, chi squared).'''
+    nStars = data.shape[0]
+    nParameters = len(parameters)
+    shifts = np.zeros((nStars, 2))
+    heights = np.array(heights, dtype=float)
+    parameters = np.array(parameters, dtype=float)
+    damping = 1e-3
+
+    def residuals(parameters, heights, shifts):
+        dx = dx0 - shifts[:, 0:1]
+        dy = dy0 - shifts[:, 1:2]
+        profile, profileX, profileY = DaoPsf.pixelProfile(label, parameters, dx, dy, gradient=True)
+        return data - heights[:, np.newaxis] * profile, profile, profileX, profileY, dx, dy
+
+    residual, profile, profileX, profileY, dx, dy = residuals(parameters, heights, shifts)
+    chi2 = (weight * residual * residual).sum()
+    for iteration in range(maxIterations):
+        # derivatives: the shared parameters by differences, each star's own analytically
+        shapeDerivatives = []
+        for k in range(nParameters):
+            step = 1e-3 * max(abs(parameters[k]), 0.01)
+            plus = parameters.copy()
+            minus = parameters.copy()
+            plus[k] += step
+            minus[k] -= step
+            shapeDerivatives.append(heights[:, np.newaxis] * (DaoPsf.pixelProfile(label, plus, dx, dy) -
+                                                              DaoPsf.pixelProfile(label, minus, dx, dy)) / (2 * step))
+        shapeDerivatives = np.array(shapeDerivatives)
+        starDerivatives = np.array([profile, -heights[:, np.newaxis] * profileX, -heights[:, np.newaxis] * profileY])
+
+        # normal equations: shared parameters first, then height, x, y of each star
+        size = nParameters + 3 * nStars
+        normal = np.zeros((size, size))
+        vector = np.zeros(size)
+        normal[:nParameters, :nParameters] = np.einsum('isp,sp,jsp->ij', shapeDerivatives, weight, shapeDerivatives)
+        vector[:nParameters] = np.einsum('isp,sp,sp->i', shapeDerivatives, weight, residual)
+        cross = np.einsum('isp,sp,jsp->sij', shapeDerivatives, weight, starDerivatives)
+        own = np.einsum('isp,sp,jsp->sij', starDerivatives, weight, starDerivatives)
+        ownVector = np.einsum('isp,sp,sp->si', starDerivatives, weight, residual)
+        for s in range(nStars):
+            block = slice(nParameters + 3 * s, nParameters + 3 * s + 3)
+            normal[:nParameters, block] = cross[s]
+            normal[block, :nParameters] = cross[s].T
+            normal[block, block] = own[s]
+            vector[block] = ownVector[s]
+        diagonal = np.arange(size)
+        scaleOfDiagonal = np.where(normal[diagonal, diagonal] > 0, normal[diagonal, diagonal], 1.0)
+
+        while True:
+            damped = normal.copy()
+            damped[diagonal, diagonal] += damping * scaleOfDiagonal
+            try:
+                step = np.linalg.solve(damped, vector)
+            except np.linalg.LinAlgError:
+                damping *= 10.0
+                continue
+            newParameters = limitParameters(label, parameters + step[:nParameters])
+            starSteps = step[nParameters:].reshape(nStars, 3)
+            newHeights = np.maximum(heights + starSteps[:, 0], 0.5 * heights)
+            newShifts = shifts + np.clip(starSteps[:, 1:3], -0.5, 0.5)
+            newResidual, newProfile, newProfileX, newProfileY, newDx, newDy = residuals(newParameters, newHeights,
+                                                                                       newShifts)
+            newChi2 = (weight * newResidual * newResidual).sum()
+            if newChi2 <= chi2 or damping > 1e6:
+                break
+            damping *= 10.0
+        improvement = (chi2 - newChi2) / max(chi2, 1e-30)
+        if newChi2 <= chi2:
+            parameters, heights, shifts = newParameters, newHeights, newShifts
+            residual, profile, profileX, profileY, dx, dy = newResidual, newProfile, newProfileX, newProfileY, newDx, newDy
+            chi2 = newChi2
+            damping = max(damping / 10.0, 1e-7)
+        if improvement < 1e-7 or damping > 1e6:
+            break
+    return parameters, heights, shifts[:, 0], shifts[:, 1], chi2
+
+
+def sampleStamps(values, valid, column, row):
+    '''Cubic convolution of each star's (stars, side, side) values at stamp coordinates
+    (stars, points). Points needing an invalid pixel come back invalid.'''
+    nStars, side = values.shape[0], values.shape[1]
+    column0 = np.floor(column).astype(int)
+    row0 = np.floor(row).astype(int)
+    weightsColumn = DaoPsf.cubicWeights(column - column0)
+    weightsRow = DaoPsf.cubicWeights(row - row0)
+    starIndex = np.arange(nStars)[:, np.newaxis]
+    result = np.zeros(column.shape)
+    good = np.ones(column.shape, dtype=bool)
+    for j in range(4):
+        rows = row0 + j - 1
+        for i in range(4):
+            columns = column0 + i - 1
+            inside = (rows >= 0) & (rows < side) & (columns >= 0) & (columns < side)
+            clippedRows = np.clip(rows, 0, side - 1)
+            clippedColumns = np.clip(columns, 0, side - 1)
+            good &= inside & valid[starIndex, clippedRows, clippedColumns]
+            result += weightsRow[j] * weightsColumn[i] * np.where(good, values[starIndex, clippedRows, clippedColumns], 0.0)
+    return result, good
+
+
+def fitTable(residuals, valid, nodeColumn, nodeRow, terms, starWeights, nexp):
+    '''Least squares over the stars for every table point: residual = sum of term_k * table_k.
+    Returns the (NEXP, NPSF, NPSF) table.'''
+    npsf = nodeColumn.shape[1]
+    samples, good = sampleStamps(residuals, valid, nodeColumn.reshape(len(residuals), -1),
+                                 nodeRow.reshape(len(residuals), -1))
+    # (points, stars)
+    samples = samples.T
+    good = good.T
+    weights = good * starWeights[np.newaxis, :]
+    for clipping in range(2):
+        normal = np.einsum('ps,sk,sl->pkl', weights, terms, terms)
+        vector = np.einsum('ps,sk,ps->pk', weights, terms, samples)
+        # points with few stars only get the constant term
+        counts = (weights > 0).sum(axis=1)
+        lowOrder = counts < 3 * nexp
+        normal[lowOrder, 1:, :] = 0.0
+        normal[lowOrder, :, 1:] = 0.0
+        vector[lowOrder, 1:] = 0.0
+        diagonal = np.arange(nexp)
+        normal[:, diagonal, diagonal] += np.where(normal[:, diagonal, diagonal] > 0,
+                                                  1e-9 * normal[:, diagonal, diagonal], 1.0)
+        table = np.linalg.solve(normal, vector[:, :, np.newaxis])[:, :, 0]
+        if clipping:
+            break
+        misfit = samples - np.dot(table, terms.T)
+        # sigma of each point from the median absolute deviation of the stars there
+        absolute = np.where(weights > 0, np.abs(misfit) * np.sqrt(starWeights)[np.newaxis, :], np.nan)
+        with np.errstate(invalid='ignore'):
+            sigma = 1.4826 * np.nanmedian(np.where(np.isnan(absolute).all(axis=1)[:, np.newaxis], 0.0, absolute), axis=1)
+            weights = weights * (absolute <= clipSigma * np.maximum(sigma, 1e-30)[:, np.newaxis])
+    return table.T.reshape(nexp, npsf, npsf)
+
+
+def buildPsf(pixels, stars, options, frameShape=None, seed=None):
+    '''The PSF from the stars ({'id', 'x', 'y', 'mag', 'sky'} arrays) on the frame. Returns
+    (DaoPsf or None if no star could be used, report). The report has 'chi', 'label',
+    'parameters' and 'stars': one {'id', 'x', 'y', 'mag', 'chi', 'flag'} per star, where flag is
+    '' (fine), '?' or '*' (chi more than 2 or 3 times the average), or why the star wasn't used
+    ('off frame', 'no sky' (sky is nan), 'saturated', 'faint'). seed is a PSF (DaoPsf) to start the profile fit from,
+    say the one of another frame of the same field.'''
+    nRows, nColumns = frameShape or pixels.shape
+    psfRadius = options['PS']
+    fittingRadius = options['FI']
+    nexp = variabilityTerms.get(int(options['VA']), 6)
+    radius = int(psfRadius) + 3
+    side = 2 * radius + 1
+    readNoise2 = options['RE'] ** 2
+    x = np.asarray(stars['x'], dtype=float)
+    y = np.asarray(stars['y'], dtype=float)
+    sky = np.asarray(stars['sky'], dtype=float)
+    noSky = np.isnan(sky)
+    sky = np.where(noSky, 0.0, sky)
+    mag = np.asarray(stars['mag'], dtype=float)
+    report = {'chi': None, 'label': None, 'parameters': [], 'stars': []}
+    flags = np.array([''] * len(x), dtype=object)
+
+    cutouts = IrafImage.stamps(pixels, x, y, radius) - sky[:, np.newaxis, np.newaxis]
+    # offsets of the cutout pixels from each star
+    centerX = np.rint(x - 1) + 1
+    centerY = np.rint(y - 1) + 1
+    offsets = np.arange(-radius, radius + 1)
+    dx0 = (centerX - x)[:, np.newaxis, np.newaxis] + offsets[np.newaxis, np.newaxis, :] + np.zeros((1, side, 1))
+    dy0 = (centerY - y)[:, np.newaxis, np.newaxis] + offsets[np.newaxis, :, np.newaxis] + np.zeros((1, 1, side))
+    near = dx0 * dx0 + dy0 * dy0 <= fittingRadius * fittingRadius
+    within = dx0 * dx0 + dy0 * dy0 <= psfRadius * psfRadius
+    valid = ~np.isnan(cutouts)
+    flags[~(valid | ~within).reshape(len(x), -1).all(axis=1)] = 'off frame'
+    flags[noSky & (flags == '')] = 'no sky'
+    flags[((cutouts + sky[:, np.newaxis, np.newaxis] >= options['HI']) & near).reshape(len(x), -1).any(axis=1) &
+          (flags == '')] = 'saturated'
+    peaks = np.where(near & valid, cutouts, -np.inf).reshape(len(x), -1).max(axis=1)
+    flags[(peaks <= 0) & (flags == '')] = 'faint'
+    used = np.nonzero(flags == '')[0]
+    if not len(used):
+        report['stars'] = starReport(stars, flags, np.zeros(len(x)))
+        return None, report
+
+    cutouts = np.where(valid, cutouts, 0.0)
+    data = cutouts[used].reshape(len(used), -1)
+    fitPixels = (near & valid)[used].reshape(len(used), -1)
+    weight = fitPixels / (readNoise2 + np.maximum(data + sky[used, np.newaxis], 0.0) / options['GA'])
+
+    # the analytic profile, or the best of all of them up to -AN
+    profileNumber = int(options['AN'])
+    numbers = [profileNumber] if profileNumber > 0 else range(1, -profileNumber + 1)
+    best = None
+    for number in numbers:
+        label = DaoPsf.analyticProfiles[number][0]
+        if seed is not None and seed.label == label:
+            start = list(seed.parameters)
+        else:
+            start = startingParameters(label, options['FW'])
+        fitted = fitProfile(label, data, weight, dx0[used].reshape(len(used), -1), dy0[used].reshape(len(used), -1),
+                            peaks[used], start)
+        if best is None or fitted[-1] < best[1][-1]:
+            best = (label, fitted)
+    label, (parameters, heights, shiftX, shiftY, chi2) = best
+    fittedX = x.copy()
+    fittedY = y.copy()
+    fittedX[used] += shiftX
+    fittedY[used] += shiftY
+
+    # heights against the aperture magnitudes: the first usable star sets PSFMAG
+    goodMags = np.nonzero(mag[used] < DaoCatalog.badMagnitude - 0.001)[0]
+    psfMag = mag[used][goodMags[0]] if len(goodMags) else 20.0
+    if len(goodMags):
+        bright = np.median(heights[goodMags] / 10.0 ** (-0.4 * (mag[used][goodMags] - psfMag)))
+    else:
+        bright = heights[0]
+    scales = heights / bright
+
+    # residuals from the profile in PSF units, on each star's cutout grid
+    dx = dx0[used] - shiftX[:, np.newaxis, np.newaxis]
+    dy = dy0[used] - shiftY[:, np.newaxis, np.newaxis]
+    profile = DaoPsf.pixelProfile(label, parameters, dx, dy)
+    residuals = cutouts[used] / scales[:, np.newaxis, np.newaxis] - bright * profile
+    npsf = DaoPsf.tableSize(psfRadius)
+    psf = DaoPsf.DaoPsf(label, parameters, np.zeros((nexp, npsf, npsf)), psfMag, bright,
+                        (nColumns - 1) / 2.0, (nRows - 1) / 2.0)
+    if int(options['VA']) >= 0:
+        nodeOffsets = (np.arange(npsf) - psf.center) / 2.0
+        # the table points in cutout coordinates (index of the cutout pixel, fractional)
+        nodeColumn = (fittedX[used] - centerX[used])[:, np.newaxis, np.newaxis] + radius + nodeOffsets[np.newaxis, np.newaxis, :]
+        nodeRow = (fittedY[used] - centerY[used])[:, np.newaxis, np.newaxis] + radius + nodeOffsets[np.newaxis, :, np.newaxis]
+        nodeColumn = nodeColumn + np.zeros((1, npsf, 1))
+        nodeRow = nodeRow + np.zeros((1, 1, npsf))
+        terms = psf.spatialTerms(fittedX[used], fittedY[used])
+        starWeights = scales ** 2 / (readNoise2 + (sky[used] + heights) / options['GA'])
+        table = fitTable(residuals, valid[used], nodeColumn, nodeRow, terms, starWeights, nexp)
+        psf = DaoPsf.DaoPsf(label, parameters, table, psfMag, bright, psf.xpsf, psf.ypsf)
+
+    # how well the finished PSF does on each star
+    model = scales[:, np.newaxis] * psf.evaluate(dx.reshape(len(used), -1), dy.reshape(len(used), -1),
+                                                 fittedX[used], fittedY[used])
+    model = model.reshape(dx.shape)
+    misfit = np.where((near & valid)[used], cutouts[used] - model, 0.0)
+    nPixels = np.maximum((near & valid)[used].reshape(len(used), -1).sum(axis=1), 1)
+    chi = np.zeros(len(x))
+    chi[used] = np.sqrt((misfit * misfit).reshape(len(used), -1).sum(axis=1) / nPixels) / heights
+    average = np.sqrt(np.mean(chi[used] ** 2))
+    flags[used[chi[used] > 2 * average]] = '?'
+    flags[used[chi[used] > 3 * average]] = '*'
+
+    report['chi'] = float(average)
+    report['label'] = label
+    report['parameters'] = [float(value) for value in parameters]
+    report['stars'] = starReport(dict(stars, x=fittedX, y=fittedY), flags, chi)
+    return psf, report
+
+
+def starReport(stars, flags, chi):
+    return [{'id': int(stars['id'][i]), 'x': float(stars['x'][i]), 'y': float(stars['y'][i]),
+             'mag': float(stars['mag'][i]), 'chi': float(chi[i]), 'flag': flags[i]} for i in range(len(flags))]
+
+
+def formatReport(report):
+    '''The report as text, laid out like daophot's list'''
+    lines = []
+    if report['label']:
+        lines.append('%s  %s' % (report['label'], '  '.join('%.4f' % value for value in report['parameters'])))
+    lines.append('     ID      Chi  Flag')
+    for star in report['stars']:
+        lines.append('%7d %8.3f  %s' % (star['id'], star['chi'], star['flag']))
+    if report['chi'] is not None:
+        lines.append('Chi = %.4f' % report['chi'])
+    return '\n'.join(lines) + '\n'
+
+
+def writeNeighbors(path, header, apColumns, psfX, psfY, radius):
+    '''Everything in the .ap within radius of a PSF star (the PSF stars too), in .lst layout,
+    for allstar to fit before the PSF is made again without them'''
+    index = CatalogMatch.GridIndex(apColumns['x'], apColumns['y'], radius)
+    queries, neighbors = index.within(psfX, psfY, radius)
+    chosen = np.unique(neighbors)
+    mag = apColumns['mag'][:, 0] if apColumns['mag'].ndim == 2 else apColumns['mag']
+    DaoCatalog.writeCatalog(path, header, {'id': apColumns['id'][chosen], 'x': apColumns['x'][chosen],
+                                           'y': apColumns['y'][chosen], 'mag': mag[chosen],
+                                           'sky': apColumns['sky'][chosen]}, 'lst')
+    return
+
+
+def removeStars(listPath, starIds):
+    '''Takes the stars with these ids out of a star list'''
+    header, columns = DaoCatalog.readCatalog(listPath)
+    keep = ~np.in1d(columns['id'], starIds)
+    DaoCatalog.writeCatalog(listPath, header, DaoCatalog.selectRows(columns, keep))
+    return
+
+
+def makePsf(workingDirectory, imageName, apName, listName, psfName, neighborsName=None, seed=None):
+    '''daophot's PSF command: the stars in listName, with sky and magnitudes from apName, on
+    imageName (.imh). Writes psfName and, if given, neighborsName. Returns the report (see
+    buildPsf, also for seed), or raises IOError if no star could be used.'''
+    options = readOptions(workingDirectory)
+    imhPath = os.path.join(workingDirectory, imageName if imageName.endswith('.imh') else imageName + '.imh')
+    pixels = FrameCache.pixels(imhPath)
+    apHeader, apColumns = DaoCatalog.readCatalog(os.path.join(workingDirectory, apName))
+    listHeader, listColumns = DaoCatalog.readCatalog(os.path.join(workingDirectory, listName))
+    # sky and magnitude from the .ap (the list may be a hand edited one without them)
+    rows = dict((starId, row) for (row, starId) in enumerate(apColumns['id']))
+    apMag = apColumns['mag'][:, 0] if apColumns['mag'].ndim == 2 else apColumns['mag']
+    # a star that isn't in the .ap takes the list's sky, and without one there buildPsf leaves it out
+    sky = np.array([apColumns['sky'][rows[starId]] if starId in rows else
+                    (listColumns['sky'][i] if 'sky' in listColumns else np.nan)
+                    for (i, starId) in enumerate(listColumns['id'])], dtype=float)
+    mag = np.array([apMag[rows[starId]] if starId in rows else DaoCatalog.badMagnitude
+                    for starId in listColumns['id']], dtype=float)
+    if apHeader:
+        options['HI'] = apHeader['HIGHBAD']
+    stars = {'id': listColumns['id'], 'x': listColumns['x'], 'y': listColumns['y'], 'mag': mag, 'sky': sky}
+
+    psf, report = buildPsf(pixels, stars, options, seed=seed)
+    if psf is None:
+        raise IOError('none of the stars in ' + listName + ' could be used for the PSF')
+    DaoPsf.writePsf(os.path.join(workingDirectory, psfName), psf)
+    if neighborsName:
+        writeNeighbors(os.path.join(workingDirectory, neighborsName), apHeader, apColumns, stars['x'], stars['y'],
+                       options['PS'] + 2 * options['FI'])
+    return report
+
+
+def psfStep(imageName, apName, listName, psfName, neighborsName=None):
+    '''StepGraph function for a native PSF run. The report goes in the log.'''
+    def runPsf(workingDirectory):
+        return formatReport(makePsf(workingDirectory, imageName, apName, listName, psfName, neighborsName))
+    return runPsf
@@ -0,0 +1,162 @@
+# Picks the PSF stars without a person in the loop. This replaces the
+# "record the number of stars and the magnitude limit" / PICK round trips:
+#
+# 1) The magnitude limit comes from the .ap file itself: the faintest
+#    magnitude where the typical error is still below maxError.
+# 2) Candidates must be brighter than that, unsaturated (peak below HI from
+#    daophot.opt), far enough from the edge for the PSF radius, free of
+#    bright neighbors, and about as wide as the FWHM says a star should be
+#    (so no cosmic rays, hot pixels or blends).
+# 3) The chip is cut into a grid and stars are taken from each cell in turn,
+#    brightest first, so the PSF sees the whole frame and not just the core
+#    of the cluster.
+# The result is written straight to ${frame}.lst in PICK's format.
+
+import os
+
+import numpy as np
+
+import CatalogMatch
+import DaoCatalog
+import FrameCache
+import IrafImage
+import OptionFiles
+
+defaultPsfStars = 100
+maxError = 0.02          # magnitude limit is where the median error passes this
+isolationMagnitudes = 2.5  # neighbors fainter than this (relative to the candidate) are harmless
+gridSize = 4             # chip is split gridSize x gridSize for spreading the stars out
+widthRange = (0.7, 1.6)  # allowed second moment FWHM, as a fraction of the frame FWHM
+
+
+def estimateMagLimit(mag, err, maxError=maxError, binWidth=0.25):
+    '''Faintest magnitude where the median error in binWidth bins stays below maxError'''
+    good = (mag < DaoCatalog.badMagnitude - 1) & (err < 9.0)
+    mag = mag[good]
+    err = err[good]
+    if len(mag) == 0:
+        return None
+    edges = np.arange(mag.min(), mag.max() + binWidth, binWidth)
+    bins = np.digitize(mag, edges) - 1
+    limit = None
+    for i in range(len(edges) - 1):
+        inBin = err[bins == i]
+        if len(inBin) == 0:
+            continue
+        if np.median(inBin) > maxError:
+            break
+        limit = edges[i + 1]
+    return limit
+
+
+def measureWidths(cutouts, sky):
+    '''Second moment FWHM of each background subtracted stamp'''
+    side = cutouts.shape[1]
+    offsets = np.arange(side) - side // 2
+    offsetY, offsetX = np.meshgrid(offsets, offsets, indexing='ij')
+    flux = np.nan_to_num(cutouts - sky[:, np.newaxis, np.newaxis])
+    flux = np.maximum(flux, 0.0)
+    total = flux.sum(axis=(1, 2))
+    total[total <= 0] = np.nan
+    centerX = (flux * offsetX).sum(axis=(1, 2)) / total
+    centerY = (flux * offsetY).sum(axis=(1, 2)) / total
+    secondMoment = (flux * ((offsetX - centerX[:, np.newaxis, np.newaxis]) ** 2 +
+                            (offsetY - centerY[:, np.newaxis, np.newaxis]) ** 2)).sum(axis=(1, 2)) / total
+    # <r^2> = 2 sigma^2 for a gaussian
+    return 2.3548 * np.sqrt(secondMoment / 2.0)
+
+
+def spreadOverChip(x, y, mag, nStars, nColumns, nRows, gridSize=gridSize):
+    '''Indices of nStars stars, taken round robin from a gridSize x gridSize grid, brightest first in each cell'''
+    cellX = np.minimum((x - 1) * gridSize // nColumns, gridSize - 1).astype(int)
+    cellY = np.minimum((y - 1) * gridSize // nRows, gridSize - 1).astype(int)
+    cells = cellY * gridSize + cellX
+    queues = []
+    for cell in range(gridSize * gridSize):
+        members = np.nonzero(cells == cell)[0]
+        queues.append(list(members[np.argsort(mag[members])]))
+    chosen = []
+    while len(chosen) < nStars and any(queues):
+        for queue in queues:
+            if queue and len(chosen) < nStars:
+                chosen.append(queue.pop(0))
+    return np.array(sorted(chosen, key=lambda i: mag[i]), dtype=int)
+
+
+def selectPsfStars(apColumns, pixels, fwhm, nStars=defaultPsfStars, magLimit=None, highBad=55000.0,
+                   psfRadius=15.0, gridSize=gridSize):
+    '''Chooses the PSF stars. Returns (indices into the .ap columns, summary dictionary).'''
+    mag = apColumns['mag'][:, 0]
+    err = apColumns['err'][:, 0]
+    x = apColumns['x']
+    y = apColumns['y']
+    nRows, nColumns = pixels.shape
+    if magLimit is None:
+        magLimit = estimateMagLimit(mag, err)
+    summary = {'magLimit': magLimit, 'stars': len(mag)}
+    if magLimit is None:
+        summary['selected'] = 0
+        return np.zeros(0, dtype=int), summary
+
+    candidates = (mag < DaoCatalog.badMagnitude - 1) & (mag <= magLimit)
+    summary['brightEnough'] = int(candidates.sum())
+
+    # the whole PSF box has to fit on the chip
+    margin = psfRadius + 1
+    onChip = (x > margin) & (x < nColumns - margin) & (y > margin) & (y < nRows - margin)
+    summary['edge'] = int((candidates & ~onChip).sum())
+    candidates &= onChip
+
+    indices = np.nonzero(candidates)[0]
+    radius = int(np.ceil(2 * fwhm))
+    cutouts = IrafImage.stamps(pixels, x[indices], y[indices], radius)
+    peaks = np.nanmax(cutouts.reshape(len(indices), -1), axis=1) if len(indices) else np.zeros(0)
+    unsaturated = peaks < highBad
+    summary['saturated'] = int((~unsaturated).sum())
+
+    widths = measureWidths(cutouts, apColumns['sky'][indices]) if len(indices) else np.zeros(0)
+    starLike = (widths > widthRange[0] * fwhm) & (widths < widthRange[1] * fwhm)
+    summary['shape'] = int((unsaturated & ~starLike).sum())
+    indices = indices[unsaturated & starLike]
+
+    # nothing within the PSF radius that is bright enough to matter
+    allGood = np.nonzero(mag < DaoCatalog.badMagnitude - 1)[0]
+    index = CatalogMatch.GridIndex(x[allGood], y[allGood], psfRadius)
+    queries, neighbors = index.within(x[indices], y[indices], psfRadius)
+    neighbors = allGood[neighbors]
+    contaminating = (neighbors != indices[queries]) & (mag[neighbors] < mag[indices[queries]] + isolationMagnitudes)
+    crowded = np.zeros(len(indices), dtype=bool)
+    crowded[queries[contaminating]] = True
+    summary['crowded'] = int(crowded.sum())
+    indices = indices[~crowded]
+
+    chosen = spreadOverChip(x[indices], y[indices], mag[indices], nStars, nColumns, nRows, gridSize)
+    summary['selected'] = len(chosen)
+    return indices[chosen], summary
+
+
+def writePsfList(path, header, apColumns, chosen):
+    '''${frame}.lst in the layout PICK writes (id x y mag sky)'''
+    if header is not None:
+        header = dict(header)
+        header['NL'] = 3
+    DaoCatalog.writeCatalog(path, header, {'id': apColumns['id'][chosen],
+                                           'x': apColumns['x'][chosen],
+                                           'y': apColumns['y'][chosen],
+                                           'mag': apColumns['mag'][chosen, 0],
+                                           'sky': apColumns['sky'][chosen]}, 'lst')
+    return
+
+
+def pickPsfStars(frameDirectory, frame, fwhm, nStars=defaultPsfStars, magLimit=None):
+    '''Reads ${frame}.ap, the image and daophot.opt from the frame folder, picks the stars and writes
+    ${frame}.lst. Returns the summary.'''
+    options = {}
+    if os.path.exists(os.path.join(frameDirectory, 'daophot.opt')):
+        options = OptionFiles.readOptionFile(os.path.join(frameDirectory, 'daophot.opt'))
+    header, apColumns = DaoCatalog.readCatalog(os.path.join(frameDirectory, frame + '.ap'))
+    pixels = FrameCache.pixels(os.path.join(frameDirectory, frame + '.imh'))
+    chosen, summary = selectPsfStars(apColumns, pixels, fwhm, nStars, magLimit,
+                                     options.get('HI', 55000.0), options.get('PS', 15.0))
+    writePsfList(os.path.join(frameDirectory, frame + '.lst'), header, apColumns, chosen)
+    return summary
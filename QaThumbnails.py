@@ -0,0 +1,295 @@
+# Pictures of every frame for checking a night's reductions in a browser
+# instead of one frame at a time in ds9. For each frame folder, dataSet/qa/
+# gets small PNGs of
+#   frame     ${frame}.imh with the PSF stars (${frame}.lst) circled
+#   psfsub    ${frame}3s.imh, the frame with the stars around the PSF stars
+#             taken out, PSF stars circled in red and the ones kept for
+#             3s.psf (${frame}_2.lst) in green, like the tvmark marks
+#   sub2      ${frame}sub2.imh, what's left after allstar
+#   edited    ${frame}.imh with a dot on every star of edt${frame}.als2
+# all on the frame's display scale (so a bad subtraction stands out), and
+# qa/index.html shows them side by side with a few numbers per frame. Frames
+# whose sub2 is much noisier than the sky of the frame are marked for a look
+# in ds9. Each frame's numbers are kept in qa/${frame}.json, so redoing one
+# frame (autoreduce does after alsedt) doesn't draw the others again.
+#
+# The pixels come from the memory mapped images a band of rows at a time and
+# the PNGs are written with zlib, so this runs anywhere (no display, no PIL).
+# Frames are done in a pool of processes.
+#
+#   python QaThumbnails.py /data/n2158_phot/n2158/ [frame ...]
+
+import cgi
+import json
+import multiprocessing
+import os
+import struct
+import sys
+import time
+import zlib
+from string import Template
+
+import numpy as np
+
+import Archive
+import Artifacts
+import Checkpoint
+import DaoCatalog
+import FrameCache
+
+thumbnailSize = 800     # pixels along the longer side, at most
+bandRows = 512          # image rows read at a time
+sampleRows = 64         # rows looked at for the noise numbers
+residualLimit = 1.5     # sub2 noise over the frame's sky noise above this gets a look
+qaFolder = 'qa'
+
+red = (255, 60, 60)
+green = (60, 255, 60)
+
+# (view, image, [(catalog, mark, color), ...])
+views = [('frame', '${frame}.imh', [('${frame}.lst', 'circle', red)]),
+         ('psfsub', '${frame}3s.imh', [('${frame}.lst', 'circle', red), ('${frame}_2.lst', 'circle', green)]),
+         ('sub2', '${frame}sub2.imh', []),
+         ('edited', '${frame}.imh', [('edt${frame}.als2', 'point', green)])]
+
+
+def pngChunk(kind, data):
+    chunk = kind + data
+    return struct.pack('>I', len(data)) + chunk + struct.pack('>I', zlib.crc32(chunk) & 0xffffffff)
+
+
+def writePng(path, image):
+    '''image is (rows, columns) gray or (rows, columns, 3) RGB, uint8, top row first'''
+    image = np.ascontiguousarray(image, dtype=np.uint8)
+    nRows, nColumns = image.shape[:2]
+    colorType = 2 if image.ndim == 3 else 0
+    # every row starts with its filter type, 0 (none)
+    raw = np.concatenate([np.zeros((nRows, 1), dtype=np.uint8), image.reshape(nRows, -1)], axis=1)
+    pngFile = open(path, 'wb')
+    pngFile.write('\x89PNG\r\n\x1a\n')
+    pngFile.write(pngChunk('IHDR', struct.pack('>IIBBBBB', nColumns, nRows, 8, colorType, 0, 0, 0)))
+    pngFile.write(pngChunk('IDAT', zlib.compress(raw.tostring(), 6)))
+    pngFile.write(pngChunk('IEND', ''))
+    pngFile.close()
+    return
+
+
+def downsample(pixels, factor):
+    '''Means of factor x factor blocks, read bandRows rows at a time'''
+    nRows, nColumns = pixels.shape[0] // factor, pixels.shape[1] // factor
+    thumbnail = np.zeros((nRows, nColumns), dtype=np.float32)
+    step = max(1, bandRows // factor)
+    for start in range(0, nRows, step):
+        stop = min(nRows, start + step)
+        block = np.asarray(pixels[start * factor:stop * factor, :nColumns * factor], dtype=np.float32)
+        thumbnail[start:stop] = block.reshape(stop - start, factor, nColumns, factor).mean(axis=3).mean(axis=1)
+    return thumbnail
+
+
+def robustSigma(values):
+    low, high = np.percentile(values, [15.87, 84.13])
+    return (high - low) / 2.0
+
+
+def displayLimits(thumbnail):
+    '''Sky a bit above black, stars well into white'''
+    level = np.median(thumbnail)
+    sigma = max(robustSigma(thumbnail), 1e-6)
+    return level - 3 * sigma, level + 40 * sigma
+
+
+def grayImage(thumbnail, limits):
+    low, high = limits
+    scaled = np.clip((thumbnail - low) / (high - low), 0.0, 1.0)
+    gray = (np.sqrt(scaled) * 255).astype(np.uint8)
+    return np.repeat(gray[:, :, np.newaxis], 3, axis=2)
+
+
+def drawMarks(image, x, y, factor, mark, color):
+    '''Marks at frame positions x, y (daophot, 1 based) on a thumbnail still in frame row order'''
+    nRows, nColumns = image.shape[:2]
+    column = (np.asarray(x, dtype=float) - 1) / factor
+    row = (np.asarray(y, dtype=float) - 1) / factor
+    if mark == 'circle':
+        angles = np.linspace(0, 2 * np.pi, 48, endpoint=False)
+        radius = max(10.0 / factor, 4.0)
+        columns = np.rint(column[:, np.newaxis] + radius * np.cos(angles)).astype(int).ravel()
+        rows = np.rint(row[:, np.newaxis] + radius * np.sin(angles)).astype(int).ravel()
+    else:
+        offsets = np.array([0, 1, 0, 1]), np.array([0, 0, 1, 1])
+        columns = (np.rint(column).astype(int)[:, np.newaxis] + offsets[0]).ravel()
+        rows = (np.rint(row).astype(int)[:, np.newaxis] + offsets[1]).ravel()
+    inside = (rows >= 0) & (rows < nRows) & (columns >= 0) & (columns < nColumns)
+    image[rows[inside], columns[inside]] = color
+    return image
+
+
+def sampledNoise(pixels):
+    '''Robust sigma of every few rows of the frame, for the noise numbers'''
+    step = max(1, pixels.shape[0] // sampleRows)
+    return robustSigma(np.asarray(pixels[::step], dtype=np.float32))
+
+
+def renderFrame(dataSetDirectory, frame):
+    '''Writes the frame's thumbnails into qa/. Returns the frame's summary: 'frame', 'views' ({view :
+    png name}), 'psfStars', 'edtStars', 'residual' (sub2 noise over the frame's sky noise), 'chi'
+    (the last PSF chi accepted), 'steps' (reduction steps done) and 'check' (worth a look in ds9).'''
+    frameDirectory = os.path.join(dataSetDirectory, frame)
+    outputDirectory = os.path.join(dataSetDirectory, qaFolder)
+    summary = {'frame': frame, 'views': {}, 'psfStars': None, 'edtStars': None, 'residual': None, 'chi': None}
+    imhPath = os.path.join(frameDirectory, frame + '.imh')
+    pixels = FrameCache.pixels(imhPath)
+    factor = max(1, int(np.ceil(max(pixels.shape) / float(thumbnailSize))))
+    limits = displayLimits(downsample(pixels, factor))
+
+    for (view, imageName, overlays) in views:
+        path = os.path.join(frameDirectory, Template(imageName).substitute(frame=frame))
+        if not os.path.exists(path):
+            continue
+        image = grayImage(downsample(FrameCache.pixels(path), factor), limits)
+        for (catalogName, mark, color) in overlays:
+            catalogPath = os.path.join(frameDirectory, Template(catalogName).substitute(frame=frame))
+            if Archive.exists(catalogPath):
+                header, columns = DaoCatalog.readCatalog(catalogPath)
+                drawMarks(image, columns['x'], columns['y'], factor, mark, color)
+        pngName = frame + '_' + view + '.png'
+        # north up like ds9: the first image row is y = 1, which goes at the bottom
+        writePng(os.path.join(outputDirectory, pngName), image[::-1])
+        summary['views'][view] = pngName
+
+    for (name, catalogName) in [('psfStars', frame + '.lst'), ('edtStars', 'edt' + frame + '.als2')]:
+        if Archive.exists(os.path.join(frameDirectory, catalogName)):
+            summary[name] = len(DaoCatalog.readCatalog(os.path.join(frameDirectory, catalogName))[1]['id'])
+    subtractedPath = os.path.join(frameDirectory, frame + 'sub2.imh')
+    if os.path.exists(subtractedPath):
+        summary['residual'] = float(sampledNoise(FrameCache.pixels(subtractedPath)) /
+                                    max(sampledNoise(pixels), 1e-6))
+    frameState = Checkpoint.FrameState(dataSetDirectory, frame)
+    accepted = frameState.getParameter('acceptedChi', [])
+    if accepted:
+        summary['chi'] = accepted[-1][1]
+    summary['steps'] = len([step for step in Checkpoint.reductionSteps if frameState.stepDone(step)])
+    summary['check'] = summary['residual'] is None or summary['residual'] > residualLimit
+    return summary
+
+
+def renderFrameJob(arguments):
+    dataSetDirectory, frame = arguments
+    try:
+        summary = renderFrame(dataSetDirectory, frame)
+    except (IOError, OSError, ValueError), e:
+        summary = {'frame': frame, 'error': str(e)}
+    # kept so the index can be written again without drawing every frame again
+    summaryFile = open(os.path.join(dataSetDirectory, qaFolder, frame + '.json'), 'w')
+    json.dump(summary, summaryFile)
+    summaryFile.close()
+    return summary
+
+
+def readSummaries(dataSetDirectory):
+    '''The summaries of every frame drawn so far'''
+    summaries = []
+    outputDirectory = os.path.join(dataSetDirectory, qaFolder)
+    for frame in Artifacts.frameNames(dataSetDirectory):
+        path = os.path.join(outputDirectory, frame + '.json')
+        if os.path.exists(path):
+            summaryFile = open(path, 'r')
+            summary = json.load(summaryFile)
+            summaryFile.close()
+            summary['frame'] = str(summary['frame'])
+            summaries.append(summary)
+    return summaries
+
+
+def formatNumber(value, form):
+    return '-' if value is None else form % value
+
+
+def writeIndex(dataSetDirectory, summaries):
+    '''qa/index.html: a row per frame, frames worth a look first'''
+    rows = []
+    order = sorted(summaries, key=lambda summary: (not summary.get('check', True), summary['frame']))
+    for summary in order:
+        cells = ['<td class="name">%s%s</td>' % (cgi.escape(summary['frame']),
+                                                 '<br><b>check in ds9</b>' if summary.get('check', True) else '')]
+        if 'error' in summary:
+            cells.append('<td colspan="%d">%s</td>' % (len(views) + 1, cgi.escape(summary['error'])))
+        else:
+            cells.append('<td class="numbers">PSF stars %s<br>chi %s<br>edited stars %s<br>sub2/sky noise %s<br>'
+                         'steps %d/%d</td>' % (formatNumber(summary['psfStars'], '%d'),
+                                               formatNumber(summary['chi'], '%.4f'),
+                                               formatNumber(summary['edtStars'], '%d'),
+                                               formatNumber(summary['residual'], '%.2f'), summary['steps'],
+                                               len(Checkpoint.reductionSteps)))
+            for (view, imageName, overlays) in views:
+                pngName = summary['views'].get(view)
+                if pngName is None:
+                    cells.append('<td>no %s</td>' % view)
+                else:
+                    cells.append('<td><a href="%s"><img src="%s" title="%s"></a></td>' % (pngName, pngName, view))
+        rows.append('<tr%s>%s</tr>' % (' class="check"' if summary.get('check', True) else '', ''.join(cells)))
+
+    page = Template('''<html><head><title>$title</title><style>
+body { font-family: sans-serif; background: #222; color: #ddd; }
+td { vertical-align: top; padding: 4px; }
+img { width: 240px; }
+tr.check td.name { color: #f66; }
+</style></head><body>
+<h2>$title</h2>
+<p>$count frames, made $made. Red circles are PSF stars, green circles the ones kept for 3s.psf,
+green dots the edited catalog. Frames worth a look in ds9 come first.</p>
+<table><tr><th>frame</th><th></th>$headings</tr>
+$rows
+</table></body></html>
+''').substitute(title=cgi.escape(dataSetDirectory), count=len(summaries), made=time.strftime('%Y-%m-%d %H:%M'),
+                headings=''.join('<th>%s</th>' % view for (view, imageName, overlays) in views),
+                rows='\n'.join(rows))
+    indexPath = os.path.join(dataSetDirectory, qaFolder, 'index.html')
+    indexFile = open(indexPath + '.tmp', 'w')
+    indexFile.write(page)
+    indexFile.close()
+    os.rename(indexPath + '.tmp', indexPath)
+    return indexPath
+
+
+def renderDataSet(dataSetDirectory, frames=None, processes=None):
+    '''Thumbnails of the frames (all of them by default) in a worker pool, and the index (frames
+    not drawn now as they were drawn last time). Returns (index path, {frame : summary}) of the
+    frames drawn now.'''
+    if frames is None:
+        frames = Artifacts.frameNames(dataSetDirectory)
+    outputDirectory = os.path.join(dataSetDirectory, qaFolder)
+    if not os.path.isdir(outputDirectory):
+        os.mkdir(outputDirectory)
+    pool = multiprocessing.Pool(processes)
+    try:
+        summaries = pool.map(renderFrameJob, [(dataSetDirectory, frame) for frame in frames])
+    finally:
+        pool.close()
+        pool.join()
+    others = [other for other in readSummaries(dataSetDirectory) if other['frame'] not in frames]
+    return writeIndex(dataSetDirectory, others + summaries), dict((summary['frame'], summary) for summary in summaries)
+
+
+def refreshFrame(dataSetDirectory, frame):
+    '''Redoes one frame's thumbnails and the index (the other frames as they were drawn last time).
+    Returns (index path, the frame's summary).'''
+    outputDirectory = os.path.join(dataSetDirectory, qaFolder)
+    if not os.path.isdir(outputDirectory):
+        os.mkdir(outputDirectory)
+    summary = renderFrameJob((dataSetDirectory, frame))
+    summaries = [other for other in readSummaries(dataSetDirectory) if other['frame'] != frame]
+    return writeIndex(dataSetDirectory, summaries + [summary]), summary
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2:
+        print 'usage: python QaThumbnails.py dataSetDirectory [frame ...]'
+        sys.exit(1)
+    indexPath, results = renderDataSet(sys.argv[1], sys.argv[2:] or None)
+    for frameName in sorted(results):
+        if 'error' in results[frameName]:
+            print '%-10s %s' % (frameName, results[frameName]['error'])
+        elif results[frameName]['check']:
+            print '%-10s check in ds9' % frameName
+    print 'Open ' + indexPath
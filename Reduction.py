@@ -0,0 +1,708 @@
+# The reduction steps as a library. Everything a step needs comes in through a
+# FrameContext (the data set, the frame, its FWHM, its saved state and the
+# settings), and every step gives back a dict of what it did, with 'error' in
+# it when it couldn't. Nothing here prompts, prints or opens ds9, so worker
+# processes, notebooks and scripts can import it and run the steps on their
+# own. autoreduce.py is the interactive program on top of it: the questions,
+# the ds9 views and the menu.
+#
+# The choices you make by looking at a frame are parameters here:
+#   psfCandidateSelection   numStars, magLimit for PICK (when PsfSelect and
+#                           the warm start aren't used or can't do it)
+#   neighborStarSubtraction the stars with close neighbors (sub_nonei.lst)
+#   badPSFSubtractionStarRemoval  the badly subtracted ones (sub.lst)
+#   acceptChi               the PSF you're happy with
+#   apcorrScript            waitForUser and askCoefficients, when it isn't
+#                           automatic (ScriptGraphs.apcorrGraph)
+# and runSteps takes a frame through the steps that need nothing else.
+#
+#   context = Reduction.openFrame('/data/n2158_phot/n2158/', 'n21157', {'psfEngine': 'native'})
+#   result = Reduction.trackStep(context, 'psfFirstPass', Reduction.psfFirstPass)
+
+import multiprocessing
+import os
+import subprocess
+import time
+from collections import OrderedDict
+from string import Template
+
+import Archive
+import Artifacts
+import Checkpoint
+import ExternalTools
+import PsfBuilder
+import PsfSelect
+import ScriptGraphs
+import Telemetry
+import WarmStart
+
+# what autoreduce's settings are when nothing says otherwise (see autoreduce.py for each one)
+defaultSettings = {'automaticPsfSelection': True,
+                   'psfStars': PsfSelect.defaultPsfStars,
+                   'warmStartFrame': None,
+                   'psfEngine': 'daophot',
+                   'allstarEngine': 'allstar',
+                   'allstarTiles': 0,
+                   'scriptGraphs': True,
+                   'scratchRoot': None,
+                   'scratchBudget': None,
+                   'automaticApcorr': True,
+                   'retentionPolicy': None,
+                   'catalogStoreDirectory': None,
+                   'filter': None,
+                   'qaThumbnails': True}
+
+externalPrograms = {'daophot': 'daophot',  # {what : program}
+                    'compapcorr': 'compapcorrHDI.e',
+                    'pyraf': 'pyraf',
+                    'ds9': 'ds9',
+                    'dao2iraf': 'dao2iraf.e',
+                    'sm': 'sm',
+                    'pstopdf': 'pstopdf',
+                    'alsedt': 'alsedt.e',
+                    'sigrejfit': 'sigrejfit.e',
+                    'poly': 'poly.e',
+                    'apply_apcorr': 'apply_apcorrHDI.e',
+                    'sublst': 'sublst.e',
+                    'magChiRoundPlotscr': 'magChiRoundPlot.scr'}
+
+
+class FrameContext:
+    '''The frame the steps work on. dataSetDirectory ends in a slash, frameDirectory doesn't.'''
+
+    def __init__(self, dataSetDirectory, frame, settings=None, fwhm=None):
+        self.dataSetDirectory = os.path.join(dataSetDirectory, '')
+        self.frame = frame
+        self.frameDirectory = self.dataSetDirectory + frame
+        self.settings = dict(defaultSettings)
+        if settings:
+            self.settings.update(settings)
+        self.frameState = Checkpoint.FrameState(self.dataSetDirectory, frame)
+        self.fwhm = fwhm
+        if self.fwhm is None:
+            self.fwhm = self.frameState.getParameter('fwhm')
+
+    def path(self, name):
+        return os.path.join(self.frameDirectory, name)
+
+    def exists(self, name):
+        return Archive.exists(self.path(name))
+
+    def setFwhm(self, fwhm):
+        self.fwhm = float(fwhm)
+        self.frameState.setParameter('fwhm', self.fwhm)
+        return
+
+    def filterName(self):
+        '''The frame's filter (CatalogMatch.frameFilter, the filter setting when the header doesn't
+        say), saved in the frame state'''
+        import CatalogMatch
+        filterName = CatalogMatch.frameFilter(self.dataSetDirectory, self.frame, self.settings['filter'] or '')
+        if filterName and self.frameState.getParameter('filter') != filterName:
+            self.frameState.setParameter('filter', filterName)
+        return filterName
+
+    def warmStarted(self):
+        return self.frameState.getParameter('warmStart') is not None
+
+    def warmStartFrame(self):
+        '''The warm start reference, if there is one and it's another frame'''
+        referenceFrame = self.settings['warmStartFrame']
+        if referenceFrame and referenceFrame != self.frame:
+            return referenceFrame
+        return None
+
+
+def openFrame(dataSetDirectory, frame, settings=None):
+    '''A FrameContext with the FWHM saved for the frame, or the warm start frame's. Makes the
+    frame log, which the scripts append to.'''
+    context = FrameContext(dataSetDirectory, frame, settings)
+    if context.fwhm is None and context.warmStartFrame():
+        fwhm = WarmStart.referenceFwhm(context.dataSetDirectory, context.warmStartFrame())
+        if fwhm is not None:
+            context.setFwhm(fwhm)
+    if not context.exists(frame + '.log'):
+        open(context.path(frame + '.log'), 'w').close()
+    return context
+
+
+def removeFiles(context, names):
+    for name in names:
+        # an archived copy left behind would be taken for the new one
+        Archive.removeArchive(context.path(name))
+        try:
+            os.remove(context.path(name))
+        except OSError:
+            # it wasn't there, we don't care
+            pass
+    return
+
+
+def writeAnswers(context, inputName, answers, **values):
+    '''The .in file a program reads its answers from (kept in the frame folder to look at later)'''
+    answerFile = open(context.path(inputName), 'w')
+    answerFile.write(Template(answers).substitute(current_frame=context.frame, **values))
+    answerFile.close()
+    return
+
+
+def runExternal(context, programName, inputName=None, arguments=(), logToFrame=True):
+    '''Runs one of the externalPrograms in the frame folder. The lines of inputName (the .in file
+    the step wrote) are its answers. Output goes to the frame log if logToFrame. Returns
+    {'returnCode'}, with 'error' if it didn't work.'''
+    program = externalPrograms[programName]
+    answers = []
+    if inputName is not None:
+        commandFile = open(context.path(inputName), 'r')
+        answers = commandFile.read().splitlines()
+        commandFile.close()
+
+    returnCode, output = ExternalTools.runTool(program, answers, context.frameDirectory, arguments)
+    if logToFrame:
+        logFile = open(context.path(context.frame + '.log'), 'a')
+        logFile.write(output)
+        logFile.close()
+    result = {'returnCode': returnCode}
+    if returnCode == ExternalTools.notInCache:
+        result['error'] = program + ' was never recorded for this input, so there is nothing to replay.'
+    elif returnCode != 0:
+        result['error'] = program + ' exited with ' + str(returnCode) + '. Check the log.'
+    return result
+
+
+def missingPrograms():
+    '''The externalPrograms that can't be found on the path'''
+    import HelperFunctions
+    return sorted(name for (name, program) in externalPrograms.items() if not HelperFunctions.which(program))
+
+
+def trackStep(context, stepName, function, *arguments, **keywords):
+    '''Runs function(context, ...) as the step stepName: checkpoints it, publishes it, then
+    registers what it made and throws away what the retention policy allows. Returns the step's
+    result, with 'status' ('done' or 'incomplete') for the reduction steps. A step that raises is
+    marked failed, published and registered all the same, and the exception goes on up.'''
+    tracked = stepName in Checkpoint.reductionSteps
+    registry = Artifacts.ArtifactRegistry(context.dataSetDirectory, context.frame, context.settings['retentionPolicy'])
+    before = registry.snapshot()
+    if tracked:
+        context.frameState.startStep(stepName)
+    Telemetry.stepStarted(context.frame, stepName)
+    started = time.time()
+
+    try:
+        result = function(context, *arguments, **keywords)
+    except BaseException, e:
+        if tracked:
+            context.frameState.failStep(stepName, str(e) or e.__class__.__name__)
+        Telemetry.stepFinished(context.frame, stepName, 'failed', time.time() - started)
+        # what it made before it fell over is registered, but nothing is thrown away
+        registry.recordStep(stepName, before)
+        raise
+
+    status = 'done'
+    if tracked and not context.frameState.finishStep(stepName):
+        status = 'incomplete'
+    Telemetry.stepFinished(context.frame, stepName, status, time.time() - started)
+    registry.recordStep(stepName, before)
+    registry.applyPolicy('step')
+    if isinstance(result, dict) and tracked:
+        result['status'] = status
+    return result
+
+
+###
+# the steps, in the order they are run
+###
+
+def optionFilesMissing(context):
+    import OptionFiles
+    return [name for name in sorted(OptionFiles.optionFileDict) if not context.exists(name)]
+
+
+def setupOptFiles(context, names=None):
+    '''Writes the option files (the ones in names, all that are missing by default) from the
+    templates, and saves the frame's filter. Returns {'written', 'filter'}.'''
+    import OptionFiles
+    options = OptionFiles.OptionFiles(context.fwhm, context.dataSetDirectory, context.frame)
+    if names is None:
+        names = optionFilesMissing(context)
+    for name in names:
+        optionFile = open(context.path(name), 'w')
+        optionFile.write(options.optionFileDict[name])
+        optionFile.close()
+    return {'written': list(names), 'filter': context.filterName()}
+
+
+def psfFirstPass(context):
+    '''FIND and PHOT: ${frame}.coo and ${frame}.ap'''
+    removeFiles(context, [context.frame + '.coo', context.frame + '.ap'])
+    writeAnswers(context, 'psfFirstPass.in', '''at ${current_frame}.imh
+nomon
+fi
+1 1
+${current_frame}.coo
+y
+ph
+
+
+${current_frame}.coo
+${current_frame}.ap
+''')
+    return runExternal(context, 'daophot', 'psfFirstPass.in')
+
+
+def pickPsfCandidates(context, numStars, magLimit):
+    '''daophot PICK: the numStars brightest stars above magLimit into ${frame}.lst. The numbers
+    aren't saved; acceptPick does that once you're happy with the list.'''
+    removeFiles(context, [context.frame + '.lst'])
+    writeAnswers(context, 'psfCandidate.in', '''at ${current_frame}.imh
+nomon
+pi
+${current_frame}.ap
+${num_stars} ${mag_limit}
+${current_frame}.lst
+''', num_stars=numStars, mag_limit=magLimit)
+    return runExternal(context, 'daophot', 'psfCandidate.in')
+
+
+def acceptPick(context, numStars, magLimit):
+    context.frameState.setParameter('numStars', numStars)
+    context.frameState.setParameter('magLimit', magLimit)
+    return
+
+
+def automaticPsfCandidates(context):
+    '''${frame}.lst from PsfSelect. Returns PsfSelect's summary, with 'error' if it couldn't
+    pick any stars.'''
+    if context.fwhm is None:
+        return {'error': 'no FWHM for this frame yet'}
+    try:
+        summary = PsfSelect.pickPsfStars(context.frameDirectory, context.frame, context.fwhm,
+                                         context.settings['psfStars'])
+    except (IOError, OSError, ValueError), e:
+        return {'error': 'automatic PSF star selection failed (' + str(e) + ')'}
+    if summary['selected'] == 0:
+        summary['error'] = 'automatic PSF star selection found no usable stars'
+        return summary
+    acceptPick(context, summary['selected'], summary['magLimit'])
+    return summary
+
+
+def warmStartCandidates(context):
+    '''The PSF lists from the warm start frame's. Returns WarmStart's summary.'''
+    referenceFrame = context.warmStartFrame()
+    try:
+        summary = WarmStart.warmStart(context.dataSetDirectory, context.frame, referenceFrame)
+    except (IOError, OSError, ValueError), e:
+        return {'reference': referenceFrame, 'error': str(e)}
+    if 'error' not in summary:
+        context.frameState.setParameter('warmStart', summary)
+        context.frameState.setParameter('numStars', summary['lists'][context.frame + '.lst'][0])
+    return summary
+
+
+def psfCandidateSelection(context, numStars=None, magLimit=None):
+    '''${frame}.lst from the warm start frame, or PsfSelect, or (with numStars and magLimit)
+    PICK, whichever works first. Returns {'method', 'attempts' (the summaries of the ones that
+    didn't work)} and the result of the one that did.'''
+    attempts = []
+    if context.warmStartFrame():
+        summary = warmStartCandidates(context)
+        if 'error' not in summary:
+            return {'method': 'warmStart', 'summary': summary, 'attempts': attempts}
+        attempts.append(summary)
+    if context.settings['automaticPsfSelection']:
+        summary = automaticPsfCandidates(context)
+        if 'error' not in summary:
+            return {'method': 'automatic', 'summary': summary, 'attempts': attempts}
+        attempts.append(summary)
+    if numStars is None or magLimit is None:
+        return {'method': None, 'attempts': attempts, 'error': 'no PSF stars picked; PICK needs numStars and magLimit'}
+    result = pickPsfCandidates(context, numStars, magLimit)
+    if 'error' not in result:
+        acceptPick(context, numStars, magLimit)
+    return dict(result, method='pick', attempts=attempts)
+
+
+def daophotPsf(context, imageName, listName, psfName, inputName):
+    '''daophot PSF on imageName with the stars in listName'''
+    removeFiles(context, [psfName])
+    writeAnswers(context, inputName, '''at ${image}.imh
+nomon
+ps
+${current_frame}.ap
+${star_list}
+${psf}
+''', image=imageName, star_list=listName, psf=psfName)
+    # there might be a hang here if it finds bad stars. Could just insert a bunch of 'y' lines into the
+    # template above if you need to
+    return runExternal(context, 'daophot', inputName)
+
+
+def nativePsf(context, imageName, listName, psfName):
+    '''psfName from PsfBuilder (from the warm start frame's PSF if there is one). Returns the
+    report, which also goes in the frame state.'''
+    try:
+        seed = None
+        if context.warmStarted() and context.warmStartFrame():
+            seed = WarmStart.referencePsf(context.dataSetDirectory, context.warmStartFrame())
+        report = PsfBuilder.makePsf(context.frameDirectory, imageName, context.frame + '.ap', listName, psfName,
+                                    seed=seed)
+    except IOError, e:
+        return {'error': 'could not make ' + psfName + ': ' + str(e)}
+    reports = context.frameState.getParameter('psfReports', {})
+    reports[psfName] = report
+    context.frameState.setParameter('psfReports', reports)
+    return report
+
+
+def nativePsfWithoutBadStars(context, imageName, listName, psfName):
+    '''What psfErrorDeletion has you do by hand: makes the PSF, takes the stars it couldn't use
+    and the ones flagged '*' out of listName, and goes again until there are none. Returns the
+    last report, with 'removed' (the ids taken out).'''
+    removed = []
+    while True:
+        report = nativePsf(context, imageName, listName, psfName)
+        if 'error' in report:
+            break
+        badIds = [star['id'] for star in report['stars'] if star['flag'] not in ['', '?']]
+        if not badIds:
+            break
+        removed += badIds
+        PsfBuilder.removeStars(context.path(listName), badIds)
+    report['removed'] = removed
+    return report
+
+
+def acceptChi(context, psfName, chi):
+    '''Records the chi of a PSF you're happy with'''
+    context.frameState.appendParameter('acceptedChi', [psfName, float(chi)])
+    return
+
+
+def markPsfStars(context):
+    '''${frame}.iraf (the PSF stars, for tvmark) from ${frame}.lst'''
+    removeFiles(context, [context.frame + '.iraf'])
+    return runExternal(context, 'dao2iraf', arguments=[context.frame + '.lst', context.frame + '.iraf'],
+                       logToFrame=False)
+
+
+def psfErrorDeletion(context):
+    '''${frame}.psf from the PSF stars (native: without the ones it can't use) and ${frame}.iraf.
+    With daophot, look at the log for stars with errors, take them out and run it again.'''
+    if context.settings['psfEngine'] == 'native':
+        result = nativePsfWithoutBadStars(context, context.frame, context.frame + '.lst', context.frame + '.psf')
+    else:
+        result = daophotPsf(context, context.frame, context.frame + '.lst', context.frame + '.psf',
+                            'psfErrorDeletion.in')
+    if 'error' in result:
+        return result
+    marked = markPsfStars(context)
+    if 'error' in marked:
+        result['error'] = marked['error']
+    return result
+
+
+def writeMarkedStars(context, listName, positions):
+    '''positions [(x, y), ...] into listName, the way tvmark writes the stars you mark'''
+    WarmStart.writePositions(context.path(listName), [x for (x, y) in positions], [y for (x, y) in positions])
+    return
+
+
+def removeMarkedStars(context, markedName, outputName, inputName):
+    '''sublst.e: ${frame}.lst without the stars in markedName, into outputName'''
+    removeFiles(context, [outputName])
+    writeAnswers(context, inputName, '''${current_frame}.lst
+${marked}
+${output}
+5 5
+''', marked=markedName, output=outputName)
+    return runExternal(context, 'sublst', inputName, logToFrame=False)
+
+
+def culledPsf(context, markedName, imageName, listName, psfName, sublstInput, psfInput, markedStars):
+    if markedStars is not None:
+        writeMarkedStars(context, markedName, markedStars)
+    for name in [context.frame + '.iraf', context.frame + '.lst', imageName + '.imh', markedName]:
+        if not context.exists(name):
+            return {'error': name + ' doesn\'t appear to exist'}
+    result = removeMarkedStars(context, markedName, listName, sublstInput)
+    if 'error' in result:
+        return result
+    if context.settings['psfEngine'] == 'native':
+        return nativePsf(context, imageName, listName, psfName)
+    return daophotPsf(context, imageName, listName, psfName, psfInput)
+
+
+def neighborStarSubtraction(context, markedStars=None):
+    '''${frame}_nonei.lst (the PSF stars without the ones with close neighbors, sub_nonei.lst)
+    and ${frame}_nonei.psf. markedStars [(x, y), ...] replace sub_nonei.lst. Returns the PSF
+    report (native) or daophot's result; acceptChi the PSF if it's good.'''
+    return culledPsf(context, 'sub_nonei.lst', context.frame, context.frame + '_nonei.lst',
+                     context.frame + '_nonei.psf', 'sublst1.in', 'psfNeighborStars.in', markedStars)
+
+
+def badPSFSubtractionStarRemoval(context, markedStars=None):
+    '''${frame}_2.lst (the PSF stars without the badly subtracted ones, sub.lst) and
+    ${frame}3s.psf from ${frame}3s.imh. Like neighborStarSubtraction.'''
+    removeFiles(context, [context.frame + '3s.psf'])
+    return culledPsf(context, 'sub.lst', context.frame + '3s', context.frame + '_2.lst', context.frame + '3s.psf',
+                     'sublst2.in', 'psfSubErrorStars.in', markedStars)
+
+
+def runScriptInScratch(context, scriptName):
+    '''Runs one of the option file scripts in a scratch workspace and copies its products back.
+    Returns {'notStaged', 'missing'}.'''
+    import OptionFiles
+    import Workspace
+
+    with Workspace.ScratchWorkspace(context.dataSetDirectory, context.frame, context.settings['scratchRoot'],
+                                    context.settings['scratchBudget']) as workspace:
+        notStaged = workspace.stage(Workspace.scriptInputs(scriptName, context.frame))
+        options = OptionFiles.OptionFiles(context.fwhm, workspace.workingDirectory, context.frame)
+        workspace.writeFile(scriptName, options.optionFileDict[scriptName], executable=True)
+        subprocess.call(['sh', scriptName], cwd=workspace.frameDirectory)
+        missing = workspace.commit(Workspace.scriptProducts(scriptName, context.frame))
+    return {'notStaged': notStaged, 'missing': missing}
+
+
+def runScriptGraph(context, scriptName, makeGraph):
+    '''Runs one of the scripts as a step graph, in a scratch workspace if scratchRoot is set.
+    makeGraph gets the folder to run in. Returns {'worked', 'timings', 'messages', 'notStaged', 'missing'}.'''
+    import Workspace
+
+    if not context.settings['scratchRoot']:
+        graph = makeGraph(context.frameDirectory)
+        worked = graph.run()
+        return {'worked': worked, 'timings': graph.formatTimings(), 'messages': graph.messages, 'notStaged': [],
+                'missing': []}
+
+    with Workspace.ScratchWorkspace(context.dataSetDirectory, context.frame, context.settings['scratchRoot'],
+                                    context.settings['scratchBudget']) as workspace:
+        graph = makeGraph(workspace.frameDirectory)
+        inputs = graph.externalInputs()
+        inputs += [name[:-4] + '.pix' for name in inputs if name.endswith('.imh')]
+        notStaged = workspace.stage(inputs)
+        worked = graph.run(restart=True)
+        timings = graph.formatTimings()
+        missing = workspace.commit(Workspace.scriptProducts(scriptName, context.frame) + [graph.name + '.steps'])
+    return {'worked': worked, 'timings': timings, 'messages': graph.messages, 'notStaged': notStaged,
+            'missing': missing if worked else []}
+
+
+def waitFor(context, name):
+    # the old scripts don't say when they're done
+    while not context.exists(name):
+        time.sleep(1)
+    return
+
+
+def mkpsfScript(context):
+    '''mkpsfHDI.scr: ${frame}3s.imh, the frame with the PSF stars' neighbors subtracted'''
+    settings = context.settings
+    if settings['scriptGraphs']:
+        result = runScriptGraph(context, 'mkpsfHDI.scr', lambda directory: ScriptGraphs.mkpsfGraph(
+            directory, context.frame, settings['psfEngine'], settings['allstarEngine']))
+        if not result['worked']:
+            result['error'] = 'mkpsf did not finish. Check mkpsf.log and run this step again.'
+        return result
+    if settings['scratchRoot']:
+        return runScriptInScratch(context, 'mkpsfHDI.scr')
+    subprocess.call('./mkpsf.scr', cwd=context.frameDirectory)
+    waitFor(context, context.frame + '3s.imh')
+    return {}
+
+
+def allstarScript(context, markStars=True):
+    '''allstarHDI.scr: ${frame}.als2 and ${frame}sub2.imh. markStars makes als.iraf from the
+    .als2 right away; leave it for markAllstarStars if you want to look at sub2 first.'''
+    settings = context.settings
+    result = {}
+    if settings['scriptGraphs']:
+        tiles = multiprocessing.cpu_count() if settings['allstarTiles'] == 'cores' else settings['allstarTiles']
+        result = runScriptGraph(context, 'allstarHDI.scr', lambda directory: ScriptGraphs.allstarGraph(
+            directory, context.frame, tiles, engine=settings['allstarEngine']))
+        if not result['worked']:
+            result['error'] = 'allstar did not finish. Check allstar.log and run this step again.'
+            return result
+    elif settings['scratchRoot']:
+        result = runScriptInScratch(context, 'allstarHDI.scr')
+        if not context.exists(context.frame + 'sub2.imh'):
+            result['error'] = context.frame + 'sub2.imh was not made. Check allstar.log and run this step again.'
+            return result
+    else:
+        subprocess.call('./allstarHDI.scr', cwd=context.frameDirectory)
+        waitFor(context, context.frame + 'sub2.imh')
+    if markStars:
+        result.update(markAllstarStars(context))
+    return result
+
+
+def markAllstarStars(context):
+    '''als.iraf from ${frame}.als2'''
+    return runExternal(context, 'dao2iraf', arguments=[context.frame + '.als2', 'als.iraf'], logToFrame=False)
+
+
+def makePlots(context, showPlots=False):
+    '''The magnitude, chi and roundness plots. showPlots opens them when they are made.'''
+    if context.settings['scriptGraphs']:
+        graph = ScriptGraphs.magChiRoundPlotGraph(context.frameDirectory, showPlots)
+        result = {'worked': graph.run(restart=True), 'timings': graph.formatTimings(), 'messages': graph.messages}
+        if not result['worked']:
+            result['error'] = 'Some plots were not made. Check macro1.log.'
+        return result
+    subprocess.call([externalPrograms['magChiRoundPlotscr']], cwd=context.frameDirectory)
+    return {}
+
+
+def alsedt(context):
+    '''alsedt.e: edt${frame}.als2 (the .als2 without the bad fits) and edt.iraf. The catalog goes
+    into the catalog store, and the QA thumbnails are made if qaThumbnails is set. Returns
+    {'stored', 'qa' (the thumbnail summary)}.'''
+    if not context.exists(context.frame + '.als2'):
+        return {'error': context.frame + '.als2 doesn\'t appear to exist'}
+
+    #string below assumes you're not using a nonlinear mag cut. Add another
+    # variable if this becomes a thing you need often.
+    writeAnswers(context, 'alsedt.in', '''${current_frame}.als2
+edt${current_frame}.als2
+2
+0.1
+0
+2
+0.2
+''')
+    result = runExternal(context, 'alsedt', 'alsedt.in')
+    if 'error' in result:
+        return result
+    result = runExternal(context, 'dao2iraf', arguments=['edt' + context.frame + '.als2', 'edt.iraf'],
+                         logToFrame=False)
+    if not context.exists('edt.iraf'):
+        result['error'] = 'edt.iraf doesn\'t appear to exist'
+        return result
+
+    result.update(storeCatalog(context))
+    if context.settings['qaThumbnails']:
+        import QaThumbnails
+        try:
+            result['qaIndex'], result['qa'] = QaThumbnails.refreshFrame(context.dataSetDirectory, context.frame)
+        except (IOError, OSError), e:
+            result['qa'] = {'frame': context.frame, 'error': str(e)}
+    return result
+
+
+def apcorrScript(context, waitForUser=None, askCoefficients=None, showPlots=False):
+    '''The aperture correction (apcorrHDI.scr and compapcorrHDI.scr) for this frame. Unless
+    automaticApcorr is set it needs someone to edit files and read off the fits: waitForUser and
+    askCoefficients (ScriptGraphs.apcorrGraph). showPlots opens the plots. Returns {'worked',
+    'timings', 'messages', 'growth' (growth.txt, when it's automatic)}.'''
+    if not context.exists('edt' + context.frame + '.als2'):
+        return {'error': 'edt' + context.frame + '.als2 doesn\'t appear to exist. Run alsedt first.'}
+    automatic = context.settings['automaticApcorr']
+    if not automatic and (waitForUser is None or askCoefficients is None):
+        return {'error': 'The apcorr without automaticApcorr needs waitForUser and askCoefficients.'}
+    graph = ScriptGraphs.apcorrGraph(context.frameDirectory, context.frame, automatic=automatic,
+                                     showPlots=showPlots, waitForUser=waitForUser, askCoefficients=askCoefficients)
+    # from the top every time, like the other scripts: sort makes apcorr.coo again before it's filtered
+    result = {'worked': graph.run(restart=True)}
+    result['timings'] = graph.formatTimings()
+    result['messages'] = graph.messages
+    if not result['worked']:
+        result['error'] = 'apcorr did not finish. Check apcorr.log and compapcorr.log, then run this step again.'
+    elif context.settings['automaticApcorr']:
+        growthFile = open(context.path('growth.txt'), 'r')
+        result['growth'] = growthFile.read()
+        growthFile.close()
+    return result
+
+
+###
+# the catalog store and the data set steps
+###
+
+def storeDirectory(context):
+    if context.settings['catalogStoreDirectory']:
+        return context.settings['catalogStoreDirectory']
+    return context.dataSetDirectory + 'catalogStore/'
+
+
+def storeCatalog(context):
+    '''Copies the frame's final catalog into the binary catalog store. Returns {'stored'}, with
+    'storeError' if it couldn't.'''
+    import CatalogStore
+    try:
+        stored = CatalogStore.storeFrame(storeDirectory(context), context.dataSetDirectory, context.frame,
+                                         context.filterName())
+    except (IOError, ValueError), e:
+        return {'stored': False, 'storeError': str(e)}
+    return {'stored': bool(stored)}
+
+
+def applyApertureCorrection(context, coefficients=None, everyFrame=False):
+    '''Applies apcorr.coef to edt${frame}.als2, writing coefficients ({'C0', 'EC0', 'CX', 'CY'},
+    from compapcorr) first if given. everyFrame does every other frame that has apcorr.coef too.
+    Returns ApplyApcorr's summary, with 'frames' (the frames done) for everyFrame.'''
+    import ApplyApcorr
+    if coefficients is not None:
+        ApplyApcorr.writeCoefficients(context.path(ApplyApcorr.coefficientFile), coefficients)
+    if not context.exists(ApplyApcorr.coefficientFile):
+        return {'error': ApplyApcorr.coefficientFile + ' doesn\'t exist yet'}
+    summary = ApplyApcorr.applyFrame(context.dataSetDirectory, context.frame)
+    if summary is None:
+        return {'error': 'edt' + context.frame + '.als2 doesn\'t appear to exist. Run alsedt first.'}
+    if everyFrame:
+        summary['frames'] = sorted(ApplyApcorr.applyDataSet(context.dataSetDirectory))
+    return summary
+
+
+def buildMasterCatalog(context, referenceFrame=None):
+    '''Matches every reduced frame in the data set to referenceFrame (this one by default),
+    writes master.cat and restores the frames in the catalog store with their positions on the
+    reference. Each filter is averaged on its own. Returns {'stars', 'stored', 'filters'}.'''
+    import CatalogMatch
+    import CatalogStore
+    filters = dict((frame, FrameContext(context.dataSetDirectory, frame, context.settings).filterName())
+                   for frame in Artifacts.frameNames(context.dataSetDirectory))
+    try:
+        columns, transforms = CatalogMatch.buildMasterCatalog(context.dataSetDirectory,
+                                                              referenceFrame or context.frame, filters=filters)
+    except IOError, e:
+        return {'error': str(e)}
+    # so the store can be searched by sky box
+    stored = CatalogStore.storeDataSet(storeDirectory(context), context.dataSetDirectory, transforms, filters)
+    return {'stars': len(columns['id']), 'stored': stored, 'filters': filters}
+
+
+def qaReview(context, processes=None):
+    '''QA thumbnails of every frame in the data set. Returns {'index', 'frames' ({frame : summary})}.'''
+    import QaThumbnails
+    indexPath, summaries = QaThumbnails.renderDataSet(context.dataSetDirectory, processes=processes)
+    return {'index': indexPath, 'frames': summaries}
+
+
+# the steps runSteps can take a frame through without anybody looking, given the settings and
+# (for the culled lists) the marked stars from the warm start or an earlier run
+unattendedSteps = OrderedDict([('setupOptFiles', setupOptFiles),
+                               ('psfFirstPass', psfFirstPass),
+                               ('psfCandidateSelection', psfCandidateSelection),
+                               ('psfErrorDeletion', psfErrorDeletion),
+                               ('neighborStarSubtraction', neighborStarSubtraction),
+                               ('mkpsfScript', mkpsfScript),
+                               ('badPSFSubtractionStarRemoval', badPSFSubtractionStarRemoval),
+                               ('allstarScript', allstarScript),
+                               ('makePlots', makePlots),
+                               ('alsedt', alsedt)])
+
+
+def runSteps(context, stepNames=None):
+    '''Takes the frame through the unattended steps that aren't done yet (or the ones in
+    stepNames), stopping at the first one that fails. Returns an OrderedDict {step : result}.'''
+    results = OrderedDict()
+    if stepNames is None:
+        stepNames = [name for name in unattendedSteps if not context.frameState.stepDone(name)]
+    for stepName in stepNames:
+        result = trackStep(context, stepName, unattendedSteps[stepName])
+        results[stepName] = result
+        if 'error' in result or result.get('status') == 'incomplete':
+            break
+    return results
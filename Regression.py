@@ -0,0 +1,660 @@
+# Regression runs: is the pipeline still as fast and the photometry still the
+# same after somebody made it faster?
+#
+# A golden data set is a folder of small synthetic frames (makeGoldenDataSet):
+# the same star field seen a few pixels apart in each frame, made with a known
+# PSF, sky and noise, plus the option files from OptionFiles. Every frame is
+# taken through the reduction steps of autoreduce's functionDictionary in a
+# scratch copy, with the native implementations (PsfSelect, PsfBuilder,
+# NativeAllstar, ModelSubtract, GrowthCurve, ApplyApcorr, CatalogMatch) and two
+# stand-ins for daophot: FIND is the list of stars the frame was made with
+# (${frame}.coo, scattered a little), PHOT is aperturePhotometry below. The
+# interactive steps (getFWHM, makePlots) aren't run; the FWHM comes from the
+# golden data set.
+#
+# The scripts of OptionFiles (mkpsfHDI.scr, allstarHDI.scr as step graphs)
+# need daophot and allstar8192. 'record' runs them for real once, with the
+# ExternalTools cache recording, and keeps their inputs; after that 'run'
+# replays them from the cache on any machine.
+#
+# Every output is compared with the blessed reference (reference/<frame>/):
+# catalogs star by star (matched by position, within positionTolerance and
+# magTolerance), images by the rms of the difference, PSFs by their profile,
+# apcorr.coef by its terms. Every step's time goes into history.json, and a
+# step that takes slowdownFactor times its median of the last historyRuns
+# runs fails the run, same as drifting photometry does.
+#
+#   python Regression.py make golden/        make a golden data set
+#   python Regression.py bless golden/       run and keep the outputs as the reference
+#   python Regression.py record golden/      run the scripts for real and keep them for replay
+#   python Regression.py run golden/         run and compare (exit code 1 on a regression)
+
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+from collections import OrderedDict
+from string import Template
+
+import numpy as np
+
+import ApplyApcorr
+import CatalogMatch
+import DaoCatalog
+import DaoPsf
+import ExternalTools
+import FrameCache
+import GrowthCurve
+import IrafImage
+import ModelSubtract
+import NativeAllstar
+import OptionFiles
+import PsfBuilder
+import PsfSelect
+import ScriptGraphs
+
+positionTolerance = 0.05    # px, 95% of the matched stars within this of the reference
+magTolerance = 0.02         # mag, 95% of the matched stars within this
+magOffsetTolerance = 0.005  # mag, median difference
+matchTolerance = 0.02       # fraction of stars that may be missing or new
+imageTolerance = 0.01       # rms of the difference, as a fraction of the reference rms
+psfTolerance = 0.01         # of the peak
+slowdownFactor = 1.5        # slower than this times the usual time is a regression...
+minimumSlowdown = 0.5       # ...if it's also this many seconds slower
+historyRuns = 10
+
+# golden data set defaults
+goldenFrames = 2
+goldenSize = 400
+goldenStars = 300
+goldenFwhm = 2.8
+goldenSky = 200.0
+goldenGain = 1.3
+goldenReadNoise = 9.0
+goldenDetectionMag = 21.0   # stars fainter than this aren't in the FIND stand-in list
+zeroPoint = 25.0            # daophot magnitudes are 25 - 2.5 log(counts)
+
+
+def readGolden(goldenDirectory):
+    goldenFile = open(os.path.join(goldenDirectory, 'golden.json'), 'r')
+    golden = json.load(goldenFile)
+    goldenFile.close()
+    # json gives unicode, which doesn't go into an imh header
+    golden['frames'] = [str(frame) for frame in golden['frames']]
+    return golden
+
+
+def goldenPsf(fwhm):
+    '''The PSF the golden frames are made with: a slightly elongated gaussian (PsfSelect's width cut
+    takes the moffats' wings for a galaxy in a frame this small)'''
+    halfWidth = fwhm / 2.0
+    table = np.zeros((1, DaoPsf.tableSize(15.0), DaoPsf.tableSize(15.0)))
+    psf = DaoPsf.DaoPsf('GAUSSIAN', [halfWidth * 1.05, halfWidth * 0.95], table, zeroPoint, 1.0,
+                        goldenSize / 2.0, goldenSize / 2.0)
+    # bright so that a star of magnitude psfMag has 1 count in all
+    offsets = np.arange(-40, 41)
+    dx, dy = np.meshgrid(offsets, offsets)
+    psf.bright = 1.0 / psf.evaluate(dx.reshape(1, -1).astype(float), dy.reshape(1, -1).astype(float),
+                                    [psf.xpsf], [psf.ypsf]).sum()
+    return psf
+
+
+def makeGoldenDataSet(goldenDirectory, nFrames=goldenFrames, size=goldenSize, nStars=goldenStars, fwhm=goldenFwhm,
+                      seed=1):
+    '''Writes the golden frames (golden01, golden02, ...) and golden.json'''
+    rng = np.random.RandomState(seed)
+    psf = goldenPsf(fwhm)
+    # one field, a bit bigger than a frame, each frame looking at it from somewhere else
+    fieldX = rng.uniform(-20, size + 20, nStars)
+    fieldY = rng.uniform(-20, size + 20, nStars)
+    # more faint stars than bright ones
+    fieldMag = 12.0 + 8.5 * rng.power(2.5, nStars)
+    frames = []
+    for i in range(nFrames):
+        frame = 'golden%02d' % (i + 1)
+        frameDirectory = os.path.join(goldenDirectory, frame)
+        if not os.path.isdir(frameDirectory):
+            os.makedirs(frameDirectory)
+        shiftX, shiftY = (0.0, 0.0) if i == 0 else tuple(rng.uniform(-12, 12, 2))
+        x = fieldX + shiftX
+        y = fieldY + shiftY
+        scale = 10.0 ** (-0.4 * (fieldMag - psf.psfMag))
+        pixels = ModelSubtract.renderModel((size, size), psf, x, y, scale) + goldenSky
+        pixels = (rng.poisson(np.maximum(pixels, 0.0) * goldenGain) / goldenGain +
+                  rng.normal(0.0, goldenReadNoise / goldenGain, pixels.shape))
+        IrafImage.writeImage(os.path.join(frameDirectory, frame + '.imh'), pixels.astype(np.float32),
+                             title='golden frame ' + frame)
+
+        header = DaoCatalog.defaultHeader(size, size, lowBad=goldenSky - 10 * goldenReadNoise, highBad=55000.0,
+                                          threshold=7.0, gain=goldenGain, readNoise=goldenReadNoise, nl=1)
+        inside = (x > 3) & (x < size - 3) & (y > 3) & (y < size - 3)
+        order = np.argsort(fieldMag)
+        truth = order[inside[order]]
+        DaoCatalog.writeCatalog(os.path.join(frameDirectory, frame + '.truth'), header,
+                                {'id': truth + 1, 'x': x[truth], 'y': y[truth], 'mag': fieldMag[truth],
+                                 'sky': np.zeros(len(truth)) + goldenSky}, 'lst')
+        # what FIND would have found: the brighter stars, a bit off
+        found = truth[fieldMag[truth] < goldenDetectionMag]
+        DaoCatalog.writeCatalog(os.path.join(frameDirectory, frame + '.coo'), header,
+                                {'id': np.arange(1, len(found) + 1), 'x': x[found] + rng.normal(0, 0.05, len(found)),
+                                 'y': y[found] + rng.normal(0, 0.05, len(found)), 'mag': fieldMag[found] - zeroPoint,
+                                 'sharp': np.zeros(len(found)) + 0.6, 'round': np.zeros(len(found)),
+                                 'dround': np.zeros(len(found))}, 'coo')
+        frames.append(frame)
+
+    goldenFile = open(os.path.join(goldenDirectory, 'golden.json'), 'w')
+    json.dump({'frames': frames, 'fwhm': fwhm, 'seed': seed, 'size': size, 'stars': nStars}, goldenFile, indent=1)
+    goldenFile.close()
+    return frames
+
+
+def apertureRadii(optPath):
+    '''Aperture radii from a photo.opt style file, up to the first zero, and the sky annulus'''
+    options = OptionFiles.readOptionFile(optPath)
+    radii = []
+    for key in GrowthCurve.apertureKeys:
+        if options.get(key, 0.0) <= 0:
+            break
+        radii.append(options[key])
+    return radii, options.get('IS', radii[-1] + 2), options.get('OS', radii[-1] + 5)
+
+
+def aperturePhotometry(pixels, x, y, radii, innerSky, outerSky, gain, readNoise):
+    '''Stand-in for daophot's PHOT: whole pixels within each radius, sky from the median of the
+    annulus. Returns the .ap columns (mag and err are stars x apertures).'''
+    x = np.asarray(x, dtype=float)
+    y = np.asarray(y, dtype=float)
+    reach = int(np.ceil(outerSky)) + 1
+    cutouts = IrafImage.stamps(pixels, x, y, reach)
+    offsets = np.arange(-reach, reach + 1)
+    dx = offsets[np.newaxis, np.newaxis, :] - (x - np.rint(x))[:, np.newaxis, np.newaxis]
+    dy = offsets[np.newaxis, :, np.newaxis] - (y - np.rint(y))[:, np.newaxis, np.newaxis]
+    distance = np.hypot(dx, dy)
+    annulus = (distance >= innerSky) & (distance <= outerSky) & np.isfinite(cutouts)
+    skyValues = np.where(annulus, cutouts, np.nan).reshape(len(x), -1)
+    sky = np.nanmedian(skyValues, axis=1)
+    skySigma = GrowthCurve.robustSigma(skyValues, axis=1)
+    nSky = annulus.reshape(len(x), -1).sum(axis=1)
+    mag = np.zeros((len(x), len(radii))) + DaoCatalog.badMagnitude
+    err = np.zeros((len(x), len(radii))) + 9.999
+    for (i, radius) in enumerate(radii):
+        inAperture = distance <= radius
+        area = inAperture.reshape(len(x), -1).sum(axis=1)
+        values = np.where(inAperture, cutouts, 0.0).reshape(len(x), -1)
+        complete = ~np.isnan(values).any(axis=1)
+        flux = np.nansum(values, axis=1) - area * sky
+        good = complete & (flux > 0) & (nSky > 0)
+        mag[good, i] = zeroPoint - 2.5 * np.log10(flux[good])
+        variance = flux / gain + area * skySigma ** 2 + area ** 2 * skySigma ** 2 / np.maximum(nSky, 1)
+        err[good, i] = np.minimum(1.0857 * np.sqrt(variance[good]) / flux[good], 9.999)
+    return {'x': x, 'y': y, 'mag': mag, 'err': err, 'sky': sky, 'skysigma': skySigma,
+            'skyskew': np.zeros(len(x))}
+
+
+def photometerFrame(workingDirectory, imageName, coordinates, optName, outputName):
+    '''PHOT stand-in on imageName.imh for the stars in coordinates (columns with id, x, y)'''
+    radii, innerSky, outerSky = apertureRadii(os.path.join(workingDirectory, optName))
+    pixels = FrameCache.pixels(os.path.join(workingDirectory, imageName + '.imh'))
+    columns = aperturePhotometry(pixels, coordinates['x'], coordinates['y'], radii, innerSky, outerSky,
+                                 goldenGain, goldenReadNoise)
+    columns['id'] = coordinates['id']
+    header = DaoCatalog.defaultHeader(pixels.shape[1], pixels.shape[0], lowBad=goldenSky - 10 * goldenReadNoise,
+                                      threshold=7.0, ap1=radii[0], gain=goldenGain, readNoise=goldenReadNoise, nl=2)
+    DaoCatalog.writeCatalog(os.path.join(workingDirectory, outputName), header, columns, 'ap')
+    return
+
+
+# the reduction steps, by the name of the autoreduce function they stand for. Each one is
+# function(workingDirectory, frame, fwhm) and makes the outputs listed (${frame} is the frame).
+
+def setupStep(workingDirectory, frame, fwhm):
+    options = OptionFiles.OptionFiles(fwhm, workingDirectory, frame)
+    for name in ['daophot.opt', 'allstar.opt', 'photo.opt', 'apcorr.opt']:
+        optionFile = open(os.path.join(workingDirectory, name), 'w')
+        optionFile.write(options.optionFileDict[name])
+        optionFile.close()
+    return
+
+
+def photStep(workingDirectory, frame, fwhm):
+    header, coordinates = DaoCatalog.readCatalog(os.path.join(workingDirectory, frame + '.coo'))
+    photometerFrame(workingDirectory, frame, coordinates, 'photo.opt', frame + '.ap')
+    return
+
+
+def selectStep(workingDirectory, frame, fwhm):
+    PsfSelect.pickPsfStars(workingDirectory, frame, fwhm)
+    return
+
+
+def psfStep(workingDirectory, frame, fwhm):
+    PsfBuilder.makePsf(workingDirectory, frame, frame + '.ap', frame + '.lst', frame + '.psf', frame + '.nei')
+    return
+
+
+def neighborStep(workingDirectory, frame, fwhm):
+    # sublst.e would take the neighbors out of the list; the golden psf stars don't have any to speak of
+    shutil.copyfile(os.path.join(workingDirectory, frame + '.lst'), os.path.join(workingDirectory, frame + '_nonei.lst'))
+    PsfBuilder.makePsf(workingDirectory, frame, frame + '.ap', frame + '_nonei.lst', frame + '_nonei.psf')
+    return
+
+
+def checkRun(result):
+    returnCode, output = result
+    if returnCode != 0:
+        raise IOError(output.strip())
+    return
+
+
+def mkpsfStep(workingDirectory, frame, fwhm):
+    # the FIND rounds on the subtracted frames need daophot; they are in the replayed scripts.
+    # RE=0 is allstar's re=0: the neighbours are fitted at fixed positions (references blessed
+    # before NativeAllstar read RE that way moved them, so bless those again)
+    checkRun(NativeAllstar.runNativeAllstar(workingDirectory, frame, frame + '_nonei.psf', frame + '.nei',
+                                            frame + 'psf.als', frame + '1s', 1, {'RE': 0.0}))
+    ModelSubtract.subtractCatalog(workingDirectory, frame, frame + '_nonei.psf', frame + 'psf.als', frame + '3s',
+                                  frame + '.lst')
+    return
+
+
+def finalPsfStep(workingDirectory, frame, fwhm):
+    PsfBuilder.makePsf(workingDirectory, frame + '3s', frame + '.ap', frame + '.lst', frame + '3s.psf')
+    return
+
+
+def allstarStep(workingDirectory, frame, fwhm):
+    checkRun(NativeAllstar.runNativeAllstar(workingDirectory, frame, frame + '3s.psf', frame + '.ap', frame + '.als',
+                                            frame + 'sub', 1))
+    checkRun(NativeAllstar.runNativeAllstar(workingDirectory, frame, frame + '3s.psf', frame + '.als',
+                                            frame + '.als2', frame + 'sub2', 1))
+    return
+
+
+def alsedtStep(workingDirectory, frame, fwhm):
+    # alsedt.e cuts on the errors, chi and sharpness
+    header, columns = DaoCatalog.readCatalog(os.path.join(workingDirectory, frame + '.als2'))
+    keep = (columns['err'] < 0.2) & (columns['chi'] < 3.0) & (np.abs(columns['sharp']) < 1.0)
+    DaoCatalog.writeCatalog(os.path.join(workingDirectory, 'edt' + frame + '.als2'), header,
+                            DaoCatalog.selectRows(columns, keep), 'als')
+    return
+
+
+def apcorrStep(workingDirectory, frame, fwhm, nStars=60):
+    '''apcorrHDI.scr: the brightest stars alone on the frame, measured in the apcorr.opt apertures'''
+    header, columns = DaoCatalog.readCatalog(os.path.join(workingDirectory, 'edt' + frame + '.als2'))
+    # the whole sky annulus has to be on the frame
+    radii, innerSky, outerSky = apertureRadii(os.path.join(workingDirectory, 'apcorr.opt'))
+    margin = outerSky + 1
+    onFrame = np.nonzero((columns['x'] > margin) & (columns['x'] < header['NX'] - margin) &
+                         (columns['y'] > margin) & (columns['y'] < header['NY'] - margin))[0]
+    # brightest first, none inside another one's sky annulus since they all stay on the frame
+    bright = []
+    for star in onFrame[np.argsort(columns['mag'][onFrame])]:
+        if len(bright) == nStars:
+            break
+        if not bright or np.hypot(columns['x'][bright] - columns['x'][star],
+                                  columns['y'][bright] - columns['y'][star]).min() > outerSky + 2 * fwhm:
+            bright.append(star)
+    bright = np.array(bright, dtype=int)
+    DaoCatalog.writeCatalog(os.path.join(workingDirectory, 'apcorr.als'), header,
+                            DaoCatalog.selectRows(columns, bright), 'als')
+    # everything else allstar found comes off
+    ModelSubtract.subtractCatalog(workingDirectory, frame, frame + '3s.psf', frame + '.als2', 'apcorr', 'apcorr.als')
+    photometerFrame(workingDirectory, 'apcorr', DaoCatalog.selectRows(columns, bright), 'apcorr.opt', 'apcorr.apfull')
+    result = GrowthCurve.measureFrame(workingDirectory, frame)
+    if 'error' in result:
+        raise ValueError(result['error'])
+    return
+
+
+def applyStep(workingDirectory, frame, fwhm):
+    if ApplyApcorr.applyFrame(os.path.dirname(workingDirectory), frame) is None:
+        raise IOError('nothing to correct')
+    return
+
+
+def masterStep(dataSetDirectory, frames):
+    CatalogMatch.buildMasterCatalog(dataSetDirectory, frames[0], frames, processes=1)
+    return
+
+
+frameSteps = [('setupOptFiles', setupStep, ['daophot.opt', 'allstar.opt', 'photo.opt', 'apcorr.opt']),
+              ('psfFirstPass', photStep, ['${frame}.ap']),
+              ('psfCandidateSelection', selectStep, ['${frame}.lst']),
+              ('psfErrorDeletion', psfStep, ['${frame}.psf', '${frame}.nei']),
+              ('neighborStarSubtraction', neighborStep, ['${frame}_nonei.psf']),
+              ('mkpsfScript', mkpsfStep, ['${frame}psf.als', '${frame}3s.imh']),
+              ('badPSFSubtractionStarRemoval', finalPsfStep, ['${frame}3s.psf']),
+              ('allstarScript', allstarStep, ['${frame}.als', '${frame}.als2', '${frame}sub2.imh']),
+              ('alsedt', alsedtStep, ['edt${frame}.als2']),
+              ('apcorrScript', apcorrStep, ['apcorr.apfull', 'apcorr.coef']),
+              ('applyApertureCorrection', applyStep, ['edt${frame}.apc'])]
+
+dataSetSteps = [('buildMasterCatalog', masterStep, ['master.cat'])]
+
+# the OptionFiles scripts as step graphs, replayed from the recorded tool cache
+scriptFlows = [('mkpsfHDI.scr', lambda directory, frame: ScriptGraphs.mkpsfGraph(directory, frame),
+                ['${frame}2s.als', '${frame}3s.imh']),
+               ('allstarHDI.scr', lambda directory, frame: ScriptGraphs.allstarGraph(directory, frame),
+                ['${frame}.als', '${frame}.als2'])]
+
+
+def outputNames(names, frame):
+    return [Template(name).substitute(frame=frame) for name in names]
+
+
+def readTable(path):
+    '''master.cat: a '#' line of column names, then the rows'''
+    tableFile = open(path, 'r')
+    names = tableFile.readline().lstrip('#').split()
+    tableFile.close()
+    values = np.loadtxt(path, ndmin=2)
+    return dict((name, values[:, i]) for (i, name) in enumerate(names))
+
+
+def catalogMagnitudes(columns):
+    mag = columns.get('mag')
+    if mag is not None and mag.ndim == 2:
+        return mag[:, 0]
+    return mag
+
+
+def compareCatalogs(columns, reference):
+    '''Problems (a list of strings) between a catalog and its reference, stars matched by position'''
+    problems = []
+    nReference = len(reference['x'])
+    if nReference == 0:
+        return [] if len(columns['x']) == 0 else ['%d stars, the reference has none' % len(columns['x'])]
+    if abs(len(columns['x']) - nReference) > matchTolerance * nReference:
+        problems.append('%d stars, the reference has %d' % (len(columns['x']), nReference))
+    index = CatalogMatch.GridIndex(reference['x'], reference['y'], 2.0)
+    matches, distances = index.nearest(columns['x'], columns['y'], 1.0)
+    matched = matches >= 0
+    if matched.sum() < (1 - matchTolerance) * nReference:
+        problems.append('only %d of %d reference stars matched' % (matched.sum(), nReference))
+    if not matched.any():
+        return problems
+    if np.percentile(distances[matched], 95) > positionTolerance:
+        problems.append('positions moved: 95%% within %.3f px' % np.percentile(distances[matched], 95))
+    mag = catalogMagnitudes(columns)
+    referenceMag = catalogMagnitudes(reference)
+    if mag is not None and referenceMag is not None:
+        both = matched.copy()
+        both[matched] = ((mag[matched] < DaoCatalog.badMagnitude - 1) &
+                         (referenceMag[matches[matched]] < DaoCatalog.badMagnitude - 1))
+        if both.any():
+            difference = mag[both] - referenceMag[matches[both]]
+            if abs(np.median(difference)) > magOffsetTolerance:
+                problems.append('magnitudes shifted by %.4f' % np.median(difference))
+            if np.percentile(np.abs(difference), 95) > magTolerance:
+                problems.append('magnitudes drifted: 95%% within %.3f mag' % np.percentile(np.abs(difference), 95))
+    return problems
+
+
+def compareImages(pixels, reference):
+    if pixels.shape != reference.shape:
+        return ['image is %s, the reference is %s' % (pixels.shape, reference.shape)]
+    difference = np.sqrt(np.mean((np.asarray(pixels, dtype=float) - reference) ** 2))
+    scale = max(np.std(np.asarray(reference, dtype=float)), 1e-12)
+    if difference > imageTolerance * scale:
+        return ['pixels differ by %.3g rms (%.2f%% of the image rms)' % (difference, 100 * difference / scale)]
+    return []
+
+
+def comparePsfs(psf, reference):
+    offsets = np.arange(-int(reference.radius), int(reference.radius) + 1)
+    dx, dy = np.meshgrid(offsets, offsets)
+    problems = []
+    for (x, y) in [(reference.xpsf, reference.ypsf), (1.0, 1.0), (2 * reference.xpsf, 2 * reference.ypsf)]:
+        shape = (1, dx.size)
+        # both as the counts of a star of the reference's psf magnitude
+        values = psf.evaluate(dx.reshape(shape) + 0.25, dy.reshape(shape) - 0.25, [x], [y]) * 10.0 ** (
+            -0.4 * (reference.psfMag - psf.psfMag))
+        referenceValues = reference.evaluate(dx.reshape(shape) + 0.25, dy.reshape(shape) - 0.25, [x], [y])
+        worst = np.abs(values - referenceValues).max() / max(referenceValues.max(), 1e-30)
+        if worst > psfTolerance:
+            problems.append('profile at (%.0f, %.0f) differs by %.1f%% of the peak' % (x, y, 100 * worst))
+    return problems
+
+
+def compareCoefficients(coefficients, reference, span):
+    '''Terms compared by what they do to a magnitude across span pixels'''
+    problems = []
+    for name in sorted(set(coefficients) | set(reference)):
+        if name not in ApplyApcorr.polynomialTerms:
+            # the errors
+            continue
+        order = sum(ApplyApcorr.polynomialTerms[name])
+        difference = abs(coefficients.get(name, 0.0) - reference.get(name, 0.0)) * span ** order
+        if difference > magOffsetTolerance:
+            problems.append('%s differs by %.4f mag' % (name, difference))
+    return problems
+
+
+def compareOutput(path, referencePath):
+    '''Problems between an output file and the reference copy'''
+    if not os.path.exists(path):
+        return ['missing']
+    if not os.path.exists(referencePath):
+        return ['no reference (bless the golden data set)']
+    name = os.path.basename(path)
+    if name.endswith('.imh'):
+        return compareImages(IrafImage.readPixels(path), IrafImage.readPixels(referencePath))
+    if name.endswith('.psf'):
+        return comparePsfs(DaoPsf.readPsf(path), DaoPsf.readPsf(referencePath))
+    if name.endswith('.coef'):
+        return compareCoefficients(ApplyApcorr.readCoefficients(path), ApplyApcorr.readCoefficients(referencePath),
+                                   goldenSize)
+    if name.endswith('.opt'):
+        options = OptionFiles.readOptionFile(path)
+        if options != OptionFiles.readOptionFile(referencePath):
+            return ['options changed']
+        return []
+    if name.endswith('.cat'):
+        return compareCatalogs(readTable(path), readTable(referencePath))
+    return compareCatalogs(DaoCatalog.readCatalog(path)[1], DaoCatalog.readCatalog(referencePath)[1])
+
+
+def copyOutput(path, destinationDirectory):
+    '''Copies an output (and the pixels of an image) into the reference'''
+    if not os.path.isdir(destinationDirectory):
+        os.makedirs(destinationDirectory)
+    destination = os.path.join(destinationDirectory, os.path.basename(path))
+    if path.endswith('.imh'):
+        IrafImage.writeImage(destination, IrafImage.readPixels(path), path)
+    else:
+        shutil.copyfile(path, destination)
+    return
+
+
+def timeStep(function, *arguments):
+    '''(seconds, error message or None)'''
+    started = time.time()
+    try:
+        function(*arguments)
+    except (IOError, OSError, ValueError, np.linalg.LinAlgError), e:
+        return time.time() - started, str(e)
+    return time.time() - started, None
+
+
+def runScriptFlows(goldenDirectory, scratchDirectory, frame, record=False):
+    '''Runs the step graphs of the scripts on their kept inputs: replayed from the golden tool cache,
+    or with record for real, into it. Returns {flow : (seconds, error, directory)}.'''
+    results = OrderedDict()
+    inputsDirectory = os.path.join(goldenDirectory, frame, 'scripts')
+    if not record and not os.path.isdir(inputsDirectory):
+        return results
+    savedMode = (ExternalTools.cacheMode, ExternalTools.cacheDirectory)
+    ExternalTools.setCacheMode('record' if record else 'replay', os.path.join(goldenDirectory, 'toolcache'))
+    try:
+        for (flowName, makeGraph, outputs) in scriptFlows:
+            flowDirectory = os.path.join(scratchDirectory, 'scripts', frame)
+            if not os.path.isdir(flowDirectory):
+                shutil.copytree(inputsDirectory if not record else os.path.join(scratchDirectory, frame), flowDirectory)
+            graph = makeGraph(flowDirectory, frame)
+            started = time.time()
+            worked = graph.run(restart=True)
+            results[flowName] = (time.time() - started,
+                                 None if worked else '; '.join(graph.messages) + ', see ' + graph.log, flowDirectory)
+    finally:
+        ExternalTools.setCacheMode(savedMode[0], savedMode[1])
+    return results
+
+
+def runGolden(goldenDirectory, bless=False, record=False, keep=False):
+    '''Takes every golden frame through the steps in a scratch copy and compares the outputs with
+    the reference (or, with bless, makes them the reference). Returns (timings {frame/step :
+    seconds}, problems {frame/step : [problem, ...]}).'''
+    golden = readGolden(goldenDirectory)
+    referenceDirectory = os.path.join(goldenDirectory, 'reference')
+    scratchDirectory = tempfile.mkdtemp(prefix='regression.')
+    timings = OrderedDict()
+    problems = {}
+    try:
+        for frame in golden['frames']:
+            workingDirectory = os.path.join(scratchDirectory, frame)
+            os.mkdir(workingDirectory)
+            for fileName in os.listdir(os.path.join(goldenDirectory, frame)):
+                path = os.path.join(goldenDirectory, frame, fileName)
+                if os.path.isfile(path):
+                    shutil.copy(path, workingDirectory)
+            IrafImage.relinkPixelFile(os.path.join(workingDirectory, frame + '.imh'))
+
+            for (stepName, function, outputs) in frameSteps:
+                key = frame + '/' + stepName
+                timings[key], error = timeStep(function, workingDirectory, frame, golden['fwhm'])
+                problems[key] = ['failed: ' + error] if error else []
+                for name in outputNames(outputs, frame):
+                    path = os.path.join(workingDirectory, name)
+                    if bless and error is None:
+                        copyOutput(path, os.path.join(referenceDirectory, frame))
+                    elif not bless:
+                        problems[key] += [name + ': ' + problem for problem in
+                                          compareOutput(path, os.path.join(referenceDirectory, frame, name))]
+
+            if record:
+                # the scripts start from what the native steps made
+                keptInputs = os.path.join(goldenDirectory, frame, 'scripts')
+                if os.path.isdir(keptInputs):
+                    shutil.rmtree(keptInputs)
+                shutil.copytree(workingDirectory, keptInputs)
+            for (flowName, (seconds, error, flowDirectory)) in runScriptFlows(goldenDirectory, scratchDirectory,
+                                                                             frame, record).items():
+                key = frame + '/' + flowName
+                timings[key] = seconds
+                problems[key] = ['failed: ' + error] if error else []
+                outputs = [flow[2] for flow in scriptFlows if flow[0] == flowName][0]
+                for name in outputNames(outputs, frame):
+                    path = os.path.join(flowDirectory, name)
+                    if (bless or record) and error is None:
+                        copyOutput(path, os.path.join(referenceDirectory, frame, 'scripts'))
+                    elif not (bless or record):
+                        problems[key] += [name + ': ' + problem for problem in
+                                          compareOutput(path, os.path.join(referenceDirectory, frame, 'scripts', name))]
+
+        for (stepName, function, outputs) in dataSetSteps:
+            timings[stepName], error = timeStep(function, scratchDirectory, golden['frames'])
+            problems[stepName] = ['failed: ' + error] if error else []
+            for name in outputs:
+                path = os.path.join(scratchDirectory, name)
+                if bless and error is None:
+                    copyOutput(path, referenceDirectory)
+                elif not bless:
+                    problems[stepName] += [name + ': ' + problem for problem in
+                                           compareOutput(path, os.path.join(referenceDirectory, name))]
+    finally:
+        if keep:
+            print 'Scratch copy kept in ' + scratchDirectory
+        else:
+            shutil.rmtree(scratchDirectory, ignore_errors=True)
+    return timings, problems
+
+
+def readHistory(goldenDirectory):
+    '''[{'time', 'timings': {step : seconds}, 'passed'}, ...], oldest first'''
+    path = os.path.join(goldenDirectory, 'history.json')
+    if not os.path.exists(path):
+        return []
+    historyFile = open(path, 'r')
+    history = json.load(historyFile)
+    historyFile.close()
+    return history
+
+
+def recordHistory(goldenDirectory, timings, passed):
+    history = readHistory(goldenDirectory)
+    history.append({'time': time.time(), 'timings': timings, 'passed': passed})
+    path = os.path.join(goldenDirectory, 'history.json')
+    historyFile = open(path + '.tmp', 'w')
+    json.dump(history, historyFile, indent=1, sort_keys=True)
+    historyFile.close()
+    os.rename(path + '.tmp', path)
+    return
+
+
+def earlierTimes(step, history):
+    '''The step's times in the last historyRuns runs that passed (a regressed run isn't the usual)'''
+    passed = [run for run in history if run['passed']]
+    return [run['timings'][step] for run in passed[-historyRuns:] if step in run['timings']]
+
+
+def slowSteps(timings, history):
+    '''{step : (seconds, usual seconds)} for the steps that got slower than their recent median'''
+    slow = {}
+    for (step, seconds) in timings.items():
+        earlier = earlierTimes(step, history)
+        if not earlier:
+            continue
+        usual = float(np.median(earlier))
+        if seconds > slowdownFactor * usual and seconds - usual > minimumSlowdown:
+            slow[step] = (seconds, usual)
+    return slow
+
+
+def printReport(timings, problems, slow, history):
+    print '%-46s %9s %9s  %s' % ('step', 'seconds', 'usual', 'result')
+    for step in timings:
+        earlier = earlierTimes(step, history)
+        usual = '%9.2f' % np.median(earlier) if earlier else '%9s' % '-'
+        result = 'ok'
+        if problems.get(step):
+            result = '; '.join(problems[step])
+        if step in slow:
+            seconds, usualSeconds = slow[step]
+            slower = 'SLOWER (%.1fx)' % (seconds / max(usualSeconds, 1e-3))
+            result = slower if result == 'ok' else slower + '; ' + result
+        print '%-46s %9.2f %s  %s' % (step, timings[step], usual, result)
+    return
+
+
+def runRegression(goldenDirectory, keep=False):
+    '''Runs the golden data set, compares it, checks the times and adds them to the history.
+    Returns True when nothing regressed.'''
+    history = readHistory(goldenDirectory)
+    timings, problems = runGolden(goldenDirectory, keep=keep)
+    slow = slowSteps(timings, history)
+    passed = not slow and not [step for step in problems if problems[step]]
+    printReport(timings, problems, slow, history)
+    recordHistory(goldenDirectory, timings, passed)
+    print '\n' + ('no regressions' if passed else 'REGRESSION: %d step(s) drifted or failed, %d slower' % (
+        len([step for step in problems if problems[step]]), len(slow)))
+    return passed
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 3 or sys.argv[1] not in ['make', 'bless', 'record', 'run']:
+        print 'usage: python Regression.py make|bless|record|run goldenDirectory'
+        sys.exit(1)
+    command, goldenDirectory = sys.argv[1], sys.argv[2]
+    if command == 'make':
+        print 'Made ' + ', '.join(makeGoldenDataSet(goldenDirectory)) + ' in ' + goldenDirectory
+    elif command in ['bless', 'record']:
+        timings, problems = runGolden(goldenDirectory, bless=True, record=command == 'record')
+        failed = [step for step in problems if problems[step]]
+        printReport(timings, problems, {}, readHistory(goldenDirectory))
+        recordHistory(goldenDirectory, timings, not failed)
+        sys.exit(1 if failed else 0)
+    else:
+        sys.exit(0 if runRegression(goldenDirectory) else 1)
@@ -0,0 +1,357 @@
+# The scripts from OptionFiles as step graphs (see StepGraph). The answers fed
+# to each program are the same lines the scripts echoed into their inpfiles,
+# so the photometry comes out the same. What changes is that each program run
+# is its own step, and the independent ones run side by side:
+#   mkpsfGraph              mkpsfHDI.scr
+#   allstarGraph            allstarHDI.scr
+#   apcorrGraph             apcorrHDI.scr, carrying on into compapcorrHDI.scr
+#                           (or GrowthCurve, without anybody looking at plots)
+#   compApcorrGraph         compapcorrHDI.scr (r/x/y fits, polys and plots in parallel)
+#   spatialPlotGraph        macro1.scr
+#   magChiRoundPlotGraph    magChiRoundPlot.scr
+# The scripts did one sm session for all three plots; here every plot is its
+# own sm run so the plots (and their pstopdf) don't wait on each other.
+
+import os
+import shutil
+import subprocess
+
+import DaoCatalog
+import ExternalTools
+import GrowthCurve
+import ModelSubtract
+import NativeAllstar
+import PsfBuilder
+import StepGraph
+import TiledAllstar
+
+# {what : program}, like externalProgramDict in autoreduce
+programs = {'daophot': 'daophot',
+            'allstar': 'allstar8192',
+            'ap2als': 'ap2als.e',
+            'merge': 'merge.e',
+            'erredit': 'erredit.e',
+            'selstar': 'selstar.e',
+            'apstar': 'apstar.e',
+            'ap_plot': 'ap_plot.e',
+            'compapcorr': 'compapcorrHDI.e',
+            'sigrejfit': 'sigrejfit.e',
+            'poly': 'poly.e',
+            'sm': 'sm',
+            'pstopdf': 'pstopdf'}
+
+editor = 'aquamacs'     # what autoreduce opens the files in for the apcorr pauses
+viewer = 'open'
+
+
+def mkpsfGraph(workingDirectory, frame, psfEngine='daophot', allstarEngine='allstar'):
+    '''PSF, ALLSTAR and SUBSTAR to make the neighbor subtracted frame (mkpsfHDI.scr). psfEngine
+    'native' makes the first PSF with PsfBuilder instead of daophot, allstarEngine 'native' does
+    the ALLSTAR runs with NativeAllstar and the SUBSTAR with ModelSubtract.'''
+    graph = StepGraph.StepGraph('mkpsf', workingDirectory)
+    # first generate the PSF for all PSF stars so that neigbors can be subtracted
+    psfInputs = [frame + '.imh', frame + '.ap', frame + '.lst', 'daophot.opt']
+    if psfEngine == 'native':
+        graph.add(StepGraph.Step('psf', function=PsfBuilder.psfStep(frame, frame + '.ap', frame + '.lst', frame + '.psf',
+                                                                    frame + '.nei'),
+                                 inputs=psfInputs, outputs=[frame + '.psf', frame + '.nei']))
+    else:
+        graph.add(StepGraph.Step('psf', programs['daophot'],
+                                 ['at ' + frame, 'nomon', 'ps', frame + '.ap', frame + '.lst', frame + '.psf', ' ', ' '],
+                                 inputs=psfInputs, outputs=[frame + '.psf', frame + '.nei']))
+    # fit the 'rough' PSF made from the uncrowded stars to stars in the neighbors file, at their
+    # PHOT positions (re=0)
+    graph.add(mkpsfAllstarStep('allstarNeighbors', frame, frame + '.nei', frame + 'psf.als', frame + '1s', allstarEngine,
+                               recenter=False))
+    # two rounds of FIND on the subtracted frame, MERGE with what we had, and ALLSTAR again
+    for (i, previous) in [(1, frame + '.nei'), (2, frame + '1s.als')]:
+        subtracted = frame + str(i) + 's'
+        graph.add(StepGraph.Step('find' + str(i), programs['daophot'],
+                                 ['at ' + subtracted, 'nomon', 'opt', ' ', 'th=2', ' ', 'fi', '1 1',
+                                  subtracted + '.coo', 'y'],
+                                 inputs=[subtracted + '.imh', 'daophot.opt'],
+                                 outputs=[subtracted + '.coo']))
+        neighbors = frame + '.neinew' + str(i)
+        graph.add(StepGraph.Step('merge' + str(i), programs['merge'],
+                                 [frame + '.lst', previous, subtracted + '.coo', neighbors, '20'],
+                                 inputs=[frame + '.lst', previous, subtracted + '.coo'],
+                                 outputs=[neighbors],
+                                 removes=[subtracted + '.imh', subtracted + '.pix']))
+        graph.add(mkpsfAllstarStep('allstar' + str(i), frame, neighbors, subtracted + '.als', frame + str(i + 1) + 's',
+                                   allstarEngine))
+    # subtract away all neighbors except the PSF stars
+    subtractInputs = [frame + '.imh', frame + '_nonei.psf', frame + '2s.als', frame + '.lst']
+    subtractOutputs = [frame + '3s.imh', frame + '3s.pix']
+    if allstarEngine == 'native':
+        graph.add(StepGraph.Step('subtractNeighbors',
+                                 function=ModelSubtract.substarStep(frame, frame + '_nonei.psf', frame + '2s.als',
+                                                                    frame + '3s', frame + '.lst'),
+                                 inputs=subtractInputs, outputs=subtractOutputs))
+    else:
+        graph.add(StepGraph.Step('subtractNeighbors', programs['daophot'],
+                                 ['at ' + frame, 'nomon', 'sub', frame + '_nonei.psf', frame + '2s.als', 'y',
+                                  frame + '.lst', frame + '3s'],
+                                 inputs=subtractInputs, outputs=subtractOutputs))
+    return graph
+
+
+def mkpsfAllstarStep(name, frame, inputName, outputName, subtractedName, engine='allstar', recenter=True):
+    '''One of mkpsf's ALLSTAR runs with the _nonei psf. The subtracted frames are still files,
+    since FIND (daophot) has to read them. Without recenter the stars keep the positions they came
+    with (allstar's re=0); the sky is fitted or not as allstar.opt's IS/OS say either way.'''
+    inputs = [frame + '.imh', frame + '_nonei.psf', inputName, 'allstar.opt']
+    outputs = [outputName, subtractedName + '.imh', subtractedName + '.pix']
+    if engine == 'native':
+        return StepGraph.Step(name, function=NativeAllstar.allstarStep(frame, frame + '_nonei.psf', inputName, outputName,
+                                                                       subtractedName, None,
+                                                                       None if recenter else {'RE': 0.0}),
+                              inputs=inputs, outputs=outputs)
+    answers = [' ', frame, frame + '_nonei.psf', inputName, outputName, subtractedName]
+    if not recenter:
+        answers = ['re=0 '] + answers
+    return StepGraph.Step(name, programs['allstar'], answers, inputs=inputs, outputs=outputs)
+
+
+def allstarGraph(workingDirectory, frame, tiles=0, processes=None, engine='allstar'):
+    '''ALLSTAR, then FIND and PHOT on the subtracted frame, and ALLSTAR again (allstarHDI.scr).
+    With tiles, both ALLSTAR runs are split into that many tiles run side by side (TiledAllstar).
+    engine 'native' fits with NativeAllstar instead of allstar8192.'''
+    graph = StepGraph.StepGraph('allstar', workingDirectory)
+    graph.add(allstarStep('allstar1', frame, frame + '.ap', frame + '.als', frame + 'sub', tiles, processes, engine))
+    graph.add(StepGraph.Step('findPhot', programs['daophot'],
+                             ['at ' + frame + 'sub', 'nomon', 'opt', ' ', 'lo=100', ' ', 'fi', '1 1', frame + 'sub.coo', 'y',
+                              'phot', 'photo.opt', ' ', frame + 'sub.coo', frame + 'sub.ap'],
+                             inputs=[frame + 'sub.imh', 'daophot.opt', 'photo.opt'],
+                             outputs=[frame + 'sub.coo', frame + 'sub.ap'],
+                             removes=[frame + 'sub.imh', frame + 'sub.pix']))
+    graph.add(StepGraph.Step('ap2als', programs['ap2als'], [frame + 'sub.ap', frame + 'sub.apals'],
+                             inputs=[frame + 'sub.ap'], outputs=[frame + 'sub.apals']))
+    graph.add(StepGraph.Step('appendSort', programs['daophot'],
+                             ['nomon', 'append', frame + '.als', frame + 'sub.apals', frame + '.ap2', 'sort', '3',
+                              frame + '.ap2', frame + '.ap2', ' ', 'y'],
+                             inputs=[frame + '.als', frame + 'sub.apals'], outputs=[frame + '.ap2']))
+    graph.add(allstarStep('allstar2', frame, frame + '.ap2', frame + '.als2', frame + 'sub2', tiles, processes, engine))
+    return graph
+
+
+def allstarStep(name, frame, inputName, outputName, subtractedName, tiles=0, processes=None, engine='allstar'):
+    '''One ALLSTAR run with the 3s psf, on the whole frame or in tiles, with allstar8192 or NativeAllstar'''
+    inputs = [frame + '.imh', frame + '3s.psf', inputName, 'allstar.opt']
+    outputs = [outputName, subtractedName + '.imh', subtractedName + '.pix']
+    fitter = NativeAllstar.runNativeAllstar if engine == 'native' else TiledAllstar.runAllstar
+    if tiles > 1:
+        return StepGraph.Step(name, function=TiledAllstar.allstarStep(frame, frame + '3s.psf', inputName, outputName,
+                                                                      subtractedName, tiles, processes, fitter),
+                              inputs=inputs, outputs=outputs)
+    if engine == 'native':
+        return StepGraph.Step(name, function=NativeAllstar.allstarStep(frame, frame + '3s.psf', inputName, outputName,
+                                                                       subtractedName, processes),
+                              inputs=inputs, outputs=outputs)
+    return StepGraph.Step(name, programs['allstar'], [' ', frame, frame + '3s.psf', inputName, outputName, subtractedName],
+                          inputs=inputs, outputs=outputs)
+
+
+def pause(waitForUser, message, fileName=None):
+    '''Step function that hands the user fileName to edit (if given) and waits until they are done.
+    waitForUser(message, path or None) is whatever asks them (autoreduce asks at the terminal).'''
+    def waitForEdit(workingDirectory):
+        waitForUser(message, os.path.join(workingDirectory, fileName) if fileName is not None else None)
+    return waitForEdit
+
+
+def lowerLowBad(fileName, lowBad):
+    '''Step function that sets LOWBAD in a catalog header to lowBad if it's higher'''
+    def editHeader(workingDirectory):
+        path = os.path.join(workingDirectory, fileName)
+        catalogFile = open(path, 'r')
+        lines = catalogFile.read().splitlines(True)
+        catalogFile.close()
+        header, used = DaoCatalog.readHeader(lines)
+        if header is None or header['LOWBAD'] <= lowBad:
+            return 'LOWBAD in ' + fileName + ' is fine\n'
+        header['LOWBAD'] = lowBad
+        catalogFile = open(path + '.tmp', 'w')
+        catalogFile.write(DaoCatalog.formatHeader(header) + ''.join(lines[used:]))
+        catalogFile.close()
+        os.rename(path + '.tmp', path)
+        return 'LOWBAD in ' + fileName + ' set to ' + str(lowBad) + '\n'
+    return editHeader
+
+
+def rename(source, destination):
+    def renameFile(workingDirectory):
+        os.rename(os.path.join(workingDirectory, source), os.path.join(workingDirectory, destination))
+    return renameFile
+
+
+def copy(source, destination):
+    def copyFile(workingDirectory):
+        shutil.copyfile(os.path.join(workingDirectory, source), os.path.join(workingDirectory, destination))
+    return copyFile
+
+
+def show(fileName):
+    def openFile(workingDirectory):
+        subprocess.call([viewer, os.path.join(workingDirectory, fileName)])
+    return openFile
+
+
+def addPlotSteps(graph, plotName, macroArguments, inputs=(), showPlot=False, log=None, preamble=()):
+    '''One sm plot (the macro of the same name from macro1.sm), its pstopdf and, if showPlot,
+    opening the pdf (only for someone sitting at the screen, never in a worker)'''
+    graph.add(StepGraph.Step(plotName, programs['sm'],
+                             list(preamble) + ['macro read macro1.sm', 'dev postlandfile ' + plotName + '.ps', plotName] +
+                             list(macroArguments) + ['end'],
+                             inputs=['macro1.sm'] + list(inputs), outputs=[plotName + '.ps'], log=log))
+    graph.add(StepGraph.Step(plotName + 'Pdf', function=convertToPdf(plotName), inputs=[plotName + '.ps'],
+                             outputs=[plotName + '.pdf'], removes=[plotName + '.ps']))
+    if showPlot:
+        graph.add(StepGraph.Step(plotName + 'Show', function=show(plotName + '.pdf'), inputs=[plotName + '.pdf']))
+    return
+
+
+def convertToPdf(plotName):
+    '''pstopdf takes the file name as an argument instead of on stdin'''
+    def runPstopdf(workingDirectory):
+        returnCode, output = ExternalTools.runTool(programs['pstopdf'], [], workingDirectory, [plotName + '.ps'])
+        if returnCode != 0:
+            return False
+        return output
+    return runPstopdf
+
+
+def addCompApcorrSteps(graph, frame, iteration, askCoefficients, psfPhotometry=None, showPlots=False, after=()):
+    '''compapcorrHDI.scr: the r, x and y fits at the same time, then the polynomials and plots.
+    askCoefficients(axis, logPath) gives back the (zero order, first order) terms the user reads
+    off that axis' sigrejfit log. psfPhotometry is edt${frame}.als2 unless given: apcorr.als only
+    has the neighbors apstar.e left to subtract.'''
+    iteration = str(iteration)
+    psfPhotometry = psfPhotometry or 'edt' + frame + '.als2'
+    graph.add(StepGraph.Step('compapcorr', programs['compapcorr'], [psfPhotometry, 'apcorr.apals', 'apcorr.out'],
+                             inputs=[psfPhotometry, 'apcorr.apals'], outputs=['apcorr.out', 'fit.dat'],
+                             after=after, log='compapcorr.log'))
+    # column of fit.dat each fit is against
+    fitColumns = {'r': '1 6', 'x': '4 6', 'y': '5 6'}
+    coefficients = {}
+    for axis in ['r', 'x', 'y']:
+        # sigrejfit.e writes some fixed names (SPATIALD), so each one gets its own folder, and its
+        # SPATIALD comes back as SPATIALD.r, .x or .y
+        graph.add(StepGraph.Step(axis + 'fit', programs['sigrejfit'],
+                                 ['fit.dat', '0', '6', fitColumns[axis], '0 0', '-10 10 -10 10', '2', '0', '1',
+                                  axis + 'fitpts' + iteration],
+                                 inputs=['fit.dat'], outputs=[axis + 'fitpts' + iteration, 'SPATIALD.' + axis],
+                                 log=axis + '.log', isolate=True, renames={'SPATIALD': 'SPATIALD.' + axis}))
+
+    def readCoefficients(workingDirectory):
+        for axis in ['r', 'x', 'y']:
+            coefficients[axis] = tuple(askCoefficients(axis, os.path.join(workingDirectory, axis + '.log')))
+    graph.add(StepGraph.Step('coefficients', function=readCoefficients, after=['rfit', 'xfit', 'yfit'],
+                             interactive=True, retries=0))
+
+    for axis in ['r', 'x', 'y']:
+        polyName = 'poly' + axis + iteration + '.dat'
+        # poly.e writes the file named on its first line, so each one can write its own straight away
+        graph.add(StepGraph.Step('poly' + axis, programs['poly'],
+                                 lambda axis=axis, polyName=polyName: [polyName, '%s %s 0 0 0' % coefficients[axis],
+                                                                       '-10 10 100 0'],
+                                 outputs=[polyName], after=['coefficients'], log='compapcorr.log'))
+        addPlotSteps(graph, axis + 'plot' + iteration, [frame], inputs=[axis + 'fitpts' + iteration, polyName],
+                     showPlot=showPlots, log='compapcorr.log')
+    return
+
+
+def compApcorrGraph(workingDirectory, frame, askCoefficients, iteration=1, psfPhotometry=None, showPlots=False):
+    graph = StepGraph.StepGraph('compapcorr', workingDirectory, 'compapcorr.log')
+    addCompApcorrSteps(graph, frame, iteration, askCoefficients, psfPhotometry, showPlots)
+    return graph
+
+
+def apcorrGraph(workingDirectory, frame, iteration=1, showPlots=False, automatic=False, waitForUser=None,
+                askCoefficients=None):
+    '''apcorrHDI.scr, pauses for editing included, then compapcorrHDI.scr. automatic leaves out the
+    pauses, the plots and compapcorr: LOWBAD is fixed in place, and GrowthCurve picks the aperture
+    and fits the correction from all twelve apertures, into apcorr.coef. Otherwise the pauses go
+    through waitForUser (see pause) and the fit coefficients come from askCoefficients (see
+    addCompApcorrSteps).'''
+    if not automatic and (waitForUser is None or askCoefficients is None):
+        raise ValueError('apcorr without automatic needs waitForUser and askCoefficients')
+    graph = StepGraph.StepGraph('apcorr', workingDirectory)
+    graph.add(StepGraph.Step('sort', programs['daophot'], ['sort', '4', 'edt' + frame + '.als2', 'apcorr.coo', 'no', 'exit'],
+                             inputs=['edt' + frame + '.als2'], outputs=['apcorr.coo']))
+    if automatic:
+        graph.add(StepGraph.Step('editLowbad', function=lowerLowBad('apcorr.coo', -9.4), after=['sort']))
+    else:
+        graph.add(StepGraph.Step('editLowbad', function=pause(waitForUser, 'Change LOWBAD to -9.4 in apcorr.coo if it is greater than '
+                                                              '-9.4, save and quit.', 'apcorr.coo'),
+                                 after=['sort'], interactive=True, retries=0))
+    graph.add(StepGraph.Step('erredit', programs['erredit'], ['apcorr.coo', 'apcorr.coo2', '2', '0.07 10'],
+                             inputs=['apcorr.coo'], outputs=['apcorr.coo2'], after=['editLowbad']))
+    # the renames say they take apcorr.coo2 away, or a second run would find it missing and
+    # filter the already filtered apcorr.coo again
+    graph.add(StepGraph.Step('erreditKeep', function=rename('apcorr.coo2', 'apcorr.coo'),
+                             inputs=['apcorr.coo2'], outputs=['apcorr.coo'], removes=['apcorr.coo2'],
+                             keepOutputs=True))
+    graph.add(StepGraph.Step('selstar', programs['selstar'], ['apcorr.coo', 'apcorr.coo2', '25'],
+                             inputs=['apcorr.coo'], outputs=['apcorr.coo2']))
+    graph.add(StepGraph.Step('selstarKeep', function=rename('apcorr.coo2', 'apcorr.coo'),
+                             inputs=['apcorr.coo2'], outputs=['apcorr.coo'], removes=['apcorr.coo2'],
+                             keepOutputs=True))
+    # automatic: the faint stars stay, GrowthCurve weights them down by their errors itself
+    if not automatic:
+        graph.add(StepGraph.Step('removeFaint', function=pause(waitForUser, 'Remove faint stars from apcorr.coo, leaving at least 100 '
+                                                               'bright stars. Magnitude 13 is often a good cutoff point.',
+                                                               'apcorr.coo'),
+                                 after=['selstarKeep'], interactive=True, retries=0))
+    # apcorr.als: the stars of edt${frame}.als2 that aren't in apcorr.coo, which SUBSTAR takes away
+    # so the apcorr stars are measured on their own
+    graph.add(StepGraph.Step('apstar', programs['apstar'], ['edt' + frame + '.als2', 'apcorr.coo', 'apcorr.als', '0.5 0.5'],
+                             inputs=['edt' + frame + '.als2', 'apcorr.coo'], outputs=['apcorr.als'],
+                             after=[] if automatic else ['removeFaint']))
+    graph.add(StepGraph.Step('subtractPhot', programs['daophot'],
+                             ['at ' + frame + '.imh', 'mon', 'sub', frame + '3s.psf', 'apcorr.als', 'no', 'apcorr',
+                              'at apcorr.imh', 'nomon', 'ph', 'apcorr.opt', ' ', ' ', ' ', 'exit'],
+                             inputs=[frame + '.imh', frame + '3s.psf', 'apcorr.als', 'apcorr.opt'],
+                             outputs=['apcorr.imh', 'apcorr.pix', 'apcorr.ap']))
+    graph.add(StepGraph.Step('keepFullAp', function=copy('apcorr.ap', 'apcorr.apfull'),
+                             inputs=['apcorr.ap'], outputs=['apcorr.apfull']))
+    if automatic:
+        graph.add(StepGraph.Step('growthCurve', function=GrowthCurve.growthCurveStep(frame),
+                                 inputs=['apcorr.apfull', 'edt' + frame + '.als2', 'apcorr.opt'],
+                                 outputs=['apcorr.coef', 'growth.txt'], retries=0))
+        return graph
+    graph.add(StepGraph.Step('editAp', function=pause(waitForUser, 'apcorr.imh and apcorr.ap have been made. Check that apcorr.imh '
+                                                      'looks right and that apcorr.ap has the 20 brightest error-free '
+                                                      'stars.', 'apcorr.ap'),
+                             after=['keepFullAp'], interactive=True, retries=0))
+    graph.add(StepGraph.Step('apPlot', programs['ap_plot'], ['apcorr.ap', 'ap_plot.out', '12', 'apcorr.opt'],
+                             inputs=['apcorr.ap', 'apcorr.opt'], outputs=['ap_plot.out'], after=['editAp']))
+    addPlotSteps(graph, 'apcorrplot', [frame, '-0.4', '-0.1'], inputs=['ap_plot.out'], showPlot=showPlots)
+    graph.add(StepGraph.Step('editRadius', function=pause(waitForUser, 'Determine the apcorr radius from apcorrplot.pdf and edit '
+                                                          'apcorr.opt. Save and quit.', 'apcorr.opt'),
+                             after=['apcorrplotPdf'], interactive=True, retries=0))
+    # daophot asks before overwriting apcorr.ap, and the blank lines say yes
+    graph.add(StepGraph.Step('phot', programs['daophot'], ['at apcorr.imh', 'ph', 'apcorr.opt', ' ', ' ', ' ', ' ', 'exit'],
+                             inputs=['apcorr.imh', 'apcorr.opt'], outputs=['apcorr.ap'], after=['editRadius'],
+                             keepOutputs=True))
+    graph.add(StepGraph.Step('ap2als', programs['ap2als'], ['apcorr.ap', 'apcorr.apals'],
+                             inputs=['apcorr.ap'], outputs=['apcorr.apals']))
+    graph.add(StepGraph.Step('checkLog', function=pause(waitForUser, 'Check that apcorr.log looks right.', 'apcorr.log'),
+                             after=['ap2als'], interactive=True, retries=0))
+    addCompApcorrSteps(graph, frame, iteration, askCoefficients, showPlots=showPlots, after=['checkLog'])
+    return graph
+
+
+def spatialPlotGraph(workingDirectory, frame, iteration=1, showPlots=False):
+    '''x, y and r spatial dependency plots (macro1.scr)'''
+    graph = StepGraph.StepGraph('macro1', workingDirectory)
+    for axis in ['x', 'y', 'r']:
+        addPlotSteps(graph, axis + 'plot' + str(iteration), [frame], showPlot=showPlots, preamble=[' '])
+    return graph
+
+
+def magChiRoundPlotGraph(workingDirectory, showPlots=False):
+    '''Magnitude, chi and roundness plots (magChiRoundPlot.scr)'''
+    graph = StepGraph.StepGraph('magChiRoundPlot', workingDirectory, 'macro1.log')
+    for plotName in ['magplot', 'chiplot', 'roundplot']:
+        addPlotSteps(graph, plotName, [], showPlot=showPlots, preamble=[' '])
+    return graph
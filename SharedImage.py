@@ -0,0 +1,247 @@
+# Images that several processes work on at once. Sending a 4k x 4k frame to
+# every pool worker would pickle 64 MB per worker (per job, if it went with the
+# jobs); here the pixels sit in one memory mapped file and every process maps
+# the same pages. A worker gets a descriptor (a small dict: file, offset,
+# shape, type) and attach() gives it the array, without copying anything.
+#
+# Two kinds of files:
+#   create(shape)      a new buffer in sharedRoot (/dev/shm, so it never goes
+#                      near a disk), deleted by whoever made it
+#   frameDescriptor()  the .pix of an .imh frame as it is, read only, or
+#                      writable for a frame from IrafImage.createImage that
+#                      the workers fill in
+# (frameImage() is the first for an archived frame, whose .pix can't be mapped,
+# and the second otherwise.)
+#
+# SharedPool is a multiprocessing.Pool whose workers attach the images it is
+# given before their first job (they're in workerImages), and which deletes
+# the buffers made through it when it's closed. Buffers left behind by a
+# process that died are removed by sweepStale, whenever a pool starts.
+#
+#   with SharedImage.SharedPool(4, {'frame': SharedImage.frameDescriptor(imhPath)}) as pool:
+#       model = pool.create(shape, label='model')
+#       ... draw into model.array ...
+#       results = pool.map(job, [{'rows': rows, 'model': model.descriptor} for rows in bands])
+#   # and in job(): SharedImage.workerImages['frame'], SharedImage.attach(job['model'])
+
+import atexit
+import errno
+import itertools
+import multiprocessing
+import os
+import tempfile
+from collections import OrderedDict
+
+import numpy as np
+
+import Archive
+import HelperFunctions
+import IrafImage
+
+sharedRoot = '/dev/shm' if os.path.isdir('/dev/shm') else tempfile.gettempdir()
+filePrefix = 'autoreduce_shared_'
+maxAttached = 16        # memory maps a process keeps open for attach()
+
+# {(path, offset, writable) : memory map} of this process, least recently used first
+attached = OrderedDict()
+# {name : array} in a SharedPool worker
+workerImages = {}
+# buffers this process made and hasn't deleted yet: {path : pid that made it}
+owned = {}
+counter = itertools.count()
+
+
+class SharedImage:
+    '''An array in a memory mapped file. descriptor is what another process needs to attach it.'''
+
+    def __init__(self, descriptor, array, owner=False):
+        self.descriptor = descriptor
+        self.array = array
+        self.owner = owner
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, kind, value, trace):
+        self.close()
+        return False
+
+    def close(self):
+        '''Lets go of the array; the owner deletes the file too (processes that still have it
+        mapped keep their pages until they let go)'''
+        if self.array is not None and hasattr(self.array, 'flush') and self.descriptor.get('writable', True):
+            self.array.flush()
+        self.array = None
+        if self.owner:
+            removeBuffer(self.descriptor['path'])
+            self.owner = False
+        return
+
+
+def create(shape, dtype=np.float32, label='image'):
+    '''A new zero filled buffer in sharedRoot, owned (and deleted when closed) by this process'''
+    path = os.path.join(sharedRoot, '%s%d_%d_%s' % (filePrefix, os.getpid(), next(counter), label))
+    descriptor = {'path': path, 'offset': 0, 'shape': tuple(int(n) for n in shape), 'columns': None,
+                  'dtype': np.dtype(dtype).str, 'writable': True}
+    owned[path] = os.getpid()
+    try:
+        array = np.memmap(path, dtype=descriptor['dtype'], mode='w+', shape=descriptor['shape'])
+    except (IOError, OSError, ValueError):
+        removeBuffer(path)
+        raise
+    return SharedImage(descriptor, array, owner=True)
+
+
+def fromArray(array, label='image'):
+    '''A shared copy of an array'''
+    image = create(array.shape, array.dtype, label)
+    image.array[...] = array
+    return image
+
+
+def frameDescriptor(imhPath, writable=False):
+    '''The descriptor of a frame's pixels in its .pix, the same array IrafImage.readPixels gives'''
+    header = IrafImage.readHeader(imhPath)
+    byteOrder = '<' if header['swapped'] else '>'
+    nColumns, nRows = header['len'][0], max(header['len'][1], 1)
+    return {'path': IrafImage.pixelFilePath(header), 'offset': (header['pixoff'] - 1) * 2,
+            'shape': (nRows, header['physlen'][0]), 'columns': nColumns,
+            'dtype': np.dtype(byteOrder + IrafImage.pixelTypes[header['pixtype']]).str, 'writable': writable}
+
+
+def frameImage(imhPath):
+    '''Read only pixels of a frame for a pool: the descriptor of its .pix, or a shared copy
+    (a SharedImage) if the frame is archived'''
+    descriptor = frameDescriptor(imhPath)
+    if Archive.isArchived(descriptor['path']):
+        return fromArray(IrafImage.readPixels(imhPath), 'frame')
+    return descriptor
+
+
+def attach(descriptor):
+    '''The array of a descriptor, mapped once per process (the last maxAttached are kept)'''
+    key = (descriptor['path'], descriptor['offset'], descriptor['writable'])
+    if key in attached:
+        array = attached.pop(key)
+    else:
+        array = np.memmap(descriptor['path'], dtype=descriptor['dtype'], mode='r+' if descriptor['writable'] else 'r',
+                          offset=descriptor['offset'], shape=tuple(descriptor['shape']))
+        while len(attached) >= maxAttached:
+            attached.popitem(last=False)
+    attached[key] = array
+    if descriptor['columns'] is not None:
+        return array[:, :descriptor['columns']]
+    return array
+
+
+def detach(descriptor=None):
+    '''Drops the memory map of a descriptor (all of them with None)'''
+    if descriptor is None:
+        attached.clear()
+        return
+    for key in [key for key in attached if key[0] == descriptor['path']]:
+        del attached[key]
+    return
+
+
+def removeBuffer(path):
+    detach({'path': path})
+    if owned.get(path) == os.getpid():
+        del owned[path]
+    try:
+        os.remove(path)
+    except OSError, e:
+        if e.errno != errno.ENOENT:
+            raise
+    return
+
+
+def removeOwned():
+    # forked workers inherit the list, but only the process that made a buffer deletes it
+    for (path, pid) in owned.items():
+        if pid == os.getpid():
+            removeBuffer(path)
+    return
+
+atexit.register(removeOwned)
+
+
+def sweepStale():
+    '''Deletes the buffers of processes that aren't running any more. Returns the bytes freed.'''
+    freed = 0
+    for fileName in os.listdir(sharedRoot):
+        if not fileName.startswith(filePrefix):
+            continue
+        try:
+            pid = int(fileName[len(filePrefix):].split('_')[0])
+        except ValueError:
+            continue
+        if HelperFunctions.processAlive(pid):
+            continue
+        path = os.path.join(sharedRoot, fileName)
+        try:
+            size = os.path.getsize(path)
+            os.remove(path)
+            freed += size
+        except OSError:
+            # another process got to it first
+            pass
+    return freed
+
+
+def attachWorker(descriptors, initializer, initializerArguments):
+    '''Pool initializer: the images first, then the pool's own initializer'''
+    workerImages.clear()
+    for (name, descriptor) in descriptors.items():
+        workerImages[name] = attach(descriptor)
+    if initializer is not None:
+        initializer(*initializerArguments)
+    return
+
+
+class SharedPool:
+    '''A multiprocessing.Pool whose workers have images ({name : SharedImage or descriptor})
+    attached in workerImages. Buffers made with create() live as long as the pool, and so do the
+    images it is given that own their buffer.'''
+
+    def __init__(self, processes=None, images=None, initializer=None, initializerArguments=()):
+        descriptors = {}
+        self.buffers = []
+        for (name, image) in (images or {}).items():
+            if isinstance(image, SharedImage):
+                descriptors[name] = image.descriptor
+                if image.owner:
+                    self.buffers.append(image)
+            else:
+                descriptors[name] = image
+        # what a killed run left in shared memory would stay there until the next reboot
+        sweepStale()
+        self.pool = multiprocessing.Pool(processes, attachWorker, (descriptors, initializer, initializerArguments))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, kind, value, trace):
+        if kind is not None:
+            self.pool.terminate()
+        self.close()
+        return False
+
+    def create(self, shape, dtype=np.float32, label='image'):
+        image = create(shape, dtype, label)
+        self.buffers.append(image)
+        return image
+
+    def map(self, function, jobs):
+        return self.pool.map(function, jobs)
+
+    def close(self):
+        '''Waits for the workers to finish and deletes the pool's buffers'''
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
+            self.pool = None
+        for image in self.buffers:
+            image.close()
+        self.buffers = []
+        return
@@ -0,0 +1,355 @@
+# The shell scripts (mkpsfHDI.scr, allstarHDI.scr, ...) as Python step graphs.
+#
+# A graph is a list of steps. Each step is one program run (or one bit of
+# Python) with the files it reads and the files it makes written down, so
+#   - a step only starts when the steps making its inputs have finished, and
+#     steps that don't depend on each other (the r/x/y sigrejfit fits, the sm
+#     plots, the pstopdf conversions) run at the same time
+#   - a step that exits without making its outputs has failed, even if the
+#     program said everything was fine (daophot always does). It is retried,
+#     and if it still fails everything after it is skipped instead of running
+#     on garbage
+#   - every step is timed (and announced to stepListeners, see Telemetry), and
+#     what happened is kept in <graph>.steps in the working directory, so
+#     running the graph again picks up at the step that failed instead of
+#     starting over
+# Nothing is printed: what went wrong is in the graph's messages after a run.
+# Program output goes into the graph's log (mkpsf.log, allstar.log, ...) like
+# it did with the scripts, one step at a time so parallel steps don't get
+# mixed together.
+
+import json
+import os
+import Queue
+import shutil
+import threading
+import time
+
+import Archive
+import ExternalTools
+import FrameCache
+
+# functions called as listener(graph name, step name, 'start'|'end', result or None) around every
+# step that runs (Telemetry puts one here)
+stepListeners = []
+
+
+class Step:
+    '''One node of a graph. Give either program and answers (the lines typed into it; a
+    function returning the lines works too, for answers that aren't known until it runs),
+    or function, which is called with the working directory and fails by returning False
+    or raising (returning a string puts it in the log).
+      inputs, outputs  file names in the working directory
+      removes          files to delete once the step worked (temporary images)
+      log              log file for this step's output instead of the graph's
+      after            names of steps that have to finish first, on top of the ones making inputs
+      retries          extra attempts before giving up
+      isolate          run in a private copy of the folder (symlinks), for programs that write
+                       fixed file names and would trip over each other when run in parallel
+      renames          {fixed name : name in the working directory} for what an isolated step
+                       writes, so each one's copy survives
+      keepOutputs      don't delete old outputs before running (for programs that ask before
+                       overwriting and have that answer in their input)
+      interactive      needs the terminal, so it only runs when nothing else is running'''
+
+    def __init__(self, name, program=None, answers=None, function=None, inputs=(), outputs=(), removes=(),
+                 log=None, after=(), retries=1, isolate=False, renames=None, keepOutputs=False, interactive=False):
+        self.name = name
+        self.program = program
+        self.answers = answers
+        self.function = function
+        self.inputs = list(inputs)
+        self.outputs = list(outputs)
+        self.removes = list(removes)
+        self.log = log
+        self.after = list(after)
+        self.retries = retries
+        self.isolate = isolate
+        self.renames = dict(renames or {})
+        self.keepOutputs = keepOutputs
+        self.interactive = interactive
+        self.dependencies = []
+
+    def __repr__(self):
+        return 'Step(' + self.name + ')'
+
+
+class StepGraph:
+    def __init__(self, name, workingDirectory, log=None, maxWorkers=3):
+        self.name = name
+        self.workingDirectory = workingDirectory
+        self.log = log if log is not None else name + '.log'
+        self.maxWorkers = maxWorkers
+        self.statePath = os.path.join(workingDirectory, name + '.steps')
+        self.steps = []
+        self.stepsByName = {}
+        self.logLock = threading.Lock()
+        self.messages = []      # what went wrong the last time the graph ran
+
+    def add(self, step):
+        '''Adds a step. It depends on the most recent step making each of its inputs, so a
+        file that gets rewritten along the way (apcorr.coo) is picked up from the right step.'''
+        if step.name in self.stepsByName:
+            raise ValueError('Two steps called ' + step.name + ' in ' + self.name)
+        dependencies = []
+        for inputName in step.inputs:
+            for earlier in reversed(self.steps):
+                if inputName in earlier.outputs:
+                    dependencies.append(earlier.name)
+                    break
+        for name in step.after:
+            if name not in self.stepsByName:
+                raise ValueError(step.name + ' comes after ' + name + ', which is not in ' + self.name)
+            dependencies.append(name)
+        step.dependencies = sorted(set(dependencies), key=lambda name: self.steps.index(self.stepsByName[name]))
+        self.steps.append(step)
+        self.stepsByName[step.name] = step
+        return step
+
+    def externalInputs(self):
+        '''Files the graph reads that none of its steps make'''
+        made = set()
+        needed = []
+        for step in self.steps:
+            for inputName in step.inputs:
+                if inputName not in made and inputName not in needed:
+                    needed.append(inputName)
+            made.update(step.outputs)
+        return needed
+
+    def transientFiles(self):
+        '''Outputs some later step deletes again, so they don't count as missing'''
+        removed = set()
+        for step in self.steps:
+            removed.update(step.removes)
+        return removed
+
+    def loadState(self):
+        if not os.path.exists(self.statePath):
+            return {'graph': self.name, 'steps': {}}
+        stateFile = open(self.statePath, 'r')
+        state = json.load(stateFile)
+        stateFile.close()
+        return state
+
+    def saveState(self, state):
+        tmpPath = self.statePath + '.tmp'
+        stateFile = open(tmpPath, 'w')
+        json.dump(state, stateFile, indent=1, sort_keys=True)
+        stateFile.close()
+        os.rename(tmpPath, self.statePath)
+        return
+
+    def outputsPresent(self, step, transient):
+        for outputName in step.outputs:
+            if outputName not in transient and not os.path.exists(os.path.join(self.workingDirectory, outputName)):
+                return False
+        return True
+
+    def run(self, restart=False, rerun=()):
+        '''Runs the graph. Steps that worked last time (and whose outputs are still there) are
+        skipped unless restart is True or they are named in rerun; anything depending on a
+        step that runs again runs again too. Returns True if every step worked.'''
+        state = {'graph': self.name, 'steps': {}} if restart else self.loadState()
+        self.messages = []
+        transient = self.transientFiles()
+        status = {}
+        pending = []
+        for step in self.steps:
+            previous = state['steps'].get(step.name)
+            if (previous is not None and previous['status'] == 'done' and step.name not in rerun and
+                    not [name for name in step.dependencies if name in pending] and
+                    self.outputsPresent(step, transient)):
+                status[step.name] = 'done'
+            else:
+                pending.append(step.name)
+        if len(pending) == len(self.steps):
+            # starting from the top, so the logs start over like the scripts' first '>' did
+            self.freshLogs = set()
+        else:
+            self.freshLogs = None
+
+        state['started'] = time.time()
+        finished = Queue.Queue()
+        running = {}
+        while pending or running:
+            started = False
+            for name in list(pending):
+                step = self.stepsByName[name]
+                if [dependency for dependency in step.dependencies if status.get(dependency) in ['failed', 'blocked']]:
+                    status[name] = 'blocked'
+                    state['steps'][name] = {'status': 'blocked'}
+                    pending.remove(name)
+                    continue
+                if [dependency for dependency in step.dependencies if status.get(dependency) != 'done']:
+                    continue
+                if step.interactive:
+                    if running:
+                        # let the running steps finish, but don't start new ones in the meantime
+                        break
+                    pending.remove(name)
+                    self.finishStep(step, self.execute(step), status, state)
+                    started = True
+                    break
+                if len(running) >= self.maxWorkers:
+                    break
+                pending.remove(name)
+                worker = threading.Thread(target=lambda step=step: finished.put((step, self.execute(step))))
+                worker.daemon = True
+                running[name] = worker
+                worker.start()
+                started = True
+            if running:
+                step, result = finished.get()
+                running.pop(step.name).join()
+                self.finishStep(step, result, status, state)
+            elif not started and pending:
+                # nothing running and nothing can start: only possible with a broken 'after'
+                for name in pending:
+                    status[name] = 'blocked'
+                    state['steps'][name] = {'status': 'blocked'}
+                pending = []
+
+        state['finished'] = time.time()
+        self.saveState(state)
+        return len([name for name in status if status[name] != 'done']) == 0
+
+    def finishStep(self, step, result, status, state):
+        status[step.name] = result['status']
+        output = result.pop('output', '')
+        state['steps'][step.name] = result
+        self.writeLog(step, result, output)
+        self.saveState(state)
+        if result['status'] != 'done':
+            self.messages.append(step.name + ' failed after ' + str(result['attempts']) + ' attempt(s): ' +
+                                 result['message'])
+        return
+
+    def writeLog(self, step, result, output):
+        logName = step.log or self.log
+        if not output and result['status'] == 'done':
+            return
+        logPath = os.path.join(self.workingDirectory, logName)
+        with self.logLock:
+            mode = 'a'
+            if self.freshLogs is not None and logName not in self.freshLogs:
+                self.freshLogs.add(logName)
+                mode = 'w'
+            logFile = open(logPath, mode)
+            logFile.write(output)
+            if result['status'] != 'done':
+                logFile.write('\n*** ' + step.name + ' failed: ' + result['message'] + '\n')
+            logFile.close()
+        return
+
+    def execute(self, step):
+        '''Runs one step with its retries. Returns a result dictionary (status, attempts, seconds, ...)'''
+        self.notify(step, 'start')
+        result = self.runAttempts(step)
+        self.notify(step, 'end', result)
+        return result
+
+    def notify(self, step, event, result=None):
+        for listener in stepListeners:
+            try:
+                listener(self.name, step.name, event, result)
+            except Exception, e:
+                # a listener never takes a step down with it
+                self.messages.append('Step listener failed on ' + step.name + ': ' + str(e))
+        return
+
+    def runAttempts(self, step):
+        started = time.time()
+        output = ''
+        message = ''
+        returnCode = None
+        for attempt in range(1, step.retries + 2):
+            if not step.keepOutputs:
+                for outputName in step.outputs:
+                    if outputName not in step.inputs:
+                        removeQuietly(os.path.join(self.workingDirectory, outputName))
+            try:
+                if step.function is not None:
+                    result = step.function(self.workingDirectory)
+                    returnCode = 1 if result is False else 0
+                    # a function can hand back text for the log
+                    attemptOutput = result if isinstance(result, basestring) else ''
+                else:
+                    answers = step.answers() if callable(step.answers) else step.answers
+                    if step.isolate:
+                        returnCode, attemptOutput = self.runIsolated(step, answers)
+                    else:
+                        returnCode, attemptOutput = ExternalTools.runTool(step.program, answers, self.workingDirectory)
+            except Exception, e:
+                returnCode, attemptOutput = 1, ''
+                message = str(e)
+            output += attemptOutput
+            missing = [outputName for outputName in step.outputs
+                       if not os.path.exists(os.path.join(self.workingDirectory, outputName))]
+            if returnCode == 127:
+                message = step.program + ' not found'
+                break
+            if not missing and returnCode == 0:
+                for removeName in step.removes:
+                    removeQuietly(os.path.join(self.workingDirectory, removeName))
+                return {'status': 'done', 'attempts': attempt, 'seconds': time.time() - started,
+                        'returnCode': returnCode, 'message': '', 'output': output}
+            if missing:
+                message = 'did not make ' + ', '.join(missing)
+            elif not message:
+                message = 'exited with ' + str(returnCode)
+        return {'status': 'failed', 'attempts': attempt, 'seconds': time.time() - started,
+                'returnCode': returnCode, 'message': message, 'output': output}
+
+    def runIsolated(self, step, answers):
+        '''Runs the program in .<step>.work/, which has a symlink to everything in the working
+        directory (except the files it renames, so it can't write through to an old copy).
+        Whatever new files it makes are moved back when it's done, renamed as step.renames says.'''
+        privateDirectory = os.path.join(self.workingDirectory, '.' + step.name + '.work')
+        if os.path.isdir(privateDirectory):
+            shutil.rmtree(privateDirectory)
+        os.mkdir(privateDirectory)
+        try:
+            for fileName in os.listdir(self.workingDirectory):
+                if not fileName.startswith('.') and fileName not in step.renames:
+                    os.symlink(os.path.join(os.path.abspath(self.workingDirectory), fileName),
+                               os.path.join(privateDirectory, fileName))
+            returnCode, output = ExternalTools.runTool(step.program, answers, privateDirectory)
+            for fileName in os.listdir(privateDirectory):
+                path = os.path.join(privateDirectory, fileName)
+                if not os.path.islink(path) and os.path.isfile(path):
+                    os.rename(path, os.path.join(self.workingDirectory, step.renames.get(fileName, fileName)))
+        finally:
+            shutil.rmtree(privateDirectory, ignore_errors=True)
+        return returnCode, output
+
+    def formatTimings(self):
+        '''What happened to each step the last time the graph ran'''
+        state = self.loadState()
+        total = 0.0
+        lines = []
+        for step in self.steps:
+            result = state['steps'].get(step.name)
+            if result is None:
+                lines.append('  %-22s not run' % step.name)
+                continue
+            seconds = result.get('seconds', 0.0)
+            total += seconds
+            lines.append('  %-22s %-8s %8.1f s  %d attempt(s)' % (step.name, result['status'], seconds,
+                                                                 result.get('attempts', 0)))
+        if 'started' in state and 'finished' in state:
+            lines.append('  %-22s %-8s %8.1f s  (%.1f s of step time)' % (self.name, 'total',
+                                                                          state['finished'] - state['started'], total))
+        return '\n'.join(lines)
+
+
+def removeQuietly(path):
+    if path.endswith('.imh') or path.endswith('.pix'):
+        # a memory map would keep the space in use
+        FrameCache.forget(path)
+    Archive.removeArchive(path)
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+    return
@@ -0,0 +1,300 @@
+# What every worker reducing a data set is doing right now, and how long the
+# rest will take. Each worker appends one json line per step start and end to
+# its own file in dataSetDirectory/.telemetry/ (one file per worker, so
+# machines sharing the RAID never write the same file):
+#   {'time', 'worker', 'host', 'frame', 'step', 'event': 'start'|'end', 'status', 'seconds'}
+# Steps are the reduction steps (Checkpoint.reductionSteps) and the steps of
+# the step graphs inside them ('mkpsfScript/allstarNeighbors').
+#
+# The ends of earlier runs are the step duration history: the dashboard
+# compares every running step with the median of its earlier runs, flags it as
+# stalled once it has taken stallFactor times as long as usual, and works out
+# the ETA of the data set from the medians of the steps still to go.
+#
+#   python Telemetry.py status /data/n2158_phot/n2158/
+#   python Telemetry.py watch /data/n2158_phot/n2158/ [seconds between updates]
+
+import glob
+import json
+import os
+import socket
+import sys
+import threading
+import time
+
+import numpy as np
+
+import Artifacts
+import Checkpoint
+import StepGraph
+import WorkQueue
+
+stallFactor = 3.0           # a step is stalled when it runs this many times longer than usual...
+stallMinimumSeconds = 120   # ...and longer than this
+throughputHours = 3.0       # frames/hour is over this many hours
+
+
+def telemetryDirectory(dataSetDirectory):
+    return os.path.join(dataSetDirectory, '.telemetry')
+
+
+class Publisher:
+    '''Writes this worker's step events'''
+
+    def __init__(self, dataSetDirectory, worker=None):
+        self.dataSetDirectory = dataSetDirectory
+        self.worker = worker or WorkQueue.workerName()
+        directory = telemetryDirectory(dataSetDirectory)
+        if not os.path.isdir(directory):
+            try:
+                os.mkdir(directory)
+            except OSError:
+                # somebody else just made it
+                pass
+        self.eventPath = os.path.join(directory, self.worker.replace(':', '_') + '.events')
+        self.frame = None
+        self.step = None
+        self.lock = threading.Lock()
+
+    def publish(self, frame, step, event, status=None, seconds=None):
+        record = {'time': time.time(), 'worker': self.worker, 'host': socket.gethostname(), 'frame': frame,
+                  'step': step, 'event': event}
+        if status is not None:
+            record['status'] = status
+        if seconds is not None:
+            record['seconds'] = seconds
+        with self.lock:
+            # one short append per event, so a reader never sees half a line for long
+            eventFile = open(self.eventPath, 'a')
+            eventFile.write(json.dumps(record, sort_keys=True) + '\n')
+            eventFile.close()
+        return
+
+    def stepStarted(self, frame, step):
+        self.frame = frame
+        self.step = step
+        self.publish(frame, step, 'start')
+        return
+
+    def stepFinished(self, frame, step, status, seconds=None):
+        self.publish(frame, step, 'end', status, seconds)
+        self.step = None
+        return
+
+    def graphEvent(self, graphName, stepName, event, result=None):
+        '''StepGraph listener: graph steps are published as part of the reduction step running them'''
+        if self.frame is None:
+            return
+        step = (self.step or graphName) + '/' + stepName
+        if event == 'start':
+            self.publish(self.frame, step, 'start')
+        else:
+            self.publish(self.frame, step, 'end', result['status'], result.get('seconds'))
+        return
+
+
+# the publisher of this process, if telemetry is on
+publisher = None
+
+
+def startPublishing(dataSetDirectory, worker=None):
+    '''Turns telemetry on for this process: reduction steps are published through stepStarted and
+    stepFinished, step graph steps automatically'''
+    global publisher
+    stopPublishing()
+    publisher = Publisher(dataSetDirectory, worker)
+    StepGraph.stepListeners.append(publisher.graphEvent)
+    return publisher
+
+
+def stopPublishing():
+    global publisher
+    if publisher is not None and publisher.graphEvent in StepGraph.stepListeners:
+        StepGraph.stepListeners.remove(publisher.graphEvent)
+    publisher = None
+    return
+
+
+def stepStarted(frame, step):
+    if publisher is not None:
+        publisher.stepStarted(frame, step)
+    return
+
+
+def stepFinished(frame, step, status, seconds=None):
+    if publisher is not None:
+        publisher.stepFinished(frame, step, status, seconds)
+    return
+
+
+def readEvents(dataSetDirectory):
+    '''Every worker's events, oldest first. A line still being written is skipped.'''
+    events = []
+    for path in glob.glob(os.path.join(telemetryDirectory(dataSetDirectory), '*.events')):
+        eventFile = open(path, 'r')
+        for line in eventFile:
+            try:
+                events.append(json.loads(line))
+            except ValueError:
+                pass
+        eventFile.close()
+    events.sort(key=lambda record: record['time'])
+    return events
+
+
+def stepHistory(events):
+    '''{step : median seconds} over every run of the step that worked'''
+    durations = {}
+    for record in events:
+        if record['event'] == 'end' and record.get('status') == 'done' and record.get('seconds') is not None:
+            durations.setdefault(record['step'], []).append(record['seconds'])
+    return dict((step, float(np.median(seconds))) for (step, seconds) in durations.items())
+
+
+def frameProgress(events):
+    '''{frame : {'worker', 'running': {step : start time}, 'done': set of reduction steps, 'last',
+    'finished'}} from the events. A frame's steps start over when a different worker picks it up.'''
+    frames = {}
+    for record in events:
+        frame = frames.setdefault(record['frame'], {'worker': record['worker'], 'running': {}, 'done': set(),
+                                                    'last': 0.0, 'finished': None})
+        if record['worker'] != frame['worker']:
+            # whatever the old worker was running died with it
+            frame['worker'] = record['worker']
+            frame['running'] = {}
+        frame['last'] = record['time']
+        if record['event'] == 'start':
+            frame['running'][record['step']] = record['time']
+            continue
+        frame['running'].pop(record['step'], None)
+        if record['step'] in Checkpoint.reductionSteps and record.get('status') == 'done':
+            frame['done'].add(record['step'])
+            if record['step'] == Checkpoint.reductionSteps[-1]:
+                frame['finished'] = record['time']
+    return frames
+
+
+def formatSeconds(seconds):
+    if seconds is None:
+        return '-'
+    seconds = int(seconds)
+    if seconds < 3600:
+        return '%dm%02ds' % (seconds / 60, seconds % 60)
+    return '%dh%02dm' % (seconds / 3600, seconds % 3600 / 60)
+
+
+def summary(dataSetDirectory, now=None):
+    '''Everything the dashboard shows, as a dictionary:
+      frames      [{'frame', 'worker', 'step', 'elapsed', 'usual', 'done', 'stalled'}] being worked on
+      stalled     the running steps that take far longer than usual
+      queue       {state : number of frames} (pending, working, done, failed, ...)
+      perHour     frames finished per hour over the last throughputHours
+      eta         seconds until the data set is finished, None without any history'''
+    now = now or time.time()
+    events = readEvents(dataSetDirectory)
+    history = stepHistory(events)
+    progress = frameProgress(events)
+
+    frameStates = {}
+    if os.path.isdir(os.path.join(dataSetDirectory, '.queue')):
+        for (frame, record) in WorkQueue.FileBroker(dataSetDirectory).status().items():
+            frameStates[frame] = record['state']
+    else:
+        # nobody uses the shared queue: frames are done when their last step is
+        for frame in Artifacts.frameNames(dataSetDirectory):
+            frameStates[frame] = 'pending'
+    for (frame, record) in progress.items():
+        if frameStates.get(frame, 'pending') == 'pending':
+            if record['finished'] is not None:
+                frameStates[frame] = 'done'
+            elif record['running']:
+                frameStates[frame] = 'working'
+
+    frames = []
+    stalled = []
+    for frame in sorted(progress):
+        record = progress[frame]
+        if not record['running'] or frameStates.get(frame) in ['done', 'failed']:
+            continue
+        # the innermost step is the one actually doing something
+        step = max(record['running'], key=lambda name: (record['running'][name], name.count('/')))
+        elapsed = now - record['running'][step]
+        usual = history.get(step)
+        entry = {'frame': frame, 'worker': record['worker'], 'step': step, 'elapsed': elapsed, 'usual': usual,
+                 'done': len(record['done']), 'stalled': False}
+        if usual is not None and elapsed > max(stallFactor * usual, stallMinimumSeconds):
+            entry['stalled'] = True
+            stalled.append(entry)
+        frames.append(entry)
+
+    queue = {}
+    for state in frameStates.values():
+        queue[state] = queue.get(state, 0) + 1
+    finishedTimes = [record['finished'] for record in progress.values()
+                     if record['finished'] is not None and record['finished'] > now - throughputHours * 3600]
+    perHour = len(finishedTimes) / throughputHours
+
+    # ETA: what's left of the working frames plus whole frames for the pending ones, spread over the workers
+    frameSeconds = sum(history.get(step, 0.0) for step in Checkpoint.reductionSteps)
+    eta = None
+    if frameSeconds > 0:
+        remaining = 0.0
+        for entry in frames:
+            done = progress[entry['frame']]['done']
+            left = [step for step in Checkpoint.reductionSteps if step not in done]
+            remaining += sum(history.get(step, 0.0) for step in left)
+            topStep = entry['step'].split('/')[0]
+            remaining -= min(now - progress[entry['frame']]['running'].get(topStep, now), history.get(topStep, 0.0))
+        remaining += queue.get('pending', 0) * frameSeconds + queue.get('expired', 0) * frameSeconds
+        workers = max(len(set(entry['worker'] for entry in frames)), 1)
+        eta = max(remaining, 0.0) / workers
+    return {'frames': frames, 'stalled': stalled, 'queue': queue, 'perHour': perHour, 'eta': eta}
+
+
+def printDashboard(dataSetDirectory):
+    report = summary(dataSetDirectory)
+    print dataSetDirectory + '   ' + time.strftime('%Y-%m-%d %H:%M:%S')
+    print ''
+    print ('frame'.ljust(12) + 'worker'.ljust(24) + 'step'.ljust(40) + 'running'.rjust(9) + 'usual'.rjust(9) +
+           'steps'.rjust(8))
+    for entry in report['frames']:
+        print (entry['frame'].ljust(12) + entry['worker'][:23].ljust(24) + entry['step'][:39].ljust(40) +
+               formatSeconds(entry['elapsed']).rjust(9) + formatSeconds(entry['usual']).rjust(9) +
+               ('%d/%d' % (entry['done'], len(Checkpoint.reductionSteps))).rjust(8) +
+               ('  STALLED' if entry['stalled'] else ''))
+    if not report['frames']:
+        print 'nothing running'
+    print ''
+    print 'queue: ' + ', '.join(str(report['queue'].get(state, 0)) + ' ' + state
+                                for state in ['pending', 'working', 'expired', 'done', 'failed'])
+    print 'throughput: %.1f frames/hour over the last %g hours' % (report['perHour'], throughputHours)
+    print 'ETA: ' + (formatSeconds(report['eta']) if report['eta'] is not None else 'no step history yet')
+    for entry in report['stalled']:
+        print ('STALLED: ' + entry['frame'] + ' ' + entry['step'] + ' running ' + formatSeconds(entry['elapsed']) +
+               ', usually ' + formatSeconds(entry['usual']))
+    return report
+
+
+def watch(dataSetDirectory, interval=10.0):
+    '''Terminal dashboard, redrawn every interval seconds until ^C'''
+    try:
+        while True:
+            # clear the screen and go to the top left
+            sys.stdout.write('\033[2J\033[H')
+            printDashboard(dataSetDirectory)
+            sys.stdout.flush()
+            time.sleep(interval)
+    except KeyboardInterrupt:
+        print ''
+    return
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 3 or sys.argv[1] not in ['status', 'watch']:
+        print 'usage: python Telemetry.py status dataSetDirectory'
+        print '       python Telemetry.py watch dataSetDirectory [seconds]'
+        sys.exit(1)
+    if sys.argv[1] == 'status':
+        printDashboard(sys.argv[2])
+    else:
+        watch(sys.argv[2], float(sys.argv[3]) if len(sys.argv) > 3 else 10.0)
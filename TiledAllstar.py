@@ -0,0 +1,197 @@
+# ALLSTAR on a big crowded frame, one tile at a time on every core.
+#
+# The frame is cut into a grid of tiles. Each tile owns its core box and also
+# looks at a margin around it (PSF radius + fitting radius, so every star
+# whose light reaches a core star is fitted together with it). A tile is just
+# a list of stars: every tile runs against the same image (symlinked, never
+# copied or cut up), with the input list cut down to the stars in its box.
+# Since positions never change, the PSF and its spatial variation work as
+# they are.
+#
+# Stitching: every star belongs to the tile whose center is closest, which on
+# a regular grid is the tile whose core holds its input position. Stars from
+# the margins are fitted but thrown away, so each star comes out exactly once.
+# The subtracted image is put together from the core of each tile's
+# subtracted image, read through memory maps.
+
+import multiprocessing
+import os
+import shutil
+
+import numpy as np
+
+import DaoCatalog
+import ExternalTools
+import FrameCache
+import IrafImage
+import OptionFiles
+
+allstarProgram = 'allstar8192'
+
+
+def tileGrid(nColumns, nRows, nTiles):
+    '''(tiles across, tiles up) for about nTiles tiles that are as square as they can be'''
+    best = None
+    for across in range(1, nTiles + 1):
+        up = int(np.ceil(nTiles / float(across)))
+        # squarer tiles need less margin for the same area
+        score = abs(np.log((nColumns / float(across)) / (nRows / float(up)))) + 0.1 * (across * up - nTiles)
+        if best is None or score < best[0]:
+            best = (score, across, up)
+    return best[1], best[2]
+
+
+def makeTiles(nColumns, nRows, across, up, margin):
+    '''List of tiles: {'name', 'core': (x0, x1, y0, y1), 'box': (x0, x1, y0, y1)} in daophot
+    pixels. Cores cover the frame without overlapping (x0 <= x < x1); boxes add the margin.'''
+    xEdges = np.linspace(0.5, nColumns + 0.5, across + 1)
+    yEdges = np.linspace(0.5, nRows + 0.5, up + 1)
+    tiles = []
+    for j in range(up):
+        for i in range(across):
+            core = (xEdges[i], xEdges[i + 1], yEdges[j], yEdges[j + 1])
+            box = (core[0] - margin, core[1] + margin, core[2] - margin, core[3] + margin)
+            tiles.append({'name': 't%d_%d' % (i, j), 'core': core, 'box': box})
+    return tiles
+
+
+def inBox(box, x, y):
+    return (x >= box[0]) & (x < box[1]) & (y >= box[2]) & (y < box[3])
+
+
+def tileMargin(workingDirectory):
+    '''PSF radius + fitting radius from daophot.opt, and a bit for stars moving while they're fitted'''
+    options = {}
+    if os.path.exists(os.path.join(workingDirectory, 'daophot.opt')):
+        options = OptionFiles.readOptionFile(os.path.join(workingDirectory, 'daophot.opt'))
+    return options.get('PS', 15.0) + options.get('FI', 5.0) + 2.0
+
+
+def runAllstar(tileDirectory, frame, psfName, inputName, outputName, subtractedName):
+    '''Fits one tile with allstar. Returns (return code, output).'''
+    return ExternalTools.runTool(allstarProgram, [' ', frame, psfName, inputName, outputName, subtractedName],
+                                 tileDirectory)
+
+
+def runTileJob(arguments):
+    fitter = arguments[0]
+    return fitter(*arguments[1:])
+
+
+def link(source, destination):
+    if os.path.lexists(destination):
+        os.remove(destination)
+    os.symlink(os.path.abspath(source), destination)
+    return
+
+
+def tiledAllstar(workingDirectory, frame, psfName, inputName, outputName, subtractedName, nTiles,
+                 processes=None, fitter=runAllstar, margin=None):
+    '''Does what one allstar run does (inputName -> outputName and subtractedName.imh), using
+    nTiles tiles in a pool of processes. fitter runs one tile (see runAllstar). Returns the
+    output of every tile run, and raises IOError if a tile failed.'''
+    imhPath = os.path.join(workingDirectory, frame + '.imh')
+    header = IrafImage.readHeader(imhPath)
+    nColumns, nRows = header['len'][0], header['len'][1]
+    if margin is None:
+        margin = tileMargin(workingDirectory)
+    across, up = tileGrid(nColumns, nRows, nTiles)
+    tiles = makeTiles(nColumns, nRows, across, up, margin)
+
+    kind = DaoCatalog.catalogKind(inputName)
+    catalogHeader, stars = DaoCatalog.readCatalog(os.path.join(workingDirectory, inputName))
+    # the frame and the options are the same for every tile, so they are linked in
+    shared = [frame + '.imh', IrafImage.pixelFilePath(header), psfName, 'allstar.opt', 'daophot.opt']
+    tilesDirectory = os.path.join(workingDirectory, '.' + os.path.splitext(outputName)[0] + '.tiles')
+    if os.path.isdir(tilesDirectory):
+        shutil.rmtree(tilesDirectory)
+    os.mkdir(tilesDirectory)
+
+    try:
+        jobs = []
+        for tile in tiles:
+            tileDirectory = os.path.join(tilesDirectory, tile['name'])
+            os.mkdir(tileDirectory)
+            for fileName in shared:
+                if os.path.exists(os.path.join(workingDirectory, fileName)):
+                    link(os.path.join(workingDirectory, fileName), os.path.join(tileDirectory, os.path.basename(fileName)))
+            inside = inBox(tile['box'], stars['x'], stars['y'])
+            tile['stars'] = int(inside.sum())
+            if not tile['stars']:
+                continue
+            DaoCatalog.writeCatalog(os.path.join(tileDirectory, inputName), catalogHeader,
+                                    DaoCatalog.selectRows(stars, inside), kind)
+            jobs.append((fitter, tileDirectory, frame, psfName, inputName, outputName, subtractedName))
+
+        pool = multiprocessing.Pool(processes)
+        try:
+            results = pool.map(runTileJob, jobs)
+        finally:
+            pool.close()
+            pool.join()
+
+        output = ''
+        for (job, (returnCode, tileOutput)) in zip(jobs, results):
+            output += '--- tile ' + os.path.basename(job[1]) + '\n' + tileOutput
+            if not os.path.exists(os.path.join(job[1], outputName)):
+                raise IOError('tile ' + os.path.basename(job[1]) + ' did not make ' + outputName)
+
+        stitchCatalogs(workingDirectory, tiles, tilesDirectory, stars, outputName)
+        stitchImages(workingDirectory, tiles, tilesDirectory, frame, subtractedName)
+    finally:
+        shutil.rmtree(tilesDirectory, ignore_errors=True)
+    return output
+
+
+def stitchCatalogs(workingDirectory, tiles, tilesDirectory, stars, outputName):
+    '''One catalog from the tiles, every star taken from the tile owning its input position'''
+    owners = {}
+    for (index, tile) in enumerate(tiles):
+        for starId in stars['id'][inBox(tile['core'], stars['x'], stars['y'])]:
+            owners[starId] = index
+
+    pieces = []
+    header = None
+    for (index, tile) in enumerate(tiles):
+        path = os.path.join(tilesDirectory, tile['name'], outputName)
+        if not os.path.exists(path):
+            continue
+        tileHeader, columns = DaoCatalog.readCatalog(path)
+        header = header or tileHeader
+        mine = np.array([owners.get(starId) == index for starId in columns['id']], dtype=bool)
+        pieces.append(DaoCatalog.selectRows(columns, mine))
+
+    names = pieces[0].keys() if pieces else DaoCatalog.catalogColumns['als']
+    columns = dict((name, np.concatenate([piece[name] for piece in pieces]) if pieces else np.zeros(0))
+                   for name in names)
+    order = np.argsort(columns['id'], kind='mergesort')
+    DaoCatalog.writeCatalog(os.path.join(workingDirectory, outputName), header,
+                            DaoCatalog.selectRows(columns, order), 'als')
+    return
+
+
+def stitchImages(workingDirectory, tiles, tilesDirectory, frame, subtractedName):
+    '''The subtracted frame: the original where no tile had stars, each tile's core everywhere else'''
+    original = FrameCache.pixels(os.path.join(workingDirectory, frame + '.imh'))
+    subtracted = np.array(original, dtype=np.float32)
+    for tile in tiles:
+        path = os.path.join(tilesDirectory, tile['name'], subtractedName + '.imh')
+        if not os.path.exists(path):
+            continue
+        tilePixels = IrafImage.readPixels(path)
+        # core edges are half pixels, so this is the rows and columns whose centers are in the core
+        x0, x1 = int(np.ceil(tile['core'][0])) - 1, int(np.ceil(tile['core'][1])) - 1
+        y0, y1 = int(np.ceil(tile['core'][2])) - 1, int(np.ceil(tile['core'][3])) - 1
+        subtracted[y0:y1, x0:x1] = tilePixels[y0:y1, x0:x1]
+        del tilePixels
+    IrafImage.writeImage(os.path.join(workingDirectory, subtractedName + '.imh'), subtracted,
+                         os.path.join(workingDirectory, frame + '.imh'))
+    return
+
+
+def allstarStep(frame, psfName, inputName, outputName, subtractedName, nTiles, processes=None, fitter=runAllstar):
+    '''StepGraph function for a tiled allstar run'''
+    def runTiles(workingDirectory):
+        return tiledAllstar(workingDirectory, frame, psfName, inputName, outputName, subtractedName, nTiles,
+                            processes, fitter)
+    return runTiles
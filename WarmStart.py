@@ -0,0 +1,168 @@
+# Starting a frame's PSF from another frame of the same field that is already
+# reduced. Exposures of the same cluster taken one after the other have the
+# same bright isolated stars, so the PSF stars picked (and culled by hand) on
+# the first frame of a series are good on the others too.
+#
+# Needs the new frame's .ap (psfFirstPass). The reference frame's .ap is
+# matched to it (CatalogMatch.solveTransform), and the reference frame's final
+# lists go through that transformation onto the new frame:
+#   ${frame}.lst        the PSF stars
+#   ${frame}_nonei.lst  the ones without close neighbors (neighborStarSubtraction)
+#   ${frame}_2.lst      the ones that subtracted cleanly (badPSFSubtractionStarRemoval)
+# Each star has to land on a star of the new .ap and still look like a PSF star
+# on the new frame (verifyStars): far enough from the edge, not saturated,
+# clearly above the sky and star shaped. The stars taken out of the lists on the
+# reference go into sub_nonei.lst and sub.lst, the lists you'd otherwise mark
+# in ds9, so sublst.e and the rest of the steps work as always.
+#
+# The reference frame's FWHM comes along too, and its PSF (3s.psf, or .psf) is
+# where PsfBuilder starts fitting the analytic profile.
+
+import os
+
+import numpy as np
+
+import Archive
+import CatalogMatch
+import Checkpoint
+import DaoCatalog
+import DaoPsf
+import FrameCache
+import IrafImage
+import OptionFiles
+import PsfSelect
+
+matchRadius = 1.5           # pixels between a mapped star and a star of the new .ap
+minimumSignificance = 20.0  # peak over the sky sigma
+minimumKept = 0.5           # fraction of the reference PSF stars that has to survive
+minimumStars = 5
+
+
+def referenceFwhm(dataSetDirectory, referenceFrame):
+    return Checkpoint.FrameState(dataSetDirectory, referenceFrame).getParameter('fwhm')
+
+
+def referencePsf(dataSetDirectory, referenceFrame):
+    '''The reference frame's final PSF (DaoPsf), or None'''
+    for name in [referenceFrame + '3s.psf', referenceFrame + '.psf']:
+        path = os.path.join(dataSetDirectory, referenceFrame, name)
+        if Archive.exists(path):
+            return DaoPsf.readPsf(path)
+    return None
+
+
+def verifyStars(pixels, x, y, sky, skySigma, fwhm, highBad, psfRadius):
+    '''Why each star (at x, y on the frame) can't be a PSF star there, '' if it can'''
+    nRows, nColumns = pixels.shape
+    flags = np.array([''] * len(x), dtype=object)
+    margin = psfRadius + 1
+    onChip = (x > margin) & (x < nColumns - margin) & (y > margin) & (y < nRows - margin)
+    flags[~onChip] = 'edge'
+    cutouts = IrafImage.stamps(pixels, x, y, int(np.ceil(2 * fwhm)))
+    peaks = np.nanmax(cutouts.reshape(len(x), -1), axis=1) if len(x) else np.zeros(0)
+    flags[(peaks >= highBad) & (flags == '')] = 'saturated'
+    flags[(peaks - sky < minimumSignificance * np.maximum(skySigma, 1e-3)) & (flags == '')] = 'faint'
+    widths = PsfSelect.measureWidths(cutouts, sky) if len(x) else np.zeros(0)
+    starLike = (widths > PsfSelect.widthRange[0] * fwhm) & (widths < PsfSelect.widthRange[1] * fwhm)
+    flags[~starLike & (flags == '')] = 'shape'
+    return flags
+
+
+def writePositions(path, x, y):
+    '''A list of x y, the way tvmark writes the stars you mark'''
+    positionFile = open(path, 'w')
+    for i in range(len(x)):
+        positionFile.write('%9.3f %9.3f\n' % (x[i], y[i]))
+    positionFile.close()
+    return
+
+
+def warmStart(dataSetDirectory, frame, referenceFrame):
+    '''Writes the frame's PSF lists from the reference frame's. Returns a summary: 'pairs' (stars
+    the transformation rests on), 'transform', 'fwhm', 'lists' ({list name : [stars written, stars
+    in the reference list]}), 'rejected' ({reason : stars}) and 'error' if it couldn't be done,
+    in which case nothing is written.'''
+    frameDirectory = os.path.join(dataSetDirectory, frame)
+    referenceDirectory = os.path.join(dataSetDirectory, referenceFrame)
+    summary = {'reference': referenceFrame, 'pairs': 0, 'transform': None, 'lists': {}, 'rejected': {},
+               'fwhm': referenceFwhm(dataSetDirectory, referenceFrame)}
+    for path in [os.path.join(frameDirectory, frame + '.ap'), os.path.join(referenceDirectory, referenceFrame + '.ap'),
+                 os.path.join(referenceDirectory, referenceFrame + '.lst')]:
+        if not Archive.exists(path):
+            summary['error'] = os.path.basename(path) + ' is missing'
+            return summary
+    if summary['fwhm'] is None:
+        summary['error'] = 'no FWHM saved for ' + referenceFrame
+        return summary
+
+    header, apColumns = DaoCatalog.readCatalog(os.path.join(frameDirectory, frame + '.ap'))
+    referenceHeader, referenceAp = DaoCatalog.readCatalog(os.path.join(referenceDirectory, referenceFrame + '.ap'))
+    frameCatalog = dict(apColumns, mag=apColumns['mag'][:, 0])
+    referenceCatalog = dict(referenceAp, mag=referenceAp['mag'][:, 0])
+    # reference positions onto this frame
+    transform, pairs = CatalogMatch.solveTransform(referenceCatalog, frameCatalog)
+    summary['pairs'] = pairs
+    if transform is None:
+        summary['error'] = 'could not match ' + referenceFrame + ' to ' + frame
+        return summary
+    summary['transform'] = [float(value) for value in transform]
+
+    listHeader, psfList = DaoCatalog.readCatalog(os.path.join(referenceDirectory, referenceFrame + '.lst'))
+    mappedX, mappedY = CatalogMatch.applyTransform(transform, psfList['x'], psfList['y'])
+    good = np.nonzero(frameCatalog['mag'] < DaoCatalog.badMagnitude - 1)[0]
+    index = CatalogMatch.GridIndex(apColumns['x'][good], apColumns['y'][good], matchRadius)
+    matches, distances = index.nearest(mappedX, mappedY, matchRadius)
+    found = matches >= 0
+    rows = good[np.where(found, matches, 0)]
+
+    options = {}
+    if os.path.exists(os.path.join(frameDirectory, 'daophot.opt')):
+        options = OptionFiles.readOptionFile(os.path.join(frameDirectory, 'daophot.opt'))
+    pixels = FrameCache.pixels(os.path.join(frameDirectory, frame + '.imh'))
+    flags = np.array(['missing'] * len(rows), dtype=object)
+    flags[found] = verifyStars(pixels, apColumns['x'][rows[found]], apColumns['y'][rows[found]],
+                               apColumns['sky'][rows[found]], apColumns['skysigma'][rows[found]], summary['fwhm'],
+                               options.get('HI', 55000.0), options.get('PS', 15.0))
+    for flag in set(flags) - set(['']):
+        summary['rejected'][flag] = int((flags == flag).sum())
+    kept = flags == ''
+    summary['lists'][frame + '.lst'] = [int(kept.sum()), len(kept)]
+    if kept.sum() < max(minimumStars, minimumKept * len(kept)):
+        summary['error'] = 'only %d of the %d PSF stars of %s are usable here' % (kept.sum(), len(kept), referenceFrame)
+        return summary
+
+    # duplicates can't happen with a sane transformation, but a list that has the same star twice would
+    chosen, first = np.unique(rows[kept], return_index=True)
+    order = np.argsort(first)
+    chosen = chosen[order]
+    referenceIds = psfList['id'][kept][first[order]]
+    PsfSelect.writePsfList(os.path.join(frameDirectory, frame + '.lst'), header, apColumns, chosen)
+
+    # the culled lists: whatever the reference kept, and the rest to sub_nonei.lst and sub.lst for sublst.e
+    for (suffix, culledName) in [('_nonei.lst', 'sub_nonei.lst'), ('_2.lst', 'sub.lst')]:
+        referencePath = os.path.join(referenceDirectory, referenceFrame + suffix)
+        if not Archive.exists(referencePath):
+            # an old one would be taken for this one's
+            if os.path.exists(os.path.join(frameDirectory, culledName)):
+                os.remove(os.path.join(frameDirectory, culledName))
+            continue
+        culledHeader, culledList = DaoCatalog.readCatalog(referencePath)
+        inList = np.in1d(referenceIds, culledList['id'])
+        PsfSelect.writePsfList(os.path.join(frameDirectory, frame + suffix), header, apColumns, chosen[inList])
+        writePositions(os.path.join(frameDirectory, culledName), apColumns['x'][chosen[~inList]],
+                       apColumns['y'][chosen[~inList]])
+        summary['lists'][frame + suffix] = [int(inList.sum()), len(culledList['id'])]
+    return summary
+
+
+def formatSummary(summary):
+    if 'error' in summary:
+        return 'No warm start from ' + summary['reference'] + ': ' + summary['error']
+    lines = ['Warm start from %s: %d stars matched, offset %.2f, %.2f, FWHM %s' % (
+        summary['reference'], summary['pairs'], summary['transform'][0], summary['transform'][3], summary['fwhm'])]
+    for (name, (written, total)) in sorted(summary['lists'].items()):
+        lines.append('  %-20s %d of %d reference stars' % (name, written, total))
+    if summary['rejected']:
+        lines.append('  not usable here: ' + ', '.join('%d %s' % (count, flag)
+                                                     for (flag, count) in sorted(summary['rejected'].items())))
+    return '\n'.join(lines)
@@ -0,0 +1,364 @@
+# Hands out the frames of a data set to however many machines are reducing it.
+# Every machine mounts the same RAID, so the queue is just a folder of small
+# files next to the frames (dataSetDirectory/.queue/):
+#   frame.claim   who is working on the frame and until when (the lease)
+#   frame.done    the frame is finished
+#   frame.failed  the frame blew up, a person needs to look at it
+# A worker keeps renewing its lease while it works. If a machine dies, its
+# lease runs out and the next worker to come along takes the frame over.
+#
+# Anything with the same methods as FileBroker can be used instead (a real
+# message broker, say). LocalBroker is an in-process stand-in for testing
+# and for running several workers on one machine without a shared folder.
+
+import json
+import logging
+import os
+import socket
+import subprocess
+import sys
+import threading
+import time
+
+import Artifacts
+import HelperFunctions
+
+log = logging.getLogger(__name__)
+log.addHandler(logging.NullHandler())
+
+defaultLeaseSeconds = 600
+
+
+def workerName():
+    return socket.gethostname() + ':' + str(os.getpid())
+
+
+class FileBroker:
+    '''Frame queue kept in lock files on the shared data directory'''
+
+    def __init__(self, dataSetDirectory, leaseSeconds=defaultLeaseSeconds, frames=None):
+        self.dataSetDirectory = dataSetDirectory
+        self.queueDirectory = os.path.join(dataSetDirectory, '.queue')
+        self.leaseSeconds = leaseSeconds
+        if frames is None:
+            frames = Artifacts.frameNames(dataSetDirectory)
+        self.frames = frames
+        self.held = {}      # {frame : 'claimed' time of the claims taken through this broker}
+        if not os.path.isdir(self.queueDirectory):
+            try:
+                os.mkdir(self.queueDirectory)
+            except OSError:
+                # somebody else just made it
+                pass
+
+    def _path(self, frame, kind):
+        return os.path.join(self.queueDirectory, frame + '.' + kind)
+
+    def _read(self, path):
+        try:
+            recordFile = open(path, 'r')
+            record = json.load(recordFile)
+            recordFile.close()
+        except (IOError, ValueError):
+            return None
+        return record
+
+    def _writeTemp(self, record):
+        tmpPath = os.path.join(self.queueDirectory, '.tmp.' + socket.gethostname() + '.' + str(os.getpid()) +
+                               '.' + str(threading.current_thread().ident))
+        recordFile = open(tmpPath, 'w')
+        json.dump(record, recordFile)
+        recordFile.close()
+        return tmpPath
+
+    def _claimRecord(self, worker):
+        now = time.time()
+        return {'worker': worker, 'host': socket.gethostname(), 'claimed': now,
+                'heartbeat': now, 'expires': now + self.leaseSeconds}
+
+    def _tryClaim(self, frame, worker):
+        '''link() is atomic on NFS where O_EXCL isn't always, so the claim is written to a
+        temporary file and hard linked into place. Only one link can win.'''
+        record = self._claimRecord(worker)
+        tmpPath = self._writeTemp(record)
+        try:
+            os.link(tmpPath, self._path(frame, 'claim'))
+        except OSError:
+            return False
+        finally:
+            os.remove(tmpPath)
+        self.held[frame] = record['claimed']
+        return True
+
+    def _holds(self, claim, frame, worker):
+        '''True if claim is the one this broker took on frame for worker'''
+        return claim is not None and claim['worker'] == worker and claim['claimed'] == self.held.get(frame)
+
+    def _claimStale(self, claim):
+        '''True if the lease ran out, or the worker holding it was on this machine and has died'''
+        if claim['expires'] <= time.time():
+            return True
+        (host, pid) = claim['worker'].rsplit(':', 1) if ':' in claim['worker'] else (None, '')
+        if claim['host'] != socket.gethostname() or host != claim['host'] or not pid.isdigit():
+            return False
+        return not HelperFunctions.processAlive(int(pid))
+
+    def _breakExpiredClaim(self, frame, worker):
+        claim = self._read(self._path(frame, 'claim'))
+        if claim is None or not self._claimStale(claim):
+            return False
+        # renaming the stale claim away is atomic, so only one worker gets to break it...
+        expiredPath = self._path(frame, 'expired.' + worker.replace(':', '_'))
+        try:
+            os.rename(self._path(frame, 'claim'), expiredPath)
+        except OSError:
+            return False
+        # ...but between reading it and renaming, another worker may have broken it and claimed
+        # the frame, or the owner renewed it. Then what was moved isn't the stale claim: put it back.
+        moved = self._read(expiredPath)
+        if moved != claim:
+            try:
+                os.link(expiredPath, self._path(frame, 'claim'))
+            except OSError:
+                # somebody claimed the frame meanwhile; the owner of the moved claim finds out at
+                # its next heartbeat and stops
+                pass
+            os.remove(expiredPath)
+            return False
+        # the rename was only there to make breaking it atomic; the frame is free to claim now
+        os.remove(expiredPath)
+        log.warning('Claim on ' + frame + ' by ' + claim['worker'] + ' is stale, taking it over')
+        return True
+
+    def claim(self, worker):
+        '''Claims the next frame nobody is working on. Returns None when there is nothing left.'''
+        for frame in self.frames:
+            if os.path.exists(self._path(frame, 'done')) or os.path.exists(self._path(frame, 'failed')):
+                continue
+            if os.path.exists(self._path(frame, 'claim')) and not self._breakExpiredClaim(frame, worker):
+                continue
+            if self._tryClaim(frame, worker):
+                return frame
+        return None
+
+    def heartbeat(self, frame, worker):
+        '''Renews the lease. Returns False if the claim isn't ours any more.'''
+        claim = self._read(self._path(frame, 'claim'))
+        if not self._holds(claim, frame, worker):
+            return False
+        # a claim that has run out (or is about to) may be broken by another worker between the
+        # read above and the rename below, and renewing it would overwrite the new owner's claim
+        now = time.time()
+        if claim['expires'] - now < self.leaseSeconds / 6.0:
+            return False
+        claim['heartbeat'] = now
+        claim['expires'] = now + self.leaseSeconds
+        os.rename(self._writeTemp(claim), self._path(frame, 'claim'))
+        # and check it's still ours after the rename
+        return self._holds(self._read(self._path(frame, 'claim')), frame, worker)
+
+    def release(self, frame, worker, outcome=None):
+        '''Gives a frame back. outcome is 'done', 'failed' or None (someone else may pick it up).
+        Returns False, and writes nothing, if the claim isn't ours any more.'''
+        claim = self._read(self._path(frame, 'claim'))
+        if not self._holds(claim, frame, worker):
+            self.held.pop(frame, None)
+            return False
+        if outcome is not None:
+            record = {'worker': worker, 'host': socket.gethostname(), 'finished': time.time(),
+                      'claimed': claim['claimed']}
+            os.rename(self._writeTemp(record), self._path(frame, outcome))
+        try:
+            os.remove(self._path(frame, 'claim'))
+        except OSError:
+            pass
+        del self.held[frame]
+        return True
+
+    def status(self):
+        '''{frame : {'state': pending|working|expired|done|failed, ...record}}'''
+        now = time.time()
+        report = {}
+        for frame in self.frames:
+            for kind in ['done', 'failed', 'claim']:
+                record = self._read(self._path(frame, kind))
+                if record is not None:
+                    break
+            if record is None:
+                report[frame] = {'state': 'pending'}
+                continue
+            record = dict(record)
+            if kind == 'claim':
+                record['state'] = 'working' if record['expires'] > now else 'expired'
+            else:
+                record['state'] = kind
+            report[frame] = record
+        return report
+
+
+class LocalBroker:
+    '''Stand-in broker that keeps the queue in memory. Good for one machine and for testing workers.'''
+
+    def __init__(self, frames, leaseSeconds=defaultLeaseSeconds):
+        self.frames = list(frames)
+        self.leaseSeconds = leaseSeconds
+        self.records = {}
+        self.lock = threading.Lock()
+
+    def claim(self, worker):
+        with self.lock:
+            now = time.time()
+            for frame in self.frames:
+                record = self.records.get(frame)
+                if record is not None and (record['state'] != 'working' or record['expires'] > now):
+                    continue
+                self.records[frame] = {'state': 'working', 'worker': worker, 'host': socket.gethostname(),
+                                       'claimed': now, 'heartbeat': now, 'expires': now + self.leaseSeconds}
+                return frame
+        return None
+
+    def heartbeat(self, frame, worker):
+        with self.lock:
+            record = self.records.get(frame)
+            if record is None or record['state'] != 'working' or record['worker'] != worker:
+                return False
+            record['heartbeat'] = time.time()
+            record['expires'] = record['heartbeat'] + self.leaseSeconds
+        return True
+
+    def release(self, frame, worker, outcome=None):
+        with self.lock:
+            record = self.records.get(frame)
+            if record is None or record['state'] != 'working' or record['worker'] != worker:
+                return False
+            if outcome is None:
+                del self.records[frame]
+            else:
+                record['state'] = outcome
+                record['finished'] = time.time()
+        return True
+
+    def status(self):
+        with self.lock:
+            now = time.time()
+            report = {}
+            for frame in self.frames:
+                record = dict(self.records.get(frame, {'state': 'pending'}))
+                if record['state'] == 'working' and record['expires'] <= now:
+                    record['state'] = 'expired'
+                report[frame] = record
+        return report
+
+
+class FrameClaim:
+    '''A claimed frame plus the thread that keeps its lease alive'''
+
+    def __init__(self, broker, frame, worker=None):
+        self.broker = broker
+        self.frame = frame
+        self.worker = worker or workerName()
+        self.lost = False
+        self.stopEvent = threading.Event()
+        self.thread = threading.Thread(target=self._beat)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _beat(self):
+        while not self.stopEvent.wait(max(1.0, self.broker.leaseSeconds / 3.0)):
+            if not self.broker.heartbeat(self.frame, self.worker):
+                log.warning('Lost the claim on ' + self.frame + '. Another worker may be reducing it now.')
+                self.lost = True
+                return
+
+    def release(self, outcome=None):
+        '''Stops the heartbeat and gives the frame back. Returns False if the claim was lost, in
+        which case no outcome is written: the frame belongs to someone else now.'''
+        self.stopEvent.set()
+        self.thread.join()
+        if self.lost:
+            return False
+        return self.broker.release(self.frame, self.worker, outcome)
+
+
+def claimNext(broker, worker=None):
+    '''Returns a FrameClaim for the next free frame, or None'''
+    worker = worker or workerName()
+    frame = broker.claim(worker)
+    if frame is None:
+        return None
+    return FrameClaim(broker, frame, worker)
+
+
+def runWorker(broker, processFrame, worker=None):
+    '''Claims frames and calls processFrame(frameClaim) on each until the queue is empty. processFrame
+    returns True when the frame is finished, and should give up early once frameClaim.lost is set.
+    Returns {frame : outcome} for everything this worker did ('lost' if another worker took it).'''
+    worker = worker or workerName()
+    outcomes = {}
+    while True:
+        frameClaim = claimNext(broker, worker)
+        if frameClaim is None:
+            break
+        try:
+            finished = processFrame(frameClaim)
+        except Exception, e:
+            log.error('Frame ' + frameClaim.frame + ' failed: ' + str(e))
+            finished = False
+        outcome = 'done' if finished else 'failed'
+        if frameClaim.lost or not frameClaim.release(outcome):
+            log.error('Frame ' + frameClaim.frame + ' abandoned: its claim was lost')
+            outcome = 'lost'
+        outcomes[frameClaim.frame] = outcome
+    return outcomes
+
+
+def printStatus(broker):
+    '''Coordinator view: every frame's state, and how far along each host is'''
+    report = broker.status()
+    hosts = {}
+    print 'frame'.ljust(12) + 'state'.ljust(10) + 'worker'.ljust(28) + 'since'
+    for frame in sorted(report):
+        record = report[frame]
+        since = ''
+        if 'finished' in record:
+            since = time.strftime('%H:%M:%S', time.localtime(record['finished']))
+        elif 'claimed' in record:
+            since = time.strftime('%H:%M:%S', time.localtime(record['claimed']))
+        print frame.ljust(12) + record['state'].ljust(10) + record.get('worker', '').ljust(28) + since
+        if 'host' in record:
+            hostCounts = hosts.setdefault(record['host'], {})
+            hostCounts[record['state']] = hostCounts.get(record['state'], 0) + 1
+
+    states = [record['state'] for record in report.values()]
+    print '\n' + ', '.join(str(states.count(state)) + ' ' + state
+                           for state in ['pending', 'working', 'expired', 'done', 'failed'])
+    for host in sorted(hosts):
+        print host.ljust(20) + ', '.join(str(count) + ' ' + state for (state, count) in sorted(hosts[host].items()))
+    return
+
+
+if __name__ == '__main__':
+    # python WorkQueue.py status /data/n2158_phot/n2158/
+    # python WorkQueue.py work /data/n2158_phot/n2158/ some_batch_script {frame}
+    #   runs the command in each claimed frame folder, {frame} is replaced with the frame name
+    if len(sys.argv) < 3 or sys.argv[1] not in ['status', 'work']:
+        print 'usage: python WorkQueue.py status dataSetDirectory'
+        print '       python WorkQueue.py work dataSetDirectory command [args, {frame} is the frame name]'
+        sys.exit(1)
+    logging.basicConfig(format='%(message)s')
+
+    fileBroker = FileBroker(sys.argv[2])
+    if sys.argv[1] == 'status':
+        printStatus(fileBroker)
+    else:
+        def runCommand(frameClaim):
+            command = [argument.replace('{frame}', frameClaim.frame) for argument in sys.argv[3:]]
+            process = subprocess.Popen(command, cwd=os.path.join(sys.argv[2], frameClaim.frame))
+            while process.poll() is None:
+                if frameClaim.lost:
+                    process.terminate()
+                    process.wait()
+                    return False
+                time.sleep(1.0)
+            return process.returncode == 0
+        print runWorker(fileBroker, runCommand)
@@ -0,0 +1,258 @@
+# Scratch workspaces for the script steps. The mkpsf and allstar scripts make
+# a pile of full size images and inpfiles that get deleted a minute later, so
+# there is no point doing that on the RAID. A workspace copies what a script
+# needs into a scratch directory (tmpfs or local disk), the script runs there,
+# and only the files we actually want are copied back to the frame folder.
+
+import fcntl
+import json
+import logging
+import os
+import shutil
+import socket
+import tempfile
+import time
+from string import Template
+
+import Archive
+import FrameCache
+import HelperFunctions
+import IrafImage
+
+log = logging.getLogger(__name__)
+log.addHandler(logging.NullHandler())
+
+# tmpfs first, then whatever local disk we have
+defaultScratchRoots = ['/dev/shm', '/tmp']
+
+# the scripts make a few subtracted copies of the frame on top of the inputs
+imageCopiesPerScript = 4
+
+# {scriptName : [inputs, final products]}. Everything else made by the script stays in scratch.
+scriptFiles = {'mkpsfHDI.scr': [['${frame}.imh', '${frame}.pix', '${frame}.ap', '${frame}.lst',
+                                 '${frame}_nonei.psf', 'daophot.opt', 'allstar.opt', 'photo.opt'],
+                                ['${frame}.psf', '${frame}.nei', '${frame}psf.als', '${frame}.neinew1',
+                                 '${frame}1s.als', '${frame}.neinew2', '${frame}2s.als',
+                                 '${frame}3s.imh', '${frame}3s.pix', 'mkpsf.log']],
+               'allstarHDI.scr': [['${frame}.imh', '${frame}.pix', '${frame}.ap', '${frame}3s.psf',
+                                   'daophot.opt', 'allstar.opt', 'photo.opt'],
+                                  ['${frame}.als', '${frame}.ap2', '${frame}.als2',
+                                   '${frame}sub2.imh', '${frame}sub2.pix', 'allstar.log']]}
+
+
+def scriptInputs(scriptName, frame):
+    return [Template(name).substitute(frame=frame) for name in scriptFiles[scriptName][0]]
+
+
+def scriptProducts(scriptName, frame):
+    return [Template(name).substitute(frame=frame) for name in scriptFiles[scriptName][1]]
+
+
+def pickScratchRoot():
+    '''First of the default scratch roots we can write to'''
+    for root in defaultScratchRoots:
+        if os.path.isdir(root) and os.access(root, os.W_OK):
+            return root
+    return tempfile.gettempdir()
+
+
+def freeBytes(path):
+    stats = os.statvfs(path)
+    return stats.f_bavail * stats.f_frsize
+
+
+def relinkQuietly(imhPath):
+    try:
+        IrafImage.relinkPixelFile(imhPath)
+    except IOError:
+        log.warning('Could not check the pixel file name in ' + os.path.basename(imhPath) + '. Make sure it uses HDR$.')
+    return
+
+
+class ScratchBudget:
+    '''Shared ledger of how much scratch space each running frame has reserved. The
+    ledger is a json file in the scratch root, so every reduction on this machine
+    sees the same numbers. Entries from processes that died are dropped.'''
+
+    def __init__(self, scratchRoot, budgetBytes=None):
+        self.scratchRoot = scratchRoot
+        self.ledgerPath = os.path.join(scratchRoot, 'autoreduce_scratch.json')
+        self.lockPath = self.ledgerPath + '.lock'
+        if budgetBytes is None:
+            # leave some room for everyone else using tmpfs
+            budgetBytes = int(freeBytes(scratchRoot) * 0.8)
+        self.budgetBytes = budgetBytes
+
+    def _readLedger(self):
+        try:
+            ledgerFile = open(self.ledgerPath, 'r')
+            ledger = json.load(ledgerFile)
+            ledgerFile.close()
+        except (IOError, ValueError):
+            ledger = {}
+        # forget about reservations whose owner is gone
+        return dict((key, entry) for (key, entry) in ledger.items()
+                    if entry['host'] != socket.gethostname() or HelperFunctions.processAlive(entry['pid']))
+
+    def _writeLedger(self, ledger):
+        tmpPath = self.ledgerPath + '.' + str(os.getpid())
+        ledgerFile = open(tmpPath, 'w')
+        json.dump(ledger, ledgerFile)
+        ledgerFile.close()
+        os.rename(tmpPath, self.ledgerPath)
+
+    def _locked(self, function):
+        lockFile = open(self.lockPath, 'a')
+        fcntl.flock(lockFile, fcntl.LOCK_EX)
+        try:
+            ledger = self._readLedger()
+            result = function(ledger)
+            self._writeLedger(ledger)
+        finally:
+            fcntl.flock(lockFile, fcntl.LOCK_UN)
+            lockFile.close()
+        return result
+
+    def reserved(self):
+        return self._locked(lambda ledger: sum(entry['bytes'] for entry in ledger.values()))
+
+    def reserve(self, key, nBytes, timeout=None, pollSeconds=5):
+        '''Blocks until nBytes fit in the budget. Returns False if we gave up after timeout seconds.'''
+        if nBytes > self.budgetBytes:
+            raise ValueError('%s needs %d bytes of scratch, but the whole budget is %d' % (key, nBytes, self.budgetBytes))
+
+        def tryReserve(ledger):
+            inUse = sum(entry['bytes'] for entry in ledger.values())
+            if inUse + nBytes > self.budgetBytes:
+                return False
+            ledger[key] = {'bytes': nBytes, 'pid': os.getpid(), 'host': socket.gethostname(),
+                           'time': time.time()}
+            return True
+
+        started = time.time()
+        waiting = False
+        while not self._locked(tryReserve):
+            if timeout is not None and time.time() - started > timeout:
+                return False
+            if not waiting:
+                log.info('Scratch space is full, waiting for another frame to finish (' + key + ')')
+                waiting = True
+            time.sleep(pollSeconds)
+        return True
+
+    def release(self, key):
+        def dropKey(ledger):
+            ledger.pop(key, None)
+        self._locked(dropKey)
+        return
+
+
+class ScratchWorkspace:
+    '''Scratch copy of one frame folder. Use it with a with-statement:
+
+        with ScratchWorkspace(dataSetDirectory, currentFrame) as workspace:
+            workspace.stage(inputs)
+            ... run things in workspace.frameDirectory ...
+            workspace.commit(products)
+
+    The layout inside the scratch directory mirrors the data set (scratch/frame/),
+    so workspace.workingDirectory can be handed to the script templates in place
+    of the data set directory.'''
+
+    def __init__(self, dataSetDirectory, frame, scratchRoot=None, budgetBytes=None, reserveBytes=None):
+        if scratchRoot is None:
+            scratchRoot = pickScratchRoot()
+        self.dataSetDirectory = dataSetDirectory
+        self.frame = frame
+        self.sourceDirectory = os.path.join(dataSetDirectory, frame)
+        self.scratchRoot = scratchRoot
+        self.budget = ScratchBudget(scratchRoot, budgetBytes)
+        self.reserveBytes = reserveBytes
+        self.budgetKey = socket.gethostname() + ':' + str(os.getpid()) + ':' + frame
+        self.workingDirectory = None
+        self.frameDirectory = None
+
+    def estimateBytes(self):
+        '''Guess at the scratch a frame needs: the frame itself plus the subtracted copies the scripts make'''
+        frameBytes = 0
+        for extension in ['.imh', '.pix']:
+            path = os.path.join(self.sourceDirectory, self.frame + extension)
+            if Archive.exists(path):
+                frameBytes += Archive.originalStat(path)[0]
+        return frameBytes * (imageCopiesPerScript + 1)
+
+    def open(self):
+        if self.reserveBytes is None:
+            self.reserveBytes = self.estimateBytes()
+        self.budget.reserve(self.budgetKey, self.reserveBytes)
+        try:
+            self.workingDirectory = tempfile.mkdtemp(prefix='autoreduce_', dir=self.scratchRoot) + '/'
+            self.frameDirectory = os.path.join(self.workingDirectory, self.frame)
+            os.mkdir(self.frameDirectory)
+        except:
+            # no scratch after all (bad scratchRoot, full disk), so the reservation goes too
+            self.close()
+            raise
+        return self
+
+    def close(self):
+        if self.workingDirectory is not None:
+            FrameCache.forget(self.workingDirectory)
+            shutil.rmtree(self.workingDirectory, ignore_errors=True)
+            self.workingDirectory = None
+            self.frameDirectory = None
+        self.budget.release(self.budgetKey)
+        return
+
+    def __enter__(self):
+        return self.open()
+
+    def __exit__(self, excType, excValue, traceback):
+        self.close()
+        return False
+
+    def path(self, fileName):
+        return os.path.join(self.frameDirectory, fileName)
+
+    def writeFile(self, fileName, contents, executable=False):
+        fileHandle = open(self.path(fileName), 'w')
+        fileHandle.write(contents)
+        fileHandle.close()
+        if executable:
+            os.chmod(self.path(fileName), 0755)
+        return
+
+    def stage(self, inputs):
+        '''Copies inputs from the frame folder into scratch (archived ones are unpacked straight
+        into scratch). Returns the names that were missing.'''
+        missing = []
+        for fileName in inputs:
+            source = os.path.join(self.sourceDirectory, fileName)
+            if Archive.isArchived(source):
+                Archive.restore(source, self.path(fileName))
+            elif os.path.exists(source):
+                shutil.copy2(source, self.path(fileName))
+            else:
+                missing.append(fileName)
+                continue
+            if fileName.endswith('.imh'):
+                relinkQuietly(self.path(fileName))
+        return missing
+
+    def commit(self, products):
+        '''Copies products back into the frame folder. Each file is copied next to its
+        destination under a temporary name and renamed over it, so nobody reading the
+        frame folder ever sees half a file. Returns the products that were not made.'''
+        missing = []
+        for fileName in products:
+            source = self.path(fileName)
+            if not os.path.exists(source):
+                missing.append(fileName)
+                continue
+            if fileName.endswith('.imh'):
+                relinkQuietly(source)
+            destination = os.path.join(self.sourceDirectory, fileName)
+            partial = os.path.join(self.sourceDirectory, '.' + fileName + '.partial')
+            shutil.copy2(source, partial)
+            os.rename(partial, destination)
+        return missing
@@ -15,42 +15,145 @@ Usage:       This program will ask for a step number to execute, corresponding t
               needed. At the completion of the task, the results will need to be checked
               by the user, either in terminal output from this program, or in a file saved
               in the working directory.
+
+              The steps themselves are in Reduction.py and don't ask anything; this is the
+              program that asks, shows you the frames in ds9 and runs the menu.
 """
-import csv
-import io
+import logging
 import os
 import subprocess
-import math
-import HelperFunctions
-from pyraf import iraf as ir
-from string import Template
-
-# top level working directory, with trailing slash. Like
-# '/data/n2158_phot/n2158/'
-dataSetDirectory = ''
-currentFrame = ''     # current frame. Like 'n21157'
-frameFWHM = None   # will hold the FWHM later
-optFilesSetup = False  # true if setup has been completed successfully
-
-testing = True
-
-externalProgramDict = {'daophot': ['daophot', True],  # {functionName : [computerFunctionName, exists?]}
-                       'compapcorr': ['compapcorrHDI.e', True],
-                       'pyraf': ['pyraf', True],
-                       'ds9': ['ds9', True],
-                       'dao2iraf': ['dao2iraf.e', True],
-                       'sm': ['sm', True],
-                       'pstopdf': ['pstopdf', True],
-                       'alsedt': ['alsedt.e', True],
-                       'sigrejfit': ['sigrejfit.e', True],
-                       'poly': ['poly.e', True],
-                       'apply_apcorr': ['apply_apcorrHDI.e', True],
-                       'sublst': ['sublst.e', True],
-                       'magChiRoundPlotscr' : ['magChiRoundPlot.scr', True]}
+import Artifacts
+import ExternalTools
+import FrameCache
+import MemoryBudget
+import PsfBuilder
+import PsfSelect
+import Reduction
+import ScriptGraphs
+import Telemetry
+import WarmStart
+import WorkQueue
+
+ir = None  # pyraf's iraf, imported when the program starts
+
+context = None  # Reduction.FrameContext of the frame we are working on
+frameClaim = None  # WorkQueue.FrameClaim if the frame came from the shared queue
+
+# how the external programs are run (see ExternalTools):
+#   'run'     always run them
+#   'cache'   reuse the result of an identical earlier run, otherwise run and keep the result
+#   'record'  always run, and keep the result
+#   'replay'  only use kept results, never run anything (regression runs without the fortran programs)
+toolMode = 'cache'
+toolCacheDirectory = None  # None is ~/.autoreduce_cache
+toolCacheBytes = 20 * 1024 ** 3
+
+# bytes of memory the external programs running at the same time may use together (MemoryBudget).
+# Programs that would go over wait for the ones running to finish. None is 80% of the RAM, 0 is no limit.
+memoryBudget = None
+
+# bytes of frames and frame products (background, noise, ...) the native steps keep open in this
+# process (FrameCache), so going over the same frame again doesn't read or work out anything again
+frameCacheBytes = 2 * 1024 ** 3
+
+# Set scratchRoot to something like '/dev/shm' to run the mkpsf and allstar scripts in a
+# scratch workspace instead of the frame folder. Only the final products get copied back.
+# scratchBudget is the number of bytes all frames on this machine may use there (None = 80% of free).
+scratchRoot = None
+scratchBudget = None
+
+# when intermediate files may be deleted, see Artifacts.defaultPolicy. None uses the default
+# (scratch files after every step, intermediates when you say the data set is finished).
+retentionPolicy = None
+
+# where the binary catalog store lives. Point several data sets at the same folder to query a
+# whole season at once. None keeps it in dataSetDirectory/catalogStore/
+catalogStoreDirectory = None
+
+# the filter of frames whose header doesn't say (FILTER, FILTERS, FILTER1 or FILTNAME). The master
+# catalog and the catalog store keep the filters apart. None leaves such frames without one.
+filterName = None
+
+# pick the PSF stars with PsfSelect (magnitude limit from the .ap errors, isolated, unsaturated,
+# spread over the chip) instead of asking for a number and a limit and running PICK.
+# Falls back to the old way if it can't find any stars. psfStars is how many it keeps.
+automaticPsfSelection = True
+psfStars = PsfSelect.defaultPsfStars
+
+# a frame of the same field that is already reduced. The other frames take its FWHM and its final
+# PSF lists (.lst, _nonei.lst, _2.lst, mapped onto them and checked star by star, see WarmStart)
+# instead of picking and culling the PSF stars again, and the native PSF starts from its PSF.
+# None does every frame from scratch.
+warmStartFrame = None
+
+# after alsedt, draw the frame, its subtracted frames and the PSF stars and edited catalog into
+# PNGs in dataSetDirectory/qa/ and add them to qa/index.html (QaThumbnails), so a night can be
+# looked over in a browser. Step qaReview redoes every frame.
+qaThumbnails = True
+
+# run the scripts as step graphs (ScriptGraphs): independent programs run at the same time, each
+# one is checked and timed, and running a step again picks up at the program that failed.
+# False goes back to the .scr files.
+scriptGraphs = True
+
+# cut the frame into this many tiles for allstar and fit them side by side (TiledAllstar).
+# 0 runs allstar on the whole frame. 'cores' uses one tile per core.
+allstarTiles = 0
+
+# what fits the stars in the allstar script: 'allstar' (allstar8192) or 'native' (NativeAllstar,
+# in Python: no limit on the number of stars, and the groups are fitted on every core). 'native'
+# also does mkpsf's allstar and substar runs, with the frames subtracted straight into their files
+allstarEngine = 'allstar'
+
+# what makes the PSFs: 'daophot' (the PSF command) or 'native' (PsfBuilder: prints the star list
+# with each star's chi, drops the bad stars from the list itself and keeps the results in the frame state)
+psfEngine = 'daophot'
+
+# pick the aperture correction radius from the growth curves and fit the correction into
+# apcorr.coef (GrowthCurve) instead of pausing for the plots and compapcorr
+automaticApcorr = True
+
+# publish every step's start and end to the data set's .telemetry folder, so
+# 'python Telemetry.py watch dataSetDirectory' shows what every machine is doing
+telemetry = True
+
+
+
+def settings():
+    '''The settings above, for Reduction'''
+    return {'automaticPsfSelection': automaticPsfSelection,
+            'psfStars': psfStars,
+            'warmStartFrame': warmStartFrame,
+            'psfEngine': psfEngine,
+            'allstarEngine': allstarEngine,
+            'allstarTiles': allstarTiles,
+            'scriptGraphs': scriptGraphs,
+            'scratchRoot': scratchRoot,
+            'scratchBudget': scratchBudget,
+            'automaticApcorr': automaticApcorr,
+            'retentionPolicy': retentionPolicy,
+            'catalogStoreDirectory': catalogStoreDirectory,
+            'filter': filterName,
+            'qaThumbnails': qaThumbnails}
+
+def printError(result):
+    '''Prints what went wrong in a step. Returns True if something did.'''
+    if 'error' in result:
+        print result['error']
+        return True
+    return False
 
+def askYesNo(question):
+    while True:
+        answer = raw_input(question)
+        if answer in ['y', 'Y']:
+            return True
+        elif answer in ['n', 'N']:
+            return False
+        print 'Invalid selection, try again.'
 
 def getWorkingDirectories():
-    '''Set up the variables for the working folder and directories. Option 0.'''
+    '''Set up the variables for the working folder and directories'''
     question1 = 'Enter the current working directory (ex: /data/n2158_phot/n2158/): '
     dataSetDirectory = raw_input(question1)
 
@@ -61,14 +164,60 @@ def getWorkingDirectories():
     if dataSetDirectory[-1] != '/':
         dataSetDirectory += '/'
 
-    question2 = 'Enter the frame you want to work on (ex: n21158): '
+    question2 = 'Enter the frame you want to work on (ex: n21158), or \'next\' for the next frame nobody has claimed: '
     currentFrame = raw_input(question2)
-    while not os.path.isdir(dataSetDirectory + currentFrame):
+    while True:
+        if currentFrame == 'next':
+            currentFrame = claimNextFrame(dataSetDirectory)
+            if currentFrame is None:
+                print 'Every frame in ' + dataSetDirectory + ' is claimed or finished.'
+                currentFrame = raw_input(question2)
+                continue
+            print 'Claimed ' + currentFrame
+        if os.path.isdir(dataSetDirectory + currentFrame):
+            break
         print 'Invalid frame selection for ' + dataSetDirectory + currentFrame + ', try again.'
         currentFrame = raw_input(question2)
 
     return dataSetDirectory, currentFrame
 
+def claimNextFrame(dataSetDirectory):
+    '''Claims the next free frame from the data set's shared queue, so other machines reducing
+    the same data set leave it alone. Returns the frame name or None.'''
+    global frameClaim
+    frameClaim = WorkQueue.claimNext(WorkQueue.FileBroker(dataSetDirectory))
+    if frameClaim is None:
+        return None
+    return frameClaim.frame
+
+def releaseFrameClaim():
+    '''Marks a claimed frame done if every step is finished, otherwise hands it back to the queue'''
+    global frameClaim
+    if frameClaim is None:
+        return
+    outcome = None
+    if context is not None and context.frameState.firstIncompleteStep() is None:
+        outcome = 'done'
+    if not frameClaim.release(outcome):
+        print 'The claim on ' + frameClaim.frame + ' was lost, another worker has it now.'
+    frameClaim = None
+    return
+
+def changeFrame():
+    '''Go over to another frame (or the next one nobody has claimed). Option 0.
+    The frame we were on is given back to the queue first, if it came from there.'''
+    global context
+    releaseFrameClaim()
+    dataSetDirectory, currentFrame = getWorkingDirectories()
+    if telemetry and dataSetDirectory != context.dataSetDirectory:
+        Telemetry.startPublishing(dataSetDirectory)
+    context = Reduction.openFrame(dataSetDirectory, currentFrame, settings())
+    if context.fwhm is None:
+        print 'No FWHM for ' + currentFrame + ' yet, get it with step 1.'
+    else:
+        print 'Using the FWHM saved for this frame: ' + str(context.fwhm)
+    return
+
 def startDS9():
     '''if ds9 is not running, we will start it. Right now I'm going to use a messy subprocess and false killall method.
      if we ever get the intel mac working with the fortran stuff, you should change this to use the "psutil" python
@@ -88,80 +237,42 @@ def startDS9():
     return
 
 def checkFunctionsExist():
-    '''Loop through function dictionary to check if all functions are callable'''
+    '''Checks that all the external programs can be found before we start'''
     print '\nChecking function dictionary to make sure all functions are callable before we start reduction...'
-    problem = False
-    for programKey in externalProgramDict:
-        exists = HelperFunctions.which(externalProgramDict[programKey][0])
-        if not exists:
-            externalProgramDict[programKey][1] = False
-            problem = True
-            print "Cannot execute program " + programKey + " called as '" + externalProgramDict[programKey][0] + "'"
-    if problem:
+    missing = Reduction.missingPrograms()
+    for programKey in missing:
+        print "Cannot execute program " + programKey + " called as '" + Reduction.externalPrograms[programKey] + "'"
+    if missing and toolMode == 'replay':
+        print '\nReplaying recorded results, so the programs above are not needed.\n'
+    elif missing:
         print '\nThe function(s) listed above are not callable. You should fix this before proceeding.\n'
     else:
         print '\nAll functions are callable.\n'
     return None
 
-
-def optFilesExist():
-    '''Returns true if all options files are in place. Should be called before each function is executed'''
-    import OptionFiles
-
-    pathToFile = dataSetDirectory + currentFrame + '/'
-    #badFiles = []
-    filesExist = True
-
-    for fileName in OptionFiles.optionFileDict:
-        if os.path.exists(pathToFile + fileName):
-            continue
-        else:
-            filesExist = False
-            # badFiles.append(file)
-            continue
-
-    if filesExist:
-        return True
-    else:
-        return False
-
+def framePath(name):
+    return context.path(name)
 
 def setupOptFiles():
     '''Sets up the option files'''
     print '\nChecking to see if option files exist...\n'
-    import OptionFiles
-
-    opt = OptionFiles.OptionFiles(frameFWHM, dataSetDirectory, currentFrame)
-
-    for fileName in opt.optionFileDict:
-        pathToFile = dataSetDirectory + currentFrame + '/' + fileName
-        if not os.path.exists(pathToFile):
-            print 'Option file ' + fileName + ' does not exist.'
-            createFile = raw_input(
-                'Do you want to create this file from a template? (y/n): ')
-            while createFile not in ['Y', 'y', 'N', 'n']:
-                print 'Invalid response'
-                createFile = raw_input(
-                    'Do you want to create this file from a template? (y/n): ')
-
-            if createFile in ['Y', 'y']:
-                fileHandle = open(pathToFile, 'w')
-                fileHandle.write(opt.optionFileDict[fileName])
-                fileHandle.close()
-            else:
-                continue
+    chosen = []
+    for fileName in Reduction.optionFilesMissing(context):
+        print 'Option file ' + fileName + ' does not exist.'
+        if askYesNo('Do you want to create this file from a template? (y/n): '):
+            chosen.append(fileName)
+    Reduction.setupOptFiles(context, chosen)
 
     print '\nDone dealing with option files\n'
     return
 
-
 def getFWHM():
     '''Gets FWHM, returns the value'''
     print '\nStarting FWHM\n'
-    print 'Opening '+currentFrame+'.imh in DS9. Hover over a star and press \'a\' to see details. The FWHM is under the \'ENCLOSED\' heading.'
+    print 'Opening '+context.frame+'.imh in DS9. Hover over a star and press \'a\' to see details. The FWHM is under the \'ENCLOSED\' heading.'
 
     try:
-        ir.display(dataSetDirectory + currentFrame + '/' + currentFrame + '.imh', 1)
+        ir.display(framePath(context.frame + '.imh'), 1)
         ir.imexam()
     except:
         print 'There was a problem using the iraf package. Try opening \'ds9 &\' in another window'
@@ -170,81 +281,53 @@ def getFWHM():
     while True:
         userIn = raw_input('Please enter the FWHM: ')
         try:
-            float(userIn)
+            context.setFwhm(userIn)
         except ValueError:
             print 'Invalid input, cannot cast to float'
             continue
-        frameFWHM = float(userIn)
         break
 
     print '\nFinished with FWHM\n'
     return
 
-
 def psfFirstPass():
     '''First time through the PSF'''
-    '''I'm going to write this in the old way, by creating a list of input commands in a text file,
-    saving it, then running that into daophot. This isn't really optimal. I'd like to use pexpect, or something
-    like it, but it might be a dead-end trying to build that from source on the PPC mac pro. This is something
-    you may look into once we get to the intel macs, or if you run out of data to reduce (ha).'''
     print '\nStarting PSF First pass\n'
-    psfFirstFile = open(dataSetDirectory + currentFrame + '/' + 'psfFirstPass.in', 'w')
-    psfFirstFile.truncate() # make sure it's blank before we start this.
-    try:
-        #getting rid of the files we'll generate in this step before we start
-        os.remove(dataSetDirectory + currentFrame + '/' + currentFrame + '.coo')
-        os.remove(dataSetDirectory + currentFrame + '/' + currentFrame + '.ap')
-    except OSError:
-        #python gives an error if the file doesn't exist. We don't care.
-        pass
-
-    psfCommands = Template('''at ${current_frame}.imh
-nomon
-fi
-1 1
-${current_frame}.coo
-y
-ph
-
-
-${current_frame}.coo
-${current_frame}.ap
-''')
-
-    '''NOTEEEEEE: I am using relative names. I lost ssh access so I can't test this with daophot directly.
-    You might need to change this to explicit paths from the root directory. I think this will be fine, since
-    I am writing the file explcitly to the directory we want, and running it from that directory (maybe the call on the
-    next line needs to give an explicit path?). Just a note on a potential sticking point.'''
-
-    psfFirstFile.write(psfCommands.substitute(current_frame=currentFrame))
-    psfFirstFile.close()
-
-    if not testing:
-        subprocess.call([externalProgramDict['daophot'][0], '<', 'psfFirstPass.in', '>>', currentFrame + '.log'])
+    printError(Reduction.psfFirstPass(context))
 
     '''I'm not including the optional step from the manual. You really only need to do that if there are problems'''
 
-    print '\nCheck the log, record the number of stars and the estimated magnitude limit'
+    if not automaticPsfSelection:
+        print '\nCheck the log, record the number of stars and the estimated magnitude limit'
     print '\nFinished with PSF First pass\n'
     return
 
+def printAutomaticSummary(summary):
+    print 'Magnitude limit %.2f (median error below %.2f)' % (summary['magLimit'], PsfSelect.maxError)
+    print '%d of %d stars are bright enough: %d too close to the edge, %d saturated, %d not star shaped, %d crowded' % (
+        summary['brightEnough'], summary['stars'], summary['edge'], summary['saturated'], summary['shape'],
+        summary['crowded'])
+    print 'Wrote %d PSF stars to %s.lst' % (summary['selected'], context.frame)
+    return
 
 def psfCandidateSelection():
     '''Picking candidate stars'''
     print '\nStarting PSF Candidate Selection\n'
-    while True:
-        psfCandidate = open(dataSetDirectory + currentFrame + '/' + 'psfCandidate.in', 'w')
-        psfCandidate.truncate() #make sure it's blank before we start this.
-        try:
-            #getting rid of the files we'll generate in this step before we start
-            os.remove(dataSetDirectory + currentFrame + '/' + currentFrame + '.lst')
-        except OSError:
-            #python gives an error if the file doesn't exist. We don't care.
-            pass
-
-        numStars = 0
-        magLimit = 0
+    result = Reduction.psfCandidateSelection(context)
+    for attempt in result['attempts']:
+        if 'reference' in attempt:
+            print WarmStart.formatSummary(attempt)
+        else:
+            print attempt['error'][0].upper() + attempt['error'][1:] + ', picking the stars by hand'
+    if result['method'] == 'warmStart':
+        print WarmStart.formatSummary(result['summary'])
+    elif result['method'] == 'automatic':
+        printAutomaticSummary(result['summary'])
+    if result['method'] is not None:
+        print '\nFinished with PSF Candidate Selection\n'
+        return
 
+    while True:
         while True:
             try:
                 numStars = int(raw_input('Number of stars? '))
@@ -254,405 +337,330 @@ def psfCandidateSelection():
                 continue
             break
 
-        psfCommands = Template('''at ${current_frame}.imh
-nomon
-pi
-${current_frame}.ap
-${num_stars} ${mag_limit}
-${current_frame}.lst
-''')
-
-
-        psfCandidate.write(psfCommands.substitute(current_frame=currentFrame,num_stars=numStars,mag_limit=magLimit))
-        psfCandidate.close()
-
-        if not testing:
-            subprocess.call([externalProgramDict['daophot'][0], '<', 'psfCandidate.in', '>>', currentFrame + '.log'])
+        printError(Reduction.pickPsfCandidates(context, numStars, magLimit))
 
         # we could probably read in the file and use a regexp to find the number of stars
         # and display it right here. Keep in mind, the log will contain multiple of these
-        # patterns, you want the last one. Either find all of them and get the last occurance
-        # (messy way), or figure out how to do a reverse direction regexp search (right to left).
-        # php has this function, I'm not sure if python does though.
+        # patterns, you want the last one.
         userHappy = raw_input('Check the log. Are you okay with the number of stars? (y/n) ')
         if userHappy in ['y','Y']:
+            Reduction.acceptPick(context, numStars, magLimit)
             break
         else:
             print 'Starting over'
 
     print '\nCheck the log, record the number of stars.'
-    print 'IF THIS IS A LONG EXPOSURE: go edit ' + currentFrame + '.lst so that it has 100-200 stars, as described in the manual'
+    print 'IF THIS IS A LONG EXPOSURE: go edit ' + context.frame + '.lst so that it has 100-200 stars, as described in the manual'
     print '\nFinished with PSF Candidate Selection\n'
     return
 
 def psfErrorDeletion():
     '''Removing errored stars'''
     print '\nStarting PSF Error Star Deletion\n'
-    redoPsf = True
-    while redoPsf:
-        print 'Creating ' + currentFrame + '.psf\n'
-        psfCandidate = open(dataSetDirectory + currentFrame + '/' + 'psfErrorDeletion.in', 'w')
-        psfCandidate.truncate() #make sure it's blank before we start this.
-        try:
-            #getting rid of the files we'll generate in this step before we start
-            os.remove(dataSetDirectory + currentFrame + '/' + currentFrame + '.psf')
-        except OSError:
-            #python gives an error if the file doesn't exist. We don't care.
-            pass
-
-        psfCommands = Template('''at ${current_frame}.imh
-nomon
-ps
-${current_frame}.ap
-${current_frame}.lst
-${current_frame}.psf
-''')
+    if psfEngine == 'native':
+        report = Reduction.psfErrorDeletion(context)
+        if printError(report):
+            return
+        if report['removed']:
+            print 'Took ' + ', '.join(str(starId) for starId in report['removed']) + ' out of ' + context.frame + '.lst'
+        print PsfBuilder.formatReport(report)
+        print '\nFinished with PSF Error Star Deletion\n'
+        return
 
-        psfCandidate.write(psfCommands.substitute(current_frame=currentFrame))
-        psfCandidate.close()
+    while True:
+        print 'Creating ' + context.frame + '.psf\n'
+        printError(Reduction.daophotPsf(context, context.frame, context.frame + '.lst', context.frame + '.psf',
+                                        'psfErrorDeletion.in'))
+        # stars with errors, take them out of the .lst and run again
+        if not askYesNo('Check the log. Were there any stars with errors? (y/n) '):
+            break
 
-        if not testing:
-            subprocess.call([externalProgramDict['daophot'][0], '<', 'psfErrorDeletion.in', '>>', currentFrame + '.log'])
+    printError(Reduction.markPsfStars(context))
 
-        while True:
-            badStars = raw_input('Check the log. Were there any stars with errors? (y/n) ')
-            if badStars in ['y','Y']:
-                # stars with errors, run again
-                redoPsf = True # I know this is redundant, leaving in for clarity.
-                break
-            elif badStars in ['n', 'N']:
-                # no more errors, move on.
-                redoPsf = False
-                break
-            else:
-                print 'Invalid input, try again'
-                continue
+    print '\nFinished with PSF Error Star Deletion\n'
+    return
 
-    #now we can delete the old .iraf file (if there is one), and make a new one
+def recordChi(psfName):
+    '''Asks for the chi value the user just accepted so it ends up in the frame state'''
+    chi = raw_input('Chi value for the record (press enter to skip): ')
     try:
-        #getting rid of the files we'll generate in this step before we start
-        os.remove(dataSetDirectory + currentFrame + '/' + currentFrame + '.iraf')
-    except OSError:
-        #python gives an error if the file doesn't exist. We don't care.
+        Reduction.acceptChi(context, psfName, chi)
+    except ValueError:
         pass
+    return
 
-    if not testing:
-        subprocess.call([externalProgramDict['dao2iraf'][0],currentFrame+'.lst',currentFrame+'.iraf'])
+def acceptPsf(result, psfName):
+    '''Asks if the PSF just made is good enough and records its chi if it is'''
+    if psfEngine == 'native':
+        print PsfBuilder.formatReport(result)
+        if askYesNo('Chi is %.4f. Is this okay? (y/n)' % result['chi']):
+            Reduction.acceptChi(context, psfName, result['chi'])
+            return True
+        return False
+    if askYesNo('Go get the chi squared value from the log. Is this okay? (y/n)'):
+        recordChi(psfName)
+        return True
+    return False
+
+def markStars(markedName, displayFrame, instruction, useWarmList):
+    '''Has you mark stars on the frame in ds9 into markedName, unless there's already a list
+    you want to keep. Returns False if ds9 didn't work.'''
+    if useWarmList and context.exists(markedName):
+        # the stars marked on the warm start frame. Mark them yourself if the PSF isn't good
+        print 'Using the stars marked on ' + warmStartFrame + ' (' + markedName + ')'
+        return True
+    if context.exists(markedName):
+        if not askYesNo(markedName + ' exists. Do you want me to delete it? (y/n)'):
+            return True
+        try:
+            os.remove(framePath(markedName))
+        except OSError:
+            print 'unable to delete ' + markedName
 
-    print '\nFinished with PSF Error Star Deletion\n'
-    return
+    try:
+        ir.display(framePath(context.frame + '.imh'), displayFrame)
+        ir.tvmark(displayFrame, framePath(context.frame + '.iraf'), number='no', mark='circle', radii=10, color=204)
+        print instruction
+        ir.tvmark(displayFrame, framePath(markedName), interactive='yes', number='no', mark='circle', radii=10,
+                  color=205)
+    except:
+        print 'There was a problem using the iraf package. Try opening \'ds9 &\' in another window and run this step again.'
+        return False
+    return True
 
 def neighborStarSubtraction():
     '''Neighbor Star Subtraction'''
-    keepGoing = True
-    while keepGoing:
+    useWarmList = context.warmStarted()
+    while True:
         print '\nStarting Neighbor Star Subtraction\n'
-        if not os.path.exists(dataSetDirectory + currentFrame + '/' + currentFrame + '.iraf'):
-            print currentFrame + '.iraf doesn\'t appear to exist. Please go create it then run this step again.'
-            return
-
-        if not os.path.exists(dataSetDirectory + currentFrame + '/' + currentFrame + '.lst'):
-            print currentFrame + '.lst doesn\'t appear to exist. Please go create it then run this step again.'
-            return
-
-        skipStarSelection = False
-        if os.path.exists(dataSetDirectory + currentFrame + '/sub_nonei.lst'):
-            while True:
-                deleteNoneiList = raw_input('sub_nonei.lst exists. Do you want me to delete it? (y/n)')
-                if deleteNoneiList in ['y','Y']:
-                    try:
-                        os.remove(dataSetDirectory + currentFrame + '/sub_nonei.lst')
-                    except OSError:
-                        print 'unable to delete sub_nonei.lst'
-
-                    break
-                elif deleteNoneiList in ['n','N']:
-                    skipStarSelection = True
-                    break
-                else:
-                    print 'Invalid selection, try again'
-                    continue
-
-
-        try:
-            #getting rid of the files we'll generate in this step before we start
-            os.remove(dataSetDirectory + currentFrame + '/' + currentFrame + '_nonei.lst')
-        except OSError:
-            #python gives an error if the file doesn't exist. We don't care.
-            pass
-
-        if not skipStarSelection:
-            try:
-                ir.display(dataSetDirectory + currentFrame + '/' + currentFrame + '.imh', 1)
-                ir.tvmark(1,dataSetDirectory + currentFrame + '/' + currentFrame + '.iraf',number='no',mark='circle',radii=10,color=204)
-                print 'In ds9, press \'a\' over all marked stars that have neighbors that are too close.'
-                ir.tvmark(1,dataSetDirectory + currentFrame + '/sub_nonei.lst', interactive='yes',number='no',mark='circle',radii=10,color=205)
-            except:
-                print 'There was a problem using the iraf package. Try opening \'ds9 &\' in another window and run this step again.'
+        for name in [context.frame + '.iraf', context.frame + '.lst']:
+            if not context.exists(name):
+                print name + ' doesn\'t appear to exist. Please go create it then run this step again.'
                 return
-
-        # running sublst.e
-        if not os.path.exists(dataSetDirectory + currentFrame + '/sub_nonei.lst'):
-            print 'sub_nonei.lst doesn\'t appear to exist. Please go create it then run this step again.'
+        if not markStars('sub_nonei.lst', 1, 'In ds9, press \'a\' over all marked stars that have neighbors that are too close.',
+                         useWarmList):
             return
+        useWarmList = False
 
-        # below may need explicit paths, depending on where you run the application from
-        sublst1 = Template('''${current_frame}.lst
-sub_nonei.lst
-${current_frame}_nonei.lst
-5 5
-''')
-        sublstFile = open(dataSetDirectory + currentFrame + '/' + 'sublst1.in', 'w')
-        sublstFile.truncate() #make sure it's blank before we start this.
-        sublstFile.write(sublst1.substitute(current_frame=currentFrame))
-        sublstFile.close()
-
-        if not testing:
-            subprocess.call([externalProgramDict['sublst'][0],'<','sublst1.in'])
-
-        #running daophot one more time
-        psfCandidate = open(dataSetDirectory + currentFrame + '/' + 'psfNeighborStars.in', 'w')
-        psfCandidate.truncate() #make sure it's blank before we start this.
-
-        psfCommands = Template('''at ${current_frame}.imh
-nomon
-ps
-${current_frame}.ap
-${current_frame}_nonei.lst
-${current_frame}_nonei.psf
-''')
-
-        psfCandidate.write(psfCommands.substitute(current_frame=currentFrame))
-        psfCandidate.close()
-
-        if not testing:
-            # there might be a hang here if it finds bad stars. Could just insert a bunch of 'y' lines into the
-            # template above if you need to
-            subprocess.call([externalProgramDict['daophot'][0], '<', 'psfNeighborStars.in', '>>', currentFrame + '.log'])
-
-        while True:
-            userHappy = raw_input('Go get the chi squared value from the log. Is this okay? (y/n)')
-            if userHappy in ['y','Y']:
-                keepGoing = False
-                break
-            elif userHappy in ['n', 'N']:
-                keepGoing = True
-                break
-            else:
-                print 'Invalid selection, try again'
-                continue
+        result = Reduction.neighborStarSubtraction(context)
+        if printError(result):
+            return
+        if acceptPsf(result, 'nonei.psf'):
+            break
 
     print '\nFinished with Neighbor Star Subtraction\n'
     return
 
+def printScriptResult(result, scriptName):
+    if result.get('notStaged'):
+        print 'Not in the frame folder (the script may fail): ' + ', '.join(result['notStaged'])
+    if result.get('timings'):
+        print result['timings']
+    for message in result.get('messages', []):
+        print message
+    if result.get('missing'):
+        print scriptName + ' did not make: ' + ', '.join(result['missing'])
+    return printError(result)
+
 def mkpsfScript():
     print '\nStarting mkpsf Script\n'
-    #this could hang, since scripts might not actually exit and return something when they're done.
-    # user `subprocess.Popen()`` instead of `subprocess.call()` here if that happens
-    subprocess.call('./mkpsf.scr')
-    while not os.path.exists(dataSetDirectory + currentFrame + '/' + currentFrame + '3s.imh'):
-        #mkpsf is not done
-        continue
-
+    printScriptResult(Reduction.mkpsfScript(context), 'mkpsfHDI.scr')
     print '\nFinished mkpsf Script\n'
     return
 
 def badPSFSubtractionStarRemoval():
-    keepGoing = True
-    while keepGoing:
+    useWarmList = context.warmStarted()
+    while True:
         print '\nStarting bad PSF subtraction removal\n'
-        if not os.path.exists(dataSetDirectory + currentFrame + '/' + currentFrame + '.iraf'):
-            print currentFrame + '.iraf doesn\'t appear to exist. Please go create it then run this step again.'
-            return
-
-        if not os.path.exists(dataSetDirectory + currentFrame + '/' + currentFrame + '.lst'):
-            print currentFrame + '.lst doesn\'t appear to exist. Please go create it then run this step again.'
-            return
-
-        skipStarSelection = False
-        if os.path.exists(dataSetDirectory + currentFrame + '/sub.lst'):
-            while True:
-                deleteSubList = raw_input('sub.lst exists. Do you want me to delete it? (y/n)')
-                if deleteSubList in ['y','Y']:
-                    try:
-                        os.remove(dataSetDirectory + currentFrame + '/sub.lst')
-                    except OSError:
-                        print 'unable to delete sub.lst'
-
-                    break
-                elif deleteSubList in ['n','N']:
-                    skipStarSelection = True
-                    break
-                else:
-                    print 'Invalid selection, try again'
-                    continue
-
-
-        try:
-            #getting rid of the files we'll generate in this step before we start
-            os.remove(dataSetDirectory + currentFrame + '/' + currentFrame + '_2.lst')
-            os.remove(dataSetDirectory + currentFrame + '/' + currentFrame + '3s.psf')
-        except OSError:
-            #python gives an error if the file doesn't exist. We don't care.
-            pass
-
-        if not skipStarSelection:
-            try:
-                ir.display(dataSetDirectory + currentFrame + '/' + currentFrame + '.imh', 2)
-                ir.tvmark(2,dataSetDirectory + currentFrame + '/' + currentFrame + '.iraf',number='no',mark='circle',radii=10,color=204)
-                print 'In ds9, press \'a\' over all stars with subtraction errors.'
-                ir.tvmark(2,dataSetDirectory + currentFrame + '/sub.lst', interactive='yes',number='no',mark='circle',radii=10,color=205)
-            except:
-                print 'There was a problem using the iraf package. Try opening \'ds9 &\' in another window and run this step again.'
+        for name in [context.frame + '.iraf', context.frame + '.lst']:
+            if not context.exists(name):
+                print name + ' doesn\'t appear to exist. Please go create it then run this step again.'
                 return
-
-        # running sublst.e
-        if not os.path.exists(dataSetDirectory + currentFrame + '/sub.lst'):
-            print 'sub.lst doesn\'t appear to exist. Please go create it then run this step again.'
+        if not markStars('sub.lst', 2, 'In ds9, press \'a\' over all stars with subtraction errors.', useWarmList):
             return
+        useWarmList = False
 
-        # below may need explicit paths, depending on where you run the application from
-        sublst2 = Template('''${current_frame}.lst
-sub.lst
-${current_frame}_2.lst
-5 5
-''')
-        sublstFile = open(dataSetDirectory + currentFrame + '/' + 'sublst2.in', 'w')
-        sublstFile.truncate() #make sure it's blank before we start this.
-        sublstFile.write(sublst2.substitute(current_frame=currentFrame))
-        sublstFile.close()
-
-        if not testing:
-            subprocess.call([externalProgramDict['sublst'][0],'<','sublst2.in'])
-
-        #running daophot one more time
-        if not os.path.exists(dataSetDirectory + currentFrame + '/' + currentFrame + '3s.imh'):
-            print currentFrame + '3s.imh doesn\'t appear to exist. Please go create it then run this step again.'
+        result = Reduction.badPSFSubtractionStarRemoval(context)
+        if printError(result):
             return
-
-        psfCandidate = open(dataSetDirectory + currentFrame + '/' + 'psfSubErrorStars.in', 'w')
-        psfCandidate.truncate() #make sure it's blank before we start this.
-
-        psfCommands = Template('''at ${current_frame}3s.imh
-nomon
-ps
-${current_frame}.ap
-${current_frame}_2.lst
-${current_frame}3s.psf
-''')
-
-        psfCandidate.write(psfCommands.substitute(current_frame=currentFrame))
-        psfCandidate.close()
-
-        if not testing:
-            # there might be a hang here if it finds bad stars. Could just insert a bunch of 'y' lines into the
-            # template above if you need to
-            subprocess.call([externalProgramDict['daophot'][0], '<', 'psfSubErrorStars.in', '>>', currentFrame + '.log'])
-
-        while True:
-            userHappy = raw_input('Go get the chi squared value from the log. Is this okay? (y/n)')
-            if userHappy in ['y','Y']:
-                keepGoing = False
-                break
-            elif userHappy in ['n', 'N']:
-                keepGoing = True
-                break
-            else:
-                print 'Invalid selection, try again'
-                continue
+        if acceptPsf(result, '3s.psf'):
+            break
 
     print '\nFinished with bad PSF subtraction removal\n'
     return
 
 def allstarScript():
     '''I'm not cleaning up after this script. You'll have to delete the output files from it
-    manually if something goes wrong. Feel free to automate this as I've done in the other
-    functions above if you want.'''
+    manually if something goes wrong.'''
     print '\nStarting allstar Script\n'
-    #this could hang, since scripts might not actually exit and return something when they're done
-    # user `subprocess.Popen()`` instead of `subprocess.call()` here if that happens
-    subprocess.call('./allstarHDI.scr')
-    while not os.path.exists(dataSetDirectory + currentFrame + '/' + currentFrame + 'sub2.imh'):
-        #mkpsf is not done
-        continue
+    if printScriptResult(Reduction.allstarScript(context, markStars=False), 'allstarHDI.scr'):
+        return
 
     try:
-        ir.display(dataSetDirectory + currentFrame + '/' + currentFrame + 'sub2.imh', 3)
+        ir.display(framePath(context.frame + 'sub2.imh'), 3)
     except:
-        print 'There was a problem displaying ' + currentFrame + 'sub2.imh with iraf. Try it in another window.'
+        print 'There was a problem displaying ' + context.frame + 'sub2.imh with iraf. Try it in another window.'
 
-    while True:
-        userHappy = raw_input('Does the image in frame 3 look okay? (y/n) ')
-        if userHappy in ['y','Y']:
-            break
-        elif userHappy in ['n', 'N']:
-            print 'Okay. You should cleanup the output files and run this step again.'
-            return
-        else:
-            print 'Invalid selection, try again.'
-            continue
+    if not askYesNo('Does the image in frame 3 look okay? (y/n) '):
+        print 'Okay. You should cleanup the output files and run this step again.'
+        return
 
-    if not testing:
-        subprocess.call([externalProgramDict['dao2iraf'][0],currentFrame+'.als2','als.iraf'])
+    printError(Reduction.markAllstarStars(context))
 
     print '\nFinished with allstar Script\n'
     return
 
 def makePlots():
     print '\nStarting to make plots\n'
-    subprocess.call([externalProgramDict['magChiRoundPlotscr'][0]])
+    printScriptResult(Reduction.makePlots(context, showPlots=True), 'magChiRoundPlot.scr')
     print '\nFinished making plots\n'
     return
 
+def waitForEdit(message, path):
+    '''Opens path (if any) in the editor and waits until you are done. The apcorr pauses.'''
+    if path is not None:
+        subprocess.call([ScriptGraphs.editor, path])
+    raw_input(message + ' Press enter to continue. ')
+    return
+
+def askFitCoefficients(axis, logPath):
+    '''The zero and first order terms of one apcorr fit, read off its log by you'''
+    while True:
+        try:
+            zeroOrder = float(raw_input('Enter the ' + axis + ' zero order term coefficient from ' + axis + '.log '))
+            firstOrder = float(raw_input('Enter the ' + axis + ' first order term coefficient from ' + axis + '.log '))
+        except ValueError:
+            print 'Invalid input, try again.'
+            continue
+        return zeroOrder, firstOrder
+
+def apcorrScript():
+    '''The aperture correction (apcorrHDI.scr and compapcorrHDI.scr) for this frame'''
+    print '\nStarting apcorr Script\n'
+    result = Reduction.apcorrScript(context, waitForEdit, askFitCoefficients, showPlots=True)
+    if 'growth' in result:
+        print result['growth']
+    printScriptResult(result, 'apcorrHDI.scr')
+    print '\nFinished apcorr Script\n'
+    return
+
 def alsedt():
     print '\nStarting alsedt\n'
-    if not os.path.exists(dataSetDirectory + currentFrame + '/' + currentFrame + '.als2'):
-        print currentFrame + '.als2 doesn\'t appear to exist. Please go create it then run this step again.'
+    result = Reduction.alsedt(context)
+    if printError(result):
+        print 'Something went wrong. Fix it and run this step again.'
         return
 
-    psfCandidate = open(dataSetDirectory + currentFrame + '/' + 'alsedt.in', 'w')
-    psfCandidate.truncate() #make sure it's blank before we start this.
+    try:
+        ir.display(framePath(context.frame + '.imh'), 1)
+        ir.tvmark(1, framePath('edt.iraf'), number='no', mark='point', pointsize=2, color=204)
+    except:
+        print 'There was a problem using the iraf package. Try opening \'ds9 &\' in another window and run this step again.'
+        return
 
-    #string below assumes you're not using a nonlinear mag cut. Add another
-    # variable if this becomes a thing you need often.
-    psfCommands = Template('''${current_frame}.als2
-edt${current_frame}.als2
-2
-0.1
-0
-2
-0.2
-''')
+    print 'There should be a mark on every non-saturated star in frame 1.'
+    if result['stored']:
+        print 'Added ' + context.frame + ' to the catalog store in ' + Reduction.storeDirectory(context)
+    elif 'storeError' in result:
+        print 'Could not add ' + context.frame + ' to the catalog store: ' + result['storeError']
+    if 'qa' in result:
+        if 'error' in result['qa']:
+            print 'Could not make the QA thumbnails: ' + result['qa']['error']
+        else:
+            print 'QA thumbnails added to ' + result['qaIndex']
+    print '\nFinished with alsedt\n'
+    return
 
-    psfCandidate.write(psfCommands.substitute(current_frame=currentFrame))
-    psfCandidate.close()
+def diskUsage():
+    '''Disk usage of every frame in the data set. Offers to clean up the data set when you are done with it,
+    and to archive (compress) the frames that are finished.'''
+    print '\nChecking disk usage of ' + context.dataSetDirectory + '\n'
+    Artifacts.printUsage(Artifacts.dataSetUsage(context.dataSetDirectory, retentionPolicy))
 
-    if not testing:
-        subprocess.call([externalProgramDict['alsedt'][0], '<', 'alsedt.in', '>>', currentFrame + '.log'])
+    if askYesNo('\nIs this data set finished? Intermediate files will be deleted. (y/n) '):
+        freed = Artifacts.finishDataSet(context.dataSetDirectory, retentionPolicy)
+        print 'Freed ' + Artifacts.formatBytes(sum(freed.values()))
 
-    if not os.path.exists(dataSetDirectory + currentFrame + '/' + currentFrame + '.als2'):
-        print 'Something went wrong. ' + currentFrame + '.als2 doesn\'t appear to exist.'
-        return
+    if askYesNo('\nArchive the finished frames? Their images and catalogs get compressed, and are still read as they are. (y/n) '):
+        archived = Artifacts.archiveDataSet(context.dataSetDirectory)
+        before = sum(sizes[0] for sizes in archived.values())
+        after = sum(sizes[1] for sizes in archived.values())
+        print 'Archived ' + str(len(archived)) + ' frames: ' + Artifacts.formatBytes(before) + ' down to ' + \
+            Artifacts.formatBytes(after)
 
-    if not testing:
-        subprocess.call([externalProgramDict['dao2iraf'][0],'edt' + currentFrame+'.als2','edt.iraf'])
+    print '\nFinished checking disk usage\n'
+    return
+
+def applyApertureCorrection():
+    '''Applies the aperture correction polynomial in apcorr.coef to edt<frame>.als2'''
+    import ApplyApcorr
+    print '\nStarting aperture correction\n'
+    coefficients = None
+    if not context.exists(ApplyApcorr.coefficientFile):
+        print ApplyApcorr.coefficientFile + ' doesn\'t exist yet. Enter the coefficients from compapcorr (r.log, x.log, y.log).'
+        coefficients = {}
+        for (name, question) in [('C0', 'Constant term? '), ('EC0', 'Error on the constant term? '),
+                                 ('CX', 'x first order term? '), ('CY', 'y first order term? ')]:
+            while True:
+                try:
+                    coefficients[name] = float(raw_input(question))
+                except ValueError:
+                    print 'Invalid input, try again.'
+                    continue
+                break
 
-    if not os.path.exists(dataSetDirectory + currentFrame + '/' + 'edt.iraf'):
-        print 'Something went wrong. edt.iraf doesn\'t appear to exist.'
+    summary = Reduction.applyApertureCorrection(context, coefficients)
+    if printError(summary):
         return
+    print 'Corrected %d stars, mean correction %.3f +/- %.3f. Written to edt%s.apc' % (
+        summary['stars'], summary['meanCorrection'], summary['correctionError'], context.frame)
 
-    try:
-        ir.display(dataSetDirectory + currentFrame + '/' + currentFrame + '.imh', 1)
-        ir.tvmark(1,dataSetDirectory + currentFrame + '/edt.iraf',number='no',mark='point',pointsize=2,color=204)
-    except:
-        print 'There was a problem using the iraf package. Try opening \'ds9 &\' in another window and run this step again.'
+    if askYesNo('Apply to every other frame in the data set that has ' + ApplyApcorr.coefficientFile + '? (y/n) '):
+        summary = Reduction.applyApertureCorrection(context, everyFrame=True)
+        print 'Corrected ' + str(len(summary['frames'])) + ' frames: ' + ', '.join(summary['frames'])
+
+    print '\nFinished with aperture correction\n'
+    return
+
+def buildMasterCatalog():
+    '''Matches every reduced frame in the data set to a reference frame and writes master.cat'''
+    print '\nStarting master catalog\n'
+    referenceFrame = raw_input('Reference frame? (press enter for ' + context.frame + ') ')
+
+    result = Reduction.buildMasterCatalog(context, referenceFrame or None)
+    if printError(result):
         return
 
-    print 'There should be a mark on every non-saturated star in frame 1.'
-    print '\nFinished with alsedt\n'
+    print str(result['stars']) + ' stars written to ' + context.dataSetDirectory + 'master.cat'
+    print str(result['stored']) + ' frames updated in the catalog store in ' + Reduction.storeDirectory(context)
+    print '\nFinished with master catalog\n'
+    return
+
+def qaReview():
+    '''Thumbnails of every frame in the data set (QaThumbnails) and an index to look them over in a browser'''
+    print '\nStarting QA thumbnails\n'
+    result = Reduction.qaReview(context)
+    for frame in sorted(result['frames']):
+        if 'error' in result['frames'][frame]:
+            print frame + ': ' + result['frames'][frame]['error']
+        elif result['frames'][frame]['check']:
+            print frame + ' is worth a look in ds9'
+    print 'Open ' + result['index'] + ' in a browser'
+    print '\nFinished with QA thumbnails\n'
+    return
+
+def runStep(stepNumber):
+    '''Runs a step from the menu, checkpointed and cleaned up after (Reduction.trackStep).
+    changeFrame isn't a step of the frame: it replaces the context (and maybe the telemetry
+    publisher) that trackStep would record its end on, so it runs on its own.'''
+    if functionDictionary[stepNumber] is changeFrame:
+        changeFrame()
+        return
+    Reduction.trackStep(context, functionDictionary[stepNumber].__name__,
+                        lambda stepContext: functionDictionary[stepNumber]())
     return
 
-functionDictionary = {0: getWorkingDirectories,
+functionDictionary = {0: changeFrame,
                          1: getFWHM,
                          2: setupOptFiles,
                          3: psfFirstPass,
@@ -665,107 +673,124 @@ functionDictionary = {0: getWorkingDirectories,
                          10: makePlots,
                          # last function in 'Data Reduction'
                          11: alsedt,
+                         12: diskUsage,
+                         # data set level
+                         13: buildMasterCatalog,
+                         14: applyApertureCorrection,
+                         15: apcorrScript,
+                         16: qaReview,
                       }
 
-###
-# Ask the user for the directories they want to use
-###
-startDS9()
-dataSetDirectory, currentFrame = getWorkingDirectories()
-checkFunctionsExist()
-
-
-###
-# Get the FWHM from the user
-###
-while True:
+def main():
+    global context, ir
+    # what the library modules have to say (their warnings, the master catalog's progress)
+    logging.basicConfig(level=logging.INFO, format='%(message)s')
+    ExternalTools.setCacheMode(toolMode, toolCacheDirectory, toolCacheBytes)
+    MemoryBudget.setBudget(memoryBudget)
+    FrameCache.setBudget(frameCacheBytes)
+    from pyraf import iraf as ir
+
+    ###
+    # Ask the user for the directories they want to use
+    ###
+    startDS9()
+    dataSetDirectory, currentFrame = getWorkingDirectories()
+    checkFunctionsExist()
+    if telemetry:
+        Telemetry.startPublishing(dataSetDirectory)
+
+    ###
+    # Load whatever we saved about this frame last time (the FWHM may come from the warm start frame)
+    ###
+    context = Reduction.openFrame(dataSetDirectory, currentFrame, settings())
+    resuming = len(context.frameState.state['steps']) > 0
+    if context.fwhm is not None:
+        print 'Using the FWHM saved for this frame: ' + str(context.fwhm)
+
+    ###
+    # Get the FWHM from the user
+    ###
+    while context.fwhm is None:
+        if askYesNo("Do you know the FWHM of this frame? If not, we can go get it together. "):
+            try:
+                context.setFwhm(raw_input("What is the FWHM? "))
+            except ValueError:
+                print 'Unable to cast FWHM to float, try again.'
+                continue
+        else:
+            getFWHM()
+            break
 
-    fwhmQ = raw_input(
-        "Do you know the FWHM of this frame? If not, we can go get it together. ")
-    if fwhmQ not in ['y', 'Y', 'n', 'N']:
-        print 'Invalid response'
-        continue
+    if not context.frameState.stepDone('getFWHM'):
+        context.frameState.startStep('getFWHM')
+        context.frameState.finishStep('getFWHM')
 
-    elif fwhmQ in ['y', 'Y']:
-        fwhm = raw_input("What is the FWHM? ")
-        try:
-            float(fwhm)
-        except ValueError:
-            print 'Unable to cast FWHM to float, try again.'
+    ###
+    # Check to see if all of the files we are about to use exist. If they don't, ask the user
+    # to place them in the directory, or offer to copy them from the templates in OptionFiles.
+    ###
+    while True:
+        if not Reduction.optionFilesMissing(context):
+            print '\nOption files appear to exist in this directory, moving on...\n'
+            break
+        if not askYesNo("\nOption files don't seem to exist in this directory. Do you want to set them up?"):
+            break
+        setupOptFiles()
+        if Reduction.optionFilesMissing(context):
+            print 'I tried setting them up, but they still don\'t appear to exist. Something is wrong.'
             continue
-        frameFWHM = float(fwhm)
         break
 
-    elif fwhmQ in ['n', 'N']:
-        getFWHM()
-        break
-
-###
-# Check to see if all of the files we are about to use exist
-#   If they don't, ask the user to place them in the directory,
-#   or offer to copy them from this program. Store them in another
-#   file as heredoc strings to prevent strange formatting problems
-###
-
-optFilesSetup = optFilesExist()
-while True:
-    if not optFilesSetup:
-        user_selection = raw_input(
-            "\nOption files don't seem to exist in this directory. Do you want to set them up?")
-        if user_selection not in ['Y', 'y', 'N', 'n']:
-            print 'Invalid response'
-            continue
-        else:
-            if user_selection in ['n', 'N']:
+    ###
+    # If this frame was started in an earlier session, carry on from the first step that
+    # isn't finished. Stop and go to the menu as soon as a step doesn't complete.
+    ###
+    if resuming:
+        stepNumbers = dict((function.__name__, number) for (number, function) in functionDictionary.items())
+        nextStep = context.frameState.firstIncompleteStep()
+        while nextStep is not None:
+            print '\nResuming ' + currentFrame + ' at step ' + str(stepNumbers[nextStep]) + ' (' + nextStep + ')'
+            runStep(stepNumbers[nextStep])
+            if not context.frameState.stepDone(nextStep):
+                print nextStep + ' did not finish. Missing: ' + ', '.join(
+                    context.frameState.state['steps'][nextStep].get('missing', []))
                 break
-            else:
-                setupOptFiles()
-                if not optFilesExist():
-                    print 'I tried setting them up, but they still don\'t appear to exist. Something is wrong.'
-                    continue
-                else:
-                    break
-    else:
-        print '\nOption files appear to exist in this directory, moving on...\n'
-        break
-
-'''Going to make this the master log file. I'm only going to add to it, never delete it,
-so if you want it deleted at some point, just rm it and this will recreate it blank'''
-if not os.path.exists(dataSetDirectory + currentFrame + '/' + currentFrame + '.log'):
-    # create the file, close it. This is so we can always use >> in our scripts
-    fileGuy = open(dataSetDirectory + currentFrame + '/' + currentFrame + '.log', 'w').close()
-
-###
-#
-# Main program loop. Option files exist, we have the fwhm. Can reduce now.
-#
-###
+            nextStep = context.frameState.firstIncompleteStep()
 
+    ###
+    #
+    # Main program loop. Option files exist, we have the fwhm. Can reduce now.
+    #
+    ###
+    while True:
+        try:
+            user_selection = raw_input('What do you want to do? (enter function number or \'h\' for help)  ')
+            int(user_selection)
+        except ValueError:
+            if user_selection == 'q' or user_selection == 'Q':
+                # quit
+                releaseFrameClaim()
+                print 'Goodbye.'
+                break
+            if user_selection == 'h' or user_selection == 'H':
+                # print help menu
+                for (number, name) in functionDictionary.items():
+                    print str(number) + ':\t' + name.__name__
 
-while True:
-    try:
-        user_selection = raw_input('What do you want to do? (enter function number or \'h\' for help)  ')
-        int(user_selection)
-    except ValueError:
-        if user_selection == 'q' or user_selection == 'Q':
-            # quit
-            print 'Goodbye.'
-            break
-        if user_selection == 'h' or user_selection == 'H':
-            # print help menu
-            for (number, name) in functionDictionary.items():
-                print str(number) + ':\t' + name.__name__
+                print '\n'
+                continue
+            else:
+                # invalid thing entered, try again
+                print 'Please enter a valid selection'
+                continue
 
-            print '\n'
-            continue
-        else:
-            # invalid thing entered, try again
-            print 'Please enter a valid selection'
+        user_selection = int(user_selection)
+        if user_selection not in functionDictionary:
+            print 'Invalid function number, try again.'
             continue
 
-    user_selection = int(user_selection)
-    try:
-        functionDictionary[user_selection]()
-    except KeyError:
-        print 'Invalid function number, try again.'
-        continue
+        runStep(user_selection)
+    return
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,9 @@
+# The modules live at the top of the repository, next to autoreduce.py, and import each other by
+# name, so the tests import them the same way.
+
+import os
+import sys
+
+repositoryDirectory = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if repositoryDirectory not in sys.path:
+    sys.path.insert(0, repositoryDirectory)
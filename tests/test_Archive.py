@@ -0,0 +1,62 @@
+import os
+
+import numpy as np
+
+import Archive
+
+
+def writeFile(path, data):
+    fileHandle = open(path, 'wb')
+    fileHandle.write(data)
+    fileHandle.close()
+    return
+
+
+def test_pixels_round_trip(tmpdir):
+    path = str(tmpdir.join('frame.pix'))
+    # a bit over two chunks of noisy floats
+    data = np.random.RandomState(1).normal(200.0, 9.0, (Archive.chunkBytes * 5) // 8).astype(np.float32).tostring()
+    writeFile(path, data)
+    os.utime(path, (1234567890, 1234567890))
+    before, after = Archive.compressFile(path)
+
+    assert before == len(data)
+    assert Archive.isArchived(path)
+    assert Archive.exists(path)
+    assert Archive.originalStat(path) == (len(data), 1234567890)
+    assert Archive.readBytes(path) == data
+    # across a chunk boundary
+    offset = Archive.chunkBytes - 10
+    assert Archive.readBytes(path, offset, 100) == data[offset:offset + 100]
+
+    assert Archive.restore(path) == path
+    restored = open(path, 'rb').read()
+    assert restored == data
+    assert os.path.getmtime(path) == 1234567890
+    # unchanged since it was restored, so the plain copy can go again
+    assert Archive.dropRestored(path)
+    assert Archive.isArchived(path)
+
+
+def test_catalog_reads_line_by_line(tmpdir):
+    path = str(tmpdir.join('frame.als2'))
+    lines = [' NL    NX    NY  LOWBAD HIGHBAD  THRESH\n', '\n'] + \
+        ['%7d %8.3f %8.3f %8.3f\n' % (i, i * 0.5, i * 0.25, 15.0 + i * 1e-4) for i in range(40000)]
+    writeFile(path, ''.join(lines))
+    Archive.compressFile(path, codec='zlib')
+
+    reader = Archive.openFile(path)
+    assert list(reader) == lines
+    reader.seek(len(lines[0]))
+    assert reader.readline() == '\n'
+    assert reader.tell() == len(lines[0]) + 1
+    reader.close()
+
+
+def test_unarchive_puts_the_file_back(tmpdir):
+    path = str(tmpdir.join('frame.coo'))
+    writeFile(path, 'x' * 1000)
+    Archive.compressFile(path)
+    assert Archive.unarchive(path)
+    assert not os.path.exists(Archive.archivePath(path))
+    assert open(path, 'rb').read() == 'x' * 1000
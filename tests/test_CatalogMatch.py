@@ -0,0 +1,75 @@
+import numpy as np
+import pytest
+
+import CatalogMatch
+
+
+def randomField(nStars, size=2000.0, seed=3):
+    rng = np.random.RandomState(seed)
+    return {'x': rng.uniform(0, size, nStars), 'y': rng.uniform(0, size, nStars),
+            'mag': rng.uniform(12.0, 20.0, nStars)}
+
+
+def test_nearest_is_the_brute_force_nearest():
+    rng = np.random.RandomState(1)
+    x, y = rng.uniform(0, 500, 400), rng.uniform(0, 500, 400)
+    queryX, queryY = rng.uniform(-10, 510, 300), rng.uniform(-10, 510, 300)
+    index = CatalogMatch.GridIndex(x, y, 8.0)
+    nearest, distances = index.nearest(queryX, queryY, 8.0)
+
+    allDistances = np.hypot(queryX[:, np.newaxis] - x, queryY[:, np.newaxis] - y)
+    expected = np.where(allDistances.min(axis=1) < 8.0, allDistances.argmin(axis=1), -1)
+    assert (nearest == expected).all()
+    found = nearest >= 0
+    assert np.allclose(distances[found], allDistances.min(axis=1)[found])
+    assert (nearest >= 0).any() and (nearest < 0).any()
+
+
+def test_within_is_every_close_pair():
+    rng = np.random.RandomState(2)
+    x, y = rng.uniform(0, 200, 300), rng.uniform(0, 200, 300)
+    index = CatalogMatch.GridIndex(x, y, 6.0)
+    queries, neighbors = index.within(x, y, 6.0)
+
+    allDistances = np.hypot(x[:, np.newaxis] - x, y[:, np.newaxis] - y)
+    expected = set(zip(*np.nonzero(allDistances <= 6.0)))
+    assert set(zip(queries, neighbors)) == expected
+
+
+def test_radius_bigger_than_the_cells_is_refused():
+    index = CatalogMatch.GridIndex([1.0, 2.0], [1.0, 2.0], 5.0)
+    with pytest.raises(ValueError):
+        index.nearest([1.0], [1.0], 6.0)
+
+
+def test_empty_index_finds_nothing():
+    index = CatalogMatch.GridIndex([], [], 5.0)
+    nearest, distances = index.nearest([1.0, 2.0], [1.0, 2.0], 5.0)
+    assert (nearest == -1).all()
+
+
+def test_solveTransform_recovers_a_shift_and_rotation():
+    reference = randomField(250)
+    angle = np.radians(0.7)
+    truth = np.array([12.3, np.cos(angle), -np.sin(angle), -7.8, np.sin(angle), np.cos(angle)])
+    # the frame sees the field through the inverse: frame -> reference is truth
+    rng = np.random.RandomState(4)
+    seen = np.sort(rng.choice(250, 220, replace=False))
+    offsetX, offsetY = reference['x'][seen] - truth[0], reference['y'][seen] - truth[3]
+    determinant = truth[1] * truth[5] - truth[2] * truth[4]
+    frame = {'x': (truth[5] * offsetX - truth[2] * offsetY) / determinant + rng.normal(0, 0.02, len(seen)),
+             'y': (-truth[4] * offsetX + truth[1] * offsetY) / determinant + rng.normal(0, 0.02, len(seen)),
+             'mag': reference['mag'][seen] + 0.3}
+
+    transform, pairs = CatalogMatch.solveTransform(frame, reference)
+    assert transform is not None
+    assert pairs >= 200
+    x, y = CatalogMatch.applyTransform(transform, frame['x'], frame['y'])
+    assert np.abs(x - reference['x'][seen]).max() < 0.1
+    assert np.abs(y - reference['y'][seen]).max() < 0.1
+
+
+def test_solveTransform_gives_up_on_unrelated_fields():
+    transform, pairs = CatalogMatch.solveTransform(randomField(100, seed=5), randomField(100, seed=6))
+    assert transform is None
+    assert pairs == 0
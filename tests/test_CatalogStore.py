@@ -0,0 +1,124 @@
+import multiprocessing
+import os
+
+import numpy as np
+
+import CatalogStore
+
+
+def makeCatalog(nStars=200, seed=1):
+    random = np.random.RandomState(seed)
+    return {'x': random.uniform(0, 1500, nStars), 'y': random.uniform(0, 1500, nStars),
+            'mag': random.uniform(12, 20, nStars), 'err': random.uniform(0.005, 0.1, nStars),
+            'chi': np.ones(nStars), 'sharp': np.zeros(nStars)}
+
+
+def test_round_trip_across_partitions(tmpdir):
+    store = CatalogStore.CatalogStore(str(tmpdir.join('store')))
+    columns = makeCatalog()
+    shift = (10.0, 1.0, 0.0, -5.0, 0.0, 1.0)
+    # partitions follow the reference positions, a few stars end up below yref = 0
+    partitions = set(zip(np.floor((columns['x'] + 10.0) / CatalogStore.binSize),
+                         np.floor((columns['y'] - 5.0) / CatalogStore.binSize)))
+    assert store.addCatalog(columns, str(tmpdir.join('n2158')), 'n21100', 'V', 'allstar', shift) == len(partitions)
+
+    stars = CatalogStore.CatalogStore(str(tmpdir.join('store'))).query(0, 1600, -10, 1600)
+    assert len(stars['mag']) == len(columns['mag'])
+    order = np.argsort(stars['x'])
+    assert np.allclose(stars['x'][order], np.sort(columns['x']), atol=1e-3)
+    assert np.allclose(stars['xref'] - stars['x'], 10.0, atol=1e-3)
+    assert np.allclose(stars['yref'] - stars['y'], -5.0, atol=1e-3)
+    assert set(stars['dataSet']) == set(['n2158'])
+    assert set(stars['dataSetPath']) == set([str(tmpdir.join('n2158'))])
+    assert set(stars['filter']) == set(['V'])
+
+
+def test_box_and_magnitude_limit(tmpdir):
+    store = CatalogStore.CatalogStore(str(tmpdir.join('store')))
+    columns = makeCatalog()
+    store.addCatalog(columns, str(tmpdir.join('n2158')), 'n21100')
+    stars = store.query(100, 700, 200, 900, magLimit=16.0, reference=False)
+    expected = ((columns['x'] >= 100) & (columns['x'] <= 700) & (columns['y'] >= 200) &
+                (columns['y'] <= 900) & (columns['mag'] <= 16.0))
+    assert len(stars['mag']) == expected.sum()
+    assert np.allclose(np.sort(stars['mag']), np.sort(columns['mag'][expected]), atol=1e-5)
+    # frames stored without a transform have no reference positions to search
+    assert len(store.query(0, 1600, 0, 1600)['mag']) == 0
+
+
+def test_adding_a_frame_again_replaces_it(tmpdir):
+    store = CatalogStore.CatalogStore(str(tmpdir.join('store')))
+    store.addCatalog(makeCatalog(200, 1), str(tmpdir.join('n2158')), 'n21100')
+    store.addCatalog(makeCatalog(50, 2), str(tmpdir.join('n2158')), 'n21100')
+    assert len(store.query(0, 1600, 0, 1600, reference=False)['mag']) == 50
+    store.removeFrame(str(tmpdir.join('n2158')), 'n21100')
+    assert len(store.query(0, 1600, 0, 1600, reference=False)['mag']) == 0
+    assert [name for name in os.listdir(str(tmpdir.join('store'))) if name.startswith('p') and
+            os.listdir(str(tmpdir.join('store', name)))] == []
+
+
+def test_data_sets_with_the_same_name_are_kept_apart(tmpdir):
+    store = CatalogStore.CatalogStore(str(tmpdir.join('store')))
+    older = str(tmpdir.join('2019', 'n2158'))
+    newer = str(tmpdir.join('2020', 'n2158'))
+    store.addCatalog(makeCatalog(200, 1), older, 'n21100')
+    store.addCatalog(makeCatalog(80, 2), newer, 'n21100')
+    assert len(store.query(0, 1600, 0, 1600, reference=False)['mag']) == 280
+    assert len(store.query(0, 1600, 0, 1600, dataSets=[older], reference=False)['mag']) == 200
+    assert len(store.query(0, 1600, 0, 1600, dataSets=['n2158'], reference=False)['mag']) == 280
+
+    store.removeFrame(newer, 'n21100')
+    stars = store.query(0, 1600, 0, 1600, reference=False)
+    assert len(stars['mag']) == 200
+    assert set(stars['dataSetPath']) == set([older])
+
+
+def test_frames_from_an_older_store_are_replaced(tmpdir):
+    storeDirectory = str(tmpdir.join('store'))
+    dataSetDirectory = str(tmpdir.join('n2158'))
+    store = CatalogStore.CatalogStore(storeDirectory)
+    store.addCatalog(makeCatalog(200, 1), dataSetDirectory, 'n21100')
+
+    # rewrite it the way stores were kept before the data set path was part of the file name
+    def makeLegacy(index):
+        for (partition, entries) in index['partitions'].items():
+            for (fileName, entry) in entries.items():
+                del entries[fileName]
+                del entry['dataSetPath']
+                entry['file'] = 'n2158_n21100.npz'
+                entries[entry['file']] = entry
+                os.rename(os.path.join(storeDirectory, partition, fileName),
+                          os.path.join(storeDirectory, partition, entry['file']))
+    store._updateIndex(makeLegacy)
+
+    store.addCatalog(makeCatalog(50, 2), dataSetDirectory, 'n21100')
+    assert len(store.query(0, 1600, 0, 1600, reference=False)['mag']) == 50
+
+
+def test_long_provenance_is_not_truncated(tmpdir):
+    store = CatalogStore.CatalogStore(str(tmpdir.join('store')))
+    dataSetDirectory = str(tmpdir.join('a_data_set_folder_with_a_rather_long_name'))
+    store.addCatalog(makeCatalog(10), dataSetDirectory, 'n21100', step='allstar after the second psf pass')
+    stars = store.query(0, 1600, 0, 1600, reference=False)
+    assert set(stars['dataSet']) == set([os.path.basename(dataSetDirectory)])
+    assert set(stars['step']) == set(['allstar after the second psf pass'])
+
+
+def addFrame(arguments):
+    (storeDirectory, dataSetDirectory, frame, seed) = arguments
+    CatalogStore.CatalogStore(storeDirectory).addCatalog(makeCatalog(100, seed), dataSetDirectory, frame)
+    return
+
+
+def test_frames_finishing_at_once_all_get_stored(tmpdir):
+    storeDirectory = str(tmpdir.join('store'))
+    frames = ['n211%02d' % i for i in range(8)]
+    pool = multiprocessing.Pool(4)
+    try:
+        pool.map(addFrame, [(storeDirectory, str(tmpdir.join('n2158')), frame, i) for (i, frame) in enumerate(frames)])
+    finally:
+        pool.close()
+        pool.join()
+    stars = CatalogStore.CatalogStore(storeDirectory).query(0, 1600, 0, 1600, reference=False)
+    assert len(stars['mag']) == 100 * len(frames)
+    assert set(stars['frame']) == set(frames)
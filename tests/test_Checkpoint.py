@@ -0,0 +1,77 @@
+import logging
+import os
+
+import Checkpoint
+
+
+def makeFrame(tmpdir, frame='n21100'):
+    tmpdir.mkdir(frame)
+    return str(tmpdir) + '/', frame
+
+
+def touch(path, contents='x'):
+    fileHandle = open(path, 'w')
+    fileHandle.write(contents)
+    fileHandle.close()
+    return
+
+
+def test_parameters_survive_a_new_session(tmpdir):
+    dataSetDirectory, frame = makeFrame(tmpdir)
+    state = Checkpoint.FrameState(dataSetDirectory, frame)
+    state.setParameter('fwhm', 2.8)
+    state.appendParameter('acceptedChi', 0.031)
+    state.appendParameter('acceptedChi', 0.027)
+
+    state = Checkpoint.FrameState(dataSetDirectory, frame)
+    assert state.getParameter('fwhm') == 2.8
+    assert state.getParameter('acceptedChi') == [0.031, 0.027]
+    assert state.getParameter('missing', 'default') == 'default'
+
+
+def test_a_step_is_done_when_its_outputs_are_there(tmpdir):
+    dataSetDirectory, frame = makeFrame(tmpdir)
+    state = Checkpoint.FrameState(dataSetDirectory, frame)
+    state.startStep('psfFirstPass')
+    touch(os.path.join(dataSetDirectory, frame, frame + '.coo'))
+    assert not state.finishStep('psfFirstPass')
+    assert state.state['steps']['psfFirstPass']['missing'] == [frame + '.ap']
+
+    touch(os.path.join(dataSetDirectory, frame, frame + '.ap'))
+    assert state.finishStep('psfFirstPass')
+    assert Checkpoint.FrameState(dataSetDirectory, frame).stepDone('psfFirstPass')
+
+    # a changed output means the step has to be done again
+    touch(os.path.join(dataSetDirectory, frame, frame + '.ap'), 'something else')
+    assert not Checkpoint.FrameState(dataSetDirectory, frame).stepDone('psfFirstPass')
+
+
+def test_first_incomplete_step(tmpdir):
+    dataSetDirectory, frame = makeFrame(tmpdir)
+    state = Checkpoint.FrameState(dataSetDirectory, frame)
+    assert state.firstIncompleteStep() == 'getFWHM'
+    # getFWHM has no files, only the FWHM
+    state.startStep('getFWHM')
+    assert not state.finishStep('getFWHM')
+    state.setParameter('fwhm', 3.1)
+    assert state.finishStep('getFWHM')
+    assert state.firstIncompleteStep() == 'setupOptFiles'
+
+
+def test_failed_step_is_not_done(tmpdir):
+    dataSetDirectory, frame = makeFrame(tmpdir)
+    state = Checkpoint.FrameState(dataSetDirectory, frame)
+    state.startStep('alsedt')
+    state.failStep('alsedt', 'alsedt.e not found')
+    entry = Checkpoint.FrameState(dataSetDirectory, frame).state['steps']['alsedt']
+    assert entry['status'] == 'failed' and entry['error'] == 'alsedt.e not found'
+    assert not state.stepDone('alsedt')
+
+
+def test_unreadable_state_starts_blank_and_says_so(tmpdir, caplog):
+    dataSetDirectory, frame = makeFrame(tmpdir)
+    touch(os.path.join(dataSetDirectory, frame, frame + '.state'), '{"frame": ')
+    with caplog.at_level(logging.WARNING):
+        state = Checkpoint.FrameState(dataSetDirectory, frame)
+    assert state.state['steps'] == {}
+    assert 'Could not read' in caplog.text
@@ -0,0 +1,33 @@
+import numpy as np
+
+import DaoPsf
+
+
+def test_write_then_read_gives_the_same_psf(tmpdir):
+    npsf = DaoPsf.tableSize(10)
+    # negative numbers run together in the fortran format, so there have to be some
+    table = np.random.RandomState(1).normal(0.0, 0.01, (3, npsf, npsf))
+    psf = DaoPsf.DaoPsf('PENNY1', [1.21, 1.34, 0.42, -0.07], table, 14.25, 1234.5, 1024.0, 1020.0)
+    path = str(tmpdir.join('frame.psf'))
+    DaoPsf.writePsf(path, psf)
+    readBack = DaoPsf.readPsf(path)
+
+    assert readBack.label == 'PENNY1'
+    assert readBack.npsf == npsf and readBack.nexp == 3
+    assert np.allclose(readBack.parameters, psf.parameters, rtol=1e-6)
+    assert np.allclose(readBack.table, psf.table, rtol=1e-6, atol=1e-12)
+    assert (readBack.psfMag, readBack.xpsf, readBack.ypsf) == (14.25, 1024.0, 1020.0)
+    assert abs(readBack.bright - 1234.5) < 1e-3
+
+    dx, dy = np.meshgrid(np.arange(-5.0, 5.5, 0.5), np.arange(-5.0, 5.5, 0.5))
+    assert np.allclose(readBack.evaluate(dx, dy, 300.0, 1500.0), psf.evaluate(dx, dy, 300.0, 1500.0), atol=1e-6)
+
+
+def test_gaussian_peaks_at_bright_and_is_zero_outside_the_radius():
+    npsf = DaoPsf.tableSize(8)
+    psf = DaoPsf.DaoPsf('GAUSSIAN', [1.5, 1.5], np.zeros((1, npsf, npsf)), 15.0, 1000.0, 512.0, 512.0)
+    values = psf.evaluate(np.array([0.0, 1.0, 20.0]), np.array([0.0, 0.0, 0.0]), 100.0, 100.0)
+    assert values[0] > values[1] > 0
+    # averaged over the pixel the peak is a little below BRIGHT
+    assert 900.0 < values[0] < 1000.0
+    assert values[2] == 0.0
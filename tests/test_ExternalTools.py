@@ -0,0 +1,84 @@
+import os
+
+import pytest
+
+import ExternalTools
+import MemoryBudget
+
+# stands in for a fortran program: copies the file named in the first answer to the second, and
+# notes every time it really ran
+fakeProgram = '''#!/bin/sh
+read input
+read output
+echo run >> "$FAKE_RUNS"
+cat "$input" > "$output"
+echo made "$output"
+'''
+
+
+@pytest.fixture
+def tools(tmpdir, monkeypatch):
+    monkeypatch.setattr(MemoryBudget, 'ledgerPath', str(tmpdir.join('memory.ledger')))
+    monkeypatch.setattr(MemoryBudget, 'historyPath', str(tmpdir.join('memory.json')))
+    monkeypatch.setattr(ExternalTools, 'cacheMode', 'run')
+    monkeypatch.setattr(ExternalTools, 'cacheDirectory', str(tmpdir.join('cache')))
+    monkeypatch.setattr(ExternalTools, 'cacheBytes', 1024 ** 2)
+    monkeypatch.setattr(ExternalTools, 'hashMemory', {})
+    program = tmpdir.join('fake.e')
+    program.write(fakeProgram)
+    program.chmod(0755)
+    monkeypatch.setenv('FAKE_RUNS', str(tmpdir.join('runs')))
+    frameDirectory = tmpdir.mkdir('n21100')
+    frameDirectory.join('n21100.coo').write('stars\n')
+    return str(program), str(frameDirectory), tmpdir
+
+
+def runs(tmpdir):
+    return len(tmpdir.join('runs').readlines()) if tmpdir.join('runs').exists() else 0
+
+
+def test_cache_puts_the_files_back_instead_of_running(tools):
+    program, frameDirectory, tmpdir = tools
+    ExternalTools.setCacheMode('cache')
+    assert ExternalTools.runTool(program, ['n21100.coo', 'n21100.lst'], frameDirectory) == (0, 'made n21100.lst\n')
+    os.remove(os.path.join(frameDirectory, 'n21100.lst'))
+    assert ExternalTools.runTool(program, ['n21100.coo', 'n21100.lst'], frameDirectory) == (0, 'made n21100.lst\n')
+    assert open(os.path.join(frameDirectory, 'n21100.lst')).read() == 'stars\n'
+    assert runs(tmpdir) == 1
+
+
+def test_changed_input_runs_again(tools):
+    program, frameDirectory, tmpdir = tools
+    ExternalTools.setCacheMode('cache')
+    ExternalTools.runTool(program, ['n21100.coo', 'n21100.lst'], frameDirectory)
+    open(os.path.join(frameDirectory, 'n21100.coo'), 'w').write('other stars\n')
+    ExternalTools.runTool(program, ['n21100.coo', 'n21100.lst'], frameDirectory)
+    assert open(os.path.join(frameDirectory, 'n21100.lst')).read() == 'other stars\n'
+    assert runs(tmpdir) == 2
+
+
+def test_replay_never_runs_anything(tools):
+    program, frameDirectory, tmpdir = tools
+    ExternalTools.setCacheMode('record')
+    ExternalTools.runTool(program, ['n21100.coo', 'n21100.lst'], frameDirectory)
+    ExternalTools.setCacheMode('replay')
+    assert ExternalTools.runTool(program, ['n21100.coo', 'n21100.lst'], frameDirectory)[0] == 0
+    assert ExternalTools.runTool(program, ['n21100.coo', 'n21100.nei'], frameDirectory)[0] == \
+        ExternalTools.notInCache
+    assert runs(tmpdir) == 1
+
+
+def test_least_recently_used_entries_are_evicted(tools):
+    program, frameDirectory, tmpdir = tools
+    cache = ExternalTools.ToolCache(str(tmpdir.join('cache')), 250)
+    for (key, fileName) in [('a', 'n21100.coo'), ('b', 'n21100.coo'), ('c', 'n21100.coo')]:
+        cache.store(key, 'command', frameDirectory, [fileName], [], 0, 'x' * 100, 'fake.e')
+    assert cache.usage() == (2, 2 * (100 + len('stars\n')))
+    assert cache.replay('a', frameDirectory) is None
+    assert cache.replay('c', frameDirectory) == (0, 'x' * 100)
+    assert sorted(os.listdir(str(tmpdir.join('cache', 'entries')))) == ['b', 'c']
+
+
+def test_missing_program(tools):
+    program, frameDirectory, tmpdir = tools
+    assert ExternalTools.runTool(str(tmpdir.join('nothing.e')), [], frameDirectory)[0] == ExternalTools.missingProgram
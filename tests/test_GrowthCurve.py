@@ -0,0 +1,67 @@
+import numpy as np
+
+import GrowthCurve
+
+radii = np.array([4.0, 7.0, 10.0, 13.0, 16.0, 18.0, 21.0, 24.0, 27.0, 30.0, 33.0, 36.0])
+
+
+def gaussianGrowth(sigma):
+    '''Magnitude in each aperture minus the total, for a gaussian star'''
+    return -2.5 * np.log10(1.0 - np.exp(-radii ** 2 / (2.0 * sigma ** 2)))
+
+
+def synthetic(growth, nStars=40, allstarOffset=0.0, seed=1):
+    '''.ap and allstar columns of stars following growth, measured like the real thing: the errors
+    grow with the aperture (sky) and with magnitude, and in the biggest aperture even the
+    brightest star is worse than maxError'''
+    rng = np.random.RandomState(seed)
+    total = rng.uniform(13.5, 16.0, nStars)
+    err = 0.003 + 0.0015 * radii[np.newaxis, :] * 10 ** (0.4 * (total[:, np.newaxis] - 13.5))
+    mag = total[:, np.newaxis] + growth[np.newaxis, :] + rng.normal(0.0, 1.0, err.shape) * err
+    ids = np.arange(1, nStars + 1)
+    apColumns = {'id': ids, 'x': rng.uniform(0, 2000, nStars), 'y': rng.uniform(0, 2000, nStars),
+                 'mag': mag, 'err': err}
+    alsColumns = {'id': ids, 'mag': total + allstarOffset + rng.normal(0.0, 0.005, nStars),
+                  'err': np.zeros(nStars) + 0.005}
+    return apColumns, alsColumns
+
+
+def test_converged_curve_is_corrected_although_the_big_apertures_are_noisy():
+    apColumns, alsColumns = synthetic(gaussianGrowth(1.2), allstarOffset=-0.05)
+    assert (apColumns['err'][:, -1] > GrowthCurve.maxError).all()
+    result = GrowthCurve.measure(apColumns, alsColumns, radii)
+
+    assert 'error' not in result, result.get('error')
+    assert result['radius'] == 4.0
+    # aperture - allstar: what the 4 px aperture misses, minus the allstar offset
+    expected = gaussianGrowth(1.2)[0] + 0.05
+    assert abs(result['coefficients']['C0'] - expected) < 3 * result['coefficients']['EC0'] + 0.005
+
+
+def test_aperture_is_where_a_wider_star_flattens_out():
+    result = GrowthCurve.measure(*synthetic(gaussianGrowth(3.0), seed=2), radii=radii)
+    assert 'error' not in result, result.get('error')
+    assert result['radius'] == 10.0
+
+
+def test_rising_curve_gives_no_correction():
+    # 0.03 mag more light in every bigger aperture
+    result = GrowthCurve.measure(*synthetic(0.03 * np.arange(11, -1, -1)), radii=radii)
+    assert 'doesn\'t flatten out' in result['error']
+    assert result['aperture'] is None
+
+
+def test_odd_curves_are_rejected():
+    apColumns, alsColumns = synthetic(gaussianGrowth(1.2), seed=3)
+    # a leftover neighbour in the outer apertures of the three brightest stars
+    brightest = np.argsort(alsColumns['mag'])[:3]
+    apColumns['mag'][brightest, 6:] -= 1.0
+    result = GrowthCurve.measure(apColumns, alsColumns, radii)
+    assert result['rejected'] >= 3
+    assert 'error' not in result, result.get('error')
+
+
+def test_too_few_stars():
+    apColumns, alsColumns = synthetic(gaussianGrowth(1.2), nStars=3)
+    result = GrowthCurve.measure(apColumns, alsColumns, radii)
+    assert 'need' in result['error']
@@ -0,0 +1,78 @@
+import subprocess
+import threading
+import time
+
+import pytest
+
+import MemoryBudget
+
+
+@pytest.fixture
+def budget(tmpdir, monkeypatch):
+    '''A private ledger and history, and a budget of 100 bytes'''
+    monkeypatch.setattr(MemoryBudget, 'ledgerPath', str(tmpdir.join('memory.ledger')))
+    monkeypatch.setattr(MemoryBudget, 'historyPath', str(tmpdir.join('memory.json')))
+    monkeypatch.setattr(MemoryBudget, 'budgetBytes', 100)
+    monkeypatch.setattr(MemoryBudget, 'pollSeconds', 0.01)
+    return tmpdir
+
+
+def test_footprint_without_history():
+    assert MemoryBudget.predictFootprint('sublst.e', 0, {}) == MemoryBudget.smallBytes
+    assert MemoryBudget.predictFootprint('/usr/local/bin/allstar', 1000, {}) == MemoryBudget.baseBytes + 48 * 1000
+
+
+def test_footprint_from_history():
+    safety = MemoryBudget.safetyFactor
+    # one image size so far: scaled up for a bigger image, never down for a smaller one
+    history = {'daophot': [[1000, 5000]]}
+    assert MemoryBudget.predictFootprint('daophot', 2000, history) == int(10000 * safety)
+    assert MemoryBudget.predictFootprint('daophot', 500, history) == int(5000 * safety)
+    # several sizes: a straight line through them
+    history = {'daophot': [[1000, 3000], [2000, 5000], [3000, 7000]]}
+    assert abs(MemoryBudget.predictFootprint('daophot', 4000, history) - 9000 * safety) <= 1
+
+
+def test_history_keeps_the_latest_runs(budget):
+    for run in range(MemoryBudget.historyRuns + 5):
+        MemoryBudget.recordRun('/usr/local/bin/allstar', run, run * 10)
+    runs = MemoryBudget.readHistory()['allstar']
+    assert len(runs) == MemoryBudget.historyRuns
+    assert runs[-1] == [MemoryBudget.historyRuns + 4, (MemoryBudget.historyRuns + 4) * 10]
+
+
+def test_admission_waits_for_room(budget):
+    admitted = []
+
+    def second():
+        with MemoryBudget.Admission('allstar', 40):
+            admitted.append(time.time())
+
+    with MemoryBudget.Admission('allstar', 80):
+        # small programs fit in the gap
+        with MemoryBudget.Admission('sublst.e', 20):
+            assert sorted(entry['bytes'] for entry in MemoryBudget.running()) == [20, 80]
+        thread = threading.Thread(target=second)
+        thread.start()
+        time.sleep(0.2)
+        assert admitted == []
+        released = time.time()
+    thread.join()
+    assert admitted and admitted[0] >= released
+    assert MemoryBudget.running() == []
+
+
+def test_too_big_runs_alone(budget):
+    with MemoryBudget.Admission('allstar8192', 500) as admission:
+        assert [entry['bytes'] for entry in MemoryBudget.running()] == [500]
+    assert admission.waited < 1.0
+
+
+def test_dead_processes_leave_the_ledger(budget):
+    process = subprocess.Popen(['true'])
+    process.wait()
+    MemoryBudget.updateJson(MemoryBudget.ledgerPath, lambda ledger: ledger.update(
+        {'gone': {'pid': process.pid, 'bytes': 90, 'program': 'allstar', 'since': 0}}), {})
+    with MemoryBudget.Admission('allstar', 80) as admission:
+        assert [entry['bytes'] for entry in MemoryBudget.running()] == [80]
+    assert admission.waited < 1.0
@@ -0,0 +1,65 @@
+import numpy as np
+import pytest
+
+import ParameterSweep
+
+
+def makeObservations(nStars=40, nFrames=3, seed=3):
+    '''nStars stars seen in nFrames frames, plus a few observations that matched nothing'''
+    random = np.random.RandomState(seed)
+    ids = np.concatenate([np.tile(np.arange(nStars), nFrames), -np.ones(5, dtype=int)])
+    nObservations = len(ids)
+    truth = random.uniform(13, 19, nStars)
+    mag = np.where(ids >= 0, truth[ids], 20.0) + random.normal(0, 0.02, nObservations)
+    quantities = {'err': random.uniform(0.005, 0.3, nObservations), 'chi': random.uniform(0.5, 4, nObservations),
+                  'sharp': random.uniform(-1.5, 1.5, nObservations), 'peak': random.uniform(0, 5e4, nObservations),
+                  'low': random.uniform(0, 8, nObservations), 'significance': random.uniform(2, 20, nObservations)}
+    quantities['chi'][3] = np.nan
+    return {'quantities': quantities, 'ids': ids, 'mag': mag, 'err': quantities['err']}
+
+
+def test_grid_expands_with_the_last_parameter_fastest():
+    grid = ParameterSweep.parseGrid(['chi=1.5,2', 'psfStars=25,50'])
+    assert grid['psfStars'] == [25, 50]
+    assert [tuple(setting.values()) for setting in ParameterSweep.expandGrid(grid)] == \
+        [(1.5, 25), (1.5, 50), (2.0, 25), (2.0, 50)]
+    with pytest.raises(ValueError):
+        ParameterSweep.parseGrid(['roundness=0.5'])
+
+
+def test_masks_match_cutting_one_setting_at_a_time():
+    quantities = makeObservations()['quantities']
+    settings = ParameterSweep.expandGrid(ParameterSweep.parseGrid(['err=0.1,0.2', 'chi=2,3', 'TH=5,10']))
+    keep = ParameterSweep.keepMasks(quantities, settings)
+    for (s, setting) in enumerate(settings):
+        with np.errstate(invalid='ignore'):
+            expected = ((quantities['err'] < setting['err']) & (quantities['chi'] < setting['chi']) &
+                        (quantities['significance'] >= setting['TH']))
+        assert np.array_equal(keep[s], expected)
+    # a star whose chi couldn't be worked out fails the chi cut
+    assert not keep[:, 3].any()
+
+
+def test_summary_counts_and_scatter():
+    observations = makeObservations()
+    settings = ParameterSweep.expandGrid(ParameterSweep.parseGrid(['err=0.1,0.3', 'sharp=0.5,2']))
+    rows = ParameterSweep.summarizeCuts(observations, settings, 40)
+    keep = ParameterSweep.keepMasks(observations['quantities'], settings)
+    for (s, row) in enumerate(rows):
+        assert row['stars'] == keep[s].sum()
+        assert abs(row['rejected'] - (1.0 - keep[s].mean())) < 1e-12
+        rms = []
+        for star in range(40):
+            mag = observations['mag'][keep[s] & (observations['ids'] == star)]
+            if len(mag) >= ParameterSweep.minDetections:
+                rms.append(np.std(mag, ddof=1))
+        assert row['repeated'] == len(rms)
+        assert abs(row['scatter'] - np.median(rms)) < 1e-9
+
+
+def test_summary_is_the_same_in_batches(monkeypatch):
+    observations = makeObservations()
+    settings = ParameterSweep.expandGrid(ParameterSweep.parseGrid(['err=0.05,0.1,0.3', 'chi=1,2,4']))
+    rows = ParameterSweep.summarizeCuts(observations, settings, 40)
+    monkeypatch.setattr(ParameterSweep, 'maskBytes', 2 * len(observations['err']))
+    assert ParameterSweep.summarizeCuts(observations, settings, 40) == rows
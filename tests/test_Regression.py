@@ -0,0 +1,28 @@
+# The golden data set from start to finish, the way the command line runs it: make, bless, run.
+
+import os
+import subprocess
+import sys
+
+from conftest import repositoryDirectory
+
+
+def regression(command, goldenDirectory):
+    process = subprocess.Popen([sys.executable, os.path.join(repositoryDirectory, 'Regression.py'), command,
+                                goldenDirectory], cwd=repositoryDirectory, stdout=subprocess.PIPE,
+                               stderr=subprocess.STDOUT)
+    output = process.communicate()[0]
+    return process.returncode, output
+
+
+def test_make_bless_run(tmpdir):
+    goldenDirectory = str(tmpdir.join('golden'))
+    for command in ['make', 'bless']:
+        returnCode, output = regression(command, goldenDirectory)
+        assert returnCode == 0, output
+    # the bless timings are from this machine under whatever load the tests put on it, so the
+    # run only checks the photometry
+    os.remove(os.path.join(goldenDirectory, 'history.json'))
+    returnCode, output = regression('run', goldenDirectory)
+    assert returnCode == 0, output
+    assert 'no regressions' in output
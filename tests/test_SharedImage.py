@@ -0,0 +1,76 @@
+import os
+import subprocess
+
+import numpy as np
+import pytest
+
+import IrafImage
+import SharedImage
+
+
+@pytest.fixture
+def sharedRoot(tmpdir, monkeypatch):
+    monkeypatch.setattr(SharedImage, 'sharedRoot', str(tmpdir.mkdir('shm')))
+    return str(tmpdir.join('shm'))
+
+
+def fillRow(job):
+    '''Pool job: row y of the model is the frame's row y plus 1'''
+    frame = SharedImage.workerImages['frame']
+    model = SharedImage.attach(job['model'])
+    model[job['row']] = frame[job['row']] + 1
+    return float(frame[job['row']].sum())
+
+
+def buffers(sharedRoot):
+    return sorted(fileName for fileName in os.listdir(sharedRoot) if fileName.startswith(SharedImage.filePrefix))
+
+
+def test_pool_workers_share_the_buffers(sharedRoot):
+    pixels = np.arange(12, dtype=np.float32).reshape(3, 4)
+    with SharedImage.SharedPool(2, {'frame': SharedImage.fromArray(pixels, 'frame')}) as pool:
+        model = pool.create(pixels.shape, label='model')
+        sums = pool.map(fillRow, [{'row': row, 'model': model.descriptor} for row in range(3)])
+        assert sums == [float(row.sum()) for row in pixels]
+        assert np.array_equal(model.array, pixels + 1)
+        assert len(buffers(sharedRoot)) == 2
+    # the pool deletes what was made through it, and the frame it was handed
+    assert buffers(sharedRoot) == []
+
+
+def test_frame_pixels_are_mapped_in_place(tmpdir, sharedRoot):
+    imhPath = str(tmpdir.join('n21100.imh'))
+    pixels = IrafImage.createImage(imhPath, (5, 7))
+    pixels[...] = np.arange(35, dtype=np.float32).reshape(5, 7)
+    pixels.flush()
+    descriptor = SharedImage.frameDescriptor(imhPath)
+    assert np.array_equal(SharedImage.attach(descriptor), IrafImage.readPixels(imhPath))
+    assert SharedImage.frameImage(imhPath) == descriptor
+    SharedImage.detach(descriptor)
+
+
+def test_attached_maps_are_bounded(sharedRoot, monkeypatch):
+    monkeypatch.setattr(SharedImage, 'maxAttached', 2)
+    images = [SharedImage.create((2, 2), label='image%d' % i) for i in range(3)]
+    try:
+        for image in images:
+            SharedImage.attach(image.descriptor)
+        assert [key[0] for key in SharedImage.attached] == [image.descriptor['path'] for image in images[1:]]
+    finally:
+        for image in images:
+            image.close()
+    assert SharedImage.attached == {}
+    assert buffers(sharedRoot) == []
+
+
+def test_buffers_of_dead_processes_are_swept(sharedRoot):
+    process = subprocess.Popen(['true'])
+    process.wait()
+    stale = os.path.join(sharedRoot, '%s%d_0_model' % (SharedImage.filePrefix, process.pid))
+    open(stale, 'w').write('x' * 64)
+    mine = SharedImage.create((4, 4), label='mine')
+    try:
+        assert SharedImage.sweepStale() == 64
+        assert buffers(sharedRoot) == [os.path.basename(mine.descriptor['path'])]
+    finally:
+        mine.close()
@@ -0,0 +1,76 @@
+import os
+
+import ScriptGraphs
+import StepGraph
+
+
+def lines(directory, name):
+    return open(os.path.join(directory, name)).read().splitlines()
+
+
+def writeLines(name, contents):
+    def write(workingDirectory):
+        open(os.path.join(workingDirectory, name), 'w').write('\n'.join(contents) + '\n')
+    return write
+
+
+def dropFirstStar(workingDirectory):
+    kept = lines(workingDirectory, 'apcorr.coo')[1:]
+    writeLines('apcorr.coo2', kept)(workingDirectory)
+
+
+def filterGraph(directory):
+    '''The shape of apcorrGraph: sort, then two filters that each rename their output back'''
+    graph = StepGraph.StepGraph('apcorr', directory)
+    graph.add(StepGraph.Step('sort', function=writeLines('apcorr.coo', ['a', 'b', 'c', 'd']), outputs=['apcorr.coo']))
+    for name in ['erredit', 'selstar']:
+        graph.add(StepGraph.Step(name, function=dropFirstStar, inputs=['apcorr.coo'], outputs=['apcorr.coo2']))
+        graph.add(StepGraph.Step(name + 'Keep', function=ScriptGraphs.rename('apcorr.coo2', 'apcorr.coo'),
+                                 inputs=['apcorr.coo2'], outputs=['apcorr.coo'], removes=['apcorr.coo2'],
+                                 keepOutputs=True))
+    return graph
+
+
+def test_second_run_does_not_filter_again(tmpdir):
+    directory = str(tmpdir)
+    assert filterGraph(directory).run()
+    assert lines(directory, 'apcorr.coo') == ['c', 'd']
+    assert filterGraph(directory).run()
+    assert lines(directory, 'apcorr.coo') == ['c', 'd']
+
+
+def test_apcorr_renames_count_as_removing_coo2(tmpdir):
+    graph = ScriptGraphs.apcorrGraph(str(tmpdir), 'n21100', automatic=True)
+    assert 'apcorr.coo2' in graph.transientFiles()
+
+
+def test_failed_step_blocks_the_rest_and_resumes(tmpdir):
+    directory = str(tmpdir)
+    calls = []
+
+    def flaky(workingDirectory):
+        calls.append(len(calls))
+        if len(calls) <= 2:
+            return False
+        writeLines('b', ['b'])(workingDirectory)
+
+    def makeGraph():
+        graph = StepGraph.StepGraph('flow', directory)
+        graph.add(StepGraph.Step('first', function=writeLines('a', ['a']), outputs=['a']))
+        graph.add(StepGraph.Step('second', function=flaky, inputs=['a'], outputs=['b'], retries=1))
+        graph.add(StepGraph.Step('third', function=writeLines('c', ['c']), inputs=['b'], outputs=['c']))
+        return graph
+
+    graph = makeGraph()
+    assert not graph.run()
+    assert len(calls) == 2
+    assert not os.path.exists(os.path.join(directory, 'c'))
+    assert graph.messages and graph.messages[0].startswith('second failed after 2 attempt(s)')
+
+    os.remove(os.path.join(directory, 'a'))
+    writeLines('a', ['kept'])(directory)
+    assert makeGraph().run()
+    assert lines(directory, 'c') == ['c']
+    # first worked last time, so it isn't run again; second is, once
+    assert lines(directory, 'a') == ['kept']
+    assert len(calls) == 3
@@ -0,0 +1,98 @@
+import json
+import logging
+import os
+
+import WorkQueue
+
+
+def makeBroker(tmpdir, frames=('n21100', 'n21101'), leaseSeconds=60):
+    return WorkQueue.FileBroker(str(tmpdir), leaseSeconds, list(frames))
+
+
+def expireClaim(broker, frame):
+    '''Backdates a claim as though its worker stopped renewing it'''
+    path = broker._path(frame, 'claim')
+    claimFile = open(path, 'r')
+    claim = json.load(claimFile)
+    claimFile.close()
+    claim['expires'] -= 2 * broker.leaseSeconds
+    claimFile = open(path, 'w')
+    json.dump(claim, claimFile)
+    claimFile.close()
+    return
+
+
+def test_each_frame_is_claimed_once(tmpdir):
+    first = makeBroker(tmpdir)
+    second = makeBroker(tmpdir)
+    assert first.claim('hostA:x') == 'n21100'
+    assert second.claim('hostB:x') == 'n21101'
+    assert first.claim('hostA:x') is None
+    assert second.claim('hostB:x') is None
+    states = first.status()
+    assert states['n21100']['state'] == 'working'
+    assert states['n21100']['worker'] == 'hostA:x'
+    assert states['n21101']['worker'] == 'hostB:x'
+
+
+def test_heartbeat_only_renews_our_own_claim(tmpdir):
+    broker = makeBroker(tmpdir)
+    frame = broker.claim('hostA:x')
+    assert broker.heartbeat(frame, 'hostA:x')
+    assert not broker.heartbeat(frame, 'hostB:x')
+    assert not makeBroker(tmpdir).heartbeat(frame, 'hostA:x')
+
+
+def test_release_outcomes(tmpdir):
+    broker = makeBroker(tmpdir, ['n21100', 'n21101', 'n21102'])
+    for frame in ['n21100', 'n21101', 'n21102']:
+        assert broker.claim('hostA:x') == frame
+    assert broker.release('n21100', 'hostA:x', 'done')
+    assert broker.release('n21101', 'hostA:x', 'failed')
+    assert broker.release('n21102', 'hostA:x')
+    states = broker.status()
+    assert [states[frame]['state'] for frame in ['n21100', 'n21101', 'n21102']] == ['done', 'failed', 'pending']
+    # done and failed frames are never handed out again, a frame given back is
+    assert broker.claim('hostB:x') == 'n21102'
+    assert broker.claim('hostB:x') is None
+
+
+def test_expired_claim_is_taken_over_cleanly(tmpdir):
+    broker = makeBroker(tmpdir, ['n21100'])
+    assert broker.claim('hostA:x') == 'n21100'
+    expireClaim(broker, 'n21100')
+    assert broker.status()['n21100']['state'] == 'expired'
+
+    assert makeBroker(tmpdir, ['n21100']).claim('hostB:x') == 'n21100'
+    assert broker.status()['n21100']['worker'] == 'hostB:x'
+    # breaking the stale claim leaves nothing but the new claim behind
+    assert sorted(os.listdir(broker.queueDirectory)) == ['n21100.claim']
+
+
+def test_lost_claim_writes_no_outcome(tmpdir):
+    broker = makeBroker(tmpdir, ['n21100'])
+    assert broker.claim('hostA:x') == 'n21100'
+    expireClaim(broker, 'n21100')
+    taker = makeBroker(tmpdir, ['n21100'])
+    assert taker.claim('hostB:x') == 'n21100'
+
+    assert not broker.heartbeat('n21100', 'hostA:x')
+    assert not broker.release('n21100', 'hostA:x', 'done')
+    assert broker.status()['n21100']['state'] == 'working'
+    assert taker.release('n21100', 'hostB:x', 'done')
+    assert broker.status()['n21100']['state'] == 'done'
+
+
+def test_run_worker_records_failures(tmpdir, caplog):
+    broker = WorkQueue.LocalBroker(['n21100', 'n21101', 'n21102'])
+
+    def processFrame(frameClaim):
+        if frameClaim.frame == 'n21101':
+            raise RuntimeError('no stars')
+        return frameClaim.frame == 'n21100'
+
+    with caplog.at_level(logging.ERROR, logger='WorkQueue'):
+        outcomes = WorkQueue.runWorker(broker, processFrame, 'hostA:x')
+    assert outcomes == {'n21100': 'done', 'n21101': 'failed', 'n21102': 'failed'}
+    assert 'no stars' in caplog.text
+    assert set(record['state'] for record in broker.status().values()) == set(['done', 'failed'])
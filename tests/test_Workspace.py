@@ -0,0 +1,57 @@
+import json
+import os
+import socket
+import subprocess
+
+import pytest
+
+import Workspace
+
+
+def test_budget_is_shared_through_the_ledger(tmpdir):
+    first = Workspace.ScratchBudget(str(tmpdir), 1000)
+    second = Workspace.ScratchBudget(str(tmpdir), 1000)
+    assert first.reserve('n21100', 600)
+    assert second.reserved() == 600
+    assert not second.reserve('n21101', 600, timeout=0, pollSeconds=0)
+    first.release('n21100')
+    assert second.reserve('n21101', 600, timeout=0, pollSeconds=0)
+    assert first.reserved() == 600
+
+
+def test_more_than_the_whole_budget_is_an_error(tmpdir):
+    with pytest.raises(ValueError):
+        Workspace.ScratchBudget(str(tmpdir), 1000).reserve('n21100', 1001)
+
+
+def test_reservations_of_dead_processes_are_dropped(tmpdir):
+    budget = Workspace.ScratchBudget(str(tmpdir), 1000)
+    process = subprocess.Popen(['true'])
+    process.wait()
+    ledgerFile = open(budget.ledgerPath, 'w')
+    json.dump({'gone:n21100': {'bytes': 900, 'pid': process.pid, 'host': socket.gethostname(), 'time': 0}},
+              ledgerFile)
+    ledgerFile.close()
+    assert budget.reserved() == 0
+    assert budget.reserve('n21101', 900, timeout=0, pollSeconds=0)
+
+
+def test_workspace_stages_and_commits_and_cleans_up(tmpdir):
+    tmpdir.mkdir('scratch')
+    frameDirectory = tmpdir.mkdir('data').mkdir('n21100')
+    frameDirectory.join('n21100.coo').write('stars')
+    frameDirectory.join('n21100.psf').write('old psf')
+    dataSetDirectory = str(tmpdir.join('data')) + '/'
+
+    workspace = Workspace.ScratchWorkspace(dataSetDirectory, 'n21100', str(tmpdir.join('scratch')), 1000, 100)
+    with workspace:
+        assert workspace.stage(['n21100.coo', 'n21100.ap']) == ['n21100.ap']
+        assert workspace.budget.reserved() == 100
+        workspace.writeFile('n21100.psf', 'new psf')
+        workspace.writeFile('mkpsf.tmp', 'scratch only')
+        assert workspace.commit(['n21100.psf', 'n21100.nei']) == ['n21100.nei']
+        workingDirectory = workspace.workingDirectory
+    assert frameDirectory.join('n21100.psf').read() == 'new psf'
+    assert not frameDirectory.join('mkpsf.tmp').exists()
+    assert not os.path.exists(workingDirectory)
+    assert workspace.budget.reserved() == 0